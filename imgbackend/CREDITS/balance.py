@@ -0,0 +1,294 @@
+"""
+Credit metering of image generation.
+
+Every organization has one CreditBalance document, so checking or changing a
+balance never sums the ledger. A generation reserves its credits before the
+Gemini call and settles them once the image is stored:
+
+    with reserve_credits(user_id, reason="white_background") as credits:
+        resp = client.models.generate_content(...)
+        if no image in resp:
+            credits.refund()
+            return ...
+        upload and save the image
+
+    reserve  available -= n, reserved += n   (only if available >= n)
+    commit   reserved -= n, and a debit is added to the CreditLedger
+    refund   available += n, reserved -= n   (no image was stored)
+
+A batch reserves the credits of all its images at once and commits the
+number actually generated, the rest being refunded.
+
+Each step is a single findAndModify with $inc, so concurrent generations of
+the same organization can neither overspend nor lose an update. The balance
+is refilled to the plan's credits_per_month on the first reservation of a
+new month.
+
+Ledger entries are buffered and stored with one insert_many per batch; the
+balance document is the source of truth, the ledger is the history.
+
+Users that are not part of an organization are not metered.
+"""
+import atexit
+import logging
+import threading
+from contextlib import asynccontextmanager
+from functools import partial
+from datetime import datetime
+from asgiref.sync import sync_to_async
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from organization.models import Organization
+from plans.models import Plan
+from .models import CreditBalance, CreditLedger
+
+logger = logging.getLogger(__name__)
+
+# Credits charged for one generated image
+CREDITS_PER_IMAGE = 1
+
+# Buffered ledger entries are stored once there are this many...
+LEDGER_FLUSH_SIZE = 100
+# ...or once the oldest is this many seconds old
+LEDGER_FLUSH_SECONDS = 2.0
+
+
+class InsufficientCredits(Exception):
+    """The organization does not have enough credits left this month"""
+
+
+def _month_start(now):
+    return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _balances():
+    return CreditBalance._get_collection()
+
+
+def get_user_organization_id(user_id):
+    """
+    Organization the credits of a user are taken from.
+
+    Args:
+        user_id (str|ObjectId): ID of the user
+
+    Returns:
+        ObjectId: The first organization the user owns or belongs to, or None
+    """
+    user_id = ObjectId(str(user_id))
+    org = Organization.objects(__raw__={
+        "$or": [{"owner": user_id}, {"members": user_id}]
+    }).only("id").order_by("id").as_pymongo().first()
+    return org["_id"] if org else None
+
+
+def _monthly_credits(organization_id):
+    org = Organization.objects(id=organization_id).only("plan").as_pymongo().first()
+    plan = Plan.objects(id=org["plan"]).only("credits_per_month").as_pymongo().first() \
+        if org and org.get("plan") else None
+    if plan and plan.get("credits_per_month") is not None:
+        return plan["credits_per_month"]
+    return Plan.credits_per_month.default
+
+
+def _start_period(organization_id, now):
+    """Refill the balance if it is from a previous month, creating it if needed"""
+    month = _month_start(now)
+    try:
+        _balances().find_one_and_update(
+            {"organization": organization_id,
+             "$or": [{"period_start": {"$lt": month}}, {"period_start": None}]},
+            {"$set": {"available": _monthly_credits(organization_id),
+                      "period_start": month, "updated_at": now},
+             "$setOnInsert": {"reserved": 0, "created_at": now}},
+            upsert=True)
+    except DuplicateKeyError:
+        # The balance is already on the current month (or another worker refilled it)
+        pass
+
+
+def _reserve(organization_id, credits):
+    """Take credits from the available balance, returns the balance left"""
+    now = datetime.utcnow()
+    for attempt in range(2):
+        balance = _balances().find_one_and_update(
+            {"organization": organization_id,
+             "period_start": {"$gte": _month_start(now)},
+             "available": {"$gte": credits}},
+            {"$inc": {"available": -credits, "reserved": credits},
+             "$set": {"updated_at": now}},
+            projection={"available": 1},
+            return_document=ReturnDocument.AFTER)
+        if balance is not None:
+            return balance["available"]
+        if attempt == 0:
+            _start_period(organization_id, now)
+    raise InsufficientCredits(
+        f"Not enough credits: {credits} required for this generation")
+
+
+def get_balance(organization_id):
+    """
+    Current balance of an organization.
+
+    Returns:
+        dict: 'available' and 'reserved' credits
+    """
+    _start_period(organization_id, datetime.utcnow())
+    balance = _balances().find_one(
+        {"organization": organization_id}, {"available": 1, "reserved": 1})
+    return {"available": balance["available"], "reserved": balance.get("reserved", 0)}
+
+
+class _LedgerBuffer:
+    """Thread-safe buffer of CreditLedger rows, stored with insert_many"""
+
+    def __init__(self, max_records=LEDGER_FLUSH_SIZE, max_age=LEDGER_FLUSH_SECONDS):
+        self.max_records = max_records
+        self.max_age = max_age
+        self._rows = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def add(self, row):
+        with self._lock:
+            self._rows.append(row)
+            full = len(self._rows) >= self.max_records
+            if not full and self._timer is None:
+                # Store a lone entry even if nothing else is added
+                self._timer = threading.Timer(self.max_age, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            rows, self._rows = self._rows, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not rows:
+            return 0
+        try:
+            CreditLedger._get_collection().insert_many(rows, ordered=False)
+        except PyMongoError as e:
+            inserted = (getattr(e, 'details', None) or {}).get('nInserted', 0)
+            logger.error("Error storing credit ledger (%s/%s stored): %s", inserted, len(rows), e)
+            return inserted
+        return len(rows)
+
+
+ledger = _LedgerBuffer()
+atexit.register(ledger.flush)
+
+
+class CreditReservation:
+    """
+    Credits held for one generation, see reserve_credits.
+
+    Used as a context manager, the credits are committed when the block
+    completes and refunded when it raises. commit() and refund() can also be
+    called directly, e.g. inside the block to charge only part of a batch;
+    only the first call has an effect.
+    """
+
+    def __init__(self, organization_id, credits, user_id, reason=None, project=None, metadata=None):
+        self.organization_id = organization_id
+        self.credits = credits
+        self.user_id = user_id
+        self.reason = reason
+        self.project = project
+        self.metadata = metadata or {}
+        self.settled = organization_id is None
+        self.balance = _reserve(organization_id, credits) if organization_id else None
+
+    def commit(self, credits=None):
+        """
+        Charge the reserved credits and record the debit in the ledger.
+
+        Args:
+            credits (int, optional): Credits actually used, when fewer than
+                reserved (e.g. some images of a batch failed); the rest is refunded
+        """
+        if self.settled:
+            return
+        self.settled = True
+        used = self.credits if credits is None else min(credits, self.credits)
+        now = datetime.utcnow()
+        balance = _balances().find_one_and_update(
+            {"organization": self.organization_id},
+            {"$inc": {"available": self.credits - used, "reserved": -self.credits},
+             "$set": {"updated_at": now}},
+            projection={"available": 1},
+            return_document=ReturnDocument.AFTER)
+        if not used:
+            return
+        ledger.add({
+            "user": ObjectId(str(self.user_id)),
+            "organization": self.organization_id,
+            "project": ObjectId(str(self.project)) if self.project else None,
+            "change_type": "debit",
+            "credits_changed": used,
+            "balance_after": balance["available"] if balance else self.balance,
+            "reason": self.reason,
+            "metadata": self.metadata,
+            "created_at": now,
+            "updated_at": now,
+        })
+
+    def refund(self):
+        """Give all the reserved credits back"""
+        self.commit(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.refund()
+        return False
+
+
+def reserve_credits(user_id, credits=CREDITS_PER_IMAGE, reason=None, project=None, metadata=None):
+    """
+    Reserve the credits of a generation from the user's organization.
+
+    Args:
+        user_id (str): ID of the user generating
+        credits (int): Credits to reserve
+        reason (str, optional): What the credits are used for, stored in the ledger
+        project (str, optional): ID of the project, stored in the ledger
+        metadata (dict, optional): Stored in the ledger
+
+    Returns:
+        CreditReservation: The reservation, to commit or refund
+
+    Raises:
+        InsufficientCredits: If the organization has fewer credits available
+    """
+    return CreditReservation(
+        get_user_organization_id(user_id), credits, user_id,
+        reason=reason, project=project, metadata=metadata)
+
+
+@asynccontextmanager
+async def areserve_credits(user_id, credits=CREDITS_PER_IMAGE, reason=None, project=None, metadata=None):
+    """
+    reserve_credits for async views, used as `async with areserve_credits(...)`.
+
+    The reservation is made, committed and refunded in a worker thread, like
+    the other database calls of the async views.
+    """
+    offload = partial(sync_to_async, thread_sensitive=False)
+    reservation = await offload(reserve_credits)(
+        user_id, credits, reason=reason, project=project, metadata=metadata)
+    try:
+        yield reservation
+    except BaseException:
+        await offload(reservation.refund)()
+        raise
+    await offload(reservation.commit)()
@@ -16,4 +16,20 @@ class CreditLedger(Document):
     created_at = DateTimeField(default=datetime.utcnow)
     updated_at = DateTimeField(default=datetime.utcnow)
 
-    meta = {"collection": "credit_ledger"}
+    meta = {"collection": "credit_ledger", "indexes": ["created_at"]}
+
+
+class CreditBalance(Document):
+    """
+    Current credits of an organization, updated atomically (see CREDITS/balance.py).
+    available is what can still be reserved this period, reserved what
+    in-flight generations hold until they are committed or refunded.
+    """
+    organization = ReferenceField("Organization", required=True, unique=True)
+    available = IntField(default=0)
+    reserved = IntField(default=0)
+    period_start = DateTimeField()
+    created_at = DateTimeField(default=datetime.utcnow)
+    updated_at = DateTimeField(default=datetime.utcnow)
+
+    meta = {"collection": "credit_balances"}
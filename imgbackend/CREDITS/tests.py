@@ -1,3 +1,77 @@
-from django.test import TestCase
+from concurrent.futures import ThreadPoolExecutor
+from common.testing import MongoTestCase
+from organization.models import Organization
+from plans.models import Plan
+from users.models import User
+from .balance import InsufficientCredits, get_balance, ledger, reserve_credits
+from .models import CreditLedger
 
-# Create your tests here.
+
+class CreditReservationTests(MongoTestCase):
+    """Concurrent generations of one organization cannot spend more than its balance"""
+
+    CREDITS = 10
+
+    def setUp(self):
+        super().setUp()
+        self.user = User(email='owner@example.com', password='x', username='owner')
+        self.user.save()
+        plan = Plan(name='Plan', credits_per_month=self.CREDITS)
+        plan.save()
+        self.organization = Organization(name='Organization', owner=self.user, plan=plan)
+        self.organization.save()
+        self.user_id = str(self.user.id)
+
+    def reserve_parallel(self, count):
+        def reserve(i):
+            try:
+                return reserve_credits(self.user_id, reason='test')
+            except InsufficientCredits:
+                return None
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            return [r for r in pool.map(reserve, range(count)) if r is not None]
+
+    def test_parallel_reservations_cannot_overdraw(self):
+        reservations = self.reserve_parallel(3 * self.CREDITS)
+
+        self.assertEqual(len(reservations), self.CREDITS)
+        self.assertEqual(get_balance(self.organization.id), {'available': 0, 'reserved': self.CREDITS})
+
+    def test_parallel_commits_and_refunds(self):
+        reservations = self.reserve_parallel(self.CREDITS)
+        committed, refunded = reservations[::2], reservations[1::2]
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda r: r.commit(), committed))
+            list(pool.map(lambda r: r.refund(), refunded))
+            # Settling twice has no effect
+            list(pool.map(lambda r: r.commit(), refunded))
+
+        self.assertEqual(get_balance(self.organization.id),
+                         {'available': len(refunded), 'reserved': 0})
+        ledger.flush()
+        self.assertEqual(CreditLedger.objects(organization=self.organization.id).count(), len(committed))
+
+    def test_batch_commits_the_credits_used(self):
+        with reserve_credits(self.user_id, 4, reason='test') as credits:
+            self.assertEqual(get_balance(self.organization.id),
+                             {'available': self.CREDITS - 4, 'reserved': 4})
+            credits.commit(1)
+
+        self.assertEqual(get_balance(self.organization.id), {'available': self.CREDITS - 1, 'reserved': 0})
+
+    def test_failed_generation_is_refunded(self):
+        with self.assertRaises(RuntimeError):
+            with reserve_credits(self.user_id, reason='test'):
+                raise RuntimeError('upload failed')
+
+        self.assertEqual(get_balance(self.organization.id), {'available': self.CREDITS, 'reserved': 0})
+
+    def test_users_without_organization_are_not_metered(self):
+        user = User(email='other@example.com', password='x', username='other')
+        user.save()
+
+        with reserve_credits(str(user.id), 3 * self.CREDITS, reason='test') as credits:
+            self.assertIsNone(credits.organization_id)
+        self.assertEqual(get_balance(self.organization.id), {'available': self.CREDITS, 'reserved': 0})
@@ -0,0 +1,186 @@
+"""
+Archival of old documents into cold storage.
+
+Append-only collections (generation history, generated images) keep growing,
+and every old document stays in their indexes and in the working set of the
+recent-activity queries. archive_documents() moves the documents created
+before a cutoff out of the hot collection, into either:
+
+    'collection'  a cold collection named '<collection>_archive', holding
+                  the documents as they were
+    'file'        compressed JSON lines files under ARCHIVE_DIR, one per
+                  batch, listed in the 'archive_manifest' collection with
+                  the range of ids they hold
+
+Documents are written to cold storage before they are deleted from the hot
+collection, so an interrupted run never loses any; running it again is safe.
+get_document() looks a document up by id in the hot collection first, then
+in cold storage, so lookups by id keep working after archival.
+
+Files are compressed with zstandard when it is installed, gzip otherwise.
+"""
+import gzip
+import os
+from datetime import datetime
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_TARGETS = ('collection', 'file')
+ARCHIVE_BATCH_SIZE = 1000
+MANIFEST_COLLECTION = 'archive_manifest'
+
+
+def archive_collection_name(model):
+    """Name of the cold collection of a model"""
+    return f"{model._get_collection_name()}_archive"
+
+
+def _archive_collection(model):
+    return model._get_db()[archive_collection_name(model)]
+
+
+def _manifest(model):
+    return model._get_db()[MANIFEST_COLLECTION]
+
+
+def _open_file(path, mode):
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f"zstandard is required to read {path}")
+        return zstandard.open(path, mode + 't', encoding='utf-8')
+    return gzip.open(path, mode + 't', encoding='utf-8')
+
+
+def _write_file(model, rows, directory):
+    """Write a batch to a compressed JSON lines file, returns its path"""
+    folder = os.path.join(directory, model._get_collection_name())
+    os.makedirs(folder, exist_ok=True)
+    extension = 'jsonl.zst' if zstandard is not None else 'jsonl.gz'
+    ids = [row['_id'] for row in rows]
+    path = os.path.join(folder, f"{min(ids)}-{max(ids)}.{extension}")
+    partial = path + '.partial'
+    with _open_file(partial, 'w') as f:
+        for row in rows:
+            f.write(json_util.dumps(row) + '\n')
+    os.replace(partial, path)
+    return path
+
+
+def _write_collection(model, rows):
+    try:
+        _archive_collection(model).insert_many(rows, ordered=False)
+    except BulkWriteError as e:
+        # Documents left over from an interrupted run are already archived
+        if any(error.get('code') != 11000 for error in e.details.get('writeErrors', [])):
+            raise
+
+
+def archive_documents(model, cutoff, target='collection', directory=None,
+                      batch_size=ARCHIVE_BATCH_SIZE, dry_run=False):
+    """
+    Move the documents of a model created before cutoff to cold storage.
+
+    Args:
+        model (type): MongoEngine document with a created_at field
+        cutoff (datetime): Documents created before this are archived
+        target (str): 'collection' or 'file'
+        directory (str, optional): Folder of the archive files, for target='file'
+        batch_size (int): Documents moved per batch
+        dry_run (bool): Only count the documents that would be archived
+
+    Returns:
+        int: Number of documents archived
+    """
+    if target not in ARCHIVE_TARGETS:
+        raise ValueError(f"Unknown archive target: {target}")
+    if target == 'file' and not directory:
+        raise ValueError("An archive directory is required for target='file'")
+
+    collection = model._get_collection()
+    query = {'created_at': {'$lt': cutoff}}
+    if dry_run:
+        return collection.count_documents(query)
+
+    if target == 'file':
+        _manifest(model).create_index([('collection', 1), ('first_id', 1), ('last_id', 1)])
+
+    archived = 0
+    while True:
+        # Oldest first, following the created_at index
+        rows = list(collection.find(query).sort('created_at', 1).limit(batch_size))
+        if not rows:
+            return archived
+        ids = [row['_id'] for row in rows]
+
+        if target == 'file':
+            path = _write_file(model, rows, directory)
+            _manifest(model).insert_one({
+                'collection': model._get_collection_name(),
+                'path': path,
+                'first_id': min(ids),
+                'last_id': max(ids),
+                'count': len(rows),
+                'created_at': datetime.utcnow(),
+            })
+        else:
+            _write_collection(model, rows)
+
+        collection.delete_many({'_id': {'$in': ids}})
+        archived += len(rows)
+
+
+def find_archived(model, document_id):
+    """
+    Look a document up in the cold storage of a model.
+
+    Args:
+        model (type): MongoEngine document
+        document_id (str|ObjectId): Id of the document
+
+    Returns:
+        dict: The raw document, or None if it is not archived
+    """
+    document_id = ObjectId(str(document_id))
+    row = _archive_collection(model).find_one({'_id': document_id})
+    if row is not None:
+        return row
+
+    files = _manifest(model).find({
+        'collection': model._get_collection_name(),
+        'first_id': {'$lte': document_id},
+        'last_id': {'$gte': document_id},
+    })
+    for entry in files:
+        with _open_file(entry['path'], 'r') as f:
+            for line in f:
+                row = json_util.loads(line)
+                if row['_id'] == document_id:
+                    return row
+    return None
+
+
+def get_document(model, document_id, **query):
+    """
+    Load a document by id, from the hot collection or else from cold storage.
+
+    Args:
+        model (type): MongoEngine document
+        document_id (str|ObjectId): Id of the document
+        **query: Raw field values the document must have, e.g. user_id=...
+
+    Returns:
+        Document: The document (an archived one is not saved back), or None
+    """
+    document = model.objects(id=document_id, **query).first()
+    if document is not None:
+        return document
+
+    row = find_archived(model, document_id)
+    if row is None or any(row.get(field) != value for field, value in query.items()):
+        return None
+    return model._from_son(row)
@@ -0,0 +1,59 @@
+"""
+Conditional GET for polled read endpoints.
+
+@conditional_get(version_func) asks version_func for the current version of
+what a view returns, which is expected to be cheap (a few indexed fields,
+not the documents themselves). When the client already has that version
+(If-None-Match / If-Modified-Since) the view is not run at all and a 304 is
+returned; otherwise the view's 200 response gets the ETag and Last-Modified
+headers.
+
+Responses are also marked Cache-Control: private, no-cache, so browsers keep
+them but revalidate them on every poll instead of guessing a freshness
+lifetime from Last-Modified.
+
+The ETag is kept on the request (request._conditional_etag), so that
+@cache_response below this decorator keys its entries by version.
+"""
+from calendar import timegm
+from functools import wraps
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+
+def conditional_get(version_func):
+    """
+    Answer GET and HEAD requests with 304 Not Modified when nothing changed.
+
+    Args:
+        version_func (callable): Called with the view's arguments, returns
+            (etag, last_modified) where etag is a str and last_modified a
+            naive UTC datetime or None, or None when the resource has no
+            version (e.g. it does not exist) and the view should just run
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view_func(request, *args, **kwargs)
+            version = version_func(request, *args, **kwargs)
+            if version is None:
+                return view_func(request, *args, **kwargs)
+
+            etag, last_modified = version
+            etag = quote_etag(etag)
+            timestamp = timegm(last_modified.utctimetuple()) if last_modified else None
+            response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+            if response is None:
+                request._conditional_etag = etag
+                response = view_func(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+
+            response.headers.setdefault("ETag", etag)
+            if timestamp is not None:
+                response.headers.setdefault("Last-Modified", http_date(timestamp))
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,91 @@
+"""
+Batched dereferencing of MongoEngine ReferenceFields.
+
+Reading `invite.project.name` in a loop runs one query per invite, because
+every ReferenceField is loaded lazily on first access. prefetch_references()
+collects the referenced ids of a whole page of documents and loads them with
+one `$in` query per referenced model, then stores the loaded documents on the
+references so the attribute access in the loop no longer hits the database.
+
+When only the id is needed, use reference_id(), which never queries.
+"""
+from bson import DBRef
+from mongoengine import Document
+from mongoengine.fields import ReferenceField
+
+
+def reference_id(document, field):
+    """
+    Id of a ReferenceField without dereferencing it.
+
+    Args:
+        document (Document|EmbeddedDocument): The document holding the reference
+        field (str): Name of the ReferenceField
+
+    Returns:
+        ObjectId: The referenced id, or None if the reference is empty
+    """
+    value = document._data.get(field)
+    if isinstance(value, DBRef):
+        return value.id
+    if isinstance(value, Document):
+        return value.pk
+    return value
+
+
+def _collect(documents, path):
+    """Yield (holder, field name) for every reference at a dotted path"""
+    name, _, rest = path.partition('.')
+    for document in documents:
+        if document is None:
+            continue
+        if not rest:
+            yield document, name
+            continue
+        value = document._data.get(name)
+        children = value if isinstance(value, (list, tuple)) else [value]
+        yield from _collect(children, rest)
+
+
+def prefetch_references(documents, *paths, only=None):
+    """
+    Load the references of many documents with one query per referenced model.
+
+    Args:
+        documents (list): Documents to resolve the references of
+        *paths (str): ReferenceField names, dotted for embedded documents,
+            e.g. 'project' or 'team_members.user'
+        only (dict, optional): Referenced model -> fields to load, for models
+            only a few fields are read from
+
+    Returns:
+        list: The documents, with the references loaded. References to
+        deleted documents are set to None.
+    """
+    documents = list(documents)
+    references = []
+    ids_by_model = {}
+    for path in paths:
+        for holder, name in _collect(documents, path):
+            field = holder._fields.get(name)
+            if not isinstance(field, ReferenceField):
+                raise ValueError(f"{path} is not a ReferenceField")
+            if isinstance(holder._data.get(name), Document):
+                continue
+            ref_id = reference_id(holder, name)
+            if ref_id is None:
+                continue
+            model = field.document_type
+            references.append((holder, name, model, ref_id))
+            ids_by_model.setdefault(model, set()).add(ref_id)
+
+    loaded = {}
+    for model, ids in ids_by_model.items():
+        queryset = model.objects(id__in=list(ids))
+        if only and only.get(model):
+            queryset = queryset.only(*only[model])
+        loaded[model] = {doc.pk: doc for doc in queryset}
+
+    for holder, name, model, ref_id in references:
+        holder._data[name] = loaded[model].get(ref_id)
+    return documents
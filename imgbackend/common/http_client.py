@@ -0,0 +1,212 @@
+"""
+Shared clients for the async views.
+
+A synchronous view holds its worker thread for the whole Gemini or
+Cloudinary call, so a process serves as many generations at a time as it
+has threads. The async views await these calls instead:
+
+    get_async_client()     httpx.AsyncClient with keep-alive connections
+    get_client()           the same for synchronous code, shared by all threads
+    fetch_bytes(url)       download a file (e.g. a previous generation)
+    cloudinary_upload()    signed Cloudinary upload, same options and result
+                           as cloudinary.uploader.upload
+    get_genai_client()     Gemini client, its .aio API is awaitable
+
+Clients are bound to the event loop they were created in, so one is kept
+per loop and closed when the loop shuts down. Under ASGI the process runs a
+single loop and the connections are reused by all requests; under WSGI
+Django runs each async view in a loop of its own (asyncio.run), so the
+clients only live for one request, but the views work the same.
+
+Both speak HTTP/2 when the h2 package is installed.
+
+Blocking work left in the async views (MongoEngine queries, the Django ORM)
+goes through run_sync(), which runs it in a thread pool.
+"""
+import asyncio
+import logging
+import os
+import threading
+import weakref
+from functools import partial
+import cloudinary
+import cloudinary.exceptions
+import httpx
+from asgiref.sync import sync_to_async
+from cloudinary import utils as cloudinary_utils
+from django.conf import settings
+
+try:
+    from google import genai
+except ImportError:
+    genai = None
+
+try:
+    import h2  # noqa: F401 (HTTP/2 support of httpx)
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+logger = logging.getLogger(__name__)
+
+HTTP_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+HTTP_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=50)
+
+_async_clients = weakref.WeakKeyDictionary()
+_genai_clients = weakref.WeakKeyDictionary()
+_watched_loops = weakref.WeakSet()
+# Strong references to the pending closer tasks, asyncio only keeps weak ones
+_closers = set()
+_client = None
+_client_lock = threading.Lock()
+
+
+def run_sync(func, *args, **kwargs):
+    """
+    Await a blocking call in a worker thread.
+
+    MongoEngine is thread-safe, so calls are not pinned to Django's single
+    "thread sensitive" thread and run concurrently. Django ORM calls must use
+    sync_to_async(func) instead.
+    """
+    return sync_to_async(partial(func, *args, **kwargs), thread_sensitive=False)()
+
+
+def get_client():
+    """httpx.Client of this process, it is thread-safe"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(
+                    timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS, http2=HTTP2, follow_redirects=True)
+    return _client
+
+
+async def _close_loop_clients(loop):
+    """
+    Wait for the shutdown of the loop, then close its clients.
+
+    asyncio.run() (used by uvicorn, and by Django for the async views under
+    WSGI) cancels the tasks still pending when its coroutine returns and runs
+    them to completion before closing the loop.
+    """
+    try:
+        await asyncio.Event().wait()
+    finally:
+        client = _async_clients.pop(loop, None)
+        genai_client = _genai_clients.pop(loop, None)
+        try:
+            if client is not None:
+                await client.aclose()
+            if genai_client is not None:
+                await genai_client.aio.aclose()
+        except Exception as e:
+            logger.warning("Error closing HTTP clients: %s", e)
+
+
+def _watch_loop(loop):
+    if loop not in _watched_loops:
+        _watched_loops.add(loop)
+        task = loop.create_task(_close_loop_clients(loop))
+        _closers.add(task)
+        task.add_done_callback(_closers.discard)
+
+
+def get_async_client():
+    """httpx.AsyncClient of the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS, http2=HTTP2, follow_redirects=True)
+        _async_clients[loop] = client
+        _watch_loop(loop)
+    return client
+
+
+def get_genai_client():
+    """
+    Gemini client of the running event loop.
+
+    Returns:
+        genai.Client: The client, or None if the Gemini SDK is not installed
+    """
+    if genai is None:
+        return None
+    loop = asyncio.get_running_loop()
+    client = _genai_clients.get(loop)
+    if client is None:
+        client = genai.Client(api_key=settings.GOOGLE_API_KEY)
+        _genai_clients[loop] = client
+        _watch_loop(loop)
+    return client
+
+
+async def fetch_bytes(url):
+    """
+    Download a file.
+
+    Raises:
+        httpx.HTTPError: If the request failed or did not return a 2xx status
+    """
+    response = await get_async_client().get(url)
+    response.raise_for_status()
+    return response.content
+
+
+def _file_part(file, filename=None):
+    if isinstance(file, (str, os.PathLike)) and os.path.isfile(file):
+        with open(file, 'rb') as f:
+            return (filename or os.path.basename(file), f.read())
+    if hasattr(file, 'read'):
+        return (filename or os.path.basename(getattr(file, 'name', '') or 'file'), file.read())
+    if isinstance(file, bytes):
+        return (filename or 'file', file)
+    # URLs and data URIs are passed through for Cloudinary to fetch
+    return None
+
+
+async def cloudinary_upload(file, **options):
+    """
+    Upload a file to Cloudinary without blocking the event loop.
+
+    Args:
+        file (str|bytes|file): Local path, bytes, file-like object, URL or data URI
+        **options: Upload options, as for cloudinary.uploader.upload
+            (folder, public_id, overwrite, ...)
+
+    Returns:
+        dict: The upload result ('secure_url', 'public_id', ...)
+
+    Raises:
+        cloudinary.exceptions.Error: If Cloudinary rejected the upload
+    """
+    params = cloudinary_utils.sign_request(
+        cloudinary_utils.cleanup_params(cloudinary_utils.build_upload_params(**options)), options)
+    data = {}
+    for key, value in params.items():
+        if isinstance(value, list):
+            data[f"{key}[]"] = value
+        elif value:
+            data[key] = value
+
+    files = None
+    part = _file_part(file, options.get('filename'))
+    if part is None:
+        data['file'] = file
+    else:
+        files = {'file': part}
+
+    response = await get_async_client().post(
+        cloudinary_utils.cloudinary_api_url('upload', **options),
+        data=data, files=files,
+        headers={'User-Agent': cloudinary.get_user_agent()})
+    try:
+        result = response.json()
+    except ValueError:
+        raise cloudinary.exceptions.Error(
+            f"Error parsing server response ({response.status_code}) - {response.text[:200]}")
+    if 'error' in result:
+        raise cloudinary.exceptions.Error(result['error'].get('message', str(result['error'])))
+    return result
@@ -1,42 +1,100 @@
+import logging
 import jwt
+from asgiref.sync import iscoroutinefunction, sync_to_async
 from django.conf import settings
-from django.http import JsonResponse
+from common.responses import JsonResponse
 from functools import wraps
-from users.models import User
+from bson.errors import InvalidId
+from .user_cache import TokenUser, get_user
 
+logger = logging.getLogger(__name__)
 
-def authenticate(view_func):
-    @wraps(view_func)
-    def wrapper(*args, **kwargs):
-        # Detect CBV (self, request, ...)
-        if hasattr(args[0], 'request'):  # self has request attr
-            request = args[1]
-        elif hasattr(args[0], 'META'):   # FBV, args[0] is request
-            request = args[0]
-        else:
-            raise Exception("Cannot find request object in arguments")
-        # print("AUTH HEADER DEBUG:", request.META.get('HTTP_AUTHORIZATION'))
-        auth_header = request.META.get('HTTP_AUTHORIZATION')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            print("DEBUG: No valid authorization header")
-            return JsonResponse({'message': 'Authorization denied'}, status=401)
 
-        try:
-            token = auth_header.split(' ')[1]
-            payload = jwt.decode(
-                token, settings.SECRET_KEY, algorithms=["HS256"])
-            # print("DEBUG payload:", payload)
-            # print("payload",payload)
-            user = User.objects(id=payload.get('id')).first()
+def _find_request(args):
+    # Detect CBV (self, request, ...)
+    if hasattr(args[0], 'request'):  # self has request attr
+        return args[1]
+    elif hasattr(args[0], 'META'):   # FBV, args[0] is request
+        return args[0]
+    raise Exception("Cannot find request object in arguments")
+
+
+def _decode_token(request):
+    """
+    Verify the bearer token of a request.
+
+    Returns:
+        tuple: (payload, None), or (None, error response)
+    """
+    # print("AUTH HEADER DEBUG:", request.META.get('HTTP_AUTHORIZATION'))
+    auth_header = request.META.get('HTTP_AUTHORIZATION')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        logger.debug("No valid authorization header")
+        return None, JsonResponse({'message': 'Authorization denied'}, status=401)
+
+    try:
+        token = auth_header.split(' ')[1]
+        return jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"]), None
+    except jwt.ExpiredSignatureError:
+        return None, JsonResponse({'message': 'Token expired'}, status=401)
+    except jwt.InvalidTokenError:
+        return None, JsonResponse({'message': 'Invalid token'}, status=401)
+
+
+def authenticate(view_func=None, stateless=False):
+    """
+    Require a valid JWT and put its user on request.user.
+
+    The user comes from the per-process user cache (see common/user_cache.py).
+    With @authenticate(stateless=True) the signed claims are trusted and
+    request.user is a TokenUser, without any database read; only use it on
+    read-only endpoints that need nothing but the user id.
+
+    Works on async views too, the user is then loaded in a worker thread.
+    """
+    if view_func is None:
+        return lambda func: authenticate(func, stateless=stateless)
+
+    if iscoroutinefunction(view_func):
+        @wraps(view_func)
+        async def async_wrapper(*args, **kwargs):
+            request = _find_request(args)
+            payload, error = _decode_token(request)
+            if error:
+                return error
+            try:
+                if stateless:
+                    user = TokenUser(payload)
+                else:
+                    user = await sync_to_async(get_user, thread_sensitive=False)(payload.get('id'))
+            except (KeyError, InvalidId):
+                return JsonResponse({'message': 'Invalid token'}, status=401)
             if not user:
                 return JsonResponse({'message': 'User not found'}, status=404)
 
             request.user = user
-        except jwt.ExpiredSignatureError:
-            return JsonResponse({'message': 'Token expired'}, status=401)
-        except jwt.InvalidTokenError:
+            return await view_func(*args, **kwargs)
+
+        return async_wrapper
+
+    @wraps(view_func)
+    def wrapper(*args, **kwargs):
+        request = _find_request(args)
+        payload, error = _decode_token(request)
+        if error:
+            return error
+        try:
+            # print("DEBUG payload:", payload)
+            if stateless:
+                user = TokenUser(payload)
+            else:
+                user = get_user(payload.get('id'))
+        except (KeyError, InvalidId):
             return JsonResponse({'message': 'Invalid token'}, status=401)
+        if not user:
+            return JsonResponse({'message': 'User not found'}, status=404)
 
+        request.user = user
         return view_func(*args, **kwargs)
 
     return wrapper
@@ -0,0 +1,113 @@
+"""
+Lazy MongoDB connection setup.
+
+settings.py only registers the connection settings; MongoEngine creates the
+MongoClient the first time a document is queried, and with connect=False the
+client does not open any socket before its first operation. Management
+commands and worker boot therefore never wait on the database server (only
+on the DNS lookup of a mongodb+srv:// URI, see configure_mongo), and a
+client is never shared between a parent process and its forked workers.
+
+Use `python manage.py check --database default` to verify the connection.
+"""
+import logging
+import os
+import threading
+import time
+import mongoengine
+from mongoengine import connection as mongo_connection
+from django.core.checks import Error, Tags, register
+from django.core.signals import request_started
+from pymongo.errors import ConfigurationError
+
+logger = logging.getLogger(__name__)
+
+
+# Seconds between two attempts to register a connection that failed
+REGISTER_RETRY_SECONDS = 5
+
+# alias -> (register_connection() arguments, time of the next attempt)
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def configure_mongo(alias=mongoengine.DEFAULT_CONNECTION_NAME, db=None, host=None, **client_options):
+    """
+    Register the MongoDB connection without connecting.
+
+    mongoengine.register_connection() parses the URI, which for a
+    mongodb+srv:// URI includes the DNS lookup of its hosts; the client itself
+    is only created by the first query. A URI that cannot be resolved (no
+    network at boot, DNS outage) does not stop settings from loading: the
+    connection stays pending and is registered again at the start of the next
+    requests, at most every REGISTER_RETRY_SECONDS, until it succeeds.
+
+    Args:
+        alias (str): MongoEngine connection alias
+        db (str): Database name
+        host (str): MongoDB URI
+        **client_options: MongoClient options (pool size, timeouts, ...)
+    """
+    with _pending_lock:
+        _pending[alias] = (dict(db=db, host=host, **client_options), 0)
+        _register(alias)
+
+
+def _register(alias):
+    kwargs, _ = _pending[alias]
+    try:
+        mongoengine.register_connection(alias, **kwargs)
+    except ConfigurationError as e:
+        logger.error("MongoDB connection %r could not be registered, retrying in %ss: %s",
+                     alias, REGISTER_RETRY_SECONDS, e)
+        _pending[alias] = (kwargs, time.monotonic() + REGISTER_RETRY_SECONDS)
+        return False
+    del _pending[alias]
+    return True
+
+
+def register_pending_connections(**kwargs):
+    """
+    Retry the connections whose registration failed, when their time has come.
+    Connected to request_started; costs nothing once every connection is registered.
+    """
+    if not _pending:
+        return
+    with _pending_lock:
+        now = time.monotonic()
+        for alias, (_, retry_at) in list(_pending.items()):
+            if alias in mongo_connection._connection_settings:
+                # Registered since by other means (mongoengine.connect() in tests)
+                del _pending[alias]
+            elif retry_at <= now:
+                _register(alias)
+
+
+request_started.connect(register_pending_connections)
+
+
+def _forget_connections():
+    # A forked child must not reuse the parent's client (pymongo is not fork
+    # safe); dropping it makes the next query create a fresh one. The parent's
+    # sockets are left alone, closing them would break the parent.
+    mongo_connection._connections.clear()
+    mongo_connection._dbs.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_connections)
+
+
+@register(Tags.database)
+def check_mongo_connection(app_configs=None, databases=None, **kwargs):
+    """System check pinging MongoDB, only run by `check --database`"""
+    if not databases:
+        return []
+    with _pending_lock:
+        for alias in list(_pending):
+            _register(alias)
+    try:
+        mongo_connection.get_connection().admin.command("ping")
+    except Exception as e:
+        return [Error(f"MongoDB connection failed: {e}", id="common.E001")]
+    return []
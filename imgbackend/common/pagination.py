@@ -0,0 +1,230 @@
+"""
+Keyset (cursor) pagination helpers.
+
+Lists are ordered by a fixed sort, newest first by (created_at, _id) unless
+stated otherwise. Instead of skipping over earlier pages, the client sends back
+the opaque cursor of the last item it received and the next page starts right
+after it, so every page costs the same no matter how deep it is.
+
+Totals are optional: they are only computed when asked for (or for clients
+still using the page parameter) and are cached for a short time.
+"""
+import base64
+import hashlib
+from bson import json_util
+from django.core.cache import cache
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+# How long list totals are cached, in seconds
+COUNT_CACHE_SECONDS = 60
+
+# (field, direction) pairs; the last field must be unique
+DEFAULT_SORT = (("created_at", -1), ("_id", -1))
+
+
+class InvalidPageParameter(ValueError):
+    """Raised when a pagination query parameter sent by the client is malformed"""
+
+
+class InvalidCursor(InvalidPageParameter):
+    """Raised when a cursor sent by the client cannot be decoded"""
+
+
+def encode_cursor(values):
+    """
+    Build the opaque cursor pointing at an item.
+
+    Args:
+        values (list): The item's values of the sort fields
+
+    Returns:
+        str: URL safe cursor
+    """
+    payload = json_util.dumps(list(values))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, sort=DEFAULT_SORT):
+    """
+    Decode a cursor built by encode_cursor.
+
+    Returns:
+        list: The values of the sort fields
+
+    Raises:
+        InvalidCursor: If the cursor is malformed
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json_util.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise InvalidCursor(f"Invalid cursor: {cursor}")
+    return values
+
+
+def keyset_query(cursor, sort=DEFAULT_SORT):
+    """
+    Raw MongoDB condition selecting the items after a cursor.
+
+    Args:
+        cursor (str): Cursor of the last item of the previous page, or None
+        sort (tuple): The (field, direction) pairs the list is ordered by
+
+    Returns:
+        dict: The condition, empty for the first page
+    """
+    if not cursor:
+        return {}
+    values = decode_cursor(cursor, sort)
+
+    # (a > x) or (a == x and b > y) or ...
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        branch = {sort[j][0]: values[j] for j in range(i)}
+        branch[field] = {"$lt" if direction < 0 else "$gt": values[i]}
+        branches.append(branch)
+    return {"$or": branches}
+
+
+def keyset_sort(sort=DEFAULT_SORT):
+    """Raw $sort specification matching keyset_query"""
+    return dict(sort)
+
+
+def _order_by(sort):
+    # MongoEngine names the _id field "id"
+    return [("-" if direction < 0 else "+") + ("id" if field == "_id" else field)
+            for field, direction in sort]
+
+
+def _sort_value(row, field):
+    if isinstance(row, dict):
+        return row.get(field)
+    return getattr(row, "id" if field == "_id" else field)
+
+
+def int_param(request, name, default=None):
+    """
+    Read an integer query parameter.
+
+    Raises:
+        InvalidPageParameter: If the parameter is not an integer
+    """
+    value = request.GET.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise InvalidPageParameter(f"Invalid {name}: {value}") from None
+
+
+def get_page_params(request, default_limit=DEFAULT_LIMIT):
+    """
+    Read the cursor and limit query parameters.
+
+    Returns:
+        tuple: (cursor or None, limit clamped to 1..MAX_LIMIT)
+
+    Raises:
+        InvalidPageParameter: If the limit is not an integer
+    """
+    cursor = request.GET.get('cursor') or None
+    limit = int_param(request, 'limit', default_limit)
+    return cursor, min(max(limit, 1), MAX_LIMIT)
+
+
+def split_page(rows, limit, sort=DEFAULT_SORT):
+    """
+    Cut a list fetched with limit + 1 rows into the page and the next cursor.
+
+    Args:
+        rows (list): Documents or raw dicts, ordered by sort
+        limit (int): Page size
+        sort (tuple): The (field, direction) pairs the list is ordered by
+
+    Returns:
+        tuple: (rows of the page, next cursor or None)
+    """
+    rows = list(rows)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor([_sort_value(rows[-1], field) for field, _ in sort])
+
+
+def get_cached_count(key_parts, count):
+    """
+    Return a cached total, computing it with count() when missing.
+
+    Args:
+        key_parts (list): Values identifying the counted set
+        count (callable): Computes the total
+
+    Returns:
+        int: The total
+    """
+    digest = hashlib.md5(json_util.dumps(
+        key_parts, sort_keys=True).encode()).hexdigest()
+    return cache.get_or_set(f"list-count:{digest}", count, COUNT_CACHE_SECONDS)
+
+
+def cached_count(queryset):
+    """Count a MongoEngine queryset, cached for COUNT_CACHE_SECONDS"""
+    return get_cached_count(
+        [queryset._document._get_collection_name(), queryset._query],
+        queryset.count)
+
+
+def paginate(request, queryset, sort=DEFAULT_SORT, default_limit=DEFAULT_LIMIT, page_numbers=False):
+    """
+    Fetch one page of a MongoEngine queryset.
+
+    Query params:
+        cursor: next_cursor of the previous page
+        limit: page size (max MAX_LIMIT)
+        include_total: also return the (cached) total
+        page: legacy page number, used when no cursor is sent
+
+    Args:
+        request (HttpRequest): The request with the query params
+        queryset (QuerySet): Filtered queryset (documents or as_pymongo)
+        sort (tuple): (field, direction) pairs, the last field must be unique
+        default_limit (int): Page size when no limit is sent
+        page_numbers (bool): Endpoint used to be page based; requests without
+            a cursor are treated as page 1 and get page/total/pages as before
+
+    Returns:
+        tuple: (rows of the page, pagination dict)
+
+    Raises:
+        InvalidPageParameter: If the cursor, limit or page is malformed
+    """
+    cursor, limit = get_page_params(request, default_limit)
+    page = None if cursor else int_param(request, 'page', 1 if page_numbers else None)
+    page = max(page, 1) if page else None
+
+    page_query = queryset.order_by(*_order_by(sort))
+    if cursor:
+        page_query = page_query.filter(__raw__=keyset_query(cursor, sort))
+    elif page and page > 1:
+        # Legacy clients: deep pages get slower, use the cursor instead
+        page_query = page_query.skip((page - 1) * limit)
+
+    rows, next_cursor = split_page(page_query.limit(limit + 1), limit, sort)
+
+    pagination = {
+        'limit': limit,
+        'next_cursor': next_cursor,
+        'has_more': next_cursor is not None
+    }
+    if page:
+        pagination['page'] = page
+    if page or request.GET.get('include_total', '').lower() == 'true':
+        total_count = cached_count(queryset)
+        pagination['total'] = total_count
+        pagination['pages'] = (total_count + limit - 1) // limit
+    return rows, pagination
@@ -0,0 +1,297 @@
+"""
+Per-user and per-organization request rate limiting.
+
+RateLimitMiddleware limits every request by the user of its JWT and by the
+organization of that user (requests without a valid token by client IP).
+Views are grouped in endpoint classes with their own limits, set in
+RATE_LIMITS:
+
+    RATE_LIMITS = {
+        'generation': {'user': '20/m', 'organization': '120/m'},
+        ...
+    }
+
+A view is put in a class with @rate_limit('generation'); views without it
+are in RATE_LIMIT_DEFAULT_CLASS, or RATE_LIMIT_UNSAFE_DEFAULT_CLASS for POST,
+PUT, PATCH and DELETE requests. A request over any of its limits gets a 429
+with a Retry-After header, before the view runs, and is not counted against
+the other ones.
+
+Behind a reverse proxy REMOTE_ADDR is the proxy's address; set
+RATE_LIMIT_CLIENT_IP_HEADER (e.g. 'HTTP_X_FORWARDED_FOR') and
+RATE_LIMIT_TRUSTED_PROXIES (the number of proxies appending to it) to limit
+anonymous requests by the client's address instead. Only the entries
+appended by the trusted proxies are used, not the ones a client can send.
+
+Two stores are available (RATE_LIMIT_STORE):
+
+    'memory'  token buckets in this process, a check costs a few
+              microseconds; each worker process enforces the limits on its own
+    'mongo'   sliding window counters in the 'rate_limits' collection, shared
+              by all workers, at the cost of two MongoDB round trips per limit
+
+The JWT of a request is verified here too (cached per token), so nobody can
+spend the limits of another user; authentication itself is still done by the
+views.
+"""
+import logging
+import math
+import threading
+import time
+from datetime import datetime
+import jwt
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from cachetools import LRUCache, TTLCache
+from django.conf import settings
+from common.responses import JsonResponse
+from mongoengine.connection import get_db
+from pymongo import ReturnDocument
+from CREDITS.balance import get_user_organization_id
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+SCOPES = ('user', 'organization')
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def rate_limit(endpoint_class):
+    """
+    Put a view in an endpoint class of RATE_LIMITS, e.g. @rate_limit('upload').
+
+    The class is read by RateLimitMiddleware; it is kept when the view is
+    wrapped by other decorators using functools.wraps.
+    """
+    def decorator(view_func):
+        view_func.rate_limit_class = endpoint_class
+        return view_func
+    return decorator
+
+
+def parse_rate(rate):
+    """
+    Parse a rate like '20/m' (per second, minute, hour or day).
+
+    Returns:
+        tuple: (requests, period in seconds)
+    """
+    count, _, unit = rate.partition('/')
+    return int(count), PERIODS[unit.strip().lower()[:1]]
+
+
+class MemoryStore:
+    """Token buckets of this process: capacity `limit`, refilled over `period`"""
+
+    def __init__(self, max_keys=100000):
+        # An evicted bucket was idle for a while, i.e. full again
+        self._buckets = LRUCache(maxsize=max_keys)
+        self._lock = threading.Lock()
+
+    def hit(self, limits):
+        """
+        Take one request from each bucket if all of them have one.
+
+        Args:
+            limits (list): (key, limit, period) of the buckets
+
+        Returns:
+            float: 0, or the seconds to wait (nothing was taken)
+        """
+        now = time.monotonic()
+        with self._lock:
+            buckets, wait = [], 0
+            for key, limit, period in limits:
+                rate = limit / period
+                tokens, last = self._buckets.get(key, (limit, now))
+                tokens = min(limit, tokens + (now - last) * rate)
+                buckets.append((key, tokens))
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+            for key, tokens in buckets:
+                self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+        return wait
+
+
+class MongoStore:
+    """
+    Sliding window counters shared by all processes.
+
+    Requests are counted per fixed window; the count of the previous window is
+    weighted by how much of it still falls in the sliding window. Counters
+    expire through a TTL index. A request over one of its limits is taken
+    back from all its counters.
+    """
+
+    COLLECTION = 'rate_limits'
+
+    def __init__(self):
+        self._indexed = False
+
+    def _collection(self):
+        collection = get_db()[self.COLLECTION]
+        if not self._indexed:
+            collection.create_index('expires_at', expireAfterSeconds=0)
+            self._indexed = True
+        return collection
+
+    def _hit(self, collection, key, limit, period, now):
+        """Count one request, returns its counter and 0 or the seconds to wait"""
+        window, elapsed = divmod(now, period)
+        window = int(window)
+        previous = collection.find_one({'_id': f"{key}:{window - 1}"}, {'count': 1})
+        counter = f"{key}:{window}"
+        current = collection.find_one_and_update(
+            {'_id': counter},
+            {'$inc': {'count': 1},
+             '$setOnInsert': {'expires_at': datetime.utcfromtimestamp((window + 2) * period)}},
+            upsert=True, return_document=ReturnDocument.AFTER)
+        count = current['count']
+        previous_count = previous['count'] if previous else 0
+        if previous_count * (1 - elapsed / period) + count <= limit:
+            return counter, 0
+        if count > limit or not previous_count:
+            return counter, period - elapsed
+        # Until enough of the previous window has slid out
+        return counter, max(period * (1 - (limit - count) / previous_count) - elapsed, 0.001)
+
+    def hit(self, limits):
+        """Count one request in each counter, see MemoryStore.hit"""
+        collection = self._collection()
+        now = time.time()
+        counters, wait = [], 0
+        for key, limit, period in limits:
+            counter, counter_wait = self._hit(collection, key, limit, period, now)
+            counters.append(counter)
+            wait = max(wait, counter_wait)
+        if wait:
+            # Counted atomically per counter, so the check across counters
+            # is done after counting and a rejected request is taken back
+            collection.update_many({'_id': {'$in': counters}}, {'$inc': {'count': -1}})
+        return wait
+
+
+STORES = {'memory': MemoryStore, 'mongo': MongoStore}
+
+_token_users = LRUCache(maxsize=10000)
+_user_organizations = TTLCache(maxsize=10000, ttl=300)
+_lock = threading.Lock()
+
+
+def _token_user_id(request):
+    """ID of the user of a valid bearer token, or None"""
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    if not header.startswith('Bearer '):
+        return None
+    token = header[7:]
+    with _lock:
+        cached = _token_users.get(token)
+    if cached is None:
+        try:
+            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=["HS256"])
+            cached = (str(payload['id']), payload.get('exp'))
+        except (jwt.InvalidTokenError, KeyError):
+            cached = (None, None)
+        with _lock:
+            _token_users[token] = cached
+    user_id, expires = cached
+    if expires is not None and expires <= time.time():
+        return None
+    return user_id
+
+
+def _organization_id(user_id):
+    """Organization of a user, cached for a few minutes ('' when there is none)"""
+    with _lock:
+        organization_id = _user_organizations.get(user_id)
+    if organization_id is None:
+        try:
+            organization_id = str(get_user_organization_id(user_id) or '')
+        except Exception as e:
+            logger.warning("Error loading organization for rate limiting: %s", e)
+            return ''
+        with _lock:
+            _user_organizations[user_id] = organization_id
+    return organization_id
+
+
+class RateLimitMiddleware:
+    """
+    Rejects requests over the RATE_LIMITS of their view's endpoint class.
+
+    Under ASGI the check runs in a worker thread of its own, so a MongoDB
+    store or organization lookup neither blocks the event loop nor waits
+    behind the other requests on Django's single thread for sync code.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+            self.process_view = self.aprocess_view
+        self.enabled = getattr(settings, 'RATE_LIMIT_ENABLED', True)
+        self.default_class = getattr(settings, 'RATE_LIMIT_DEFAULT_CLASS', 'read')
+        self.unsafe_default_class = getattr(settings, 'RATE_LIMIT_UNSAFE_DEFAULT_CLASS', self.default_class)
+        self.ip_header = getattr(settings, 'RATE_LIMIT_CLIENT_IP_HEADER', None)
+        self.trusted_proxies = getattr(settings, 'RATE_LIMIT_TRUSTED_PROXIES', 1)
+        self.store = STORES[getattr(settings, 'RATE_LIMIT_STORE', 'memory')]()
+        self.limits = {
+            endpoint_class: [(scope, *parse_rate(rates[scope])) for scope in SCOPES if rates.get(scope)]
+            for endpoint_class, rates in getattr(settings, 'RATE_LIMITS', {}).items()
+        }
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def client_ip(self, request):
+        """
+        Address of the client: the one the outermost trusted proxy put in
+        RATE_LIMIT_CLIENT_IP_HEADER, or REMOTE_ADDR without a proxy.
+        """
+        if self.ip_header:
+            addresses = [a.strip() for a in request.META.get(self.ip_header, '').split(',') if a.strip()]
+            if len(addresses) >= self.trusted_proxies > 0:
+                return addresses[-self.trusted_proxies]
+        return request.META.get('REMOTE_ADDR')
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        return self.check(request, view_func)
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        return await sync_to_async(self.check, thread_sensitive=False)(request, view_func)
+
+    def check(self, request, view_func):
+        """The 429 response of a request over its limits, or None"""
+        if not self.enabled or request.method == 'OPTIONS':
+            return None
+        default_class = self.default_class if request.method in SAFE_METHODS else self.unsafe_default_class
+        endpoint_class = getattr(view_func, 'rate_limit_class', default_class)
+        limits = self.limits.get(endpoint_class)
+        if not limits:
+            return None
+
+        user_id = _token_user_id(request)
+        buckets = []
+        for scope, limit, period in limits:
+            if scope == 'user':
+                key = f"user:{user_id}" if user_id else f"ip:{self.client_ip(request)}"
+            else:
+                organization_id = _organization_id(user_id) if user_id else ''
+                if not organization_id:
+                    continue
+                key = f"org:{organization_id}"
+            buckets.append((f"{endpoint_class}:{key}", limit, period))
+        try:
+            retry_after = self.store.hit(buckets)
+        except Exception as e:
+            # Never turn a store outage into failed requests
+            logger.warning("Error checking rate limit: %s", e)
+            return None
+
+        if not retry_after:
+            return None
+        response = JsonResponse({'error': 'Too many requests, please retry later'}, status=429)
+        response['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
@@ -0,0 +1,315 @@
+"""
+Server-side cache of heavy read responses.
+
+@cache_response(depends_on) keeps the JSON responses of a GET view, keyed by
+view, user and full path (query string included), and serves them again
+until something they were built from changes:
+
+    @cache_response(lambda request, collection_id: {'collection': collection_id})
+    def api_collection_detail(request, collection_id): ...
+
+Dependencies are tags like ('collection', id), ('project', id) or
+('user', id). A view can add the ones it only finds while running with
+cache_depends_on(request, project=[...]). Every tag has a generation, and
+an entry remembers the generations of its tags when it was built; writes
+call invalidate(collection=id, ...) which bumps the generations, so every
+entry built from the old data misses from then on, without finding or
+deleting them. The generations of an entry are read before the view runs,
+except for the tags added with cache_depends_on(), which are read when
+added.
+
+Three backends are available (RESPONSE_CACHE_BACKEND):
+
+    'mongo'   LRU of RESPONSE_CACHE_SIZE responses in this process, with the
+              generations in MongoDB: an invalidation made by any worker is
+              seen by all of them at their next request
+    'django'  Django's default cache (e.g. Redis or Memcached in CACHES),
+              entries and generations are shared by all workers
+    'memory'  entries and generations in this process only; other workers
+              keep serving their entries until they expire after
+              RESPONSE_CACHE_TTL seconds, so only for a single process
+              (runserver, tests)
+
+Views under @conditional_get are also keyed by their ETag, so an entry is
+never served under a version it was not built from.
+
+Hits, misses and invalidations are counted per view (response_cache_stats()),
+and cached responses carry an X-Cache: HIT / MISS header.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from functools import wraps
+from cachetools import LRUCache, TTLCache
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.http import HttpResponse
+from mongoengine.connection import get_db
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'response-cache'
+# Tag every entry depends on, bumped to drop them all
+ALL = '*'
+
+
+def _tags(dependencies):
+    """('kind', id) tags of keyword dependencies, an id or a list of ids per kind"""
+    tags = []
+    for kind, ids in dependencies.items():
+        if ids is None:
+            continue
+        if not isinstance(ids, (list, tuple, set, frozenset)):
+            ids = [ids]
+        tags.extend(f"{kind}:{id_}" for id_ in ids if id_)
+    return tags
+
+
+class _Generations(LRUCache):
+    """
+    Generations of the tags seen recently.
+
+    A tag that is not known reads as `floor`, which is raised to the
+    generation of every tag pushed out of the LRU: an entry built before its
+    tag was bumped and forgotten can never match again.
+    """
+
+    floor = 0
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.floor = max(self.floor, value)
+        return key, value
+
+
+class MemoryBackend:
+    """Size bounded LRU of this process, entries also expire after `ttl` seconds"""
+
+    def __init__(self, max_entries, ttl):
+        self._entries = TTLCache(maxsize=max_entries, ttl=ttl)
+        self._generations = _Generations(maxsize=max_entries * 4)
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+
+    def generations(self, tags):
+        with self._lock:
+            floor = self._generations.floor
+            return {tag: self._generations.get(tag, floor) for tag in tags}
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._clock += 1
+                self._generations[tag] = self._clock
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class MongoBackend(MemoryBackend):
+    """
+    Entries in this process, generations in MongoDB shared by all workers.
+
+    A generation is a counter incremented by every bump; a tag never bumped
+    reads as 0. Reading the generations of a hit is one query by _id.
+    """
+
+    COLLECTION = 'response_cache_generations'
+
+    def generations(self, tags):
+        stored = {row['_id']: row['generation'] for row in get_db()[self.COLLECTION].find(
+            {'_id': {'$in': list(tags)}}, {'generation': 1})}
+        return {tag: stored.get(tag, 0) for tag in tags}
+
+    def bump(self, tags):
+        collection = get_db()[self.COLLECTION]
+        for tag in tags:
+            collection.update_one({'_id': tag}, {'$inc': {'generation': 1}}, upsert=True)
+
+
+class DjangoCacheBackend:
+    """
+    Entries and generations in Django's default cache, shared by all workers.
+
+    A generation is the time it was bumped at (in ns). Generations outlive
+    the entries built from them (2 * ttl), so an expired generation never
+    makes an old entry valid again.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.ttl = ttl
+
+    def get(self, key):
+        return django_cache.get(f"{KEY_PREFIX}:{key}")
+
+    def set(self, key, entry):
+        django_cache.set(f"{KEY_PREFIX}:{key}", entry, self.ttl)
+
+    def generations(self, tags):
+        stored = django_cache.get_many([f"{KEY_PREFIX}:gen:{tag}" for tag in tags])
+        return {tag: stored.get(f"{KEY_PREFIX}:gen:{tag}", 0) for tag in tags}
+
+    def bump(self, tags):
+        generation = time.time_ns()
+        django_cache.set_many(
+            {f"{KEY_PREFIX}:gen:{tag}": generation for tag in tags}, self.ttl * 2)
+
+    def clear(self):
+        # Entries of other workers cannot be listed, they are all outdated instead
+        pass
+
+
+BACKENDS = {'memory': MemoryBackend, 'mongo': MongoBackend, 'django': DjangoCacheBackend}
+
+_backend = None
+_backend_lock = threading.Lock()
+_stats = {'hits': Counter(), 'misses': Counter(), 'invalidations': 0}
+_stats_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = BACKENDS[getattr(settings, 'RESPONSE_CACHE_BACKEND', 'mongo')](
+                    getattr(settings, 'RESPONSE_CACHE_SIZE', 2048),
+                    getattr(settings, 'RESPONSE_CACHE_TTL', 30))
+    return _backend
+
+
+def _enabled():
+    return getattr(settings, 'RESPONSE_CACHE_ENABLED', True)
+
+
+def invalidate(**dependencies):
+    """
+    Drop the cached responses built from changed data, e.g.
+    invalidate(project=project_id) or invalidate(user=[id1, id2]).
+
+    Never raises: a cache outage must not fail the write that called it.
+    """
+    tags = _tags(dependencies)
+    if not tags or not _enabled():
+        return
+    try:
+        get_backend().bump(tags)
+    except Exception as e:
+        logger.warning("Error invalidating response cache: %s", e)
+        return
+    with _stats_lock:
+        _stats['invalidations'] += len(tags)
+
+
+def cache_depends_on(request, **dependencies):
+    """
+    Add dependencies found while a cached view runs, e.g. the projects of a
+    list: cache_depends_on(request, project=[p.id for p in projects]).
+    Does nothing for views that are not cached.
+    """
+    generations = getattr(request, '_response_cache_generations', None)
+    if generations is None:
+        return
+    tags = [tag for tag in _tags(dependencies) if tag not in generations]
+    if not tags:
+        return
+    try:
+        generations.update(get_backend().generations(tags))
+    except Exception as e:
+        logger.warning("Error reading response cache: %s", e)
+        request._response_cache_generations = None
+
+
+def cache_response(depends_on, per_user=True):
+    """
+    Cache the 200 responses of a GET view until a dependency is invalidated.
+
+    Args:
+        depends_on (callable): Called with the view's arguments, returns the
+            dependencies as a dict of kind -> id or list of ids
+        per_user (bool): Key the entries by request.user too, for responses
+            that depend on who asks (roles, permissions, own projects)
+    """
+    def decorator(view_func):
+        name = f"{view_func.__module__}.{view_func.__name__}"
+
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method != 'GET' or not _enabled():
+                return view_func(request, *args, **kwargs)
+
+            user_id = str(request.user.id) if per_user else ''
+            # Set by @conditional_get when it wraps this view
+            etag = getattr(request, '_conditional_etag', '')
+            key = f"{name}:{user_id}:{etag}:{request.get_full_path()}"
+            try:
+                backend = get_backend()
+                entry = backend.get(key)
+                if entry is not None and backend.generations(entry[2]) == entry[2]:
+                    with _stats_lock:
+                        _stats['hits'][name] += 1
+                    response = HttpResponse(entry[0], content_type=entry[1])
+                    response['X-Cache'] = 'HIT'
+                    return response
+                generations = backend.generations(
+                    [ALL] + _tags(depends_on(request, *args, **kwargs)))
+            except Exception as e:
+                logger.warning("Error reading response cache: %s", e)
+                return view_func(request, *args, **kwargs)
+
+            with _stats_lock:
+                _stats['misses'][name] += 1
+            request._response_cache_generations = generations
+            response = view_func(request, *args, **kwargs)
+            generations = request._response_cache_generations
+            if generations is not None and response.status_code == 200 and not response.streaming:
+                try:
+                    backend.set(key, (response.content, response['Content-Type'], generations))
+                except Exception as e:
+                    logger.warning("Error storing response cache entry: %s", e)
+            response['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+
+def response_cache_stats():
+    """
+    Hit and miss counts of this process, in total and per view.
+
+    Returns:
+        dict: {'hits', 'misses', 'hit_ratio', 'invalidations', 'views': {name: {...}}}
+    """
+    with _stats_lock:
+        hits, misses = Counter(_stats['hits']), Counter(_stats['misses'])
+        invalidations = _stats['invalidations']
+
+    def summary(hit_count, miss_count):
+        total = hit_count + miss_count
+        return {'hits': hit_count, 'misses': miss_count,
+                'hit_ratio': round(hit_count / total, 4) if total else None}
+
+    stats = summary(sum(hits.values()), sum(misses.values()))
+    stats['invalidations'] = invalidations
+    stats['views'] = {name: summary(hits[name], misses[name]) for name in sorted(set(hits) | set(misses))}
+    return stats
+
+
+def clear_response_cache():
+    """Drop all cached responses and reset the statistics"""
+    get_backend().bump([ALL])
+    get_backend().clear()
+    with _stats_lock:
+        _stats['hits'].clear()
+        _stats['misses'].clear()
+        _stats['invalidations'] = 0
@@ -0,0 +1,109 @@
+"""
+Fast JSON responses for the API views.
+
+JsonResponse here is a drop-in replacement for django.http.JsonResponse that
+serializes with orjson when it is installed, which is several times faster
+than the standard library encoder on the large nested payloads of the
+collection and history endpoints. It also converts the values read from
+MongoDB itself, so views can put them in the response as they are:
+
+    datetime, date, time   ISO 8601, as datetime.isoformat()
+    timedelta              ISO 8601 duration, like DjangoJSONEncoder
+    ObjectId, DBRef        the id as a string
+    Decimal, UUID          string, like DjangoJSONEncoder
+    lazy translations      the translated string
+    documents              embedded documents (and documents) as their dict
+    Enum                   its value
+    set, tuple             list
+
+Without orjson (or when a view passes its own encoder / json_dumps_params)
+the standard library encoder is used, with the same conversions.
+"""
+import datetime
+import decimal
+import enum
+import json
+import uuid
+from bson import DBRef, ObjectId
+from django.http import HttpResponse
+from django.utils.duration import duration_iso_string
+from django.utils.functional import Promise
+from mongoengine.base import BaseDocument
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def to_json_value(value):
+    """
+    JSON-compatible form of a value the encoders do not know.
+
+    Raises:
+        TypeError: If the value cannot be converted
+    """
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return duration_iso_string(value)
+    if isinstance(value, (decimal.Decimal, uuid.UUID, Promise)):
+        return str(value)
+    if isinstance(value, BaseDocument):
+        return value.to_mongo().to_dict()
+    if isinstance(value, DBRef):
+        return str(value.id)
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class JSONEncoder(json.JSONEncoder):
+    """Standard library encoder with the conversions of to_json_value"""
+
+    def default(self, o):
+        try:
+            return to_json_value(o)
+        except TypeError:
+            return super().default(o)
+
+
+def dumps(data):
+    """
+    Serialize data to JSON bytes, with orjson when it is installed.
+
+    Returns:
+        bytes: The UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=to_json_value, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, cls=JSONEncoder).encode()
+
+
+class JsonResponse(HttpResponse):
+    """
+    HTTP response with a JSON body, see django.http.JsonResponse.
+
+    Args:
+        data: The object to serialize, a dict unless safe is False
+        encoder (type, optional): JSONEncoder subclass, forces the standard library encoder
+        safe (bool): Only allow dicts, like Django's JsonResponse
+        json_dumps_params (dict, optional): Arguments for json.dumps, forces
+            the standard library encoder
+        **kwargs: Passed to HttpResponse (status, headers, ...)
+    """
+
+    def __init__(self, data, encoder=None, safe=True, json_dumps_params=None, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError(
+                "In order to allow non-dict objects to be serialized set the safe parameter to False.")
+        kwargs.setdefault('content_type', 'application/json')
+        if encoder is None and json_dumps_params is None:
+            content = dumps(data)
+        else:
+            content = json.dumps(data, cls=encoder or JSONEncoder, **(json_dumps_params or {}))
+        super().__init__(content=content, **kwargs)
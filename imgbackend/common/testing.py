@@ -0,0 +1,177 @@
+"""
+Test helpers for code that talks to MongoDB.
+
+MongoTestCase points the default MongoEngine connection at a throwaway
+database for each test class: the MongoDB server at MONGO_TEST_URI when it
+is set, an in-memory mongomock database otherwise. The database is dropped
+and the connection of settings.MONGODB registered again afterwards. Files
+saved by the code under test go to a temporary MEDIA_ROOT, removed with it.
+
+mongomock does not apply an update atomically (it finds the document, then
+changes it), so on mongomock the collection operations are serialized by one
+lock, like a single MongoDB server applies a findAndModify; concurrency tests
+then check the application's logic, not the fake's.
+
+Recent pymongo versions pass a `sort` option to the bulk operations of
+mongomock, which does not take it; MongoTestCase drops it when it is unset.
+
+assertNumMongoCommands() counts the commands a block sends, like Django's
+assertNumQueries: with a pymongo CommandListener on a MongoDB server, from
+the collection methods called on mongomock (which has no command events).
+"""
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+from unittest import SkipTest
+import mongoengine
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+from pymongo import monitoring
+from common.mongo import configure_mongo
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+# Commands counted by assertNumMongoCommands; getMore (the next batch of a
+# cursor) and the index and server commands are not
+COUNTED_COMMANDS = frozenset((
+    'find', 'aggregate', 'count', 'distinct', 'findAndModify', 'insert', 'update', 'delete'))
+
+# mongomock.Collection methods that read or write documents, with the
+# command pymongo sends for them
+_MONGOMOCK_COMMANDS = {
+    'find': 'find', 'find_one': 'find',
+    'count_documents': 'aggregate', 'estimated_document_count': 'count',
+    'aggregate': 'aggregate', 'distinct': 'distinct',
+    'find_one_and_update': 'findAndModify', 'find_one_and_replace': 'findAndModify',
+    'find_one_and_delete': 'findAndModify',
+    'insert_one': 'insert', 'insert_many': 'insert',
+    'update_one': 'update', 'update_many': 'update', 'replace_one': 'update',
+    'delete_one': 'delete', 'delete_many': 'delete',
+    'bulk_write': None,
+}
+_mongomock_lock = threading.RLock()
+_mongomock_depth = 0
+
+
+class MongoCommandCounter(monitoring.CommandListener):
+    """Records the names of the commands sent while counting"""
+
+    def __init__(self):
+        self.commands = None
+
+    def record(self, command_name):
+        commands = self.commands
+        if commands is not None and command_name in COUNTED_COMMANDS:
+            commands.append(command_name)
+
+    def started(self, event):
+        self.record(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def _instrumented(method, command_name, counter):
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        global _mongomock_depth
+        with _mongomock_lock:
+            # Only the outermost call is a command (find_one calls find)
+            if not _mongomock_depth and command_name:
+                counter.record(command_name)
+            _mongomock_depth += 1
+            try:
+                return method(*args, **kwargs)
+            finally:
+                _mongomock_depth -= 1
+    return wrapper
+
+
+def _without_sort(method):
+    @wraps(method)
+    def wrapper(*args, sort=None, **kwargs):
+        if sort is not None:
+            raise NotImplementedError('mongomock bulk operations do not support sort')
+        return method(*args, **kwargs)
+    return wrapper
+
+
+class MongoTestCase(SimpleTestCase):
+    """Test case with the default MongoEngine connection on a test database"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        uri = os.environ.get('MONGO_TEST_URI')
+        if not uri and mongomock is None:
+            raise SkipTest('Set MONGO_TEST_URI or install mongomock to run MongoDB tests')
+
+        cls.media_root = tempfile.mkdtemp()
+        cls._media_settings = override_settings(MEDIA_ROOT=cls.media_root)
+        cls._media_settings.enable()
+
+        cls.mongo_db_name = f"test_{settings.MONGODB['db']}_{uuid.uuid4().hex[:8]}"
+        cls.mongo_commands = MongoCommandCounter()
+        mongoengine.disconnect()
+        if uri:
+            mongoengine.connect(cls.mongo_db_name, host=uri, event_listeners=[cls.mongo_commands])
+            cls._patched = {}
+        else:
+            mongoengine.connect(cls.mongo_db_name, host='mongodb://localhost',
+                                mongo_client_class=mongomock.MongoClient)
+            cls._patched = {name: getattr(mongomock.Collection, name) for name in _MONGOMOCK_COMMANDS}
+            for name, method in cls._patched.items():
+                setattr(mongomock.Collection, name, _instrumented(
+                    method, _MONGOMOCK_COMMANDS[name], cls.mongo_commands))
+            cls._patched_bulk = {name: getattr(mongomock.collection.BulkOperationBuilder, name)
+                                 for name in ('add_update', 'add_replace')}
+            for name, method in cls._patched_bulk.items():
+                setattr(mongomock.collection.BulkOperationBuilder, name, _without_sort(method))
+
+    @classmethod
+    def tearDownClass(cls):
+        for name, method in cls._patched.items():
+            setattr(mongomock.Collection, name, method)
+        for name, method in getattr(cls, '_patched_bulk', {}).items():
+            setattr(mongomock.collection.BulkOperationBuilder, name, method)
+        mongoengine.connection.get_connection().drop_database(cls.mongo_db_name)
+        mongoengine.disconnect()
+        configure_mongo(**settings.MONGODB)
+        cls._media_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        # Emptied rather than dropped, the indexes (unique ones included) stay
+        db = mongoengine.connection.get_db()
+        for name in db.list_collection_names():
+            db[name].delete_many({})
+
+    @contextmanager
+    def captureMongoCommands(self):
+        """Collect the names of the MongoDB commands the block sends (see COUNTED_COMMANDS)"""
+        self.mongo_commands.commands = commands = []
+        try:
+            yield commands
+        finally:
+            self.mongo_commands.commands = None
+
+    @contextmanager
+    def assertNumMongoCommands(self, num):
+        """Assert that the block sends `num` MongoDB commands"""
+        with self.captureMongoCommands() as commands:
+            yield commands
+        self.assertEqual(
+            len(commands), num,
+            f"{len(commands)} MongoDB commands sent, {num} expected: {', '.join(commands)}")
@@ -1,3 +1,229 @@
-from django.test import TestCase
+from unittest import mock
+import jwt
+from asgiref.sync import async_to_sync, iscoroutinefunction
+import datetime
+import decimal
+import json
+import time
+import uuid
+from bson import ObjectId
+from django.conf import settings
+from django.utils.translation import gettext_lazy
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from users.models import Role
+from django.core.signals import request_started
+from pymongo.errors import ConfigurationError
+from . import http_client, mongo, response_cache, responses
+from .conditional import conditional_get
+from .pagination import MAX_LIMIT, InvalidCursor, InvalidPageParameter, get_page_params, keyset_query
+from .ratelimit import MongoStore, RateLimitMiddleware, rate_limit
+from .response_cache import MemoryBackend, MongoBackend, cache_response, invalidate
+from .testing import MongoTestCase
+from .user_cache import TokenUser
 
-# Create your tests here.
+
+class PageParamsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_limit_is_clamped(self):
+        self.assertEqual(get_page_params(self.factory.get('/', {'limit': 1000})), (None, MAX_LIMIT))
+        self.assertEqual(get_page_params(self.factory.get('/', {'limit': 0})), (None, 1))
+        self.assertEqual(get_page_params(self.factory.get('/'), default_limit=5), (None, 5))
+
+    def test_malformed_limit_is_rejected(self):
+        with self.assertRaises(InvalidPageParameter):
+            get_page_params(self.factory.get('/', {'limit': 'abc'}))
+
+    def test_malformed_cursor_is_rejected(self):
+        with self.assertRaises(InvalidCursor):
+            keyset_query('not-a-cursor')
+
+
+class TokenUserTests(SimpleTestCase):
+
+    def test_role_from_claims(self):
+        user_id = ObjectId()
+        user = TokenUser({'id': str(user_id), 'email': 'admin@example.com', 'role': 'admin'})
+        self.assertEqual((user.id, user.email, user.role), (user_id, 'admin@example.com', Role.ADMIN))
+
+    def test_missing_or_unknown_role_is_user(self):
+        self.assertEqual(TokenUser({'id': str(ObjectId())}).role, Role.USER)
+        self.assertEqual(TokenUser({'id': str(ObjectId()), 'role': 'superuser'}).role, Role.USER)
+
+
+@override_settings(
+    RATE_LIMIT_ENABLED=True, RATE_LIMIT_STORE='memory',
+    RATE_LIMIT_DEFAULT_CLASS='read', RATE_LIMIT_UNSAFE_DEFAULT_CLASS='write',
+    RATE_LIMIT_CLIENT_IP_HEADER=None,
+    RATE_LIMITS={
+        'read': {'user': '100/m'},
+        'write': {'user': '1/m'},
+        'generation': {'user': '1/m', 'organization': '2/m'},
+    })
+class RateLimitTests(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.middleware = RateLimitMiddleware(lambda request: None)
+
+    def request(self, method='get', user_id=None, view=None, **extra):
+        if user_id:
+            token = jwt.encode({'id': user_id}, settings.SECRET_KEY, algorithm='HS256')
+            extra['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+        request = getattr(self.factory, method)('/', **extra)
+        response = self.middleware.process_view(request, view or (lambda request: None), (), {})
+        return response.status_code if response else 200
+
+    def test_rejected_request_does_not_spend_other_limits(self):
+        @rate_limit('generation')
+        def view(request):
+            pass
+
+        first, second = str(ObjectId()), str(ObjectId())
+        with mock.patch('common.ratelimit._organization_id', return_value='organization'):
+            self.assertEqual(self.request(user_id=first, view=view), 200)
+            # Over the user limit, the organization's request is not spent
+            self.assertEqual(self.request(user_id=first, view=view), 429)
+            self.assertEqual(self.request(user_id=second, view=view), 200)
+            self.assertEqual(self.request(user_id=str(ObjectId()), view=view), 429)
+
+    def test_unsafe_methods_have_their_own_default_class(self):
+        self.assertEqual(self.request('post'), 200)
+        self.assertEqual(self.request('delete'), 429)
+        self.assertEqual(self.request('get'), 200)
+
+    def test_anonymous_requests_are_limited_by_remote_addr(self):
+        self.assertEqual(self.request('post', HTTP_X_FORWARDED_FOR='10.0.0.1'), 200)
+        self.assertEqual(self.request('post', HTTP_X_FORWARDED_FOR='10.0.0.2'), 429)
+
+    def test_async_middleware(self):
+        async def get_response(request):
+            pass
+
+        self.middleware = RateLimitMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(self.middleware))
+        self.assertTrue(iscoroutinefunction(self.middleware.process_view))
+        request = self.factory.post('/')
+        statuses = [getattr(async_to_sync(self.middleware.process_view)(request, lambda r: None, (), {}),
+                            'status_code', 200) for _ in range(2)]
+        self.assertEqual(statuses, [200, 429])
+
+    def test_anonymous_requests_behind_a_proxy(self):
+        with self.settings(RATE_LIMIT_CLIENT_IP_HEADER='HTTP_X_FORWARDED_FOR', RATE_LIMIT_TRUSTED_PROXIES=1):
+            self.middleware = RateLimitMiddleware(lambda request: None)
+            self.assertEqual(self.request('post', HTTP_X_FORWARDED_FOR='10.0.0.1'), 200)
+            self.assertEqual(self.request('post', HTTP_X_FORWARDED_FOR='10.0.0.2'), 200)
+            # Entries sent by the client before the proxy's are ignored
+            self.assertEqual(self.request('post', HTTP_X_FORWARDED_FOR='1.2.3.4, 10.0.0.1'), 429)
+
+
+class MongoRateLimitStoreTests(MongoTestCase):
+
+    def test_rejected_request_is_taken_back(self):
+        store = MongoStore()
+        limits = [('user:1', 1, 60), ('org:1', 5, 60)]
+        self.assertEqual(store.hit(limits), 0)
+        self.assertGreater(store.hit(limits), 0)
+
+        counts = {'user:1': 0, 'org:1': 0}
+        for row in store._collection().find():
+            counts[row['_id'].rsplit(':', 1)[0]] += row['count']
+        self.assertEqual(counts, {'user:1': 1, 'org:1': 1})
+
+
+@override_settings(RESPONSE_CACHE_ENABLED=True)
+class ResponseCacheTests(MongoTestCase):
+    """Two backend instances stand for the caches of two workers"""
+
+    def setUp(self):
+        super().setUp()
+        self.factory = RequestFactory()
+        self.version = {'etag': '1'}
+        self.builds = 0
+
+        @conditional_get(lambda request: (self.version['etag'], None))
+        @cache_response(lambda request: {'collection': 'c1'}, per_user=False)
+        def view(request):
+            self.builds += 1
+            return responses.JsonResponse({'build': self.builds})
+
+        self.view = view
+
+    def get(self, backend):
+        with mock.patch.object(response_cache, '_backend', backend):
+            response = self.view(self.factory.get('/collection/'))
+        return response['X-Cache'], json.loads(response.content)['build']
+
+    def test_invalidation_reaches_other_workers(self):
+        first, second = MongoBackend(16, 60), MongoBackend(16, 60)
+        self.assertEqual(self.get(first), ('MISS', 1))
+        self.assertEqual(self.get(first), ('HIT', 1))
+
+        with mock.patch.object(response_cache, '_backend', second):
+            invalidate(collection='c1')
+        self.assertEqual(self.get(first), ('MISS', 2))
+
+    def test_entries_are_keyed_by_version(self):
+        # Even with a backend that does not see the other worker's invalidation
+        backend = MemoryBackend(16, 60)
+        self.assertEqual(self.get(backend), ('MISS', 1))
+        self.version['etag'] = '2'
+        self.assertEqual(self.get(backend), ('MISS', 2))
+        self.assertEqual(self.get(backend), ('HIT', 2))
+
+
+class MongoRegistrationTests(SimpleTestCase):
+
+    def test_failed_registration_is_retried_on_request(self):
+        with mock.patch.object(mongo.mongoengine, 'register_connection',
+                               side_effect=[ConfigurationError('DNS'), None]) as register, \
+                mock.patch.dict(mongo._pending, clear=True), \
+                self.assertLogs('common.mongo', 'ERROR'):
+            mongo.configure_mongo('retry-test', db='test', host='mongodb+srv://cluster.example.com')
+            self.assertIn('retry-test', mongo._pending)
+
+            # Not before REGISTER_RETRY_SECONDS
+            request_started.send(sender=None)
+            self.assertEqual(register.call_count, 1)
+
+            with mock.patch.object(mongo.time, 'monotonic', return_value=time.monotonic() + 60):
+                request_started.send(sender=None)
+            self.assertEqual(register.call_count, 2)
+            self.assertNotIn('retry-test', mongo._pending)
+
+
+class LoopClientTests(SimpleTestCase):
+
+    def test_clients_are_closed_with_their_loop(self):
+        async def view():
+            return http_client.get_async_client(), http_client.get_async_client()
+
+        # Like an async view under WSGI, run in an event loop of its own
+        first, again = async_to_sync(view)()
+        second, _ = async_to_sync(view)()
+
+        self.assertIs(first, again)
+        self.assertIsNot(first, second)
+        self.assertTrue(first.is_closed and second.is_closed)
+        self.assertFalse(http_client._closers)
+
+
+class JsonResponseTests(SimpleTestCase):
+    """JsonResponse converts the values DjangoJSONEncoder did, with orjson and without"""
+
+    def test_django_encoder_types(self):
+        value = uuid.uuid4()
+        data = {'price': decimal.Decimal('1.50'), 'uuid': value, 'label': gettext_lazy('Name'),
+                'duration': datetime.timedelta(minutes=1, seconds=30), 'id': ObjectId('0' * 24)}
+        expected = {'price': '1.50', 'uuid': str(value), 'label': 'Name', 'duration': 'P0DT00H01M30S',
+                    'id': '0' * 24}
+
+        self.assertEqual(json.loads(responses.JsonResponse(data).content), expected)
+        with mock.patch.object(responses, 'orjson', None):
+            self.assertEqual(json.loads(responses.JsonResponse(data).content), expected)
+
+    def test_unknown_type_is_rejected(self):
+        with self.assertRaises(TypeError):
+            responses.JsonResponse({'value': object()})
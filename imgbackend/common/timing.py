@@ -0,0 +1,220 @@
+"""
+Per-request timing.
+
+RequestTimingMiddleware measures every request and breaks its time down in
+phases:
+
+    total   wall time of the request, middleware included
+    mongo   time spent in MongoDB commands, from a pymongo CommandListener
+            (MongoCommandTimer, passed to the client in settings.MONGODB)
+    http    time spent in outbound HTTP calls (Gemini, Cloudinary, image
+            downloads), through httpx and urllib3
+    cpu     CPU time of the thread serving a synchronous request (not
+            measured for async views, whose thread serves other requests too)
+
+The breakdown is sent back in a Server-Timing header, visible in the
+browser's developer tools, and logged by the 'common.timing' logger:
+requests slower than REQUEST_SLOW_MS as warnings, the others as info for a
+REQUEST_TIMING_SAMPLE_RATE fraction of them. Log lines are logfmt
+(key=value); the values are also on the record as record.timing, for
+structured handlers.
+
+Mongo and HTTP times are the sum of the calls' durations: calls running
+concurrently (asyncio.gather) can add up to more than the total. Work
+handed to threads that do not copy the request context, e.g. a
+ThreadPoolExecutor, is not counted.
+"""
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('request_timings', default=None)
+# Set while an outbound call is timed, so retries and redirects that call
+# back into the same function are counted once
+_in_http_call = ContextVar('in_http_call', default=False)
+_http_installed = False
+_http_lock = threading.Lock()
+
+
+class RequestTimings:
+    """Time spent per phase by one request, in seconds"""
+
+    def __init__(self):
+        self.mongo = 0.0
+        self.mongo_count = 0
+        self.http = 0.0
+        self.http_count = 0
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            setattr(self, phase, getattr(self, phase) + seconds)
+            setattr(self, f"{phase}_count", getattr(self, f"{phase}_count") + 1)
+
+
+def record(phase, seconds):
+    """Add the duration of a call to the current request's phase ('mongo' or 'http')"""
+    timings = _current.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Adds the duration of every MongoDB command to the request it runs for"""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record('mongo', event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record('mongo', event.duration_micros / 1e6)
+
+
+def _timed(send):
+    @wraps(send)
+    def wrapper(*args, **kwargs):
+        if _current.get() is None or _in_http_call.get():
+            return send(*args, **kwargs)
+        token = _in_http_call.set(True)
+        start = time.perf_counter()
+        try:
+            return send(*args, **kwargs)
+        finally:
+            record('http', time.perf_counter() - start)
+            _in_http_call.reset(token)
+    return wrapper
+
+
+def _atimed(send):
+    @wraps(send)
+    async def wrapper(*args, **kwargs):
+        if _current.get() is None or _in_http_call.get():
+            return await send(*args, **kwargs)
+        token = _in_http_call.set(True)
+        start = time.perf_counter()
+        try:
+            return await send(*args, **kwargs)
+        finally:
+            record('http', time.perf_counter() - start)
+            _in_http_call.reset(token)
+    return wrapper
+
+
+def install_http_timing():
+    """
+    Time outbound HTTP calls of this process.
+
+    The HTTP clients used here have no process-wide hooks, so the methods
+    every request goes through are wrapped once: httpx Client.send and
+    AsyncClient.send (our clients and the Gemini SDK) and urllib3's
+    HTTPConnectionPool.urlopen (Cloudinary SDK, requests). Outside of a
+    request the wrappers only check a context variable.
+    """
+    global _http_installed
+    with _http_lock:
+        if _http_installed:
+            return
+        try:
+            import httpx
+            httpx.Client.send = _timed(httpx.Client.send)
+            httpx.AsyncClient.send = _atimed(httpx.AsyncClient.send)
+        except ImportError:
+            pass
+        try:
+            from urllib3.connectionpool import HTTPConnectionPool
+            HTTPConnectionPool.urlopen = _timed(HTTPConnectionPool.urlopen)
+        except ImportError:
+            pass
+        _http_installed = True
+
+
+class RequestTimingMiddleware:
+    """Adds Server-Timing to responses and logs slow (and sampled) requests"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        self.enabled = getattr(settings, 'REQUEST_TIMING_ENABLED', True)
+        self.header = getattr(settings, 'REQUEST_TIMING_HEADER', True)
+        self.sample_rate = getattr(settings, 'REQUEST_TIMING_SAMPLE_RATE', 0.01)
+        self.slow_seconds = getattr(settings, 'REQUEST_SLOW_MS', 1000) / 1000
+        if self.enabled:
+            install_http_timing()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._finish(request, response, timings, time.perf_counter() - start,
+                     time.thread_time() - cpu_start)
+        return response
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        self._finish(request, response, timings, time.perf_counter() - start, None)
+        return response
+
+    def _finish(self, request, response, timings, total, cpu):
+        phases = [('total', total, None),
+                  ('mongo', timings.mongo, f"{timings.mongo_count} commands"),
+                  ('http', timings.http, f"{timings.http_count} calls")]
+        if cpu is not None:
+            phases.append(('cpu', cpu, None))
+        if self.header:
+            response['Server-Timing'] = ', '.join(
+                f'{name};dur={seconds * 1000:.1f}' + (f';desc="{desc}"' if desc else '')
+                for name, seconds, desc in phases)
+
+        slow = total >= self.slow_seconds
+        if not slow and random.random() >= self.sample_rate:
+            return
+        fields = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+            'mongo_ms': round(timings.mongo * 1000, 1),
+            'mongo_commands': timings.mongo_count,
+            'http_ms': round(timings.http * 1000, 1),
+            'http_calls': timings.http_count,
+        }
+        if cpu is not None:
+            fields['cpu_ms'] = round(cpu * 1000, 1)
+        logger.log(logging.WARNING if slow else logging.INFO,
+                   '%s %s', 'slow_request' if slow else 'request',
+                   ' '.join(f'{key}={value}' for key, value in fields.items()),
+                   extra={'timing': fields})
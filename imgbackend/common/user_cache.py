@@ -0,0 +1,82 @@
+"""
+Per-process cache of authenticated users.
+
+authenticate() used to load the user with User.objects(id=...).first() on
+every API call, polling endpoints included. get_user() keeps the raw user
+documents of recently seen users in a TTL/LRU cache (USER_CACHE_SIZE users,
+for USER_CACHE_TTL seconds) and builds a fresh User from them for each
+request, so a view changing request.user never changes the cached copy.
+
+The cache belongs to one process: call invalidate_user() after saving a
+user so this process sees the change at once; other workers see it when
+their entry expires.
+
+TokenUser is what authenticate(stateless=True) puts on request.user: the
+signed JWT claims only, for read-only endpoints that just need the user id.
+"""
+import copy
+import threading
+from bson import ObjectId
+from cachetools import TTLCache
+from django.conf import settings
+from users.models import Role, User
+
+_users = TTLCache(
+    maxsize=getattr(settings, 'USER_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'USER_CACHE_TTL', 60))
+_lock = threading.Lock()
+
+
+def get_user(user_id):
+    """
+    Load a user, from the cache when it was loaded recently.
+
+    Args:
+        user_id (str): ID of the user
+
+    Returns:
+        User: A User document of its own, or None if the user does not exist
+    """
+    key = str(user_id)
+    with _lock:
+        son = _users.get(key)
+    if son is not None:
+        return User._from_son(copy.deepcopy(son))
+
+    user = User.objects(id=user_id).first()
+    if user is not None:
+        with _lock:
+            _users[key] = user.to_mongo()
+    return user
+
+
+def invalidate_user(user_id):
+    """Drop a user from the cache, after the user was changed or deleted"""
+    with _lock:
+        _users.pop(str(user_id), None)
+
+
+def clear_user_cache():
+    with _lock:
+        _users.clear()
+
+
+class TokenUser:
+    """
+    User built from the JWT claims (id, email, role), without a database read.
+
+    A missing or unknown role (e.g. from a token issued before a role was
+    renamed) is the least privileged one, Role.USER.
+    """
+
+    def __init__(self, payload):
+        self.id = ObjectId(payload['id'])
+        self.pk = self.id
+        self.email = payload.get('email')
+        try:
+            self.role = Role(payload.get('role') or Role.USER)
+        except ValueError:
+            self.role = Role.USER
+
+    def __str__(self):
+        return self.email or str(self.id)
@@ -10,6 +10,7 @@ urlpatterns = [
     # replace 'myapp' with your app name
     path("probackendapp/", include("probackendapp.urls", namespace="probackendapp")),
     path('api/', include('users.urls'), name='users'),
+    path('usage/', include('usage_tracking.urls')),
 
 ]
 
@@ -1,7 +1,7 @@
 # imgbackendapp/auth_utils.py
 import jwt
 from django.conf import settings
-from django.http import JsonResponse
+from common.responses import JsonResponse
 from functools import wraps
 
 
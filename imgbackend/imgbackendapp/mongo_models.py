@@ -33,7 +33,7 @@
 #     meta = {"collection": "jewellery"}
 
 
-from mongoengine import Document, StringField, URLField, DateTimeField, ListField, ReferenceField, ObjectIdField
+from mongoengine import Document, StringField, URLField, DateTimeField, ListField, ReferenceField, ObjectIdField, IntField
 import datetime
 
 
@@ -49,6 +49,10 @@ class OrnamentMongo(Document):
     # Regeneration tracking - reference to parent image if this is a regeneration
     parent_image_id = ObjectIdField()
     original_prompt = StringField()  # Store the original prompt for context
+    # Materialized lineage of regenerations (see probackendapp/lineage_utils.py)
+    lineage_root = ObjectIdField()
+    lineage_depth = IntField(default=0)
+    lineage_path = ListField(ObjectIdField())
 
     # Single model image (only for campaign)
     model_image_url = URLField()
@@ -69,4 +73,14 @@ class OrnamentMongo(Document):
     created_at = DateTimeField(default=datetime.datetime.utcnow)
     updated_at = DateTimeField(default=datetime.datetime.utcnow)
 
-    meta = {"collection": "jewellery"}
+    meta = {
+        "collection": "jewellery",
+        # Newest-first keyset pagination per user (see common/pagination.py)
+        "indexes": [
+            ("user_id", "-created_at", "-id"),
+            ("user_id", "type", "-created_at", "-id"),
+            ("lineage_root", "lineage_depth", "created_at"),
+            # Archival of old images (see common/archive.py)
+            "created_at",
+        ]
+    }
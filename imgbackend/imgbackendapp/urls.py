@@ -12,6 +12,8 @@ urlpatterns = [
     path('generate-campaign-shot/', views.generate_campaign_shot_advanced,
          name='generate_campaign_shot_advanced'),
     path('regenerate/', views.regenerate_image, name='regenerate_image'),
+    path('image-lineage/<str:image_id>/', views.get_image_lineage,
+         name='get_image_lineage'),
 ]
 
 
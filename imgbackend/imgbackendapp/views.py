@@ -771,14 +771,15 @@
 
 
 # imgbackendapp/views.py
+import asyncio
 import base64
-import traceback
+import logging
 from io import BytesIO
 from django.shortcuts import render
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.contrib import messages
-from django.http import JsonResponse
+from common.responses import JsonResponse
 import cloudinary.uploader
 from .forms import OrnamentForm, BackgroundChangeForm
 from .models import Ornament
@@ -789,10 +790,16 @@ import cv2
 import os
 import time
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse, HttpResponseBadRequest
+from django.http import HttpResponseBadRequest
+from common.archive import get_document
+from CREDITS.balance import InsufficientCredits, areserve_credits
+from common.http_client import cloudinary_upload, fetch_bytes, get_genai_client, run_sync
 from common.middleware import authenticate
-from urllib.request import urlopen
+from common.pagination import InvalidPageParameter, paginate
+from common.ratelimit import rate_limit
+from probackendapp.lineage_utils import build_lineage_tree, get_lineage_tree, lineage_for
 from bson import ObjectId
+from asgiref.sync import sync_to_async
 
 # Check for Gemini SDK
 try:
@@ -802,10 +809,84 @@ try:
 except ImportError:
     has_genai = False
 
+logger = logging.getLogger(__name__)
+
+
+# The local fallbacks are CPU bound: the views run them with run_sync() so
+# that the event loop keeps serving the other requests meanwhile
+
+def extract_on_background(source, bg_color):
+    """
+    Cut the ornament out of a photo on a light background with OpenCV, and
+    paste it on a plain background.
+
+    Args:
+        source (str|file): Path or file object of the photo
+        bg_color (tuple): RGB color of the new background
+
+    Returns:
+        bytes: The JPEG image, or None if no ornament was found
+    """
+    original = Image.open(source).convert("RGB")
+    img_array = np.array(original)
+    img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
+    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
+    blur = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, thresh = cv2.threshold(blur, 240, 255, cv2.THRESH_BINARY_INV)
+
+    kernel = np.ones((3, 3), np.uint8)
+    thresh = cv2.morphologyEx(
+        thresh, cv2.MORPH_CLOSE, kernel, iterations=2)
+    thresh = cv2.morphologyEx(
+        thresh, cv2.MORPH_OPEN, kernel, iterations=1)
+
+    contours, _ = cv2.findContours(
+        thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    largest_contour = max(contours, key=cv2.contourArea)
+    mask = np.zeros_like(gray)
+    cv2.drawContours(mask, [largest_contour], -1, 255, -1)
+    mask = cv2.GaussianBlur(mask, (5, 5), 0)
+    rgba_array = np.dstack((img_array, mask))
+    transparent_img = Image.fromarray(rgba_array, 'RGBA')
+    bg = Image.new("RGB", original.size, bg_color)
+    bg.paste(transparent_img, mask=transparent_img.split()[3])
+    buf = BytesIO()
+    bg.save(buf, format="JPEG", quality=95)
+    return buf.getvalue()
+
+
+def composite_on_background(ornament_img, bg_b64, bg_color):
+    """
+    Paste the ornament on the background image, or on a plain color.
+
+    Args:
+        ornament_img (Image): The ornament
+        bg_b64 (str): Base64 JPEG of the background, or None
+        bg_color (tuple): RGB color used without a background image
+
+    Returns:
+        bytes: The JPEG image
+    """
+    if bg_b64:
+        bg_img = Image.open(
+            BytesIO(base64.b64decode(bg_b64))).convert("RGB")
+        bg_img = bg_img.resize(ornament_img.size)
+    else:
+        bg_img = Image.new(
+            "RGB", ornament_img.size, bg_color or (255, 255, 255))
+    bg_img.paste(ornament_img, (0, 0),
+                 ornament_img.convert("RGBA"))
+    buf = BytesIO()
+    bg_img.save(buf, format="JPEG", quality=95)
+    return buf.getvalue()
+
 
 @csrf_exempt
 @authenticate
-def upload_ornament(request):
+@rate_limit('generation')
+async def upload_ornament(request):
     if request.method == "POST":
         # Get user from authentication middleware
         user = request.user
@@ -813,7 +894,7 @@ def upload_ornament(request):
 
         form = OrnamentForm(request.POST, request.FILES)
         if form.is_valid():
-            ornament = form.save()
+            ornament = await sync_to_async(form.save)()
             try:
                 bg_color = request.POST.get(
                     "background_color", "white").strip()
@@ -828,129 +909,110 @@ def upload_ornament(request):
                 from probackendapp.prompt_initializer import get_prompt_from_db
                 extra_prompt_text = f" {extra_prompt}" if extra_prompt else ""
                 default_prompt = f"Remove the background from this ornament image and replace it with a plain {bg_color} background.{extra_prompt_text}"
-                text_prompt = get_prompt_from_db(
+                text_prompt = await run_sync(
+                    get_prompt_from_db,
                     'images_white_background',
                     default_prompt,
                     bg_color=bg_color,
                     extra_prompt=extra_prompt_text
                 )
 
-                if has_genai:
-                    if not settings.GOOGLE_API_KEY or settings.GOOGLE_API_KEY == "your_api_key_here":
-                        raise Exception("GOOGLE_API_KEY not configured")
-
-                    client = genai.Client(api_key=settings.GOOGLE_API_KEY)
-                    model_name = "gemini-2.5-flash-image-preview"
-
-                    contents = [
-                        {
-                            "parts": [
-                                {"inline_data": {
-                                    "mime_type": "image/jpeg", "data": img_b64}},
-                                {"text": text_prompt}
-                            ]
-                        }
-                    ]
-
-                    config = types.GenerateContentConfig(
-                        response_modalities=[types.Modality.IMAGE]
-                    )
+                # Charged once the image is stored, refunded if anything before fails
+                async with areserve_credits(user_id, reason="white_background") as credits:
+                    if has_genai:
+                        if not settings.GOOGLE_API_KEY or settings.GOOGLE_API_KEY == "your_api_key_here":
+                            raise Exception("GOOGLE_API_KEY not configured")
+
+                        client = get_genai_client()
+                        model_name = "gemini-2.5-flash-image-preview"
+
+                        contents = [
+                            {
+                                "parts": [
+                                    {"inline_data": {
+                                        "mime_type": "image/jpeg", "data": img_b64}},
+                                    {"text": text_prompt}
+                                ]
+                            }
+                        ]
+
+                        config = types.GenerateContentConfig(
+                            response_modalities=[types.Modality.IMAGE]
+                        )
 
-                    resp = client.models.generate_content(
-                        model=model_name,
-                        contents=contents,
-                        config=config
-                    )
+                        resp = await client.aio.models.generate_content(
+                            model=model_name,
+                            contents=contents,
+                            config=config
+                        )
 
-                    candidates = getattr(resp, "candidates", [])
-                    for cand in candidates:
-                        content = getattr(cand, "content", [])
-                        for part in content.parts if hasattr(content, "parts") else []:
-                            if getattr(part, "inline_data", None):
-                                data = part.inline_data.data
-                                generated_bytes = data if isinstance(
-                                    data, bytes) else base64.b64decode(data)
+                        candidates = getattr(resp, "candidates", [])
+                        for cand in candidates:
+                            content = getattr(cand, "content", [])
+                            for part in content.parts if hasattr(content, "parts") else []:
+                                if getattr(part, "inline_data", None):
+                                    data = part.inline_data.data
+                                    generated_bytes = data if isinstance(
+                                        data, bytes) else base64.b64decode(data)
+                                    break
+                            if generated_bytes:
                                 break
-                        if generated_bytes:
-                            break
 
-                    if not generated_bytes:
-                        messages.warning(
-                            request, "Gemini did not return an image. Using local fallback.")
+                        if not generated_bytes:
+                            messages.warning(
+                                request, "Gemini did not return an image. Using local fallback.")
 
-                # ---- Fallback ----
-                if not generated_bytes:
-                    original = Image.open(ornament.image.path).convert("RGB")
-                    img_array = np.array(original)
-                    img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-                    gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-                    blur = cv2.GaussianBlur(gray, (5, 5), 0)
-                    _, thresh = cv2.threshold(
-                        blur, 240, 255, cv2.THRESH_BINARY_INV)
-                    kernel = np.ones((3, 3), np.uint8)
-                    thresh = cv2.morphologyEx(
-                        thresh, cv2.MORPH_CLOSE, kernel, iterations=2)
-                    thresh = cv2.morphologyEx(
-                        thresh, cv2.MORPH_OPEN, kernel, iterations=1)
-                    contours, _ = cv2.findContours(
-                        thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                    if contours:
-                        largest_contour = max(contours, key=cv2.contourArea)
-                        mask = np.zeros_like(gray)
-                        cv2.drawContours(mask, [largest_contour], -1, 255, -1)
-                        mask = cv2.GaussianBlur(mask, (5, 5), 0)
-                        rgba_array = np.dstack((img_array, mask))
-                        transparent_img = Image.fromarray(rgba_array, 'RGBA')
-                        bg = Image.new("RGB", original.size, bg_color)
-                        bg.paste(transparent_img,
-                                 mask=transparent_img.split()[3])
-                        buf = BytesIO()
-                        bg.save(buf, format="JPEG", quality=95)
-                        generated_bytes = buf.getvalue()
-                    else:
-                        raise Exception(
-                            "Could not extract ornament using fallback method.")
-
-                # ---- Upload original and generated to Cloudinary ----
-                ornament_buf = BytesIO(img_bytes)
-                ornament_buf.seek(0)
-                upload_orig = cloudinary.uploader.upload(
-                    ornament_buf,
-                    folder="ornaments",
-                    public_id=f"ornament_original_{ornament.id}",
-                    overwrite=True
-                )
-                uploaded_image_url = upload_orig["secure_url"]
-
-                buf = BytesIO(generated_bytes)
-                buf.seek(0)
-                upload_gen = cloudinary.uploader.upload(
-                    buf,
-                    folder="ornaments",
-                    public_id=f"ornament_generated_{ornament.id}",
-                    overwrite=True
-                )
-                generated_image_url = upload_gen["secure_url"]
+                    # ---- Fallback ----
+                    if not generated_bytes:
+                        # The local fallback is not charged
+                        await run_sync(credits.refund)
+                        generated_bytes = await run_sync(
+                            extract_on_background, ornament.image.path, bg_color)
+                        if not generated_bytes:
+                            raise Exception(
+                                "Could not extract ornament using fallback method.")
+
+                    # ---- Upload original and generated to Cloudinary ----
+                    ornament_buf = BytesIO(img_bytes)
+                    ornament_buf.seek(0)
+                    upload_orig = await cloudinary_upload(
+                        ornament_buf,
+                        folder="ornaments",
+                        public_id=f"ornament_original_{ornament.id}",
+                        overwrite=True
+                    )
+                    uploaded_image_url = upload_orig["secure_url"]
+
+                    buf = BytesIO(generated_bytes)
+                    buf.seek(0)
+                    upload_gen = await cloudinary_upload(
+                        buf,
+                        folder="ornaments",
+                        public_id=f"ornament_generated_{ornament.id}",
+                        overwrite=True
+                    )
+                    generated_image_url = upload_gen["secure_url"]
 
-                # ---- Save in MongoDB ----
-                filename = f"{ornament.id}_generated.jpg"
-                ornament_doc = OrnamentMongo(
-                    prompt=text_prompt,
-                    uploaded_image_url=uploaded_image_url,
-                    generated_image_url=generated_image_url,
-                    uploaded_image_path=ornament.image.path,
-                    generated_image_path=filename,
-                    type="white_background",
-                    user_id=user_id,
-                    original_prompt=text_prompt
+                    # ---- Save in MongoDB ----
+                    filename = f"{ornament.id}_generated.jpg"
+                    ornament_doc = OrnamentMongo(
+                        prompt=text_prompt,
+                        uploaded_image_url=uploaded_image_url,
+                        generated_image_url=generated_image_url,
+                        uploaded_image_path=ornament.image.path,
+                        generated_image_path=filename,
+                        type="white_background",
+                        user_id=user_id,
+                        original_prompt=text_prompt
 
-                )
-                ornament_doc.save()
+                    )
+                    await run_sync(ornament_doc.save)
 
                 # Track image generation in history
                 try:
                     from probackendapp.history_utils import track_image_generation
-                    track_image_generation(
+                    await run_sync(
+                        track_image_generation,
                         user_id=user_id,
                         image_type="white_background",
                         image_url=generated_image_url,
@@ -963,11 +1025,10 @@ def upload_ornament(request):
                         }
                     )
                 except Exception as history_error:
-                    print(
-                        f"Error tracking image generation history: {history_error}")
+                    logger.exception("Error tracking image generation history")
 
                 # ---- Save locally in Django model ----
-                ornament.generated_image.save(
+                await sync_to_async(ornament.generated_image.save)(
                     filename, ContentFile(generated_bytes), save=True)
 
                 return JsonResponse({
@@ -980,12 +1041,14 @@ def upload_ornament(request):
                     "type": "white_background"
                 })
 
+            except InsufficientCredits as e:
+                return JsonResponse({"success": False, "error": str(e)}, status=402)
             except Exception as e:
-                traceback.print_exc()
+                logger.exception("Error in upload_ornament")
                 return JsonResponse({"success": False, "error": str(e)})
 
         else:
-            print("Form errors:", form.errors)
+            logger.warning("Form errors: %s", form.errors)
             return JsonResponse({"success": False, "error": "Invalid form submission"})
 
     return JsonResponse({"success": False, "error": "Invalid request method"})
@@ -993,14 +1056,15 @@ def upload_ornament(request):
 
 @csrf_exempt
 @authenticate
-def change_background(request):
+@rate_limit('generation')
+async def change_background(request):
     if request.method == "POST":
         # Get user from authentication middleware
         user = request.user
         user_id = str(user.id)
 
-        print("POST keys:", request.POST.keys())
-        print("FILES keys:", request.FILES.keys())
+        logger.debug("POST keys: %s", list(request.POST.keys()))
+        logger.debug("FILES keys: %s", list(request.FILES.keys()))
         form = BackgroundChangeForm(request.POST, request.FILES)
         if form.is_valid():
             ornament = form.cleaned_data['ornament_image']
@@ -1018,7 +1082,7 @@ def change_background(request):
                     for chunk in ornament.chunks():
                         dest.write(chunk)
 
-                uploaded_result = cloudinary.uploader.upload(
+                uploaded_result = await cloudinary_upload(
                     local_uploaded_path,
                     folder="ornaments_originals",
                     public_id=f"ornament_original_{os.path.splitext(ornament.name)[0]}",
@@ -1045,97 +1109,94 @@ def change_background(request):
                 user_prompt = prompt.strip()
 
                 if bg_color:
-                    color_prompt = get_prompt_from_db(
+                    color_prompt = await run_sync(
+                        get_prompt_from_db,
                         'images_background_change_with_color',
                         f" The background should be {bg_color}, but make sure to highlight the ornament and make it stand out and the background color should be the same as the {bg_color}.",
                         bg_color=bg_color
                     )
                     final_prompt = user_prompt + color_prompt
                 else:
-                    default_prompt = get_prompt_from_db(
+                    default_prompt = await run_sync(
+                        get_prompt_from_db,
                         'images_background_change_default',
                         " Change only the background without modifying the ornament."
                     )
                     final_prompt = user_prompt + \
                         (" " + default_prompt if user_prompt else default_prompt)
 
-                base_prompt = get_prompt_from_db(
+                base_prompt = await run_sync(
+                    get_prompt_from_db,
                     'images_background_change_base',
                     "Change the background of this ornament. {final_prompt}",
                     final_prompt=final_prompt
                 )
 
                 generated_bytes = None
-                if has_genai:
-                    client = genai.Client(api_key=settings.GOOGLE_API_KEY)
-                    model_name = "gemini-2.5-flash-image-preview"
-
-                    contents = [
-                        {"inline_data": {"mime_type": "image/jpeg", "data": img_b64}},
-                        {"text": base_prompt}
-                    ]
-                    if bg_b64:
-                        contents.append(
-                            {"inline_data": {"mime_type": "image/jpeg", "data": bg_b64}})
+                # Charged once the image is stored, refunded if anything before fails
+                async with areserve_credits(user_id, reason="background_change") as credits:
+                    if has_genai:
+                        client = get_genai_client()
+                        model_name = "gemini-2.5-flash-image-preview"
+
+                        contents = [
+                            {"inline_data": {"mime_type": "image/jpeg", "data": img_b64}},
+                            {"text": base_prompt}
+                        ]
+                        if bg_b64:
+                            contents.append(
+                                {"inline_data": {"mime_type": "image/jpeg", "data": bg_b64}})
+
+                        config = types.GenerateContentConfig(
+                            response_modalities=[types.Modality.IMAGE]
+                        )
 
-                    config = types.GenerateContentConfig(
-                        response_modalities=[types.Modality.IMAGE]
+                        resp = await client.aio.models.generate_content(
+                            model=model_name, contents=contents, config=config
+                        )
+                        candidate = resp.candidates[0]
+                        for part in candidate.content.parts:
+                            if part.inline_data:
+                                data = part.inline_data.data
+                                generated_bytes = data if isinstance(
+                                    data, bytes) else base64.b64decode(data)
+                                break
+                        if not generated_bytes:
+                            raise Exception(
+                                "Gemini response had no image inline_data")
+                    else:
+                        # The local compositing is not charged
+                        await run_sync(credits.refund)
+                        generated_bytes = await run_sync(
+                            composite_on_background, ornament_img, bg_b64, bg_color)
+
+                    gen_dir = os.path.join(
+                        settings.MEDIA_ROOT, "generated_ornaments")
+                    os.makedirs(gen_dir, exist_ok=True)
+                    local_generated_path = os.path.join(
+                        gen_dir, f"generated_{ornament.name}")
+                    with open(local_generated_path, "wb") as f:
+                        f.write(generated_bytes)
+
+                    upload_result = await cloudinary_upload(
+                        local_generated_path,
+                        folder="ornaments_bg_change",
+                        public_id=f"ornament_bg_{os.path.splitext(ornament.name)[0]}",
+                        overwrite=True
                     )
-
-                    resp = client.models.generate_content(
-                        model=model_name, contents=contents, config=config
+                    generated_url = upload_result['secure_url']
+
+                    ornament_doc = OrnamentMongo(
+                        prompt=prompt,
+                        uploaded_image_url=uploaded_url,
+                        generated_image_url=generated_url,
+                        uploaded_image_path=local_uploaded_path,
+                        generated_image_path=local_generated_path,
+                        type="background_change",
+                        user_id=user_id,
+                        original_prompt=prompt
                     )
-                    candidate = resp.candidates[0]
-                    for part in candidate.content.parts:
-                        if part.inline_data:
-                            data = part.inline_data.data
-                            generated_bytes = data if isinstance(
-                                data, bytes) else base64.b64decode(data)
-                            break
-                    if not generated_bytes:
-                        raise Exception(
-                            "Gemini response had no image inline_data")
-                else:
-                    if bg_b64:
-                        bg_img = Image.open(
-                            BytesIO(base64.b64decode(bg_b64))).convert("RGB")
-                        bg_img = bg_img.resize(ornament_img.size)
-                    else:
-                        bg_img = Image.new(
-                            "RGB", ornament_img.size, bg_color or (255, 255, 255))
-                    bg_img.paste(ornament_img, (0, 0),
-                                 ornament_img.convert("RGBA"))
-                    buf = BytesIO()
-                    bg_img.save(buf, format="JPEG", quality=95)
-                    generated_bytes = buf.getvalue()
-
-                gen_dir = os.path.join(
-                    settings.MEDIA_ROOT, "generated_ornaments")
-                os.makedirs(gen_dir, exist_ok=True)
-                local_generated_path = os.path.join(
-                    gen_dir, f"generated_{ornament.name}")
-                with open(local_generated_path, "wb") as f:
-                    f.write(generated_bytes)
-
-                upload_result = cloudinary.uploader.upload(
-                    local_generated_path,
-                    folder="ornaments_bg_change",
-                    public_id=f"ornament_bg_{os.path.splitext(ornament.name)[0]}",
-                    overwrite=True
-                )
-                generated_url = upload_result['secure_url']
-
-                ornament_doc = OrnamentMongo(
-                    prompt=prompt,
-                    uploaded_image_url=uploaded_url,
-                    generated_image_url=generated_url,
-                    uploaded_image_path=local_uploaded_path,
-                    generated_image_path=local_generated_path,
-                    type="background_change",
-                    user_id=user_id,
-                    original_prompt=prompt
-                )
-                ornament_doc.save()
+                    await run_sync(ornament_doc.save)
 
                 return JsonResponse({
                     "success": True,
@@ -1147,8 +1208,10 @@ def change_background(request):
                     "type": "background_change"
                 })
 
+            except InsufficientCredits as e:
+                return JsonResponse({"success": False, "error": str(e)}, status=402)
             except Exception as e:
-                traceback.print_exc()
+                logger.exception("Error in change_background")
                 return JsonResponse({"success": False, "error": str(e)})
 
         else:
@@ -1159,7 +1222,8 @@ def change_background(request):
 
 @csrf_exempt
 @authenticate
-def generate_model_with_ornament(request):
+@rate_limit('generation')
+async def generate_model_with_ornament(request):
     if request.method == 'POST':
         # Get user from authentication middleware
         user = request.user
@@ -1169,12 +1233,13 @@ def generate_model_with_ornament(request):
             ornament_img = request.FILES.get('ornament_image')
             pose_img = request.FILES.get('pose_style')
             prompt = request.POST.get('prompt', '')
-            print(prompt)
+            logger.debug("Prompt: %s", prompt)
             measurements = request.POST.get('measurements', '')
             ornament_type = request.POST.get('ornament_type', '')
             ornament_measurements = request.POST.get(
                 'ornament_measurements', '{}')
-            print(ornament_type, ornament_measurements)
+            logger.debug(
+                "Ornament type: %s, measurements: %s", ornament_type, ornament_measurements)
 
             if not ornament_img:
                 return JsonResponse({"error": "Please upload an ornament image."}, status=400)
@@ -1189,7 +1254,7 @@ def generate_model_with_ornament(request):
                     dest.write(chunk)
 
             # STEP 2: Upload ornament to Cloudinary
-            uploaded_result = cloudinary.uploader.upload(
+            uploaded_result = await cloudinary_upload(
                 local_uploaded_path,
                 folder="ornaments_originals",
                 public_id=f"ornament_original_{os.path.splitext(ornament_img.name)[0]}",
@@ -1209,117 +1274,120 @@ def generate_model_with_ornament(request):
 
             generated_bytes = None
 
-            if has_genai:
-                client = genai.Client(api_key=settings.GOOGLE_API_KEY)
-                model_name = "gemini-2.5-flash-image-preview"
-
-                contents = [
-                    {"inline_data": {"mime_type": "image/jpeg", "data": ornament_b64}},
-                ]
-                if pose_b64:
-                    contents.append(
-                        {"inline_data": {"mime_type": "image/jpeg", "data": pose_b64}}
-                    )
+            # Charged once the image is stored, refunded if anything before fails
+            async with areserve_credits(user_id, reason="model_with_ornament"):
+                if has_genai:
+                    client = get_genai_client()
+                    model_name = "gemini-2.5-flash-image-preview"
 
-                # Parse ornament measurements
-                import json
-                try:
-                    ornament_measurements_dict = json.loads(
-                        ornament_measurements) if ornament_measurements else {}
-                except:
-                    ornament_measurements_dict = {}
-
-                # Build ornament type and measurements description
-                ornament_description = ""
-                if ornament_type:
-                    ornament_description += f"This is a {ornament_type}. "
-                if ornament_measurements_dict:
-                    measurements_text = ", ".join(
-                        [f"{key}: {value}" for key, value in ornament_measurements_dict.items() if value])
-                    if measurements_text:
-                        ornament_description += f"Specific measurements: {measurements_text}. "
+                    contents = [
+                        {"inline_data": {"mime_type": "image/jpeg", "data": ornament_b64}},
+                    ]
+                    if pose_b64:
+                        contents.append(
+                            {"inline_data": {"mime_type": "image/jpeg", "data": pose_b64}}
+                        )
 
-                # Get prompt from database
-                from probackendapp.prompt_initializer import get_prompt_from_db
-                measurements_text = f"measurements: {measurements}. " if measurements else ""
-                default_prompt = (
-                    "Generate a close-up, high-fashion portrait of an elegant Indian woman "
-                    "wearing this 100% real accurate uploaded ornament. Focus tightly on the neckline and jewelry area according to the ornament. "
-                    "Ensure the jewelry fits naturally and realistically on the model. "
-                    "Lighting should be soft and natural, highlighting the sparkle of the jewelry and the model's features. "
-                    "Use a shallow depth of field with a softly blurred background that hints at an elegant setting. "
-                    "Do not include any watermark, text, or unnatural effects. "
-                    f"{ornament_description}"
-                    f"{measurements_text}Make sure to follow the measurements strictly.\n"
-                    f"mandatory consideration details: {prompt}"
-                )
-                user_prompt = get_prompt_from_db(
-                    'images_model_with_ornament',
-                    default_prompt,
-                    ornament_description=ornament_description,
-                    measurements_text=measurements_text,
-                    user_prompt=prompt
-                )
-                print("user_prompt", user_prompt)
+                    # Parse ornament measurements
+                    import json
+                    try:
+                        ornament_measurements_dict = json.loads(
+                            ornament_measurements) if ornament_measurements else {}
+                    except:
+                        ornament_measurements_dict = {}
+
+                    # Build ornament type and measurements description
+                    ornament_description = ""
+                    if ornament_type:
+                        ornament_description += f"This is a {ornament_type}. "
+                    if ornament_measurements_dict:
+                        measurements_text = ", ".join(
+                            [f"{key}: {value}" for key, value in ornament_measurements_dict.items() if value])
+                        if measurements_text:
+                            ornament_description += f"Specific measurements: {measurements_text}. "
+
+                    # Get prompt from database
+                    from probackendapp.prompt_initializer import get_prompt_from_db
+                    measurements_text = f"measurements: {measurements}. " if measurements else ""
+                    default_prompt = (
+                        "Generate a close-up, high-fashion portrait of an elegant Indian woman "
+                        "wearing this 100% real accurate uploaded ornament. Focus tightly on the neckline and jewelry area according to the ornament. "
+                        "Ensure the jewelry fits naturally and realistically on the model. "
+                        "Lighting should be soft and natural, highlighting the sparkle of the jewelry and the model's features. "
+                        "Use a shallow depth of field with a softly blurred background that hints at an elegant setting. "
+                        "Do not include any watermark, text, or unnatural effects. "
+                        f"{ornament_description}"
+                        f"{measurements_text}Make sure to follow the measurements strictly.\n"
+                        f"mandatory consideration details: {prompt}"
+                    )
+                    user_prompt = await run_sync(
+                        get_prompt_from_db,
+                        'images_model_with_ornament',
+                        default_prompt,
+                        ornament_description=ornament_description,
+                        measurements_text=measurements_text,
+                        user_prompt=prompt
+                    )
+                    logger.debug("User prompt: %s", user_prompt)
 
-                contents.append({"text": user_prompt})
+                    contents.append({"text": user_prompt})
 
-                config = types.GenerateContentConfig(
-                    response_modalities=[types.Modality.IMAGE]
-                )
+                    config = types.GenerateContentConfig(
+                        response_modalities=[types.Modality.IMAGE]
+                    )
 
-                resp = client.models.generate_content(
-                    model=model_name,
-                    contents=contents,
-                    config=config
-                )
+                    resp = await client.aio.models.generate_content(
+                        model=model_name,
+                        contents=contents,
+                        config=config
+                    )
 
-                candidate = resp.candidates[0]
-                for part in candidate.content.parts:
-                    if part.inline_data:
-                        data = part.inline_data.data
-                        generated_bytes = (
-                            data if isinstance(data, bytes)
-                            else base64.b64decode(data)
-                        )
-                        break
+                    candidate = resp.candidates[0]
+                    for part in candidate.content.parts:
+                        if part.inline_data:
+                            data = part.inline_data.data
+                            generated_bytes = (
+                                data if isinstance(data, bytes)
+                                else base64.b64decode(data)
+                            )
+                            break
 
-                if not generated_bytes:
-                    raise Exception("No image returned from Gemini")
+                    if not generated_bytes:
+                        raise Exception("No image returned from Gemini")
 
-            else:
-                raise Exception("Gemini SDK not available or misconfigured.")
+                else:
+                    raise Exception("Gemini SDK not available or misconfigured.")
 
-            # STEP 4: Save generated image locally
-            gen_dir = os.path.join(settings.MEDIA_ROOT, "generated_ornaments")
-            os.makedirs(gen_dir, exist_ok=True)
-            local_generated_path = os.path.join(
-                gen_dir, f"generated_{ornament_img.name}")
+                # STEP 4: Save generated image locally
+                gen_dir = os.path.join(settings.MEDIA_ROOT, "generated_ornaments")
+                os.makedirs(gen_dir, exist_ok=True)
+                local_generated_path = os.path.join(
+                    gen_dir, f"generated_{ornament_img.name}")
 
-            with open(local_generated_path, "wb") as f:
-                f.write(generated_bytes)
+                with open(local_generated_path, "wb") as f:
+                    f.write(generated_bytes)
 
-            # STEP 5: Upload generated image to Cloudinary
-            upload_result = cloudinary.uploader.upload(
-                local_generated_path,
-                folder="model_ornament",
-                public_id=f"ornament_generated_{os.path.splitext(ornament_img.name)[0]}",
-                overwrite=True
-            )
-            generated_url = upload_result['secure_url']
+                # STEP 5: Upload generated image to Cloudinary
+                upload_result = await cloudinary_upload(
+                    local_generated_path,
+                    folder="model_ornament",
+                    public_id=f"ornament_generated_{os.path.splitext(ornament_img.name)[0]}",
+                    overwrite=True
+                )
+                generated_url = upload_result['secure_url']
 
-            # STEP 6: Save to MongoDB
-            ornament_doc = OrnamentMongo(
-                prompt=prompt,
-                uploaded_image_url=uploaded_url,
-                generated_image_url=generated_url,
-                uploaded_image_path=local_uploaded_path,
-                generated_image_path=local_generated_path,
-                type="model_with_ornament",
-                user_id=user_id,
-                original_prompt=prompt
-            )
-            ornament_doc.save()
+                # STEP 6: Save to MongoDB
+                ornament_doc = OrnamentMongo(
+                    prompt=prompt,
+                    uploaded_image_url=uploaded_url,
+                    generated_image_url=generated_url,
+                    uploaded_image_path=local_uploaded_path,
+                    generated_image_path=local_generated_path,
+                    type="model_with_ornament",
+                    user_id=user_id,
+                    original_prompt=prompt
+                )
+                await run_sync(ornament_doc.save)
 
             return JsonResponse({
                 "status": "success",
@@ -1332,8 +1400,10 @@ def generate_model_with_ornament(request):
                 "type": "model_with_ornament"
             }, status=200)
 
+        except InsufficientCredits as e:
+            return JsonResponse({"status": "error", "message": str(e)}, status=402)
         except Exception as e:
-            traceback.print_exc()
+            logger.exception("Error in generate_model_with_ornament")
             return JsonResponse({"status": "error", "message": str(e)}, status=500)
 
     return JsonResponse({"error": "Invalid request method. Use POST."}, status=405)
@@ -1345,7 +1415,8 @@ def generate_model_with_ornament(request):
 
 @csrf_exempt
 @authenticate
-def generate_real_model_with_ornament(request):
+@rate_limit('generation')
+async def generate_real_model_with_ornament(request):
     """
     Generate an AI image of a real uploaded model wearing the uploaded ornament.
     Ensures output is realistic, jewelry-focused, and high-quality.
@@ -1388,18 +1459,20 @@ def generate_real_model_with_ornament(request):
                 for chunk in ornament_img.chunks():
                     dest.write(chunk)
 
-            # === STEP 2: Upload both to Cloudinary ===
-            model_upload = cloudinary.uploader.upload(
-                local_model_path,
-                folder="models_originals",
-                public_id=f"model_original_{os.path.splitext(model_img.name)[0]}",
-                overwrite=True
-            )
-            ornament_upload = cloudinary.uploader.upload(
-                local_ornament_path,
-                folder="ornaments_originals",
-                public_id=f"ornament_original_{os.path.splitext(ornament_img.name)[0]}",
-                overwrite=True
+            # === STEP 2: Upload both to Cloudinary, at the same time ===
+            model_upload, ornament_upload = await asyncio.gather(
+                cloudinary_upload(
+                    local_model_path,
+                    folder="models_originals",
+                    public_id=f"model_original_{os.path.splitext(model_img.name)[0]}",
+                    overwrite=True
+                ),
+                cloudinary_upload(
+                    local_ornament_path,
+                    folder="ornaments_originals",
+                    public_id=f"ornament_original_{os.path.splitext(ornament_img.name)[0]}",
+                    overwrite=True
+                )
             )
 
             model_url = model_upload["secure_url"]
@@ -1419,113 +1492,116 @@ def generate_real_model_with_ornament(request):
             generated_bytes = None
 
             # === STEP 4: Generate AI image ===
-            if has_genai:
-                client = genai.Client(api_key=settings.GOOGLE_API_KEY)
-                model_name = "gemini-2.5-flash-image-preview"
-
-                contents = [
-                    {"inline_data": {"mime_type": "image/jpeg", "data": ornament_b64}},
-                    {"inline_data": {"mime_type": "image/jpeg", "data": model_b64}},
-                ]
-                if pose_b64:
-                    contents.append(
-                        {"inline_data": {"mime_type": "image/jpeg", "data": pose_b64}})
-
-                # Parse ornament measurements
-                import json
-                try:
-                    ornament_measurements_dict = json.loads(
-                        ornament_measurements) if ornament_measurements else {}
-                except:
-                    ornament_measurements_dict = {}
-
-                # Build ornament type and measurements description
-                ornament_description = ""
-                if ornament_type:
-                    ornament_description += f"This is a {ornament_type}. "
-                if ornament_measurements_dict:
-                    measurements_text = ", ".join(
-                        [f"{key}: {value}" for key, value in ornament_measurements_dict.items() if value])
-                    if measurements_text:
-                        ornament_description += f"Specific measurements: {measurements_text}. "
+            # Charged once the image is stored, refunded if anything before fails
+            async with areserve_credits(user_id, reason="real_model_with_ornament"):
+                if has_genai:
+                    client = get_genai_client()
+                    model_name = "gemini-2.5-flash-image-preview"
 
-                # Get prompt from database
-                from probackendapp.prompt_initializer import get_prompt_from_db
-                measurements_text = f"Additional measurements: {measurements}. " if measurements else ""
-                default_prompt = (
-                    "Generate a realistic, high-quality close-up image of the uploaded model wearing "
-                    "the exact uploaded ornament. Keep the model's face fully intact and recognizable. "
-                    "Ensure the ornament fits naturally and realistically on the model. "
-                    "Generate a background suitable for both the model and the ornament. "
-                    "Lighting should be soft, natural, and elegant. "
-                    "Focus tightly on the jewelry area. "
-                    "Follow the pose from the uploaded pose image if provided. "
-                    f"{ornament_description}"
-                    f"{measurements_text}"
-                    f"Additional user instructions: {prompt}"
-                )
-                user_prompt = get_prompt_from_db(
-                    'images_real_model_with_ornament',
-                    default_prompt,
-                    ornament_description=ornament_description,
-                    measurements_text=measurements_text,
-                    user_prompt=prompt
-                )
+                    contents = [
+                        {"inline_data": {"mime_type": "image/jpeg", "data": ornament_b64}},
+                        {"inline_data": {"mime_type": "image/jpeg", "data": model_b64}},
+                    ]
+                    if pose_b64:
+                        contents.append(
+                            {"inline_data": {"mime_type": "image/jpeg", "data": pose_b64}})
+
+                    # Parse ornament measurements
+                    import json
+                    try:
+                        ornament_measurements_dict = json.loads(
+                            ornament_measurements) if ornament_measurements else {}
+                    except:
+                        ornament_measurements_dict = {}
+
+                    # Build ornament type and measurements description
+                    ornament_description = ""
+                    if ornament_type:
+                        ornament_description += f"This is a {ornament_type}. "
+                    if ornament_measurements_dict:
+                        measurements_text = ", ".join(
+                            [f"{key}: {value}" for key, value in ornament_measurements_dict.items() if value])
+                        if measurements_text:
+                            ornament_description += f"Specific measurements: {measurements_text}. "
+
+                    # Get prompt from database
+                    from probackendapp.prompt_initializer import get_prompt_from_db
+                    measurements_text = f"Additional measurements: {measurements}. " if measurements else ""
+                    default_prompt = (
+                        "Generate a realistic, high-quality close-up image of the uploaded model wearing "
+                        "the exact uploaded ornament. Keep the model's face fully intact and recognizable. "
+                        "Ensure the ornament fits naturally and realistically on the model. "
+                        "Generate a background suitable for both the model and the ornament. "
+                        "Lighting should be soft, natural, and elegant. "
+                        "Focus tightly on the jewelry area. "
+                        "Follow the pose from the uploaded pose image if provided. "
+                        f"{ornament_description}"
+                        f"{measurements_text}"
+                        f"Additional user instructions: {prompt}"
+                    )
+                    user_prompt = await run_sync(
+                        get_prompt_from_db,
+                        'images_real_model_with_ornament',
+                        default_prompt,
+                        ornament_description=ornament_description,
+                        measurements_text=measurements_text,
+                        user_prompt=prompt
+                    )
 
-                contents.append({"text": user_prompt})
-                config = types.GenerateContentConfig(
-                    response_modalities=[types.Modality.IMAGE])
+                    contents.append({"text": user_prompt})
+                    config = types.GenerateContentConfig(
+                        response_modalities=[types.Modality.IMAGE])
 
-                resp = client.models.generate_content(
-                    model=model_name, contents=contents, config=config)
-                candidate = resp.candidates[0]
+                    resp = await client.aio.models.generate_content(
+                        model=model_name, contents=contents, config=config)
+                    candidate = resp.candidates[0]
 
-                for part in candidate.content.parts:
-                    if part.inline_data:
-                        data = part.inline_data.data
-                        generated_bytes = data if isinstance(
-                            data, bytes) else base64.b64decode(data)
-                        break
+                    for part in candidate.content.parts:
+                        if part.inline_data:
+                            data = part.inline_data.data
+                            generated_bytes = data if isinstance(
+                                data, bytes) else base64.b64decode(data)
+                            break
 
-                if not generated_bytes:
-                    raise Exception("No image returned from Gemini")
+                    if not generated_bytes:
+                        raise Exception("No image returned from Gemini")
 
-            else:
-                raise Exception(
-                    "Gemini SDK not available. Please install or configure it.")
+                else:
+                    raise Exception(
+                        "Gemini SDK not available. Please install or configure it.")
 
-            # === STEP 5: Save generated image locally ===
-            generated_dir = os.path.join(
-                settings.MEDIA_ROOT, "generated_models")
-            os.makedirs(generated_dir, exist_ok=True)
-            local_generated_path = os.path.join(
-                generated_dir, f"generated_{model_img.name}")
+                # === STEP 5: Save generated image locally ===
+                generated_dir = os.path.join(
+                    settings.MEDIA_ROOT, "generated_models")
+                os.makedirs(generated_dir, exist_ok=True)
+                local_generated_path = os.path.join(
+                    generated_dir, f"generated_{model_img.name}")
 
-            with open(local_generated_path, "wb") as f:
-                f.write(generated_bytes)
+                with open(local_generated_path, "wb") as f:
+                    f.write(generated_bytes)
 
-            # === STEP 6: Upload generated image to Cloudinary ===
-            upload_result = cloudinary.uploader.upload(
-                local_generated_path,
-                folder="real_model_output",
-                public_id=f"model_generated_{os.path.splitext(model_img.name)[0]}",
-                overwrite=True
-            )
-            generated_url = upload_result["secure_url"]
+                # === STEP 6: Upload generated image to Cloudinary ===
+                upload_result = await cloudinary_upload(
+                    local_generated_path,
+                    folder="real_model_output",
+                    public_id=f"model_generated_{os.path.splitext(model_img.name)[0]}",
+                    overwrite=True
+                )
+                generated_url = upload_result["secure_url"]
 
-            # === STEP 7: Save to MongoDB ===
-            ornament_doc = OrnamentMongo(
-                prompt=prompt,
-                model_image_url=model_url,  # main input model image
-                uploaded_image_url=ornament_url,  # optionally add this field in your model
-                generated_image_url=generated_url,
-                uploaded_image_path=local_model_path,
-                generated_image_path=local_generated_path,
-                type="real_model_with_ornament",
-                user_id=user_id,
-                original_prompt=prompt
-            )
-            ornament_doc.save()
+                # === STEP 7: Save to MongoDB ===
+                ornament_doc = OrnamentMongo(
+                    prompt=prompt,
+                    model_image_url=model_url,  # main input model image
+                    uploaded_image_url=ornament_url,  # optionally add this field in your model
+                    generated_image_url=generated_url,
+                    uploaded_image_path=local_model_path,
+                    generated_image_path=local_generated_path,
+                    type="real_model_with_ornament",
+                    user_id=user_id,
+                    original_prompt=prompt
+                )
+                await run_sync(ornament_doc.save)
 
             # === STEP 8: Return response ===
             return JsonResponse({
@@ -1540,8 +1616,10 @@ def generate_real_model_with_ornament(request):
                 "type": "real_model_with_ornament"
             }, status=200)
 
+        except InsufficientCredits as e:
+            return JsonResponse({"status": "error", "message": str(e)}, status=402)
         except Exception as e:
-            traceback.print_exc()
+            logger.exception("Error in generate_real_model_with_ornament")
             return JsonResponse({"status": "error", "message": str(e)}, status=500)
 
     return JsonResponse({"error": "Invalid request method. Use POST."}, status=405)
@@ -1549,7 +1627,8 @@ def generate_real_model_with_ornament(request):
 
 @csrf_exempt
 @authenticate
-def generate_campaign_shot_advanced(request):
+@rate_limit('generation')
+async def generate_campaign_shot_advanced(request):
     if request.method != 'POST':
         return JsonResponse({"error": "Invalid request method. Use POST."}, status=405)
 
@@ -1573,17 +1652,11 @@ def generate_campaign_shot_advanced(request):
             return JsonResponse({"error": "Please upload a model image for Real Model option."}, status=400)
 
         # === Upload ornaments to Cloudinary & encode ===
-        ornament_urls = []
         ornament_b64_list = []
         for idx, ornament in enumerate(ornaments):
             ornament_bytes = ornament.read()
             ornament.seek(0)
 
-            # Upload
-            result = cloudinary.uploader.upload(
-                ornament, folder="ornaments", overwrite=True)
-            ornament_urls.append(result['secure_url'])
-
             # Encode
             ornament_name = ornament_names[idx] if idx < len(
                 ornament_names) else f"Ornament {idx+1}"
@@ -1598,11 +1671,18 @@ def generate_campaign_shot_advanced(request):
         if model_img:
             model_bytes = model_img.read()
             model_img.seek(0)
-            model_upload = cloudinary.uploader.upload(
-                model_img, folder="models", overwrite=True)
-            model_url = model_upload['secure_url']
             model_b64 = base64.b64encode(model_bytes).decode('utf-8')
 
+        # Upload all the ornaments (and the model) at the same time
+        uploads = [cloudinary_upload(ornament, folder="ornaments", overwrite=True)
+                   for ornament in ornaments]
+        if model_img:
+            uploads.append(cloudinary_upload(model_img, folder="models", overwrite=True))
+        results = await asyncio.gather(*uploads)
+        ornament_urls = [result['secure_url'] for result in results[:len(ornaments)]]
+        if model_img:
+            model_url = results[-1]['secure_url']
+
         # === Theme images encoding ===
         theme_b64_list = []
         for theme in theme_images:
@@ -1619,7 +1699,7 @@ def generate_campaign_shot_advanced(request):
                 "Gemini SDK not available. Please install or configure it.")
 
         # === Build Gemini request ===
-        client = genai.Client(api_key=settings.GOOGLE_API_KEY)
+        client = get_genai_client()
         model_name = "gemini-2.5-flash-image-preview"
 
         # Build parts array
@@ -1654,7 +1734,8 @@ def generate_campaign_shot_advanced(request):
                 "Preserve the model's facial features and natural pose while making a small smile. "
                 f"Campaign instructions: {prompt}"
             )
-            user_prompt = get_prompt_from_db(
+            user_prompt = await run_sync(
+                get_prompt_from_db,
                 'images_campaign_shot_real',
                 default_prompt,
                 user_prompt=prompt
@@ -1665,7 +1746,8 @@ def generate_campaign_shot_advanced(request):
                 "Use realistic lighting, texture, and cohesive fashion aesthetics. "
                 f"Campaign instructions: {prompt}"
             )
-            user_prompt = get_prompt_from_db(
+            user_prompt = await run_sync(
+                get_prompt_from_db,
                 'images_campaign_shot_ai',
                 default_prompt,
                 user_prompt=prompt
@@ -1681,41 +1763,43 @@ def generate_campaign_shot_advanced(request):
         )
 
         # === Generate via Gemini ===
-        resp = client.models.generate_content(
-            model=model_name, contents=contents, config=config)
-        candidate = resp.candidates[0]
+        # Charged once the image is stored, refunded if anything before fails
+        async with areserve_credits(user_id, reason="campaign_shot_advanced"):
+            resp = await client.aio.models.generate_content(
+                model=model_name, contents=contents, config=config)
+            candidate = resp.candidates[0]
 
-        generated_bytes = None
-        for part in candidate.content.parts:
-            if getattr(part, "inline_data", None):
-                data = part.inline_data.data
-                generated_bytes = data if isinstance(
-                    data, bytes) else base64.b64decode(data)
-                break
-
-        if not generated_bytes:
-            raise Exception("No image returned from Gemini")
-
-        # === Upload generated image ===
-        buf = BytesIO(generated_bytes)
-        buf.seek(0)
-        upload_result = cloudinary.uploader.upload(
-            buf, folder="campaign_shots", overwrite=True)
-        generated_url = upload_result['secure_url']
-
-        # === Save record to MongoDB ===
-        ornament_doc = OrnamentMongo(
-            prompt=prompt,
-            type="campaign_shot_advanced",
-            model_image_url=model_url,
-            uploaded_ornament_urls=ornament_urls,
-            generated_image_url=generated_url,
-            uploaded_image_path="Multiple ornaments",
-            generated_image_path=f"media/generated/campaign_{len(ornaments)}.jpg",
-            user_id=user_id,
-            original_prompt=prompt
-        )
-        ornament_doc.save()
+            generated_bytes = None
+            for part in candidate.content.parts:
+                if getattr(part, "inline_data", None):
+                    data = part.inline_data.data
+                    generated_bytes = data if isinstance(
+                        data, bytes) else base64.b64decode(data)
+                    break
+
+            if not generated_bytes:
+                raise Exception("No image returned from Gemini")
+
+            # === Upload generated image ===
+            buf = BytesIO(generated_bytes)
+            buf.seek(0)
+            upload_result = await cloudinary_upload(
+                buf, folder="campaign_shots", overwrite=True)
+            generated_url = upload_result['secure_url']
+
+            # === Save record to MongoDB ===
+            ornament_doc = OrnamentMongo(
+                prompt=prompt,
+                type="campaign_shot_advanced",
+                model_image_url=model_url,
+                uploaded_ornament_urls=ornament_urls,
+                generated_image_url=generated_url,
+                uploaded_image_path="Multiple ornaments",
+                generated_image_path=f"media/generated/campaign_{len(ornaments)}.jpg",
+                user_id=user_id,
+                original_prompt=prompt
+            )
+            await run_sync(ornament_doc.save)
 
         return JsonResponse({
             "status": "success",
@@ -1730,14 +1814,17 @@ def generate_campaign_shot_advanced(request):
             "type": "campaign_shot_advanced"
         }, status=200)
 
+    except InsufficientCredits as e:
+        return JsonResponse({"status": "error", "message": str(e)}, status=402)
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Error in generate_campaign_shot_advanced")
         return JsonResponse({"status": "error", "message": str(e)}, status=500)
 
 
 @csrf_exempt
 @authenticate
-def regenerate_image(request):
+@rate_limit('generation')
+async def regenerate_image(request):
     """
     Regenerate an image from a previously generated image.
     Works for all image types. Combines the original prompt with the new prompt.
@@ -1755,7 +1842,7 @@ def regenerate_image(request):
         # MongoDB ID of the image to regenerate
         image_id = request.POST.get('image_id')
         new_prompt = request.POST.get('prompt', '').strip()
-        print(new_prompt)
+        logger.debug("New prompt: %s", new_prompt)
 
         if not image_id:
             return JsonResponse({"error": "image_id is required"}, status=400)
@@ -1763,13 +1850,13 @@ def regenerate_image(request):
         if not new_prompt:
             return JsonResponse({"error": "New prompt is required"}, status=400)
 
-        # Fetch the previous image record from MongoDB
+        # Fetch the previous image record from MongoDB, or from the archive
         try:
-            prev_doc = OrnamentMongo.objects.get(id=ObjectId(image_id))
-        except OrnamentMongo.DoesNotExist:
-            return JsonResponse({"error": "Image record not found"}, status=404)
+            prev_doc = await run_sync(get_document, OrnamentMongo, ObjectId(image_id))
         except Exception as e:
             return JsonResponse({"error": f"Invalid image_id: {str(e)}"}, status=400)
+        if prev_doc is None:
+            return JsonResponse({"error": "Image record not found"}, status=404)
 
         # Verify that the image belongs to the user (security check)
         if prev_doc.user_id != user_id:
@@ -1781,124 +1868,102 @@ def regenerate_image(request):
         # Combine the original prompt with the new prompt
         original_prompt = prev_doc.original_prompt or prev_doc.prompt
         combined_prompt = f"{original_prompt}. {new_prompt}"
-        print("combined_prompt", combined_prompt)
+        logger.debug("Combined prompt: %s", combined_prompt)
 
         # Download the previous generated image from Cloudinary
-        with urlopen(prev_generated_url) as resp:
-            img_bytes = resp.read()
+        img_bytes = await fetch_bytes(prev_generated_url)
         img_b64 = base64.b64encode(img_bytes).decode("utf-8")
 
         # Generate new image using Gemini
         generated_bytes = None
 
-        if has_genai:
-            if not settings.GOOGLE_API_KEY or settings.GOOGLE_API_KEY == 'your_api_key_here':
-                raise Exception("GOOGLE_API_KEY not configured")
+        # Charged once the image is stored, refunded if anything before fails
+        async with areserve_credits(user_id, reason=f"{prev_doc.type}_regenerated") as credits:
+            if has_genai:
+                if not settings.GOOGLE_API_KEY or settings.GOOGLE_API_KEY == 'your_api_key_here':
+                    raise Exception("GOOGLE_API_KEY not configured")
 
-            client = genai.Client(api_key=settings.GOOGLE_API_KEY)
-            model_name = "gemini-2.5-flash-image-preview"
+                client = get_genai_client()
+                model_name = "gemini-2.5-flash-image-preview"
 
-            contents = [
-                {"inline_data": {"mime_type": "image/jpeg", "data": img_b64}},
-                {"text": combined_prompt}
-            ]
+                contents = [
+                    {"inline_data": {"mime_type": "image/jpeg", "data": img_b64}},
+                    {"text": combined_prompt}
+                ]
 
-            config = types.GenerateContentConfig(
-                response_modalities=[types.Modality.IMAGE]
-            )
+                config = types.GenerateContentConfig(
+                    response_modalities=[types.Modality.IMAGE]
+                )
 
-            resp = client.models.generate_content(
-                model=model_name,
-                contents=contents,
-                config=config
-            )
+                resp = await client.aio.models.generate_content(
+                    model=model_name,
+                    contents=contents,
+                    config=config
+                )
 
-            candidate = resp.candidates[0]
-            for part in candidate.content.parts:
-                if getattr(part, 'inline_data', None):
-                    data = part.inline_data.data
-                    generated_bytes = data if isinstance(
-                        data, bytes) else base64.b64decode(data)
-                    break
+                candidate = resp.candidates[0]
+                for part in candidate.content.parts:
+                    if getattr(part, 'inline_data', None):
+                        data = part.inline_data.data
+                        generated_bytes = data if isinstance(
+                            data, bytes) else base64.b64decode(data)
+                        break
 
-            if not generated_bytes:
-                raise Exception("Gemini response had no image inline_data")
-        else:
-            # Fallback: Use OpenCV/PIL processing
-            original = Image.open(BytesIO(img_bytes)).convert("RGB")
-            img_array = np.array(original)
-            img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-            gray = cv2.cvtColor(img_bgr, cv2.COLOR_BGR2GRAY)
-            blur = cv2.GaussianBlur(gray, (5, 5), 0)
-            _, thresh = cv2.threshold(blur, 240, 255, cv2.THRESH_BINARY_INV)
-
-            kernel = np.ones((3, 3), np.uint8)
-            thresh = cv2.morphologyEx(
-                thresh, cv2.MORPH_CLOSE, kernel, iterations=2)
-            thresh = cv2.morphologyEx(
-                thresh, cv2.MORPH_OPEN, kernel, iterations=1)
-
-            contours, _ = cv2.findContours(
-                thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            if contours:
-                largest_contour = max(contours, key=cv2.contourArea)
-                mask = np.zeros_like(gray)
-                cv2.drawContours(mask, [largest_contour], -1, 255, -1)
-                mask = cv2.GaussianBlur(mask, (5, 5), 0)
-                rgba_array = np.dstack((img_array, mask))
-                transparent_img = Image.fromarray(rgba_array, 'RGBA')
-                white_bg = Image.new("RGB", original.size, (255, 255, 255))
-                white_bg.paste(transparent_img,
-                               mask=transparent_img.split()[3])
-                buf = BytesIO()
-                white_bg.save(buf, format="JPEG", quality=95)
-                generated_bytes = buf.getvalue()
+                if not generated_bytes:
+                    raise Exception("Gemini response had no image inline_data")
             else:
-                raise Exception(
-                    "Could not process image using fallback method.")
-
-        # Save regenerated image locally
-        regen_filename = f"regen_{image_id}_{int(time.time())}.jpg"
-        regen_dir = os.path.join(settings.MEDIA_ROOT, "generated")
-        os.makedirs(regen_dir, exist_ok=True)
-        local_regen_path = os.path.join(regen_dir, regen_filename)
-
-        with open(local_regen_path, "wb") as f:
-            f.write(generated_bytes)
-
-        # Upload regenerated image to Cloudinary
-        buf = BytesIO(generated_bytes)
-        buf.seek(0)
-        upload_result = cloudinary.uploader.upload(
-            buf,
-            folder="ornaments_regenerated",
-            public_id=f"regen_{image_id}_{int(time.time())}",
-            overwrite=True
-        )
-        regenerated_url = upload_result['secure_url']
-
-        # Create new MongoDB document for the regenerated image
-        new_doc = OrnamentMongo(
-            prompt=combined_prompt,
-            type=prev_doc.type,  # Keep the same type
-            user_id=user_id,
-            parent_image_id=ObjectId(image_id),  # Reference to parent
-            original_prompt=original_prompt,  # Keep the original prompt
-            uploaded_image_url=prev_doc.uploaded_image_url,  # Same uploaded image
-            generated_image_url=regenerated_url,  # New generated URL
-            uploaded_image_path=prev_doc.uploaded_image_path,  # Same uploaded path
-            generated_image_path=local_regen_path,  # New local path
-            model_image_url=prev_doc.model_image_url if hasattr(
-                prev_doc, 'model_image_url') else None,
-            uploaded_ornament_urls=prev_doc.uploaded_ornament_urls if hasattr(
-                prev_doc, 'uploaded_ornament_urls') else None
-        )
-        new_doc.save()
+                # Fallback: Use OpenCV/PIL processing, not charged
+                await run_sync(credits.refund)
+                generated_bytes = await run_sync(
+                    extract_on_background, BytesIO(img_bytes), (255, 255, 255))
+                if not generated_bytes:
+                    raise Exception(
+                        "Could not process image using fallback method.")
+
+            # Save regenerated image locally
+            regen_filename = f"regen_{image_id}_{int(time.time())}.jpg"
+            regen_dir = os.path.join(settings.MEDIA_ROOT, "generated")
+            os.makedirs(regen_dir, exist_ok=True)
+            local_regen_path = os.path.join(regen_dir, regen_filename)
+
+            with open(local_regen_path, "wb") as f:
+                f.write(generated_bytes)
+
+            # Upload regenerated image to Cloudinary
+            buf = BytesIO(generated_bytes)
+            buf.seek(0)
+            upload_result = await cloudinary_upload(
+                buf,
+                folder="ornaments_regenerated",
+                public_id=f"regen_{image_id}_{int(time.time())}",
+                overwrite=True
+            )
+            regenerated_url = upload_result['secure_url']
+
+            # Create new MongoDB document for the regenerated image
+            new_doc = OrnamentMongo(
+                prompt=combined_prompt,
+                type=prev_doc.type,  # Keep the same type
+                user_id=user_id,
+                parent_image_id=ObjectId(image_id),  # Reference to parent
+                original_prompt=original_prompt,  # Keep the original prompt
+                uploaded_image_url=prev_doc.uploaded_image_url,  # Same uploaded image
+                generated_image_url=regenerated_url,  # New generated URL
+                uploaded_image_path=prev_doc.uploaded_image_path,  # Same uploaded path
+                generated_image_path=local_regen_path,  # New local path
+                model_image_url=prev_doc.model_image_url if hasattr(
+                    prev_doc, 'model_image_url') else None,
+                uploaded_ornament_urls=prev_doc.uploaded_ornament_urls if hasattr(
+                    prev_doc, 'uploaded_ornament_urls') else None,
+                **(await run_sync(lineage_for, prev_doc))
+            )
+            await run_sync(new_doc.save)
 
         # Track regeneration in history
         try:
             from probackendapp.history_utils import track_image_regeneration
-            track_image_regeneration(
+            await run_sync(
+                track_image_regeneration,
                 user_id=user_id,
                 original_image_id=image_id,
                 new_image_url=regenerated_url,
@@ -1912,7 +1977,7 @@ def regenerate_image(request):
                 }
             )
         except Exception as history_error:
-            print(f"Error tracking regeneration history: {history_error}")
+            logger.exception("Error tracking regeneration history")
 
         return JsonResponse({
             "success": True,
@@ -1927,17 +1992,20 @@ def regenerate_image(request):
             "type": prev_doc.type
         }, status=200)
 
+    except InsufficientCredits as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=402)
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Error in regenerate_image")
         return JsonResponse({"success": False, "error": str(e)}, status=500)
 
 
 @csrf_exempt
-@authenticate
+@authenticate(stateless=True)
 def get_user_images(request):
     """
     Fetch all images generated by the authenticated user.
-    Supports filtering by type and pagination.
+    Supports filtering by type and cursor pagination
+    (cursor, limit, include_total; page is still accepted).
     """
     if request.method != 'GET':
         return JsonResponse({"error": "Invalid request method. Use GET."}, status=405)
@@ -1949,19 +2017,15 @@ def get_user_images(request):
     try:
         # Get query parameters
         image_type = request.GET.get('type', None)  # Optional filter by type
-        page = int(request.GET.get('page', 1))
-        limit = int(request.GET.get('limit', 20))
 
         # Build query
         query = {"user_id": user_id}
         if image_type:
             query["type"] = image_type
 
-        # Fetch images from MongoDB with pagination
-        skip = (page - 1) * limit
-        images = OrnamentMongo.objects(
-            **query).order_by('-created_at').skip(skip).limit(limit)
-        total_count = OrnamentMongo.objects(**query).count()
+        # Fetch one page from MongoDB, newest first
+        images, pagination = paginate(
+            request, OrnamentMongo.objects(**query), page_numbers=True)
 
         # Convert to list of dictionaries
         images_list = []
@@ -1988,14 +2052,66 @@ def get_user_images(request):
         return JsonResponse({
             "success": True,
             "images": images_list,
-            "pagination": {
-                "page": page,
-                "limit": limit,
-                "total": total_count,
-                "pages": (total_count + limit - 1) // limit
-            }
+            "pagination": pagination
+        }, status=200)
+
+    except InvalidPageParameter as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=400)
+    except Exception as e:
+        logger.exception("Error in get_user_images")
+        return JsonResponse({"success": False, "error": str(e)}, status=500)
+
+
+def _serialize_lineage_image(row):
+    """Raw OrnamentMongo row -> the image dict returned by get_user_images"""
+    image = {
+        "id": str(row["_id"]),
+        "prompt": row.get("prompt"),
+        "type": row.get("type"),
+        "uploaded_image_url": row.get("uploaded_image_url"),
+        "generated_image_url": row.get("generated_image_url"),
+        "created_at": row["created_at"].isoformat() if row.get("created_at") else None,
+        "parent_image_id": str(row["parent_image_id"]) if row.get("parent_image_id") else None,
+        "original_prompt": row.get("original_prompt"),
+    }
+    if row.get("model_image_url"):
+        image["model_image_url"] = row["model_image_url"]
+    if row.get("uploaded_ornament_urls"):
+        image["uploaded_ornament_urls"] = row["uploaded_ornament_urls"]
+    return image
+
+
+@csrf_exempt
+@authenticate
+def get_image_lineage(request, image_id):
+    """
+    Fetch the whole version tree (original image and all its regenerations)
+    of one of the authenticated user's images, with one indexed query.
+    """
+    if request.method != 'GET':
+        return JsonResponse({"error": "Invalid request method. Use GET."}, status=405)
+
+    user_id = str(request.user.id)
+
+    try:
+        if not ObjectId.is_valid(image_id):
+            return JsonResponse({"success": False, "error": "Invalid image_id"}, status=400)
+
+        root_id, rows = get_lineage_tree(
+            OrnamentMongo, image_id, query={"user_id": user_id})
+        if root_id is None:
+            return JsonResponse({"success": False, "error": "Image record not found"}, status=404)
+
+        # Only the user's own images are part of their tree
+        rows = [row for row in rows if row.get("user_id") == user_id]
+
+        return JsonResponse({
+            "success": True,
+            "root_id": str(root_id),
+            "total_versions": len(rows),
+            "tree": build_lineage_tree(rows, root_id, _serialize_lineage_image)
         }, status=200)
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Error in get_image_lineage")
         return JsonResponse({"success": False, "error": str(e)}, status=500)
@@ -1,19 +1,19 @@
+import logging
 import re
 from cloudinary.utils import cloudinary_url
 from .models import Project, ProjectInvite, ProjectMember, ImageGenerationHistory
-from django.http import JsonResponse
+from common.responses import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.shortcuts import get_object_or_404
-from mongoengine.errors import DoesNotExist
+from mongoengine.errors import DoesNotExist, SaveConditionError
 from django.conf import settings
 import json
 import os
 from datetime import datetime, timezone
 import cloudinary
 import cloudinary.uploader
-import jwt
-from .models import Project, Collection, CollectionItem, ProjectRole, ProjectMember, UploadedImage, PromptMaster
+from .models import Project, Collection, CollectionItem, ProjectRole, ProjectMember, UploadedImage, PromptMaster, GeneratedImage
 from users.models import User
 from .views import (
     project_setup_description,
@@ -24,7 +24,48 @@ from .views import (
     generate_all_product_model_images,
     regenerate_product_model_image
 )
+from .project_utils import get_user_projects, get_member_role, get_collection_summaries, get_recent_activity
+from .membership_utils import forget_project_collections, get_project_role, invalidate_membership
+from .prompt_registry import bump_prompt_version
+from .version_utils import collection_history_version, collection_version, project_version
+from .image_counters import record_image_counts, tally_collection_images
+from .history_utils import HistoryWriter
+from .lineage_utils import build_lineage_tree, get_lineage_tree
+from .generated_image_utils import (
+    create_generated_image,
+    find_generated_image,
+    find_product,
+    find_products,
+    serialize_generated_image
+)
+from .serialization_utils import (
+    get_raw_collection,
+    serialize_collection_detail,
+    serialize_prompt
+)
+from .collection_updates import (
+    item_field,
+    pull_item_values,
+    push_item_values,
+    set_item_fields,
+    touch_collection,
+    update_collection
+)
+from common.conditional import conditional_get
+from common.dereference import prefetch_references, reference_id
 from common.middleware import authenticate
+from common.user_cache import invalidate_user
+from common.ratelimit import rate_limit
+from common.response_cache import cache_depends_on, cache_response, invalidate
+from common.pagination import MAX_LIMIT, InvalidPageParameter, get_cached_count, get_page_params, int_param, paginate, split_page
+
+logger = logging.getLogger(__name__)
+
+
+def conflict_response():
+    """409 for a save that lost the race with another write (SaveConditionError)"""
+    return JsonResponse({'error': 'The project was changed by another request, please try again'}, status=409)
+
 
 # -------------------------
 # Project API Views
@@ -33,81 +74,59 @@ from common.middleware import authenticate
 
 @require_http_methods(["GET"])
 @authenticate
+@cache_response(lambda request: {'user': request.user.id})
 def api_projects_list(request):
     """Get projects where the user is a team member"""
     try:
         user = request.user
-        all_projects = Project.objects.all()
+        projects = prefetch_references(
+            get_user_projects(user), 'team_members.user',
+            only={User: ('username', 'full_name', 'email')})
+        cache_depends_on(request, project=[p.id for p in projects])
+        summaries = get_collection_summaries([p.id for p in projects])
         projects_data = []
 
-        for project in all_projects:
-            # Check if user is a team member
-            user_member = None
-            for member in project.team_members:
-                if str(member.user.id) == str(user.id):
-                    user_member = member
-                    break
-
-            # Only include projects where user is a member
-            if user_member:
-                # Get the first collection for each project
-                collection = Collection.objects(project=project).first()
-
-                # Calculate total images
-                # Calculate total images
-                total_images = 0
-                if collection and collection.items:
-                    for item in collection.items:
-                        # Check each product image under the item
-                        if item.product_images:
-                            for prod_img in item.product_images:
-                                total_images += 1  # count the product image itself
-
-                                # Count generated images under this product
-                                if hasattr(prod_img, "generated_images") and prod_img.generated_images:
-                                    for gen_img in prod_img.generated_images:
-                                        total_images += 1  # count generated image
-
-                                        # Count regenerated images under this generated image
-                                        if hasattr(gen_img, "regenerated_images") and gen_img.regenerated_images:
-                                            total_images += len(
-                                                gen_img.regenerated_images)
-
-                projects_data.append({
-                    'id': str(project.id),
-                    'name': project.name,
-                    'about': project.about,
-                    'created_at': project.created_at.isoformat(),
-                    'status': project.status,
-                    'collection_id': str(collection.id) if collection else None,
-                    'total_images': total_images,
-                    'user_role': user_member.role,  # Add user's role in this project
-                    "team_members": [
-                        {
-                            "username": member.user.username if member.user else None,
-                            "full_name": member.user.full_name if member.user else None,
-                            "email": member.user.email if member.user else None,
-                            "role": member.role,
-                            "joined_at": member.joined_at.isoformat() if member.joined_at else None
-                        }
-                        for member in project.team_members
-                    ]
-                })
+        for project in projects:
+            summary = summaries.get(str(project.id), {})
+
+            projects_data.append({
+                'id': str(project.id),
+                'name': project.name,
+                'about': project.about,
+                'created_at': project.created_at.isoformat(),
+                'status': project.status,
+                'collection_id': summary.get('collection_id'),
+                'total_images': project.total_images or 0,
+                # Add user's role in this project
+                'user_role': get_member_role(project, user),
+                "team_members": [
+                    {
+                        "username": member.user.username if member.user else None,
+                        "full_name": member.user.full_name if member.user else None,
+                        "email": member.user.email if member.user else None,
+                        "role": member.role,
+                        "joined_at": member.joined_at.isoformat() if member.joined_at else None
+                    }
+                    for member in project.team_members
+                ]
+            })
 
         return JsonResponse({'projects': projects_data})
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_projects_list")
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @require_http_methods(["GET"])
+@conditional_get(project_version)
 def api_project_detail(request, project_id):
     """Get a specific project"""
     try:
         project = Project.objects.get(id=project_id)
-        collection = Collection.objects(project=project).first()
+        prefetch_references([project], 'team_members.user',
+                            only={User: ('username', 'full_name', 'email')})
+        collection = get_raw_collection(project=project.id)
 
         project_data = {
             'id': str(project.id),
@@ -115,7 +134,7 @@ def api_project_detail(request, project_id):
             'about': project.about,
             'created_at': project.created_at.isoformat(),
             'status': project.status,
-            'collection_id': str(collection.id) if collection else None,
+            'collection_id': str(collection['_id']) if collection else None,
             'team_members': [
                 {
                     'user_id': str(member.user.id),
@@ -127,55 +146,15 @@ def api_project_detail(request, project_id):
         }
 
         if collection:
-            project_data['collection'] = {
-                'id': str(collection.id),
-                'description': collection.description,
-                'target_audience': collection.target_audience,
-                'campaign_season': collection.campaign_season,
-                'created_at': collection.created_at.isoformat(),
-                'items': []
-            }
-
-            for item in collection.items:
-                item_data = {
-                    'suggested_themes': item.suggested_themes or [],
-                    'suggested_backgrounds': item.suggested_backgrounds or [],
-                    'suggested_poses': item.suggested_poses or [],
-                    'suggested_locations': item.suggested_locations or [],
-                    'suggested_colors': item.suggested_colors or [],
-                    'selected_themes': item.selected_themes or [],
-                    'selected_backgrounds': item.selected_backgrounds or [],
-                    'selected_poses': item.selected_poses or [],
-                    'selected_locations': item.selected_locations or [],
-                    'selected_colors': item.selected_colors or [],
-                    'uploaded_theme_images': [img.to_mongo().to_dict() for img in item.uploaded_theme_images],
-                    'uploaded_background_images': [img.to_mongo().to_dict() for img in item.uploaded_background_images],
-                    'uploaded_pose_images': [img.to_mongo().to_dict() for img in item.uploaded_pose_images],
-                    'uploaded_location_images': [img.to_mongo().to_dict() for img in item.uploaded_location_images],
-                    'uploaded_color_images': [img.to_mongo().to_dict() for img in item.uploaded_color_images],
-                    'generated_prompts': item.generated_prompts or {},
-                    'generated_model_images': item.generated_model_images or [],
-                    'uploaded_model_images': item.uploaded_model_images or [],
-                    'selected_model': item.selected_model if hasattr(item, 'selected_model') else None,
-                    'product_images': []
-                }
-
-                # Add product images data
-                for product_img in item.product_images:
-                    product_data = {
-                        'uploaded_image_url': product_img.uploaded_image_url,
-                        'uploaded_image_path': product_img.uploaded_image_path,
-                        'generated_images': product_img.generated_images or []
-                    }
-                    item_data['product_images'].append(product_data)
-
-                project_data['collection']['items'].append(item_data)
+            collection_data = serialize_collection_detail(collection)
+            del collection_data['project_id']
+            project_data['collection'] = collection_data
 
         return JsonResponse(project_data)
     except DoesNotExist:
         return JsonResponse({'error': 'Project not found'}, status=404)
     except Exception as e:
-        print(e)
+        logger.exception("Error in api_project_detail")
         return JsonResponse({'error': str(e)}, status=500)
 
 
@@ -200,9 +179,11 @@ def api_create_project(request):
         owner_member = ProjectMember(user=user, role=ProjectRole.OWNER.value)
         project.team_members.append(owner_member)
         project.save()
+        invalidate(user=user.id)
         if project not in user.projects:
             user.projects.append(project)
             user.save()
+            invalidate_user(user.id)
 
         return JsonResponse({
             'id': str(project.id),
@@ -219,8 +200,10 @@ def api_create_project(request):
                 } for member in project.team_members
             ]
         })
+    except SaveConditionError:
+        return conflict_response()
     except Exception as e:
-        print(e)
+        logger.exception("Error in api_create_project")
         return JsonResponse({'error': str(e)}, status=500)
 
 
@@ -259,6 +242,8 @@ def api_update_project(request, project_id):
         })
     except DoesNotExist:
         return JsonResponse({'error': 'Project not found'}, status=404)
+    except SaveConditionError:
+        return conflict_response()
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
@@ -271,6 +256,9 @@ def api_delete_project(request, project_id):
     try:
         project = Project.objects.get(id=project_id)
         project.delete()
+        invalidate(project=project_id)
+        invalidate_membership(project_id)
+        forget_project_collections(project_id)
         return JsonResponse({'success': True})
     except DoesNotExist:
         return JsonResponse({'error': 'Project not found'}, status=404)
@@ -284,56 +272,17 @@ def api_delete_project(request, project_id):
 
 @require_http_methods(["GET"])
 @authenticate
+@conditional_get(collection_version)
+# The same for every user
+@cache_response(lambda request, collection_id: {'collection': collection_id}, per_user=False)
 def api_collection_detail(request, collection_id):
     """Get collection details"""
     try:
-        collection = Collection.objects.get(id=collection_id)
-
-        collection_data = {
-            'id': str(collection.id),
-            'project_id': str(collection.project.id),
-            'description': collection.description,
-            'target_audience': collection.target_audience,
-            'campaign_season': collection.campaign_season,
-            'created_at': collection.created_at.isoformat(),
-            'items': []
-        }
-
-        for item in collection.items:
-            item_data = {
-                'suggested_themes': item.suggested_themes or [],
-                'suggested_backgrounds': item.suggested_backgrounds or [],
-                'suggested_poses': item.suggested_poses or [],
-                'suggested_locations': item.suggested_locations or [],
-                'suggested_colors': item.suggested_colors or [],
-                'selected_themes': item.selected_themes or [],
-                'selected_backgrounds': item.selected_backgrounds or [],
-                'selected_poses': item.selected_poses or [],
-                'selected_locations': item.selected_locations or [],
-                'selected_colors': item.selected_colors or [],
-                'uploaded_theme_images': [img.to_mongo().to_dict() for img in item.uploaded_theme_images],
-                'uploaded_background_images': [img.to_mongo().to_dict() for img in item.uploaded_background_images],
-                'uploaded_pose_images': [img.to_mongo().to_dict() for img in item.uploaded_pose_images],
-                'uploaded_location_images': [img.to_mongo().to_dict() for img in item.uploaded_location_images],
-                'uploaded_color_images': [img.to_mongo().to_dict() for img in item.uploaded_color_images],
-                'generated_prompts': item.generated_prompts or {},
-                'generated_model_images': item.generated_model_images or [],
-                'picked_colors': item.picked_colors or [],
-                "global_instructions": item.global_instructions or "",
-                'uploaded_model_images': item.uploaded_model_images or [],
-                'selected_model': item.selected_model if hasattr(item, 'selected_model') else None,
-                'product_images': []
-            }
-
-            for product_img in item.product_images:
-                product_data = {
-                    'uploaded_image_url': product_img.uploaded_image_url,
-                    'uploaded_image_path': product_img.uploaded_image_path,
-                    'generated_images': product_img.generated_images or []
-                }
-                item_data['product_images'].append(product_data)
+        collection = get_raw_collection(id=collection_id)
+        if collection is None:
+            return JsonResponse({'error': 'Collection not found'}, status=404)
 
-            collection_data['items'].append(item_data)
+        collection_data = serialize_collection_detail(collection)
 
         return JsonResponse(collection_data)
     except DoesNotExist:
@@ -341,6 +290,57 @@ def api_collection_detail(request, collection_id):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+
+@require_http_methods(["GET"])
+@authenticate
+def api_collection_generated_images(request, collection_id):
+    """
+    Get a page of a collection's generated images, newest first.
+    Query params: cursor, limit, include_total, product_id,
+    kind ('generated', 'regenerated', 'enhanced'), type
+    """
+    try:
+        if not Collection.objects(id=collection_id).count():
+            return JsonResponse({'error': 'Collection not found'}, status=404)
+
+        filters = {'collection': collection_id}
+        for param in ('product_id', 'kind', 'type'):
+            if request.GET.get(param):
+                filters[param] = request.GET[param]
+
+        page_images, pagination = paginate(
+            request, GeneratedImage.objects(**filters).as_pymongo())
+
+        return JsonResponse({
+            'success': True,
+            'images': [serialize_generated_image(image) for image in page_images],
+            'pagination': pagination
+        })
+    except InvalidPageParameter as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+
+@require_http_methods(["GET"])
+@authenticate
+def api_generated_image_lineage(request, collection_id, image_id):
+    """Get the version tree (generated image with its regenerated and enhanced images) of an image"""
+    try:
+        root_id, rows = get_lineage_tree(
+            GeneratedImage, image_id, query={'collection': collection_id})
+        if root_id is None:
+            return JsonResponse({'error': 'Generated image not found'}, status=404)
+
+        return JsonResponse({
+            'success': True,
+            'root_id': str(root_id),
+            'total_versions': len(rows),
+            'tree': build_lineage_tree(rows, root_id, serialize_generated_image)
+        })
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
 # -------------------------
 # Workflow API Views (wrapper around existing views)
 # -------------------------
@@ -370,6 +370,7 @@ def api_project_setup_description(request, project_id):
 
         # Get or create collection
         collection = Collection.objects(project=project).first()
+        is_new_collection = not collection or not collection.items
         if not collection:
             collection = Collection(project=project)
             item = CollectionItem()
@@ -394,7 +395,21 @@ def api_project_setup_description(request, project_id):
         item.suggested_locations = suggestions.get("locations", [])
         item.suggested_colors = suggestions.get("colors", [])
 
-        collection.save()
+        if is_new_collection:
+            collection.save()
+        else:
+            # Only send the changed fields so concurrent uploads are kept
+            set_item_fields(collection.id, {
+                'suggested_themes': item.suggested_themes,
+                'suggested_backgrounds': item.suggested_backgrounds,
+                'suggested_poses': item.suggested_poses,
+                'suggested_locations': item.suggested_locations,
+                'suggested_colors': item.suggested_colors,
+            }, collection_fields={
+                'description': description,
+                'target_audience': target_audience,
+                'campaign_season': campaign_season,
+            })
 
         # Prepare collection response data - match the structure expected by frontend (items array)
         item_data = {
@@ -423,7 +438,7 @@ def api_project_setup_description(request, project_id):
 
         collection_data = {
             'id': str(collection.id),
-            'project_id': str(collection.project.id),
+            'project_id': str(reference_id(collection, 'project')),
             'description': collection.description,
             'target_audience': collection.target_audience,
             'campaign_season': collection.campaign_season,
@@ -438,71 +453,55 @@ def api_project_setup_description(request, project_id):
         })
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_project_setup_description")
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@authenticate
+@rate_limit('upload')
 def api_upload_workflow_image(request, project_id, collection_id):
     """Upload images immediately when user selects them in workflow"""
     try:
-        print(
-            f"DEBUG: Upload request received for project {project_id}, collection {collection_id}")
-        print(f"DEBUG: Request method: {request.method}")
-        print(f"DEBUG: Request content type: {request.content_type}")
-        print(f"DEBUG: Request FILES: {list(request.FILES.keys())}")
-        print(f"DEBUG: Request POST: {dict(request.POST)}")
-
-        # Manual authentication check
-        auth_header = request.META.get('HTTP_AUTHORIZATION')
-        if not auth_header or not auth_header.startswith('Bearer '):
-            print("DEBUG: No valid authorization header")
-            return JsonResponse({'error': 'Authorization required'}, status=401)
+        logger.debug(
+            "Upload request received for project %s, collection %s", project_id, collection_id)
+        logger.debug("Request method: %s", request.method)
+        logger.debug("Request content type: %s", request.content_type)
+        logger.debug("Request FILES: %s", list(request.FILES.keys()))
+        logger.debug("Request POST: %s", dict(request.POST))
 
-        try:
-            token = auth_header.split(' ')[1]
-            payload = jwt.decode(
-                token, settings.SECRET_KEY, algorithms=["HS256"])
-            user = User.objects(id=payload.get('id')).first()
-            if not user:
-                print("DEBUG: User not found")
-                return JsonResponse({'error': 'User not found'}, status=404)
-            user_id = str(user.id)
-            print(f"DEBUG: User authenticated: {user_id}")
-        except Exception as auth_error:
-            print(f"DEBUG: Authentication failed: {str(auth_error)}")
-            return JsonResponse({'error': 'Authentication failed'}, status=401)
+        user = request.user
+        user_id = str(user.id)
 
         # Get the collection
         try:
             collection = Collection.objects.get(id=collection_id)
-            print(f"DEBUG: Collection found: {collection.id}")
+            logger.debug("Collection found: %s", collection.id)
         except DoesNotExist:
-            print("DEBUG: Collection not found")
+            logger.debug("Collection not found")
             return JsonResponse({'error': 'Collection not found'}, status=404)
 
         # Get the first item
         if not collection.items:
-            print("DEBUG: No collection items found")
+            logger.debug("No collection items found")
             return JsonResponse({'error': 'No collection items found'}, status=404)
 
         item = collection.items[0]
-        print(f"DEBUG: Collection item found")
+        logger.debug("Collection item found")
 
         # Get uploaded files and category
         uploaded_files = request.FILES.getlist('images')
-        print(f"DEBUG: Uploaded files: {uploaded_files}")
+        logger.debug("Uploaded files: %s", uploaded_files)
         # 'theme', 'background', 'pose', 'location', 'color'
         category = request.POST.get('category')
 
-        print(f"DEBUG: Uploaded files count: {len(uploaded_files)}")
-        print(f"DEBUG: Category: {category}")
+        logger.debug("Uploaded files count: %s", len(uploaded_files))
+        logger.debug("Category: %s", category)
 
         if not uploaded_files or not category:
-            print(
-                f"DEBUG: Missing files or category - files: {len(uploaded_files)}, category: {category}")
+            logger.debug(
+                "Missing files or category - files: %s, category: %s", len(uploaded_files), category)
             return JsonResponse({'error': 'No images or category provided'}, status=400)
 
         # Normalize category (convert plural to singular)
@@ -518,13 +517,12 @@ def api_upload_workflow_image(request, project_id, collection_id):
         normalized_category = category_mapping.get(category, category)
 
         if normalized_category not in ['theme', 'background', 'pose', 'location', 'color']:
-            print(
-                f"DEBUG: Invalid category: {category} (normalized: {normalized_category})")
+            logger.debug("Invalid category: %s (normalized: %s)", category, normalized_category)
             return JsonResponse({'error': 'Invalid category'}, status=400)
 
         # Use the normalized category for the rest of the function
         category = normalized_category
-        print(f"DEBUG: Using normalized category: {category}")
+        logger.debug("Using normalized category: %s", category)
 
         # Create local directory for this category
         local_dir = os.path.join(
@@ -568,18 +566,9 @@ def api_upload_workflow_image(request, project_id, collection_id):
 
             uploaded_images.append(uploaded_image)
 
-        # Add to the appropriate category in the collection item
+        # Append to the appropriate category in the collection item
         category_field = f"uploaded_{category}_images"
-        if not hasattr(item, category_field):
-            setattr(item, category_field, [])
-
-        current_images = getattr(item, category_field)
-        current_images.extend(uploaded_images)
-        setattr(item, category_field, current_images)
-
-        # Save the collection
-        collection.items[0] = item
-        collection.save()
+        push_item_values(collection.id, category_field, uploaded_images)
 
         # Return the uploaded images data
         response_data = []
@@ -602,14 +591,13 @@ def api_upload_workflow_image(request, project_id, collection_id):
         })
 
     except Exception as e:
-        import traceback
-        print(f"DEBUG: Exception occurred in upload_workflow_image: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Error in api_upload_workflow_image")
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@rate_limit('upload')
 def api_project_setup_select(request, project_id, collection_id):
     """API wrapper for project setup select - saves user selections and generates prompts"""
     try:
@@ -652,7 +640,18 @@ def api_project_setup_select(request, project_id, collection_id):
         item.picked_colors = data.get('pickedColors', [])
         item.color_instructions = data.get('colorInstructions', '')
         item.global_instructions = data.get('globalInstructions', '')
-        print("global INstructions : ", item.global_instructions)
+        logger.debug("Global instructions: %s", item.global_instructions)
+
+        set_item_fields(collection.id, {
+            'selected_themes': item.selected_themes,
+            'selected_backgrounds': item.selected_backgrounds,
+            'selected_poses': item.selected_poses,
+            'selected_locations': item.selected_locations,
+            'selected_colors': item.selected_colors,
+            'picked_colors': item.picked_colors,
+            'color_instructions': item.color_instructions,
+            'global_instructions': item.global_instructions,
+        })
 
         # Note: Uploaded images are now handled by the separate upload endpoint
         # This endpoint only handles selections and prompt generation
@@ -837,20 +836,19 @@ Generate prompts for the following 4 types. Respond ONLY in valid JSON:
             )
 
         # Debug information
-        print(
-            f"DEBUG: Categories with uploaded images: {categories_with_uploads}")
-        print(f"DEBUG: Has uploaded images: {has_uploaded_images}")
-        print(
-            f"DEBUG: Final selections - Themes: {final_themes}, Backgrounds: {final_backgrounds}, Poses: {final_poses}, Locations: {final_locations}, Colors: {final_colors}")
+        logger.debug("Categories with uploaded images: %s", categories_with_uploads)
+        logger.debug("Has uploaded images: %s", has_uploaded_images)
+        logger.debug(
+            "Final selections - Themes: %s, Backgrounds: %s, Poses: %s, Locations: %s, Colors: %s", final_themes, final_backgrounds, final_poses, final_locations, final_colors)
 
         # Call Gemini API
-        print(f"DEBUG: Gemini prompt: {gemini_prompt}")
+        logger.debug("Gemini prompt: %s", gemini_prompt)
         ai_json_text = call_gemini_api(gemini_prompt)
         ai_response = parse_gemini_response(ai_json_text)
 
         # Fallback if parsing failed
         if not ai_response or "error" in ai_response or not isinstance(ai_response, dict):
-            print("⚠️ Gemini API parsing failed, using fallback prompts")
+            logger.warning("Gemini API parsing failed, using fallback prompts")
             ai_response = {
                 "white_background": "Professional product photography with clean white background, studio lighting, sharp focus on product details",
                 "background_replace": "Same product with themed background replacement, maintaining product integrity and lighting",
@@ -870,10 +868,14 @@ Generate prompts for the following 4 types. Respond ONLY in valid JSON:
         item.moodboard_explanation = ai_json_text
         item.generated_prompts = ai_response
 
-        collection.save()
+        set_item_fields(collection.id, {
+            'final_moodboard_prompt': item.final_moodboard_prompt,
+            'moodboard_explanation': item.moodboard_explanation,
+            'generated_prompts': item.generated_prompts,
+        })
 
-        print("✅ Prompts generated and saved successfully")
-        print(f"Generated prompts: {ai_response}")
+        logger.info("Prompts generated and saved successfully")
+        logger.debug("Generated prompts: %s", ai_response)
 
         return JsonResponse({
             'success': True,
@@ -891,8 +893,7 @@ Generate prompts for the following 4 types. Respond ONLY in valid JSON:
             'message': 'Selections saved and prompts generated successfully'
         })
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_project_setup_select")
         return JsonResponse({'error': str(e)}, status=500)
 
 # -------------------------
@@ -902,6 +903,7 @@ Generate prompts for the following 4 types. Respond ONLY in valid JSON:
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@rate_limit('generation')
 def api_generate_ai_images(request, collection_id):
     """API wrapper for generate AI images"""
     return generate_ai_images(request, collection_id)
@@ -917,6 +919,7 @@ def api_save_generated_images(request, collection_id):
 @csrf_exempt
 @require_http_methods(["POST"])
 @authenticate
+@rate_limit('upload')
 def api_upload_product_images(request, collection_id):
     """API wrapper for upload product images"""
     return upload_product_images_api(request, collection_id)
@@ -924,6 +927,7 @@ def api_upload_product_images(request, collection_id):
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@rate_limit('generation')
 def api_generate_all_product_model_images(request, collection_id):
     """API wrapper for generate all product model images"""
     return generate_all_product_model_images(request, collection_id)
@@ -931,6 +935,7 @@ def api_generate_all_product_model_images(request, collection_id):
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@rate_limit('generation')
 def api_regenerate_product_model_image(request, collection_id):
     """API wrapper for regenerate product model image"""
     return regenerate_product_model_image(request, collection_id)
@@ -942,6 +947,7 @@ def api_regenerate_product_model_image(request, collection_id):
 
 @csrf_exempt
 @require_http_methods(["POST"])
+@rate_limit('upload')
 def api_upload_real_models(request, collection_id):
     """Upload real model images"""
     if request.method != "POST":
@@ -986,11 +992,8 @@ def api_upload_real_models(request, collection_id):
             new_real_models.append(entry)
 
         # Append to uploaded_model_images
-        if not hasattr(item, "uploaded_model_images"):
-            item.uploaded_model_images = []
-        item.uploaded_model_images.extend(new_real_models)
-
-        collection.save()
+        push_item_values(collection.id, "uploaded_model_images",
+                         new_real_models)
 
         return JsonResponse({
             "success": True,
@@ -999,12 +1002,12 @@ def api_upload_real_models(request, collection_id):
         })
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_upload_real_models")
         return JsonResponse({"success": False, "error": str(e)})
 
 
 @require_http_methods(["GET"])
+@conditional_get(collection_version)
 def api_get_all_models(request, collection_id):
     """Get all models (AI generated and real uploaded)"""
     try:
@@ -1027,8 +1030,7 @@ def api_get_all_models(request, collection_id):
         })
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_get_all_models")
         return JsonResponse({"success": False, "error": str(e)})
 
 
@@ -1059,7 +1061,7 @@ def api_select_model(request, collection_id):
             "name": model_data.get("name", "")
         }
 
-        collection.save()
+        set_item_fields(collection.id, {"selected_model": item.selected_model})
 
         return JsonResponse({
             "success": True,
@@ -1067,8 +1069,7 @@ def api_select_model(request, collection_id):
         })
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_select_model")
         return JsonResponse({"success": False, "error": str(e)})
 
 
@@ -1089,9 +1090,7 @@ def api_invite_member(request, project_id):
             return JsonResponse({"error": "Project not found"}, status=404)
 
         # Check if current user is an owner
-        owner_member = next(
-            (m for m in project.team_members if m.user.id == user.id and m.role == "owner"), None)
-        if not owner_member:
+        if get_project_role(user.id, project_id) != "owner":
             return JsonResponse({"error": "Only project owner can invite members"}, status=403)
 
         # Find invitee
@@ -1100,8 +1099,7 @@ def api_invite_member(request, project_id):
             return JsonResponse({"error": "User with this email not found"}, status=404)
 
         # Check if already a team member
-        already_member = any(
-            m.user.id == invitee.id for m in project.team_members)
+        already_member = get_project_role(invitee.id, project_id) is not None
         if already_member:
             return JsonResponse({"error": "User already part of the team"}, status=400)
 
@@ -1147,6 +1145,8 @@ def api_accept_invite(request, project_id):
         member = ProjectMember(user=user, role=invite.role)
         project.team_members.append(member)
         project.save()
+        invalidate_membership(project.id, user.id)
+        invalidate(user=user.id)
 
         # Mark invite as accepted
         invite.accepted = True
@@ -1156,6 +1156,7 @@ def api_accept_invite(request, project_id):
         if project not in user.projects:
             user.projects.append(project)
             user.save()
+            invalidate_user(user.id)
 
         return JsonResponse({
             "message": "Invite accepted successfully",
@@ -1164,6 +1165,8 @@ def api_accept_invite(request, project_id):
             "role": invite.role
         }, status=200)
 
+    except SaveConditionError:
+        return conflict_response()
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
 
@@ -1187,6 +1190,8 @@ def api_accept_invite_by_id(request, invite_id):
         member = ProjectMember(user=user, role=invite.role)
         project.team_members.append(member)
         project.save()
+        invalidate_membership(project.id, user.id)
+        invalidate(user=user.id)
 
         # Mark invite as accepted
         invite.accepted = True
@@ -1196,6 +1201,7 @@ def api_accept_invite_by_id(request, invite_id):
         if project not in user.projects:
             user.projects.append(project)
             user.save()
+            invalidate_user(user.id)
 
         return JsonResponse({
             "message": "Invitation accepted successfully",
@@ -1204,6 +1210,8 @@ def api_accept_invite_by_id(request, invite_id):
             "role": invite.role
         }, status=200)
 
+    except SaveConditionError:
+        return conflict_response()
     except Exception as e:
         return JsonResponse({"error": str(e)}, status=500)
 
@@ -1237,10 +1245,15 @@ def api_reject_invite(request, invite_id):
 @require_http_methods(["GET"])
 @authenticate
 def api_list_invites(request, project_id):
-    """Get pending invitations for a specific project"""
+    """Get pending invitations for a specific project (cursor paginated, newest first)"""
     # Get all pending invites for this project (not just for the current user)
-    invites = ProjectInvite.objects(
-        project=project_id, accepted=False)
+    try:
+        invites, pagination = paginate(request, ProjectInvite.objects(
+            project=project_id, accepted=False), default_limit=MAX_LIMIT)
+    except InvalidPageParameter as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    prefetch_references(invites, 'project', 'invitee', 'inviter', only={
+        Project: ('name',), User: ('username', 'full_name', 'email')})
     data = [{
         "id": str(inv.id),
         "project": inv.project.name,
@@ -1249,25 +1262,31 @@ def api_list_invites(request, project_id):
         "role": inv.role,
         "created_at": inv.created_at.isoformat()
     } for inv in invites]
-    return JsonResponse({"pending_invites": data})
+    return JsonResponse({"pending_invites": data, "pagination": pagination})
 
 
 @csrf_exempt
 @require_http_methods(["GET"])
 @authenticate
 def api_list_all_invites(request):
-    """Get ALL pending invitations for the current user (across all projects)"""
-    invites = ProjectInvite.objects(invitee=request.user, accepted=False)
+    """Get ALL pending invitations for the current user (across all projects, cursor paginated)"""
+    try:
+        invites, pagination = paginate(request, ProjectInvite.objects(
+            invitee=request.user, accepted=False), default_limit=MAX_LIMIT)
+    except InvalidPageParameter as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    prefetch_references(invites, 'project', 'inviter', only={
+        Project: ('name',), User: ('username', 'full_name', 'email')})
     data = [{
         "id": str(inv.id),
-        "project_id": str(inv.project.id),
+        "project_id": str(reference_id(inv, 'project')),
         "project_name": inv.project.name,
         "inviter_name": inv.inviter.full_name or inv.inviter.username,
         "inviter_email": inv.inviter.email,
         "role": inv.role,
         "created_at": inv.created_at.isoformat()
     } for inv in invites]
-    return JsonResponse({"pending_invites": data})
+    return JsonResponse({"pending_invites": data, "pagination": pagination})
 
 
 @csrf_exempt
@@ -1281,7 +1300,8 @@ def api_available_users(request, project_id):
             return JsonResponse({"error": "Project not found"}, status=404)
 
         # Get IDs of users already in the project
-        member_ids = [str(member.user.id) for member in project.team_members]
+        member_ids = [str(reference_id(member, 'user'))
+                      for member in project.team_members]
 
         # Get all users except those already in the project
         all_users = User.objects.all()
@@ -1325,19 +1345,17 @@ def api_update_member_role(request, project_id):
             return JsonResponse({"error": "Project not found"}, status=404)
 
         # Check if current user is an owner
-        owner_member = next(
-            (m for m in project.team_members if str(m.user.id) == str(user.id) and m.role == "owner"), None)
-        if not owner_member:
+        if get_project_role(user.id, project_id) != "owner":
             return JsonResponse({"error": "Only project owner can update member roles"}, status=403)
 
-        # Find the member to update
+        # Find the member to update, without loading every member's user
         member_to_update = next(
-            (m for m in project.team_members if str(m.user.id) == str(member_user_id)), None)
+            (m for m in project.team_members if str(reference_id(m, 'user')) == str(member_user_id)), None)
         if not member_to_update:
             return JsonResponse({"error": "Member not found in project"}, status=404)
 
         # Prevent owner from changing their own role
-        if str(member_to_update.user.id) == str(user.id):
+        if str(reference_id(member_to_update, 'user')) == str(user.id):
             return JsonResponse({"error": "You cannot change your own role"}, status=400)
 
         # Prevent changing role of another owner
@@ -1347,6 +1365,7 @@ def api_update_member_role(request, project_id):
         # Update the role
         member_to_update.role = new_role
         project.save()
+        invalidate_membership(project_id, member_user_id)
 
         return JsonResponse({
             "message": "Member role updated successfully",
@@ -1354,9 +1373,10 @@ def api_update_member_role(request, project_id):
             "new_role": new_role
         }, status=200)
 
+    except SaveConditionError:
+        return conflict_response()
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_update_member_role")
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -1365,16 +1385,20 @@ def api_update_member_role(request, project_id):
 # -------------------------
 
 @require_http_methods(["GET"])
-@authenticate
+@authenticate(stateless=True)
 def api_recent_history(request):
-    """Get recent image generation history for the authenticated user"""
+    """
+    Get recent image generation history for the authenticated user.
+    Query params: cursor (from pagination.next_cursor), limit, days;
+    page is still accepted for clients that do not send a cursor.
+    """
     try:
         user = request.user
         user_id = str(user.id)
 
         # Get query parameters
-        page = int(request.GET.get('page', 1))
-        limit = int(request.GET.get('limit', 20))
+        cursor, limit = get_page_params(request)
+        page = int_param(request, 'page', 1) if not cursor else None
         days = int(request.GET.get('days', 30))  # Default to last 30 days
 
         # Calculate date range
@@ -1382,134 +1406,98 @@ def api_recent_history(request):
         end_date = datetime.now(timezone.utc)
         start_date = end_date - timedelta(days=days)
 
-        # Fetch recent history from both systems
+        # Fetch one page of project and individual history, merged in MongoDB
+        from .history_utils import get_user_history_page, count_user_history
+        rows = get_user_history_page(
+            user_id, start_date, end_date, cursor=cursor, limit=limit,
+            skip=(page - 1) * limit if page and page > 1 else 0)
+        rows, next_cursor = split_page(rows, limit)
 
-        # 1. Get project-based image generation history
-        # Filter to exclude individual image section activities and only include project-specific activities
-        project_history = ImageGenerationHistory.objects(
-            user_id=user_id,
-            created_at__gte=start_date,
-            created_at__lte=end_date,
-            # Only include records that have a project or collection associated
-            # AND exclude individual image section activities
-            __raw__={
-                "$and": [
-                    {
-                        "$or": [
-                            {"project": {"$exists": True, "$ne": None}},
-                            {"collection": {"$exists": True, "$ne": None}}
-                        ]
+        # Resolve project names of this page with one query
+        project_ids = {row['project'] for row in rows if row.get('project')}
+        project_names = {
+            project['_id']: project.get('name')
+            for project in Project.objects(id__in=list(project_ids)).only('name').as_pymongo()
+        } if project_ids else {}
+
+        # Format the results
+        paginated_history = []
+        for row in rows:
+            entry = {
+                'id': row['_id'],
+                'image_type': row.get('image_type'),
+                'image_url': row.get('image_url'),
+                'prompt': row.get('prompt'),
+                'original_prompt': row.get('original_prompt'),
+                'created_at': row.get('created_at'),
+            }
+            if row['source'] == 'project':
+                project_id = row.get('project')
+                entry.update({
+                    'type': 'project_image',
+                    'parent_image_id': row.get('parent_image_id'),
+                    'project': {
+                        'id': project_id,
+                        'name': project_names.get(project_id) or 'Unknown Project'
                     },
-                    {
-                        # Exclude individual image section activities
-                        "image_type": {
-                            "$nin": [
-                                # Individual image section activities
-                                "white_background",
-                                "background_change",
-                                "model_with_ornament",
-                                "real_model_with_ornament",
-                                "campaign_shot_advanced",
-                                # Individual image section regenerations
-                                "white_background_regenerated",
-                                "background_change_regenerated",
-                                "model_with_ornament_regenerated",
-                                "real_model_with_ornament_regenerated",
-                                "campaign_shot_advanced_regenerated"
-                            ]
-                        }
+                    'collection': {
+                        'id': row.get('collection')
+                    },
+                    'metadata': row.get('metadata') or {}
+                })
+            else:
+                entry.update({
+                    'type': 'individual_image',
+                    'parent_image_id': row.get('parent_image_id') or None,
+                    'project': None,
+                    'collection': None,
+                    'metadata': {
+                        'uploaded_image_url': row.get('uploaded_image_url'),
+                        'model_image_url': row.get('model_image_url')
                     }
-                ]
-            }
-        ).order_by('-created_at')
-
-        # 2. Get individual image generation history from imgbackendapp
-        from imgbackendapp.mongo_models import OrnamentMongo
-        individual_history = OrnamentMongo.objects(
-            user_id=user_id,
-            created_at__gte=start_date,
-            created_at__lte=end_date
-        ).order_by('-created_at')
-
-        # Combine and format the results
-        combined_history = []
-
-        # Add project-based history
-        for item in project_history:
-            combined_history.append({
-                'id': str(item.id),
-                'type': 'project_image',
-                'image_type': item.image_type,
-                'image_url': item.image_url,
-                'prompt': item.prompt,
-                'original_prompt': item.original_prompt,
-                'parent_image_id': item.parent_image_id,
-                'created_at': item.created_at.isoformat(),
-                'project': {
-                    'id': str(item.project.id) if item.project else None,
-                    'name': item.project.name if item.project else 'Unknown Project'
-                },
-                'collection': {
-                    'id': str(item.collection.id) if item.collection else None
-                },
-                'metadata': item.metadata or {}
-            })
-
-        # Add individual image history
-        for item in individual_history:
-            combined_history.append({
-                'id': str(item.id),
-                'type': 'individual_image',
-                'image_type': item.type,
-                'image_url': item.generated_image_url,
-                'prompt': item.prompt,
-                'original_prompt': item.original_prompt,
-                'parent_image_id': str(item.parent_image_id) if item.parent_image_id else None,
-                'created_at': item.created_at.isoformat() if item.created_at else None,
-                'project': None,
-                'collection': None,
-                'metadata': {
-                    'uploaded_image_url': item.uploaded_image_url,
-                    'model_image_url': getattr(item, 'model_image_url', None)
-                }
-            })
-
-        # Sort by creation date (most recent first)
-        combined_history.sort(key=lambda x: x['created_at'], reverse=True)
+                })
+            paginated_history.append(entry)
 
-        # Apply pagination
-        total_count = len(combined_history)
-        start_idx = (page - 1) * limit
-        end_idx = start_idx + limit
-        paginated_history = combined_history[start_idx:end_idx]
+        pagination = {
+            'limit': limit,
+            'next_cursor': next_cursor,
+            'has_more': next_cursor is not None
+        }
+        if page:
+            pagination['page'] = page
+        # Totals are only needed to render the first page
+        if not cursor and page == 1:
+            total_count = get_cached_count(
+                ['recent-history', user_id, days],
+                lambda: count_user_history(user_id, start_date, end_date))
+            pagination['total'] = total_count
+            pagination['pages'] = (total_count + limit - 1) // limit
 
         return JsonResponse({
             'success': True,
             'history': paginated_history,
-            'pagination': {
-                'page': page,
-                'limit': limit,
-                'total': total_count,
-                'pages': (total_count + limit - 1) // limit
-            }
+            'pagination': pagination
         })
 
+    except InvalidPageParameter as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_recent_history")
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @require_http_methods(["GET"])
 @authenticate
+@cache_response(lambda request: {'user': request.user.id})
 def api_recent_projects(request):
-    """Get recent project activity for the authenticated user"""
+    """
+    Get recent project activity for the authenticated user.
+    Query params: cursor, limit, include_total, days; page is still accepted.
+    """
     try:
         user = request.user
 
         # Get query parameters
-        page = int(request.GET.get('page', 1))
-        limit = int(request.GET.get('limit', 10))
         days = int(request.GET.get('days', 30))
 
         # Calculate date range
@@ -1517,89 +1505,57 @@ def api_recent_projects(request):
         end_date = datetime.now(timezone.utc)
         start_date = end_date - timedelta(days=days)
 
-        # Get projects where user is a member
-        user_projects = []
-        all_projects = Project.objects.all()
-
-        for project in all_projects:
-            # Check if user is a team member
-            user_member = None
-            for member in project.team_members:
-                if str(member.user.id) == str(user.id):
-                    user_member = member
-                    break
-
-            if user_member:
-                # Get recent activity for this project
-                recent_activity = ImageGenerationHistory.objects(
-                    project=project,
-                    created_at__gte=start_date,
-                    created_at__lte=end_date
-                ).order_by('-created_at').limit(5)
-
-                # Get collection info
-                collection = Collection.objects(project=project).first()
-
-                # Count total images in project
-                total_images = 0
-                if collection and collection.items:
-                    for item in collection.items:
-                        if item.product_images:
-                            total_images += len(item.product_images)
-
-                project_data = {
-                    'id': str(project.id),
-                    'name': project.name,
-                    'about': project.about,
-                    'created_at': project.created_at.isoformat(),
-                    'updated_at': project.updated_at.isoformat(),
-                    'status': project.status,
-                    'user_role': user_member.role,
-                    'total_images': total_images,
-                    'collection_id': str(collection.id) if collection else None,
-                    'recent_activity': []
-                }
-
-                # Add recent activity
-                for activity in recent_activity:
-                    project_data['recent_activity'].append({
-                        'id': str(activity.id),
-                        'image_type': activity.image_type,
-                        'image_url': activity.image_url,
-                        'created_at': activity.created_at.isoformat(),
-                        'prompt': activity.prompt
-                    })
-
-                user_projects.append(project_data)
-
-        # Sort by most recent activity
-        user_projects.sort(key=lambda x: x['updated_at'], reverse=True)
-
-        # Apply pagination
-        total_count = len(user_projects)
-        start_idx = (page - 1) * limit
-        end_idx = start_idx + limit
-        paginated_projects = user_projects[start_idx:end_idx]
+        # Get projects where user is a member, most recently updated first
+        # Only the member ids are read (get_member_role), their users are not loaded
+        page_projects, pagination = paginate(
+            request, get_user_projects(user).no_dereference(),
+            sort=(("updated_at", -1), ("_id", -1)), default_limit=10, page_numbers=True)
+        # Any update of a project of the user can move it onto this page
+        cache_depends_on(request, project=list(get_user_projects(user).scalar('id')))
+        summaries = get_collection_summaries([p.id for p in page_projects])
+
+        activity = get_recent_activity([p.id for p in page_projects], start_date, end_date)
+
+        paginated_projects = []
+        for project in page_projects:
+            # Get collection info
+            summary = summaries.get(str(project.id), {})
+
+            paginated_projects.append({
+                'id': str(project.id),
+                'name': project.name,
+                'about': project.about,
+                'created_at': project.created_at.isoformat(),
+                'updated_at': project.updated_at.isoformat(),
+                'status': project.status,
+                'user_role': get_member_role(project, user),
+                # Count total product images in project
+                'total_images': (project.image_type_counts or {}).get('product', 0),
+                'collection_id': summary.get('collection_id'),
+                'recent_activity': [{
+                    'id': str(record['_id']),
+                    'image_type': record.get('image_type'),
+                    'image_url': record.get('image_url'),
+                    'created_at': record['created_at'].isoformat(),
+                    'prompt': record.get('prompt')
+                } for record in activity.get(str(project.id), [])]
+            })
 
         return JsonResponse({
             'success': True,
             'projects': paginated_projects,
-            'pagination': {
-                'page': page,
-                'limit': limit,
-                'total': total_count,
-                'pages': (total_count + limit - 1) // limit
-            }
+            'pagination': pagination
         })
 
+    except InvalidPageParameter as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_recent_projects")
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @require_http_methods(["GET"])
-@authenticate
+@authenticate(stateless=True)
 def api_recent_images(request):
     """Get the 5 most recent images from ImageGenerationHistory for the authenticated user"""
     try:
@@ -1607,7 +1563,7 @@ def api_recent_images(request):
         user_id = str(user.id)
 
         # Get query parameters
-        limit = int(request.GET.get('limit', 5))
+        limit = int_param(request, 'limit', 5)
 
         # Get the most recent images from ImageGenerationHistory
         recent_images = ImageGenerationHistory.objects(
@@ -1631,23 +1587,25 @@ def api_recent_images(request):
             'count': len(images_list)
         })
 
+    except InvalidPageParameter as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_recent_images")
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @require_http_methods(["GET"])
 @authenticate
 def api_recent_project_history(request):
-    """Get recent image generation history for projects only (no individual images)"""
+    """
+    Get recent image generation history for projects only (no individual images).
+    Query params: cursor, limit, include_total, days; page is still accepted.
+    """
     try:
         user = request.user
         user_id = str(user.id)
 
         # Get query parameters
-        page = int(request.GET.get('page', 1))
-        limit = int(request.GET.get('limit', 20))
         days = int(request.GET.get('days', 30))  # Default to last 30 days
 
         # Calculate date range
@@ -1657,6 +1615,7 @@ def api_recent_project_history(request):
 
         # Get only project-based image generation history
         # Filter to exclude individual image section activities and only include project-specific activities
+        from .history_utils import INDIVIDUAL_IMAGE_TYPES
         project_history = ImageGenerationHistory.objects(
             user_id=user_id,
             created_at__gte=start_date,
@@ -1671,32 +1630,20 @@ def api_recent_project_history(request):
                             {"collection": {"$exists": True, "$ne": None}}
                         ]
                     },
-                    {
-                        # Exclude individual image section activities
-                        "image_type": {
-                            "$nin": [
-                                # Individual image section activities
-                                "white_background",
-                                "background_change",
-                                "model_with_ornament",
-                                "real_model_with_ornament",
-                                "campaign_shot_advanced",
-                                # Individual image section regenerations
-                                "white_background_regenerated",
-                                "background_change_regenerated",
-                                "model_with_ornament_regenerated",
-                                "real_model_with_ornament_regenerated",
-                                "campaign_shot_advanced_regenerated"
-                            ]
-                        }
-                    }
+                    {"image_type": {"$nin": INDIVIDUAL_IMAGE_TYPES}}
                 ]
             }
-        ).order_by('-created_at')
+        )
+        page_history, pagination = paginate(
+            request, project_history, page_numbers=True)
+
+        prefetch_references(page_history, 'project',
+                            only={Project: ('name',)})
 
         # Format the results
         history_list = []
-        for item in project_history:
+        for item in page_history:
+            collection_ref = reference_id(item, 'collection')
             history_list.append({
                 'id': str(item.id),
                 'type': 'project_image',
@@ -1711,36 +1658,27 @@ def api_recent_project_history(request):
                     'name': item.project.name if item.project else 'Unknown Project'
                 },
                 'collection': {
-                    'id': str(item.collection.id) if item.collection else None
+                    'id': str(collection_ref) if collection_ref else None
                 },
                 'metadata': item.metadata or {}
             })
 
-        # Apply pagination
-        total_count = len(history_list)
-        start_idx = (page - 1) * limit
-        end_idx = start_idx + limit
-        paginated_history = history_list[start_idx:end_idx]
-
         return JsonResponse({
             'success': True,
-            'history': paginated_history,
-            'pagination': {
-                'page': page,
-                'limit': limit,
-                'total': total_count,
-                'pages': (total_count + limit - 1) // limit
-            }
+            'history': history_list,
+            'pagination': pagination
         })
 
+    except InvalidPageParameter as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_recent_project_history")
         return JsonResponse({'error': str(e)}, status=500)
 
 
 @require_http_methods(["GET"])
 @authenticate
+@conditional_get(collection_history_version)
 def api_collection_history(request, collection_id):
     """Get image generation history for a specific collection, grouped by product images"""
     try:
@@ -1769,10 +1707,13 @@ def api_collection_history(request, collection_id):
             filtered_history = []
             for item in collection_history:
                 # Check if the history item's project matches the collection's project
+                # Compared by id, without loading each item's project/collection
+                item_project_ref = reference_id(item, 'project')
+                item_collection_ref = reference_id(item, 'collection')
                 item_project_id = str(
-                    item.project.id) if item.project else None
+                    item_project_ref) if item_project_ref else None
                 item_collection_id = str(
-                    item.collection.id) if item.collection else None
+                    item_collection_ref) if item_collection_ref else None
 
                 # Include if project matches OR if no project but collection matches
                 if item_project_id == project_id:
@@ -1878,8 +1819,7 @@ def api_collection_history(request, collection_id):
         })
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_collection_history")
         return JsonResponse({'error': str(e)}, status=500)
 
 
@@ -1889,6 +1829,7 @@ def api_collection_history(request, collection_id):
 @csrf_exempt
 @authenticate
 @require_http_methods(["POST"])
+@rate_limit('generation')
 def api_image_enhance(request):
     """Auto-enhance a Cloudinary image and store it in projects section with proper tracking."""
     try:
@@ -1896,6 +1837,8 @@ def api_image_enhance(request):
         image_url = data.get("image_url")
         collection_id = data.get("collection_id")
         product_image_path = data.get("product_image_path")
+        # The generated image can be addressed by id instead of by paths
+        generated_image_id = data.get("generated_image_id")
         generated_image_path = data.get("generated_image_path")
 
         if not image_url:
@@ -1904,10 +1847,10 @@ def api_image_enhance(request):
         if not collection_id:
             return JsonResponse({"error": "collection_id is required"}, status=400)
 
-        if not product_image_path:
+        if not product_image_path and not generated_image_id:
             return JsonResponse({"error": "product_image_path is required"}, status=400)
 
-        if not generated_image_path:
+        if not generated_image_path and not generated_image_id:
             return JsonResponse({"error": "generated_image_path is required"}, status=400)
 
         user = request.user
@@ -1938,42 +1881,34 @@ def api_image_enhance(request):
             ]
         )
 
-        # Get the collection and find the specific product image
+        # Get the collection and find the specific generated image
         try:
-            collection = Collection.objects.get(id=collection_id)
-            if not collection.items:
-                return JsonResponse({"error": "No collection items found"}, status=404)
-
-            item = collection.items[0]
-            product_image = None
-
-            # Find the specific product image
-            for product in item.product_images:
-                if product.uploaded_image_path == product_image_path:
-                    product_image = product
-                    break
-
-            if not product_image:
-                return JsonResponse({"error": "Product image not found"}, status=404)
-
-            # Find the specific generated image
-            generated_image = None
-            for img in product_image.generated_images:
-                if img.get("local_path") == generated_image_path:
-                    generated_image = img
-                    break
+            collection = Collection.objects.only('project').get(id=collection_id)
 
+            # Find the specific generated image (indexed lookup by id or path)
+            generated_image = find_generated_image(
+                collection.id, generated_image_path, kinds=["generated"],
+                image_id=generated_image_id)
             if not generated_image:
                 return JsonResponse({"error": "Generated image not found"}, status=404)
+            generated_image_path = generated_image.local_path
+
+            # Resolve its product on the server instead of scanning all products
+            product_image = find_product(
+                collection.id, product_id=generated_image.product_id)
+            if not product_image or (
+                    product_image_path and product_image.uploaded_image_path != product_image_path):
+                return JsonResponse({"error": "Product image not found"}, status=404)
+            product_image_path = product_image.uploaded_image_path
 
             # Create enhanced image entry
             enhanced_image_entry = {
-                "type": f"{generated_image.get('type', 'generated')}_enhanced",
-                "prompt": f"{generated_image.get('prompt', '')} (Enhanced with AI)",
+                "type": f"{generated_image.type or 'generated'}_enhanced",
+                "prompt": f"{generated_image.prompt or ''} (Enhanced with AI)",
                 "local_path": generated_image_path.replace('.png', '_enhanced.png'),
                 "cloud_url": enhanced_url,
                 "created_at": datetime.now(timezone.utc).isoformat(),
-                "model_used": generated_image.get("model_used", {}),
+                "model_used": generated_image.model_used or {},
                 "enhanced_from": {
                     "original_url": image_url,
                     "original_path": generated_image_path,
@@ -1981,23 +1916,19 @@ def api_image_enhance(request):
                 }
             }
 
-            # Add enhanced image to the generated image's enhanced_images list
-            if "enhanced_images" not in generated_image:
-                generated_image["enhanced_images"] = []
-
-            generated_image["enhanced_images"].append(enhanced_image_entry)
-
-            # Save the collection
-            collection.save()
-
-            # Track enhancement in history
-            from .history_utils import track_project_image_generation
-            track_project_image_generation(
-                user_id=user_id,
-                collection_id=collection_id,
-                image_type=f"{generated_image.get('type', 'generated')}_enhanced",
+            # Store the enhanced image under the generated image it came from
+            enhanced_image = create_generated_image(
+                collection, product_image, enhanced_image_entry,
+                kind="enhanced", parent=generated_image, user=user)
+            enhanced_image_entry["id"] = str(enhanced_image.id)
+            record_image_counts(collection, {"enhanced": 1})
+
+            # Track enhancement in history (the collection is already loaded)
+            history = HistoryWriter.for_collection(collection, user_id)
+            history.add(
+                image_type=enhanced_image_entry["type"],
                 image_url=enhanced_url,
-                prompt=f"{generated_image.get('prompt', '')} (Enhanced with AI)",
+                prompt=enhanced_image_entry["prompt"],
                 local_path=enhanced_image_entry["local_path"],
                 metadata={
                     "enhanced_from": image_url,
@@ -2006,6 +1937,7 @@ def api_image_enhance(request):
                     "generated_image_path": generated_image_path
                 }
             )
+            history.flush()
 
             return JsonResponse({
                 "success": True,
@@ -2017,13 +1949,11 @@ def api_image_enhance(request):
         except Collection.DoesNotExist:
             return JsonResponse({"error": "Collection not found"}, status=404)
         except Exception as e:
-            import traceback
-            traceback.print_exc()
+            logger.exception("Error storing enhanced image")
             return JsonResponse({"error": str(e)}, status=500)
 
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_image_enhance")
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -2059,34 +1989,32 @@ def api_remove_model(request, collection_id):
 
         # Choose correct list based on type
         if model_type == "ai":
-            models_list = item.generated_model_images
+            models_field = "generated_model_images"
         elif model_type == "real":
-            models_list = item.uploaded_model_images
+            models_field = "uploaded_model_images"
         else:
             return JsonResponse({"error": "Invalid model type"}, status=400)
 
-        # Filter out the model to delete
+        # Match the model to delete by cloud URL or local path
         model_cloud = model.get("cloud")
         model_local = model.get("local")
-        new_list = [m for m in models_list if m.get(
-            "cloud") != model_cloud and m.get("local") != model_local]
+        matches = [{key: value} for key, value in (
+            ("cloud", model_cloud), ("local", model_local)) if value]
+        if not matches:
+            return JsonResponse({"error": "Model cloud URL or local path is required"}, status=400)
 
-        # Update the list
-        if model_type == "ai":
-            item.generated_model_images = new_list
-        else:
-            item.uploaded_model_images = new_list
+        pull_item_values(collection.id, models_field, {"$or": matches})
 
         # If deleted model was selected, clear it
-        selected = item.selected_model or {}
-        if selected.get("cloud") == model_cloud or selected.get("local") == model_local:
-            item.selected_model = {}
-
-        collection.save()
+        update_collection(
+            collection.id,
+            {"$set": {item_field("selected_model"): {}}},
+            query={"$or": [{item_field(f"selected_model.{key}"): value}
+                           for match in matches for key, value in match.items()]})
         return JsonResponse({"success": True, "message": "Model removed successfully"})
 
     except Exception as e:
-        print("Error removing model:", str(e))
+        logger.exception("Error removing model")
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -2098,48 +2026,55 @@ def api_remove_product_image(request, collection_id):
     Remove a specific product image from the collection.
     Body:
     {
-        "product_image_url": "..." or "product_image_path": "..."
+        "product_id": "..." or "product_image_url": "..." or "product_image_path": "..."
     }
     """
     try:
         data = json.loads(request.body)
+        product_id = data.get("product_id")
         product_image_url = data.get("product_image_url")
         product_image_path = data.get("product_image_path")
 
-        if not product_image_url and not product_image_path:
-            return JsonResponse({"error": "Product image URL or path is required"}, status=400)
+        if not product_id and not product_image_url and not product_image_path:
+            return JsonResponse({"error": "Product id, image URL or path is required"}, status=400)
 
-        collection = Collection.objects(id=collection_id).first()
+        collection = Collection.objects(id=collection_id).only('project').first()
         if not collection:
             return JsonResponse({"error": "Collection not found"}, status=404)
 
-        if not collection.items:
-            return JsonResponse({"error": "No items found in this collection"}, status=404)
-
-        # For simplicity, assuming only one item per collection
-        item = collection.items[0]
-
-        if not hasattr(item, "product_images") or not item.product_images:
-            return JsonResponse({"error": "No product images found in this collection"}, status=404)
-
-        # Filter out the product image to delete
-        new_product_images = []
-        for product_img in item.product_images:
-            # Match by URL or path
-            if product_image_url and product_img.uploaded_image_url == product_image_url:
-                continue  # Skip this product image
-            if product_image_path and product_img.uploaded_image_path == product_image_path:
-                continue  # Skip this product image
-            new_product_images.append(product_img)
-
-        # Update the list
-        item.product_images = new_product_images
-        collection.save()
+        # Find the product images to delete (matched on the server)
+        removed_product_images = find_products(
+            collection.id,
+            product_ids=[product_id] if product_id else None,
+            paths=[product_image_path] if product_image_path else None,
+            urls=[product_image_url] if product_image_url else None)
+
+        if not removed_product_images:
+            return JsonResponse({"success": True, "message": "Product image removed successfully"})
+
+        # Pull only the removed products so concurrent uploads are kept
+        pull_item_values(collection.id, "product_images", {"$or": [
+            {"uploaded_image_url": product_img.uploaded_image_url,
+             "uploaded_image_path": product_img.uploaded_image_path}
+            for product_img in removed_product_images
+        ]})
+
+        # Drop everything generated from the removed products
+        removed_filters = {"product_id__in": [
+            product_img.product_id for product_img in removed_product_images]}
+        removed_kinds, removed_models = tally_collection_images(
+            collection.id, **removed_filters)
+        GeneratedImage.objects(collection=collection.id,
+                               **removed_filters).delete()
+        touch_collection(collection.id)
+        removed_kinds["product"] += len(removed_product_images)
+        record_image_counts(collection, removed_kinds,
+                            removed_models, sign=-1)
 
         return JsonResponse({"success": True, "message": "Product image removed successfully"})
 
     except Exception as e:
-        print("Error removing product image:", str(e))
+        logger.exception("Error removing product image")
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -2165,45 +2100,32 @@ def api_prompt_master_list(request):
         if is_active_filter is not None:
             query['is_active'] = is_active_filter.lower() == 'true'
 
-        if query:
-            prompts = PromptMaster.objects(
-                **query).order_by('category', 'prompt_key')
+        # Ordered by category, then prompt_key (unique), so it can be keyset paginated
+        prompts = PromptMaster.objects(**query).as_pymongo()
+        sort = (("category", 1), ("prompt_key", 1))
+        if 'cursor' in request.GET or 'limit' in request.GET:
+            prompts, pagination = paginate(request, prompts, sort=sort, default_limit=MAX_LIMIT)
         else:
-            prompts = PromptMaster.objects.all().order_by('category', 'prompt_key')
-
-        prompts_data = []
-        for prompt in prompts:
-            prompts_data.append({
-                "id": str(prompt.id),
-                "prompt_key": prompt.prompt_key,
-                "title": prompt.title,
-                "description": prompt.description,
-                "prompt_content": prompt.prompt_content,
-                "instructions": prompt.instructions or "",
-                "rules": prompt.rules or "",
-                "category": prompt.category,
-                "prompt_type": prompt.prompt_type,
-                "is_active": prompt.is_active,
-                "created_at": prompt.created_at.isoformat() if prompt.created_at else None,
-                "updated_at": prompt.updated_at.isoformat() if prompt.updated_at else None,
-                "created_by": str(prompt.created_by.id) if prompt.created_by else None,
-                "updated_by": str(prompt.updated_by.id) if prompt.updated_by else None,
-                "metadata": prompt.metadata or {}
-            })
+            # Clients that do not paginate still get every prompt
+            prompts = prompts.order_by('category', 'prompt_key')
+            pagination = {'limit': None, 'next_cursor': None, 'has_more': False}
+        prompts_data = [serialize_prompt(prompt) for prompt in prompts]
 
         # Also return unique categories for frontend convenience
-        all_categories = list(
-            set([p.category for p in PromptMaster.objects.all() if p.category]))
-        all_categories.sort()
+        all_categories = sorted(
+            category for category in PromptMaster.objects.distinct('category') if category)
 
         return JsonResponse({
             "success": True,
             "prompts": prompts_data,
-            "categories": all_categories  # Include all available categories
+            "categories": all_categories,  # Include all available categories
+            "pagination": pagination
         })
 
+    except InvalidPageParameter as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
-        print("Error fetching prompts:", str(e))
+        logger.exception("Error fetching prompts")
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -2214,32 +2136,17 @@ def api_prompt_master_detail(request, prompt_id):
     """Get a specific prompt by ID"""
     try:
         user = request.user
-        prompt = PromptMaster.objects.get(id=prompt_id)
-
-        prompt_data = {
-            "id": str(prompt.id),
-            "prompt_key": prompt.prompt_key,
-            "title": prompt.title,
-            "description": prompt.description,
-            "prompt_content": prompt.prompt_content,
-            "instructions": prompt.instructions or "",
-            "rules": prompt.rules or "",
-            "category": prompt.category,
-            "prompt_type": prompt.prompt_type,
-            "is_active": prompt.is_active,
-            "created_at": prompt.created_at.isoformat() if prompt.created_at else None,
-            "updated_at": prompt.updated_at.isoformat() if prompt.updated_at else None,
-            "created_by": str(prompt.created_by.id) if prompt.created_by else None,
-            "updated_by": str(prompt.updated_by.id) if prompt.updated_by else None,
-            "metadata": prompt.metadata or {}
-        }
+        prompt = PromptMaster.objects(id=prompt_id).as_pymongo().first()
+        if prompt is None:
+            return JsonResponse({"error": "Prompt not found"}, status=404)
+        prompt_data = serialize_prompt(prompt)
 
         return JsonResponse({"success": True, "prompt": prompt_data})
 
     except PromptMaster.DoesNotExist:
         return JsonResponse({"error": "Prompt not found"}, status=404)
     except Exception as e:
-        print("Error fetching prompt:", str(e))
+        logger.exception("Error fetching prompt")
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -2271,6 +2178,7 @@ def api_prompt_master_create(request):
             metadata=data.get('metadata', {})
         )
         prompt.save()
+        bump_prompt_version()
 
         prompt_data = {
             "id": str(prompt.id),
@@ -2293,7 +2201,7 @@ def api_prompt_master_create(request):
         return JsonResponse({"success": True, "prompt": prompt_data}, status=201)
 
     except Exception as e:
-        print("Error creating prompt:", str(e))
+        logger.exception("Error creating prompt")
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -2331,6 +2239,7 @@ def api_prompt_master_update(request, prompt_id):
         prompt.updated_by = user
         prompt.updated_at = datetime.now(timezone.utc)
         prompt.save()
+        bump_prompt_version()
 
         prompt_data = {
             "id": str(prompt.id),
@@ -2355,7 +2264,7 @@ def api_prompt_master_update(request, prompt_id):
     except PromptMaster.DoesNotExist:
         return JsonResponse({"error": "Prompt not found"}, status=404)
     except Exception as e:
-        print("Error updating prompt:", str(e))
+        logger.exception("Error updating prompt")
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -2368,13 +2277,14 @@ def api_prompt_master_delete(request, prompt_id):
         user = request.user
         prompt = PromptMaster.objects.get(id=prompt_id)
         prompt.delete()
+        bump_prompt_version()
 
         return JsonResponse({"success": True, "message": "Prompt deleted successfully"})
 
     except PromptMaster.DoesNotExist:
         return JsonResponse({"error": "Prompt not found"}, status=404)
     except Exception as e:
-        print("Error deleting prompt:", str(e))
+        logger.exception("Error deleting prompt")
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -2405,7 +2315,7 @@ def api_prompt_master_get_by_key(request, prompt_key):
     except PromptMaster.DoesNotExist:
         return JsonResponse({"error": "Prompt not found"}, status=404)
     except Exception as e:
-        print("Error fetching prompt by key:", str(e))
+        logger.exception("Error fetching prompt by key")
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -2426,5 +2336,5 @@ def api_prompt_master_initialize(request):
         })
 
     except Exception as e:
-        print("Error initializing prompts:", str(e))
+        logger.exception("Error initializing prompts")
         return JsonResponse({"error": str(e)}, status=500)
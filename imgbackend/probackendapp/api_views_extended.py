@@ -2,58 +2,43 @@
 Extended API views for advanced features:
 - Model usage statistics
 - Role-based access control endpoints
+- Response cache statistics
 """
 
-from django.http import JsonResponse
+import logging
+from common.responses import JsonResponse
 from django.views.decorators.http import require_http_methods
 from mongoengine.errors import DoesNotExist
 from .models import Collection
-from .permissions import require_collection_role, get_user_role_in_project
+from .permissions import require_collection_role
+from .membership_utils import get_project_role, project_exists
+from .image_counters import decode_counter_key
 from common.middleware import authenticate
+from common.response_cache import cache_response, response_cache_stats
+from users.models import Role
+
+logger = logging.getLogger(__name__)
 
 
 @require_http_methods(["GET"])
 @authenticate
+@cache_response(lambda request, collection_id: {'collection': collection_id}, per_user=False)
 def api_get_model_usage_stats(request, collection_id):
     """
     Get model usage statistics for a collection.
     Returns count of models used and their types.
     """
     try:
-        collection = Collection.objects.get(id=collection_id)
-
-        if not collection.items:
-            return JsonResponse({
-                "success": True,
-                "total_models_used": 0,
-                "models_breakdown": [],
-                "total_generations": 0
-            })
-
-        item = collection.items[0]
-        products = item.product_images or []
+        # Usage is kept in denormalized counters, no need to load the items
+        collection = Collection.objects.only(
+            'model_usage_counts').get(id=collection_id)
 
-        # Track model usage
-        model_usage = {}  # key: model identifier, value: count
-        total_generations = 0
-
-        for product in products:
-            for gen_img in product.generated_images:
-                # Count initial generation
-                model_info = gen_img.get("model_used", {})
-                if model_info:
-                    model_key = f"{model_info.get('type', 'unknown')}:{model_info.get('name', 'unnamed')}"
-                    model_usage[model_key] = model_usage.get(model_key, 0) + 1
-                    total_generations += 1
-
-                # Count regenerations
-                for regen in gen_img.get("regenerated_images", []):
-                    regen_model = regen.get("model_used", {})
-                    if regen_model:
-                        regen_key = f"{regen_model.get('type', 'unknown')}:{regen_model.get('name', 'unnamed')}"
-                        model_usage[regen_key] = model_usage.get(
-                            regen_key, 0) + 1
-                        total_generations += 1
+        model_usage = {
+            decode_counter_key(model_key): count
+            for model_key, count in (collection.model_usage_counts or {}).items()
+            if count > 0
+        }
+        total_generations = sum(model_usage.values())
 
         # Format breakdown
         models_breakdown = []
@@ -78,8 +63,7 @@ def api_get_model_usage_stats(request, collection_id):
             "error": "Collection not found"
         }, status=404)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in api_get_model_usage_stats")
         return JsonResponse({
             "success": False,
             "error": str(e)
@@ -93,12 +77,14 @@ def api_get_user_role(request, project_id):
     Get the current user's role in a project.
     """
     try:
-        from .models import Project
-
-        project = Project.objects.get(id=project_id)
-        user_role = get_user_role_in_project(request.user, project)
+        user_role = get_project_role(request.user.id, project_id)
 
         if not user_role:
+            if not project_exists(project_id):
+                return JsonResponse({
+                    "success": False,
+                    "error": "Project not found"
+                }, status=404)
             return JsonResponse({
                 "success": False,
                 "error": "You are not a member of this project"
@@ -116,13 +102,22 @@ def api_get_user_role(request, project_id):
             }
         })
 
-    except DoesNotExist:
-        return JsonResponse({
-            "success": False,
-            "error": "Project not found"
-        }, status=404)
     except Exception as e:
         return JsonResponse({
             "success": False,
             "error": str(e)
         }, status=500)
+
+
+@require_http_methods(["GET"])
+@authenticate(stateless=True)
+def api_response_cache_stats(request):
+    """
+    Hit ratio of the response cache of the worker serving the request (admins only).
+    """
+    if request.user.role != Role.ADMIN:
+        return JsonResponse({
+            "success": False,
+            "error": "Only admins can view cache statistics"
+        }, status=403)
+    return JsonResponse({"success": True, "stats": response_cache_stats()})
@@ -0,0 +1,172 @@
+"""
+Targeted updates for Collection documents.
+
+Loading a collection, changing one nested field and calling collection.save()
+rewrites the whole document, and concurrent requests overwrite each other's
+changes. The helpers below send only the change ($set / $push / $pull) for the
+collection's first item, which is where all workflow data lives.
+
+Every update also increments Collection.revision, sets updated_at and
+invalidates the collection's cached responses. When a
+change has to be computed from the current data (read-modify-write), pass the
+revision that was read as expected_revision, or use update_with_retry(), so
+the write only applies if nobody else changed the collection in between.
+"""
+from datetime import datetime
+from bson import ObjectId
+from common.response_cache import invalidate
+from .models import Collection
+
+# All workflow data is stored on the collection's first item
+ITEM_PATH = "items.0"
+
+
+class ConcurrentUpdateError(Exception):
+    """Raised when a collection kept changing while an update was retried"""
+
+
+def item_field(field):
+    """Full path of a field of the collection's first item"""
+    return f"{ITEM_PATH}.{field}"
+
+
+def to_mongo_value(value):
+    """Convert embedded documents (or lists of them) to plain MongoDB values"""
+    if isinstance(value, (list, tuple)):
+        return [to_mongo_value(v) for v in value]
+    if hasattr(value, "to_mongo"):
+        return value.to_mongo().to_dict()
+    return value
+
+
+def _revision_query(expected_revision):
+    if expected_revision:
+        return {"revision": expected_revision}
+    # Collections stored before revisions existed have no field yet
+    return {"$or": [{"revision": 0}, {"revision": {"$exists": False}}]}
+
+
+def update_collection(collection_id, update, expected_revision=None, array_filters=None, query=None):
+    """
+    Apply a raw update to one collection and bump its revision and updated_at.
+
+    Args:
+        collection_id (str|ObjectId): ID of the collection
+        update (dict): Raw MongoDB update, e.g. {"$push": {...}}
+        expected_revision (int, optional): Only apply if the collection still has this revision
+        array_filters (list, optional): Array filters for $[<identifier>] paths
+        query (dict, optional): Extra raw conditions the collection must match
+
+    Returns:
+        bool: True if the collection was updated
+    """
+    raw_query = {"_id": ObjectId(str(collection_id))}
+    if query:
+        raw_query.update(query)
+    if expected_revision is not None:
+        raw_query = {"$and": [raw_query, _revision_query(expected_revision)]}
+
+    update = dict(update)
+    update["$inc"] = dict(update.get("$inc", {}), revision=1)
+    update["$set"] = {"updated_at": datetime.utcnow(), **update.get("$set", {})}
+
+    updated = Collection.objects(__raw__=raw_query).update_one(
+        __raw__=update, array_filters=array_filters)
+    if updated:
+        invalidate(collection=collection_id)
+    return updated == 1
+
+
+def touch_collection(collection_id):
+    """
+    Bump the revision of a collection whose data stored elsewhere changed
+    (e.g. its generated images), so its detail is served fresh.
+    """
+    return update_collection(collection_id, {})
+
+
+def set_item_fields(collection_id, fields, collection_fields=None, expected_revision=None):
+    """
+    $set fields of the collection's first item (and optionally of the collection).
+
+    Args:
+        collection_id (str): ID of the collection
+        fields (dict): Item field name -> new value
+        collection_fields (dict, optional): Top level field name -> new value
+        expected_revision (int, optional): See update_collection
+
+    Returns:
+        bool: True if the collection was updated
+    """
+    values = {item_field(k): to_mongo_value(v) for k, v in fields.items()}
+    values.update({k: to_mongo_value(v)
+                  for k, v in (collection_fields or {}).items()})
+    return update_collection(collection_id, {"$set": values},
+                             expected_revision=expected_revision)
+
+
+def push_item_values(collection_id, field, values):
+    """
+    Atomically append values to a list field of the collection's first item.
+
+    Returns:
+        bool: True if the collection was updated
+    """
+    if not values:
+        return False
+    return update_collection(collection_id, {
+        "$push": {item_field(field): {"$each": to_mongo_value(list(values))}}
+    })
+
+
+def pull_item_values(collection_id, field, condition):
+    """
+    Atomically remove the elements matching a condition from a list field of the first item.
+
+    Args:
+        collection_id (str): ID of the collection
+        field (str): List field of the item, e.g. 'uploaded_model_images'
+        condition (dict): Query the removed elements match, e.g. {"cloud": url}
+
+    Returns:
+        bool: True if the collection was updated
+    """
+    return update_collection(collection_id, {"$pull": {item_field(field): condition}})
+
+
+def update_with_retry(collection_id, build_update, retries=5, only=None):
+    """
+    Optimistic read-modify-write of a collection.
+
+    The collection is loaded, build_update(collection) returns the raw update
+    to apply (or None for no change), and the update is only applied if the
+    revision did not change meanwhile. On a conflict the collection is reloaded
+    and the update rebuilt.
+
+    Args:
+        collection_id (str): ID of the collection
+        build_update (callable): Collection -> raw update dict or None
+        retries (int): Attempts before giving up
+        only (tuple, optional): Fields to load, 'revision' is always added
+
+    Returns:
+        Collection: The collection the applied update was built from
+
+    Raises:
+        Collection.DoesNotExist: If the collection does not exist
+        ConcurrentUpdateError: If every attempt conflicted
+    """
+    for _ in range(retries):
+        queryset = Collection.objects
+        if only:
+            queryset = queryset.only("revision", *only)
+        collection = queryset.get(id=collection_id)
+
+        update = build_update(collection)
+        if not update:
+            return collection
+        if update_collection(collection_id, update, expected_revision=collection.revision or 0):
+            return collection
+
+    raise ConcurrentUpdateError(
+        f"Collection {collection_id} was modified concurrently, please retry")
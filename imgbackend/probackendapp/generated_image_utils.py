@@ -0,0 +1,284 @@
+"""
+Helpers for the GeneratedImage collection.
+
+Generated, regenerated and enhanced images used to be nested dicts inside
+Collection.items[0].product_images[*].generated_images. They are now stored as
+their own documents, so adding an image is a single insert and reads are
+indexed queries. The helpers below also rebuild the old nested shape, which is
+what the frontend still expects from the collection detail endpoints.
+"""
+from datetime import datetime, timezone
+from bson import ObjectId
+from .models import Collection, GeneratedImage, ProductImage
+from .collection_updates import ConcurrentUpdateError, to_mongo_value, touch_collection, update_collection
+from .lineage_utils import lineage_for
+
+# Keys of the embedded format that map onto GeneratedImage fields
+IMAGE_FIELDS = (
+    "type", "prompt", "original_prompt", "combined_prompt", "local_path",
+    "cloud_url", "model_used", "enhanced_from", "product_image_path",
+)
+
+
+def _isoformat(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.isoformat()
+    return value
+
+
+def _parse_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    if value:
+        try:
+            parsed = datetime.fromisoformat(str(value))
+            if parsed.tzinfo is not None:
+                parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+            return parsed
+        except ValueError:
+            pass
+    return datetime.utcnow()
+
+
+def ensure_product_ids(collection, retries=5):
+    """
+    Persist ProductImage.product_id for products stored before it existed.
+
+    MongoEngine fills the default on load but does not mark it as changed,
+    so the loaded items are written back, guarded by the collection revision.
+
+    Returns:
+        Collection: The collection whose product ids are stored; reloaded if
+        it changed concurrently, so callers must use it from here on
+    """
+    for _ in range(retries):
+        missing = Collection.objects(__raw__={
+            "_id": collection.id,
+            "items.product_images": {"$elemMatch": {"product_id": {"$exists": False}}},
+        }).count()
+        if not missing:
+            return collection
+        if update_collection(collection.id, {"$set": {"items": to_mongo_value(collection.items)}},
+                             expected_revision=collection.revision or 0):
+            # Keep the loaded revision current for the caller's own guarded updates
+            collection.revision = (collection.revision or 0) + 1
+            return collection
+        collection = Collection.objects.get(id=collection.id)
+
+    raise ConcurrentUpdateError(
+        f"Collection {collection.id} was modified concurrently, please retry")
+
+
+def create_generated_image(collection, product, data, kind="generated", parent=None, user=None,
+                           image_id=None, touch=True):
+    """
+    Insert one generated image document.
+
+    Args:
+        collection (Collection): The collection the image belongs to
+        product (ProductImage): The product the image was generated from
+        data (dict): Image data in the embedded format (type, prompt, local_path, ...)
+        kind (str): 'generated', 'regenerated' or 'enhanced'
+        parent (GeneratedImage, optional): Generated image a regenerated or enhanced image comes from
+        user (User, optional): User who generated the image
+        image_id (ObjectId, optional): ID of the new document, generated if not given
+        touch (bool): Bump the collection's revision; False when the caller
+            updates the collection itself afterwards with expected_revision
+
+    Returns:
+        GeneratedImage: The saved document
+    """
+    data = dict(data)
+    fields = {key: data.pop(key) for key in IMAGE_FIELDS if key in data}
+    created_at = _parse_datetime(data.pop("created_at", None))
+    # Nested lists belong to the embedded format and are stored as documents
+    data.pop("regenerated_images", None)
+    data.pop("enhanced_images", None)
+    data.pop("id", None)
+
+    fields.setdefault("product_image_path", product.uploaded_image_path)
+    if parent is not None:
+        fields.update(lineage_for(parent))
+    image = GeneratedImage(
+        id=image_id,
+        collection=collection.id,
+        project=collection._data.get("project"),
+        product_id=product.product_id,
+        parent=parent,
+        kind=kind,
+        metadata=data,
+        created_by=user,
+        updated_by=user,
+        created_at=created_at,
+        updated_at=created_at,
+        **fields
+    )
+    image.save(force_insert=True)
+    if touch:
+        # The collection detail includes its generated images
+        touch_collection(collection.id)
+    return image
+
+
+def find_generated_image(collection_id, local_path=None, kinds=None, image_id=None, cloud_url=None):
+    """
+    Find an image of a collection by its id, local path or cloud URL.
+
+    Every lookup is an indexed query; the id is used when given, then the
+    local path, then the URL.
+
+    Args:
+        collection_id (str): ID of the collection
+        local_path (str, optional): The image's local path
+        kinds (list, optional): Only match these kinds
+        image_id (str, optional): The image's id
+        cloud_url (str, optional): The image's cloud URL
+
+    Returns:
+        GeneratedImage: The image, or None if not found
+    """
+    if image_id:
+        if not ObjectId.is_valid(str(image_id)):
+            return None
+        query = GeneratedImage.objects(collection=collection_id, id=image_id)
+    elif local_path:
+        query = GeneratedImage.objects(collection=collection_id, local_path=local_path)
+    elif cloud_url:
+        query = GeneratedImage.objects(collection=collection_id, cloud_url=cloud_url)
+    else:
+        return None
+    if kinds:
+        query = query.filter(kind__in=list(kinds))
+    return query.first()
+
+
+def find_products(collection_id, product_ids=None, paths=None, urls=None):
+    """
+    Resolve products of a collection's first item by id, uploaded path or URL.
+
+    The products are filtered on the server, so only the matching entries are
+    sent back instead of the whole collection document.
+
+    Args:
+        collection_id (str): ID of the collection
+        product_ids (list, optional): ProductImage.product_id values
+        paths (list, optional): uploaded_image_path values
+        urls (list, optional): uploaded_image_url values
+
+    Returns:
+        list: Matching ProductImage objects, in their stored order
+    """
+    conditions = [
+        {"$in": [f"$$product.{field}", values]}
+        for field, values in (
+            ("product_id", [ObjectId(str(v)) for v in product_ids or [] if ObjectId.is_valid(str(v))]),
+            ("uploaded_image_path", [v for v in paths or [] if v]),
+            ("uploaded_image_url", [v for v in urls or [] if v]),
+        )
+        if values
+    ]
+    if not conditions:
+        return []
+
+    pipeline = [
+        {"$match": {"_id": ObjectId(str(collection_id))}},
+        {"$project": {"_id": 0, "products": {"$filter": {
+            "input": {"$ifNull": [{"$arrayElemAt": ["$items.product_images", 0]}, []]},
+            "as": "product",
+            "cond": {"$or": conditions},
+        }}}},
+    ]
+    for row in Collection.objects.aggregate(pipeline):
+        return [ProductImage._from_son(product) for product in row.get("products") or []]
+    return []
+
+
+def find_product(collection_id, product_id=None, path=None, url=None):
+    """
+    Resolve one product of a collection, see find_products.
+
+    Returns:
+        ProductImage: The first matching product, or None
+    """
+    products = find_products(
+        collection_id,
+        product_ids=[product_id] if product_id else None,
+        paths=[path] if path else None,
+        urls=[url] if url else None)
+    return products[0] if products else None
+
+
+def serialize_generated_image(image):
+    """
+    Convert a GeneratedImage (document or raw pymongo dict) to the embedded format.
+
+    Returns:
+        dict: The image with 'id' and 'kind' added
+    """
+    if isinstance(image, GeneratedImage):
+        image = image.to_mongo().to_dict()
+
+    data = dict(image.get("metadata") or {})
+    for key in IMAGE_FIELDS:
+        if image.get(key) not in (None, {}):
+            data[key] = image[key]
+    data["model_used"] = image.get("model_used") or {}
+    data["created_at"] = _isoformat(image.get("created_at"))
+    data["id"] = str(image["_id"])
+    data["kind"] = image.get("kind", "generated")
+    if image.get("parent"):
+        data["parent_id"] = str(image["parent"])
+    if image.get("product_id"):
+        data["product_id"] = str(image["product_id"])
+    return data
+
+
+def get_generated_images_by_product(collection_id):
+    """
+    Load a collection's images with one indexed query, grouped per product.
+
+    Regenerated and enhanced images are nested under their parent, matching
+    the old ProductImage.generated_images format.
+
+    Returns:
+        dict: product id (str) -> list of generated image dicts
+    """
+    rows = GeneratedImage.objects(collection=collection_id).order_by(
+        "created_at").as_pymongo()
+
+    by_product = {}
+    by_id = {}
+    children = []
+    for row in rows:
+        image = serialize_generated_image(row)
+        if image["kind"] == "generated":
+            image["regenerated_images"] = []
+            image["enhanced_images"] = []
+            by_id[image["id"]] = image
+            by_product.setdefault(image.get("product_id"), []).append(image)
+        else:
+            children.append(image)
+
+    for image in children:
+        parent = by_id.get(image.get("parent_id"))
+        if parent is None:
+            continue
+        parent[f"{image['kind']}_images"].append(image)
+    return by_product
+
+
+def serialize_product_images(product_images, images_by_product):
+    """Build the product_images list of a collection item response from raw product dicts"""
+    return [
+        {
+            'product_id': product.get('product_id'),
+            'uploaded_image_url': product.get('uploaded_image_url'),
+            'uploaded_image_path': product.get('uploaded_image_path'),
+            # Products that were not migrated yet still carry embedded images
+            'generated_images': images_by_product.get(str(product.get('product_id')))
+            or product.get('generated_images') or []
+        }
+        for product in product_images
+    ]
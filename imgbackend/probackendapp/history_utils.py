@@ -1,8 +1,27 @@
 """
 Utility functions for tracking image generation history
 """
+import logging
+import time
+from django.conf import settings
+from pymongo.errors import PyMongoError
+from common.dereference import reference_id
+from common.response_cache import invalidate
 from .models import ImageGenerationHistory, Project, Collection
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+# A HistoryWriter stores its buffered records once it holds this many...
+HISTORY_FLUSH_SIZE = 50
+# ...or once its oldest buffered record is this many seconds old
+HISTORY_FLUSH_SECONDS = 5.0
+
+
+def history_expiry(created_at):
+    """expires_at of a record created at created_at, None unless HISTORY_TTL_DAYS is set"""
+    ttl_days = getattr(settings, 'HISTORY_TTL_DAYS', 0)
+    return created_at + timedelta(days=ttl_days) if ttl_days else None
 
 
 def track_image_generation(
@@ -53,6 +72,7 @@ def track_image_generation(
                 pass
 
         # Create history record
+        created_at = datetime.now(timezone.utc)
         history_record = ImageGenerationHistory(
             user_id=user_id,
             image_type=image_type,
@@ -64,14 +84,18 @@ def track_image_generation(
             collection=collection,
             local_path=local_path,
             metadata=metadata or {},
-            created_at=datetime.now(timezone.utc)
+            created_at=created_at,
+            expires_at=history_expiry(created_at)
         )
 
         history_record.save()
+        # Recent project activity lists the project's history
+        if project:
+            invalidate(project=project.id)
         return history_record
 
     except Exception as e:
-        print(f"Error tracking image generation history: {str(e)}")
+        logger.exception("Error tracking image generation history")
         # Don't raise the exception to avoid breaking the main flow
         return None
 
@@ -101,25 +125,25 @@ def track_project_image_generation(
         ImageGenerationHistory: The created history record
     """
     try:
-        collection = Collection.objects.get(id=collection_id)
-        project = collection.project
+        # Only the project reference is needed, the project itself is not loaded
+        collection = Collection.objects(
+            id=collection_id).only('project').first()
+        if collection is None:
+            logger.warning("Collection %s not found for history tracking", collection_id)
+            return None
 
-        return track_image_generation(
-            user_id=user_id,
+        history = HistoryWriter.for_collection(collection, user_id)
+        record = history.add(
             image_type=image_type,
             image_url=image_url,
             prompt=prompt,
-            project_id=str(project.id),
-            collection_id=str(collection.id),
             local_path=local_path,
             metadata=metadata
         )
+        return record if history.flush() else None
 
-    except Collection.DoesNotExist:
-        print(f"Collection {collection_id} not found for history tracking")
-        return None
     except Exception as e:
-        print(f"Error tracking project image generation: {str(e)}")
+        logger.exception("Error tracking project image generation")
         return None
 
 
@@ -167,6 +191,127 @@ def track_image_regeneration(
     )
 
 
+class HistoryWriter:
+    """
+    Buffer ImageGenerationHistory records and store them with one insert_many.
+
+    Unlike track_project_image_generation, which looks up the collection and
+    saves each record on its own, the writer takes already resolved
+    references, so a batch of generated images costs a single insert.
+    Records are stored when flush() is called (at the end of the batch or
+    request), or automatically once HISTORY_FLUSH_SIZE records are buffered
+    or the oldest is HISTORY_FLUSH_SECONDS old.
+
+    History is best effort: add() and flush() never raise, errors are logged
+    and the failing records are dropped.
+
+    Usage:
+        history = HistoryWriter.for_collection(collection, str(request.user.id))
+        for image in images:
+            history.add(image_type="project_white_background", image_url=url)
+        history.flush()
+    """
+
+    def __init__(self, user_id, project=None, collection=None,
+                 max_records=HISTORY_FLUSH_SIZE, max_age=HISTORY_FLUSH_SECONDS):
+        """
+        Args:
+            user_id (str): ID of the user the records belong to
+            project (Project|ObjectId, optional): Project of every record
+            collection (Collection|ObjectId, optional): Collection of every record
+            max_records (int): Flush once this many records are buffered
+            max_age (float): Flush once the oldest buffered record is this many seconds old
+        """
+        self.user_id = user_id
+        self.project = project
+        self.collection = collection
+        self.max_records = max_records
+        self.max_age = max_age
+        self._records = []
+        self._first_added = None
+
+    @classmethod
+    def for_collection(cls, collection, user_id, **kwargs):
+        """Writer for records of a loaded collection and its project"""
+        return cls(user_id, project=reference_id(collection, 'project'),
+                   collection=collection.id, **kwargs)
+
+    def add(
+        self,
+        image_type,
+        image_url,
+        prompt=None,
+        original_prompt=None,
+        parent_image_id=None,
+        local_path=None,
+        metadata=None
+    ):
+        """
+        Buffer one record, see track_image_generation for the arguments.
+
+        Returns:
+            ImageGenerationHistory: The record, unsaved until the writer flushes
+        """
+        try:
+            created_at = datetime.now(timezone.utc)
+            record = ImageGenerationHistory(
+                user_id=self.user_id,
+                image_type=image_type,
+                image_url=image_url,
+                prompt=prompt,
+                original_prompt=original_prompt,
+                parent_image_id=parent_image_id,
+                project=self.project,
+                collection=self.collection,
+                local_path=local_path,
+                metadata=metadata or {},
+                created_at=created_at,
+                expires_at=history_expiry(created_at)
+            )
+            record.validate()
+        except Exception as e:
+            logger.exception("Error tracking image generation history")
+            return None
+
+        if not self._records:
+            self._first_added = time.monotonic()
+        self._records.append(record)
+        if len(self._records) >= self.max_records or \
+                time.monotonic() - self._first_added >= self.max_age:
+            self.flush()
+        return record
+
+    def flush(self):
+        """
+        Store the buffered records with one insert_many.
+
+        Returns:
+            int: Number of records stored
+        """
+        records, self._records = self._records, []
+        if not records:
+            return 0
+
+        rows = [record.to_mongo() for record in records]
+        try:
+            ImageGenerationHistory._get_collection().insert_many(rows, ordered=False)
+        except PyMongoError as e:
+            # With ordered=False the valid records are still stored
+            inserted = (getattr(e, 'details', None) or {}).get('nInserted', 0)
+            logger.error(
+                "Error storing image generation history (%s/%s stored): %s", inserted, len(records), e)
+            return inserted
+        except Exception as e:
+            logger.exception("Error storing image generation history")
+            return 0
+
+        for record, row in zip(records, rows):
+            record.id = row['_id']
+        if self.project:
+            invalidate(project=getattr(self.project, 'id', self.project))
+        return len(records)
+
+
 def get_user_recent_activity(user_id, days=30, limit=50):
     """
     Get recent activity for a user
@@ -191,7 +336,7 @@ def get_user_recent_activity(user_id, days=30, limit=50):
         ).order_by('-created_at').limit(limit)
 
     except Exception as e:
-        print(f"Error getting user recent activity: {str(e)}")
+        logger.exception("Error getting user recent activity")
         return []
 
 
@@ -219,5 +364,120 @@ def get_project_recent_activity(project_id, days=30, limit=20):
         ).order_by('-created_at').limit(limit)
 
     except Exception as e:
-        print(f"Error getting project recent activity: {str(e)}")
+        logger.exception("Error getting project recent activity")
         return []
+
+
+# Image types generated in the individual image section; they are already
+# listed from the jewellery collection, so the project history skips them
+INDIVIDUAL_IMAGE_TYPES = [
+    "white_background",
+    "background_change",
+    "model_with_ornament",
+    "real_model_with_ornament",
+    "campaign_shot_advanced",
+    "white_background_regenerated",
+    "background_change_regenerated",
+    "model_with_ornament_regenerated",
+    "real_model_with_ornament_regenerated",
+    "campaign_shot_advanced_regenerated",
+]
+
+
+def get_user_history_page(user_id, start_date, end_date, cursor=None, limit=20, skip=0):
+    """
+    Get one page of a user's merged project and individual image history.
+
+    Both collections are sorted and limited on the server and merged with
+    $unionWith, so a page only reads about `limit` records from each side
+    instead of the user's whole history.
+
+    Args:
+        user_id (str): ID of the user
+        start_date (datetime): Oldest record to include
+        end_date (datetime): Newest record to include
+        cursor (str, optional): Cursor of the last record of the previous page
+        limit (int): Page size
+        skip (int): Records to skip (only for the legacy page parameter)
+
+    Returns:
+        list: Up to skip + limit + 1 raw records, newest first, each with a 'source'
+        of 'project' or 'individual'
+    """
+    from imgbackendapp.mongo_models import OrnamentMongo
+    from common.pagination import keyset_query, keyset_sort
+
+    window = {
+        "user_id": user_id,
+        "created_at": {"$gte": start_date, "$lte": end_date},
+    }
+    after_cursor = keyset_query(cursor)
+    sort = keyset_sort()
+    fetch = skip + limit + 1
+
+    project_match = [
+        window,
+        # Only records that have a project or collection associated
+        {"$or": [
+            {"project": {"$exists": True, "$ne": None}},
+            {"collection": {"$exists": True, "$ne": None}}
+        ]},
+        {"image_type": {"$nin": INDIVIDUAL_IMAGE_TYPES}},
+    ]
+    individual_match = [window]
+    if after_cursor:
+        project_match.append(after_cursor)
+        individual_match.append(after_cursor)
+
+    pipeline = [
+        {"$match": {"$and": project_match}},
+        {"$sort": sort},
+        {"$limit": fetch},
+        {"$project": {
+            "source": "project", "image_type": 1, "image_url": 1, "prompt": 1,
+            "original_prompt": 1, "parent_image_id": 1, "created_at": 1,
+            "project": 1, "collection": 1, "metadata": 1,
+        }},
+        {"$unionWith": {
+            "coll": OrnamentMongo._get_collection_name(),
+            "pipeline": [
+                {"$match": {"$and": individual_match}},
+                {"$sort": sort},
+                {"$limit": fetch},
+                {"$project": {
+                    "source": "individual", "image_type": "$type",
+                    "image_url": "$generated_image_url", "prompt": 1,
+                    "original_prompt": 1, "parent_image_id": 1, "created_at": 1,
+                    "uploaded_image_url": 1, "model_image_url": 1,
+                }},
+            ],
+        }},
+        {"$sort": sort},
+    ]
+    if skip:
+        pipeline.append({"$skip": skip})
+    pipeline.append({"$limit": limit + 1})
+
+    return list(ImageGenerationHistory.objects.aggregate(pipeline))
+
+
+def count_user_history(user_id, start_date, end_date):
+    """
+    Count a user's merged history records in a date window.
+
+    Returns:
+        int: Number of project and individual history records
+    """
+    from imgbackendapp.mongo_models import OrnamentMongo
+
+    window = {"user_id": user_id, "created_at__gte": start_date,
+              "created_at__lte": end_date}
+    project_count = ImageGenerationHistory.objects(
+        __raw__={"$or": [
+            {"project": {"$exists": True, "$ne": None}},
+            {"collection": {"$exists": True, "$ne": None}}
+        ]},
+        image_type__nin=INDIVIDUAL_IMAGE_TYPES,
+        **window
+    ).count()
+    return project_count + OrnamentMongo.objects(**window).count()
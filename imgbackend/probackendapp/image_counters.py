@@ -0,0 +1,201 @@
+"""
+Denormalized image counters for projects and collections.
+
+Every collection (and its project) keeps:
+- total_images: product images + generated images + regenerated images
+  (generated images are stored in the GeneratedImage collection)
+- image_type_counts: counts per kind ('product', 'generated', 'regenerated', 'enhanced')
+- model_usage_counts: generations per model, keyed by "<type>:<name>"
+
+Counters are changed with atomic $inc updates whenever images are added or
+removed, so listing endpoints never have to walk the collection tree.
+Run `python manage.py recount_images` to rebuild them from the source data.
+"""
+import logging
+from collections import Counter
+from common.response_cache import invalidate
+from .models import Project, Collection, GeneratedImage
+
+logger = logging.getLogger(__name__)
+
+# Kinds that make up total_images (enhanced images are tracked separately)
+TOTAL_IMAGE_KINDS = ("product", "generated", "regenerated")
+
+# MongoDB field names cannot contain "." or start with "$"
+_DOT = "．"
+_DOLLAR = "＄"
+
+
+def encode_counter_key(key):
+    """Make a counter key safe to use as a MongoDB field name"""
+    key = str(key).replace(".", _DOT)
+    if key.startswith("$"):
+        key = _DOLLAR + key[1:]
+    return key
+
+
+def decode_counter_key(key):
+    """Reverse encode_counter_key"""
+    if key.startswith(_DOLLAR):
+        key = "$" + key[len(_DOLLAR):]
+    return key.replace(_DOT, ".")
+
+
+def model_usage_key(model_used):
+    """Build the "<type>:<name>" key used for model usage statistics"""
+    if not model_used:
+        return None
+    return f"{model_used.get('type', 'unknown')}:{model_used.get('name', 'unnamed')}"
+
+
+def tally_generated_images(images):
+    """
+    Count generated images by kind and model.
+
+    Args:
+        images (iterable): Raw image dicts with 'kind' and 'model_used'
+
+    Returns:
+        tuple: (Counter of kinds, Counter of model usage keys)
+    """
+    kinds = Counter()
+    models = Counter()
+    for image in images:
+        kind = image.get("kind", "generated")
+        kinds[kind] += 1
+        if kind in TOTAL_IMAGE_KINDS:
+            key = model_usage_key(image.get("model_used"))
+            if key:
+                models[key] += 1
+    return kinds, models
+
+
+def tally_collection_images(collection_id, **filters):
+    """
+    Count a collection's generated images with one aggregation.
+
+    Args:
+        collection_id: ID of the collection
+        **filters: Extra GeneratedImage filters, e.g. product_id__in=[...]
+
+    Returns:
+        tuple: (Counter of kinds, Counter of model usage keys)
+    """
+    pipeline = [
+        {"$group": {
+            "_id": {
+                "kind": "$kind",
+                "type": "$model_used.type",
+                "name": "$model_used.name",
+            },
+            "count": {"$sum": 1},
+        }},
+    ]
+    kinds = Counter()
+    models = Counter()
+    rows = GeneratedImage.objects(
+        collection=collection_id, **filters).aggregate(pipeline)
+    for row in rows:
+        group = row["_id"]
+        model_used = {k: group[k] for k in ("type", "name") if k in group}
+        image_kinds, image_models = tally_generated_images(
+            [{"kind": group.get("kind", "generated"), "model_used": model_used}])
+        for kind in image_kinds:
+            kinds[kind] += row["count"]
+        for key in image_models:
+            models[key] += row["count"]
+    return kinds, models
+
+
+def _build_inc(kinds, models, sign):
+    inc = {}
+    total = 0
+    for kind, count in kinds.items():
+        if not count:
+            continue
+        inc[f"image_type_counts.{encode_counter_key(kind)}"] = sign * count
+        if kind in TOTAL_IMAGE_KINDS:
+            total += count
+    for key, count in models.items():
+        if count:
+            inc[f"model_usage_counts.{encode_counter_key(key)}"] = sign * count
+    if total:
+        inc["total_images"] = sign * total
+    return inc
+
+
+def project_id_of(collection):
+    """Get a collection's project id without dereferencing the project"""
+    project = collection._data.get("project")
+    return getattr(project, "id", project)
+
+
+def record_image_counts(collection, kinds=None, models=None, sign=1):
+    """
+    Atomically apply counter changes to a collection and its project.
+
+    Args:
+        collection (Collection): The collection the images belong to
+        kinds (dict): Number of images per kind
+        models (dict): Number of generations per model usage key
+        sign (int): 1 when images were added, -1 when they were removed
+    """
+    inc = _build_inc(kinds or {}, models or {}, sign)
+    if not inc:
+        return
+
+    try:
+        Collection.objects(id=collection.id).update_one(
+            __raw__={"$inc": inc})
+        project_id = project_id_of(collection)
+        if project_id:
+            Project.objects(id=project_id).update_one(__raw__={"$inc": inc})
+        invalidate(collection=collection.id, project=project_id)
+    except Exception as e:
+        # Counters can be rebuilt with recount_images; never fail the request
+        logger.exception("Error updating image counters")
+
+
+def record_image_delta(collection, before, after):
+    """
+    Apply the difference between two (kinds, models) tallies.
+
+    Used when a whole set of images is replaced, e.g. regenerating all product images.
+    """
+    kinds = Counter(after[0])
+    kinds.subtract(before[0])
+    models = Counter(after[1])
+    models.subtract(before[1])
+    record_image_counts(collection, kinds, models)
+
+
+def recount_collection(collection):
+    """
+    Recompute a collection's counters from its products and generated images and store them.
+
+    Returns:
+        tuple: (Counter of kinds, Counter of model usage keys)
+    """
+    kinds, models = tally_collection_images(collection.id)
+    for item in collection.items or []:
+        kinds["product"] += len(item.product_images or [])
+
+    Collection.objects(id=collection.id).update_one(
+        __raw__={"$set": _counter_fields(kinds, models)})
+    invalidate(collection=collection.id)
+    return kinds, models
+
+
+def store_project_counts(project_id, kinds, models):
+    """Overwrite a project's counters with already computed tallies"""
+    Project.objects(id=project_id).update_one(
+        __raw__={"$set": _counter_fields(kinds, models)})
+    invalidate(project=project_id)
+
+
+def _counter_fields(kinds, models):
+    return {
+        "total_images": sum(kinds[k] for k in TOTAL_IMAGE_KINDS),
+        "image_type_counts": {encode_counter_key(k): v for k, v in kinds.items() if v},
+        "model_usage_counts": {encode_counter_key(k): v for k, v in models.items() if v},
+    }
@@ -0,0 +1,116 @@
+"""
+Materialized lineage of regenerated images.
+
+A regeneration only points at the image it was made from (OrnamentMongo.parent_image_id,
+GeneratedImage.parent), so showing a whole version tree used to mean following
+those links one query at a time. Every image made from another one now also
+stores:
+
+    lineage_root   id of the first image of the chain
+    lineage_depth  number of ancestors (0 for an original image)
+    lineage_path   ids of the ancestors, root first
+
+so a whole tree is one indexed query on lineage_root. Original images keep
+lineage_root empty and are matched by their own id.
+"""
+from bson import ObjectId
+
+# Name of the field linking each model to the image it was made from
+PARENT_FIELDS = {
+    "OrnamentMongo": "parent_image_id",
+    "GeneratedImage": "parent",
+}
+
+
+def _parent_id(document):
+    value = document._data.get(PARENT_FIELDS[type(document).__name__])
+    return getattr(value, "id", value)
+
+
+def _ancestor_path(document):
+    """Ancestor ids of an image, root first, walking up links when not stored yet"""
+    if document.lineage_path or not _parent_id(document):
+        return list(document.lineage_path or [])
+
+    model = type(document)
+    path = []
+    seen = {document.id}
+    parent_id = _parent_id(document)
+    while parent_id and parent_id not in seen:
+        path.insert(0, parent_id)
+        seen.add(parent_id)
+        parent = model.objects(id=parent_id).first()
+        if parent is None:
+            break
+        if parent.lineage_path:
+            return list(parent.lineage_path) + path
+        parent_id = _parent_id(parent)
+    return path
+
+
+def lineage_for(parent):
+    """
+    Lineage fields of an image made from parent.
+
+    Args:
+        parent (OrnamentMongo|GeneratedImage): The image it was regenerated or enhanced from
+
+    Returns:
+        dict: lineage_root, lineage_depth and lineage_path to set on the new image
+    """
+    path = _ancestor_path(parent) + [parent.id]
+    return {
+        "lineage_root": path[0],
+        "lineage_depth": len(path),
+        "lineage_path": path,
+    }
+
+
+def get_lineage_tree(model, image_id, query=None):
+    """
+    Load the whole version tree an image belongs to.
+
+    Args:
+        model (type): OrnamentMongo or GeneratedImage
+        image_id (str): Any image of the tree
+        query (dict, optional): Extra filters the image must match, e.g. user_id
+
+    Returns:
+        tuple: (root id, list of raw images ordered by depth and creation),
+        or (None, []) if the image does not exist
+    """
+    image = model.objects(id=image_id, **(query or {})).only(
+        "lineage_root").as_pymongo().first()
+    if image is None:
+        return None, []
+
+    root_id = image.get("lineage_root") or image["_id"]
+    rows = model.objects(__raw__={
+        "$or": [{"_id": root_id}, {"lineage_root": root_id}]
+    }).order_by("lineage_depth", "created_at").as_pymongo()
+    return root_id, list(rows)
+
+
+def build_lineage_tree(rows, root_id, serialize):
+    """
+    Nest the rows of get_lineage_tree under their parents.
+
+    Args:
+        rows (list): Raw images ordered by depth
+        root_id (ObjectId): Root of the tree
+        serialize (callable): Raw image -> response dict
+
+    Returns:
+        dict: The serialized root with a 'children' list on every node
+    """
+    nodes = {}
+    root = None
+    for row in rows:
+        node = dict(serialize(row), depth=row.get("lineage_depth", 0), children=[])
+        nodes[row["_id"]] = node
+        path = row.get("lineage_path") or []
+        if row["_id"] == ObjectId(str(root_id)):
+            root = node
+        elif path and path[-1] in nodes:
+            nodes[path[-1]]["children"].append(node)
+    return root
@@ -0,0 +1,45 @@
+"""
+Helpers of the benchmark_* management commands (not a command itself).
+
+The benchmarks seed synthetic documents into scratch collections of the
+configured database (benchmark_<collection>), so real data is never read or
+changed, and drop them when done.
+"""
+import timeit
+from contextlib import ExitStack, contextmanager
+from mongoengine.context_managers import switch_collection
+
+PREFIX = 'benchmark_'
+
+
+@contextmanager
+def scratch_collections(*documents):
+    """
+    Point the given Document classes at empty benchmark_* collections.
+
+    The collections get the documents' indexes, and are dropped on exit.
+    """
+    with ExitStack() as stack:
+        switched = [stack.enter_context(switch_collection(
+            document, PREFIX + document._get_collection_name())) for document in documents]
+        for document in switched:
+            document.drop_collection()
+            document.ensure_indexes()
+        try:
+            yield switched
+        finally:
+            for document in switched:
+                document.drop_collection()
+
+
+def insert(document, rows):
+    """Store raw rows (dicts) into a document's collection with insert_many"""
+    if rows:
+        document._get_collection().insert_many(rows, ordered=False)
+    return rows
+
+
+def best_of(func, repeat):
+    """Best wall time of `repeat` calls of func, in milliseconds"""
+    return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
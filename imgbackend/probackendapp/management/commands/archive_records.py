@@ -0,0 +1,53 @@
+"""
+Django management command to archive old generation history and images.
+Run with: python manage.py archive_records [--days N] [--target collection|file] [--dry-run]
+
+Moves ImageGenerationHistory records and OrnamentMongo images (the 'jewellery'
+collection) created more than ARCHIVE_AFTER_DAYS ago to cold storage, see
+common/archive.py. Archived images can still be looked up by id.
+"""
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from common.archive import ARCHIVE_BATCH_SIZE, ARCHIVE_TARGETS, archive_documents
+from imgbackendapp.mongo_models import OrnamentMongo
+from probackendapp.models import ImageGenerationHistory
+
+ARCHIVED_MODELS = {
+    'history': ImageGenerationHistory,
+    'images': OrnamentMongo,
+}
+
+
+class Command(BaseCommand):
+    help = 'Move old generation history and images to cold storage'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.ARCHIVE_AFTER_DAYS,
+            help='Archive records created more than this many days ago')
+        parser.add_argument(
+            '--target', choices=ARCHIVE_TARGETS, default=settings.ARCHIVE_TARGET,
+            help='Archive into a cold collection or into compressed files')
+        parser.add_argument(
+            '--only', choices=sorted(ARCHIVED_MODELS), help='Archive only these records')
+        parser.add_argument(
+            '--batch-size', type=int, default=ARCHIVE_BATCH_SIZE, help='Records moved per batch')
+        parser.add_argument(
+            '--dry-run', action='store_true', help='Count the records without moving anything')
+
+    def handle(self, *args, **options):
+        dry_run = options.get('dry_run')
+        cutoff = datetime.utcnow() - timedelta(days=options['days'])
+        names = [options['only']] if options.get('only') else list(ARCHIVED_MODELS)
+
+        for name in names:
+            model = ARCHIVED_MODELS[name]
+            self.stdout.write(f'Archiving {model.__name__} created before {cutoff:%Y-%m-%d}...')
+            count = archive_documents(
+                model, cutoff, target=options['target'], directory=settings.ARCHIVE_DIR,
+                batch_size=options['batch_size'], dry_run=dry_run)
+            self.stdout.write(f'  {count} records {"to archive" if dry_run else "archived"}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{"Would archive" if dry_run else "Successfully archived"} old records!'))
@@ -0,0 +1,83 @@
+"""
+Django management command to store the lineage of existing regenerated images.
+Run with: python manage.py backfill_lineage [--dry-run]
+
+Sets lineage_root, lineage_depth and lineage_path (see probackendapp/lineage_utils.py)
+on every OrnamentMongo and GeneratedImage that was made from another image,
+following the parent_image_id / parent links. The command can be run again safely.
+"""
+from django.core.management.base import BaseCommand
+from pymongo import UpdateOne
+from imgbackendapp.mongo_models import OrnamentMongo
+from probackendapp.models import GeneratedImage
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Store lineage root, depth and ancestor path on regenerated images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true', help='Count the images without writing anything')
+
+    def handle(self, *args, **options):
+        dry_run = options.get('dry_run')
+        for model, parent_field in ((OrnamentMongo, 'parent_image_id'), (GeneratedImage, 'parent')):
+            self.stdout.write(f'Backfilling {model.__name__} lineage...')
+            updated, total = self._backfill(model, parent_field, dry_run)
+            self.stdout.write(f'  {updated} of {total} regenerated images updated')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{"Would backfill" if dry_run else "Successfully backfilled"} lineage!'))
+
+    def _backfill(self, model, parent_field, dry_run):
+        """Compute the lineage of every image with a parent, returns (updated, total)"""
+        collection = model._get_collection()
+        # Only the links are loaded: child id -> parent id and the stored lineage
+        rows = collection.find(
+            {parent_field: {"$ne": None}},
+            {parent_field: 1, "lineage_root": 1, "lineage_path": 1})
+        parents = {}
+        stored = {}
+        for row in rows:
+            parents[row["_id"]] = row[parent_field]
+            stored[row["_id"]] = (row.get("lineage_root"), row.get("lineage_path"))
+
+        paths = {}
+
+        def path_of(image_id):
+            # Walk up until an image whose path is known, or a root
+            chain = []
+            seen = set()
+            current = image_id
+            while current in parents and current not in paths and current not in seen:
+                chain.append(current)
+                seen.add(current)
+                current = parents[current]
+            # A cycle of broken links makes the repeated image the root
+            base = paths[current] + [current] if current in paths else [current]
+            for child in reversed(chain):
+                paths[child] = base
+                base = base + [child]
+            return paths[image_id]
+
+        operations = []
+        updated = 0
+        for image_id in parents:
+            path = path_of(image_id)
+            if stored[image_id] == (path[0], path):
+                continue
+            updated += 1
+            operations.append(UpdateOne({"_id": image_id}, {"$set": {
+                "lineage_root": path[0],
+                "lineage_depth": len(path),
+                "lineage_path": path,
+            }}))
+            if len(operations) >= BATCH_SIZE and not dry_run:
+                collection.bulk_write(operations, ordered=False)
+                operations = []
+
+        if operations and not dry_run:
+            collection.bulk_write(operations, ordered=False)
+        return updated, len(parents)
@@ -0,0 +1,130 @@
+"""
+Django management command to compare the async generation views under ASGI and WSGI.
+Run with: python manage.py benchmark_async_views [--requests 100 --concurrency 50 --threads 8]
+
+Sends concurrent change_background requests (/image/change_background/)
+through Django's WSGI handler, from a pool of --threads threads like the
+threads of a WSGI worker, then through the ASGI handler in a single event
+loop, like one ASGI worker. Gemini and Cloudinary are replaced by calls that
+wait --latency seconds, so only the handling of the waits is measured; the
+rest of the view (form, image encoding, MongoDB writes) runs as in
+production. Uses scratch collections, see _benchmark.py.
+"""
+import asyncio
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock
+import jwt
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client, override_settings
+from PIL import Image
+from users.models import User
+from imgbackendapp.mongo_models import OrnamentMongo
+from ._benchmark import scratch_collections, insert
+
+URL = '/image/change_background/'
+
+
+def jpeg_bytes(size=256):
+    buf = BytesIO()
+    Image.new('RGB', (size, size), (200, 170, 90)).save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+def fake_upstreams(latency, image):
+    """Gemini client and Cloudinary upload that answer after `latency` seconds"""
+    async def generate_content(**kwargs):
+        await asyncio.sleep(latency)
+        part = SimpleNamespace(inline_data=SimpleNamespace(data=image))
+        return SimpleNamespace(candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))])
+
+    async def cloudinary_upload(file, **options):
+        await asyncio.sleep(latency)
+        return {'secure_url': f"https://res.cloudinary.com/demo/{options.get('public_id')}.jpg"}
+
+    genai_client = SimpleNamespace(aio=SimpleNamespace(models=SimpleNamespace(generate_content=generate_content)))
+    return genai_client, cloudinary_upload
+
+
+def form_data(image, i):
+    return {
+        'ornament_image': SimpleUploadedFile(f'ornament_{i}.jpg', image, 'image/jpeg'),
+        'prompt': 'Benchmark',
+    }
+
+
+def summary(label, durations, elapsed):
+    durations = sorted(durations)
+    p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+    return (f'{label:28} {len(durations) / elapsed:8.1f} req/s '
+            f'{statistics.median(durations) * 1000:9.0f} ms p50 {p95 * 1000:9.0f} ms p95')
+
+
+class Command(BaseCommand):
+    help = 'Compare the throughput of the async generation views under WSGI and ASGI'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100)
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help='Requests in flight at a time')
+        parser.add_argument('--threads', type=int, default=8,
+                            help='Threads of the WSGI worker')
+        parser.add_argument('--latency', type=float, default=0.5,
+                            help='Seconds each Gemini call and Cloudinary upload takes')
+
+    def handle(self, *args, **options):
+        count, latency = options['requests'], options['latency']
+        image = jpeg_bytes()
+        genai_client, cloudinary_upload = fake_upstreams(latency, image)
+
+        with scratch_collections(User, OrnamentMongo) as (users, _), \
+                tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root, RATE_LIMIT_ENABLED=False,
+                                  ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']), \
+                mock.patch('imgbackendapp.views.get_genai_client', return_value=genai_client), \
+                mock.patch('imgbackendapp.views.cloudinary_upload', cloudinary_upload):
+            user_id = insert(users, [{'email': 'benchmark@example.com', 'password': 'x',
+                                      'username': 'benchmark'}])[0]['_id']
+            token = jwt.encode({'id': str(user_id)}, settings.SECRET_KEY, algorithm='HS256')
+            headers = {'Authorization': f'Bearer {token}'}
+
+            def wsgi_request(i):
+                started = time.perf_counter()
+                response = Client().post(URL, form_data(image, i), headers=headers)
+                if response.status_code != 200 or not response.json().get('success'):
+                    raise RuntimeError(f'WSGI request failed: {response.content[:200]}')
+                return time.perf_counter() - started
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=min(options['threads'], options['concurrency'])) as pool:
+                wsgi = list(pool.map(wsgi_request, range(count)))
+            wsgi_elapsed = time.perf_counter() - started
+
+            async def asgi_requests():
+                client = AsyncClient()
+                slots = asyncio.Semaphore(options['concurrency'])
+
+                async def asgi_request(i):
+                    async with slots:
+                        started = time.perf_counter()
+                        response = await client.post(URL, form_data(image, i), headers=headers)
+                        if response.status_code != 200 or not response.json().get('success'):
+                            raise RuntimeError(f'ASGI request failed: {response.content[:200]}')
+                        return time.perf_counter() - started
+
+                return await asyncio.gather(*(asgi_request(i) for i in range(count)))
+
+            started = time.perf_counter()
+            asgi = asyncio.run(asgi_requests())
+            asgi_elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"{count} requests, {options['concurrency']} in flight, {latency}s per upstream call")
+        self.stdout.write(summary(f"WSGI, {options['threads']} threads", wsgi, wsgi_elapsed))
+        self.stdout.write(summary('ASGI, one event loop', asgi, asgi_elapsed))
@@ -0,0 +1,97 @@
+"""
+Django management command to time the serialization of collection detail payloads.
+Run with: python manage.py benchmark_json [--collection <id>] [--products 100 --images 20]
+"""
+import datetime
+import json
+import timeit
+from bson import ObjectId
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from common import responses
+from probackendapp.serialization_utils import get_raw_collection, serialize_collection_detail
+
+
+def synthetic_collection(products, images):
+    """Collection detail payload with raw ObjectIds and datetimes, as built from MongoDB"""
+    created_at = datetime.datetime(2024, 1, 1, 12, 0, 0, 123456)
+    product_images = []
+    for _ in range(products):
+        product_id = ObjectId()
+        product_images.append({
+            'product_id': product_id,
+            'uploaded_image_url': 'https://res.cloudinary.com/demo/image/upload/product.png',
+            'uploaded_image_path': None,
+            'generated_images': [{
+                'id': str(ObjectId()),
+                'product_id': str(product_id),
+                'kind': 'generated',
+                'type': 'white_background',
+                'prompt': 'Professional studio photograph of the product ' * 5,
+                'cloud': 'https://res.cloudinary.com/demo/image/upload/generated.png',
+                'model_used': {'type': 'ai', 'name': 'model', 'cloud': 'https://res.cloudinary.com/demo/m.png'},
+                'created_at': created_at.isoformat(),
+                'regenerated_images': [],
+                'enhanced_images': [],
+            } for _ in range(images)],
+        })
+    return {
+        'id': ObjectId(),
+        'project_id': ObjectId(),
+        'description': 'Benchmark collection',
+        'created_at': created_at,
+        'items': [{'selected_themes': ['Minimal', 'Festive'], 'product_images': product_images}],
+    }
+
+
+def converted(value):
+    """The payload with ObjectIds and datetimes converted by hand, as the views used to"""
+    if isinstance(value, dict):
+        return {key: converted(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [converted(item) for item in value]
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+class Command(BaseCommand):
+    help = 'Time the JSON serialization of a large collection detail payload'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--collection', help='Serialize this stored collection')
+        parser.add_argument('--products', type=int, default=100,
+                            help='Products of the synthetic collection')
+        parser.add_argument('--images', type=int, default=20,
+                            help='Generated images per product of the synthetic collection')
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        if options.get('collection'):
+            collection = get_raw_collection(id=options['collection'])
+            if collection is None:
+                raise CommandError('Collection not found')
+            payload = serialize_collection_detail(collection)
+        else:
+            payload = synthetic_collection(options['products'], options['images'])
+
+        repeat = options['repeat']
+        size = len(responses.dumps(payload))
+        self.stdout.write(f'Payload: {size / 1024:.0f} KB, best of {repeat} runs')
+
+        # What django.http.JsonResponse did, after the views' own conversions
+        stdlib = converted(payload)
+        timings = [('json + DjangoJSONEncoder (hand converted)',
+                    lambda: json.dumps(stdlib, cls=DjangoJSONEncoder).encode())]
+        if responses.orjson is not None:
+            timings.append(('common.responses with orjson', lambda: responses.dumps(payload)))
+        else:
+            self.stdout.write(self.style.WARNING('orjson is not installed'))
+        timings.append(('common.responses, stdlib fallback',
+                        lambda: json.dumps(payload, cls=responses.JSONEncoder).encode()))
+
+        for label, func in timings:
+            best = min(timeit.repeat(func, number=1, repeat=repeat))
+            self.stdout.write(f'{label:45} {best * 1000:8.2f} ms')
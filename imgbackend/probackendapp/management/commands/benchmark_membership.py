@@ -0,0 +1,94 @@
+"""
+Django management command to time how the projects of a user are found.
+Run with: python manage.py benchmark_membership [--projects 2000 --member-of 20]
+
+Compares the former scan (every project loaded, its members dereferenced and
+checked in Python, then one query per project for its latest collection)
+with the indexed team_members.user query and the single collection
+aggregation of api_projects_list. Uses scratch collections, see _benchmark.py.
+"""
+import random
+from datetime import datetime, timedelta
+from bson import ObjectId
+from django.core.management.base import BaseCommand
+from users.models import User
+from probackendapp.models import Project, Collection
+from probackendapp.project_utils import get_user_projects, get_collection_summaries
+from ._benchmark import scratch_collections, insert, best_of
+
+
+def seed(projects, users, members, member_of):
+    """Store the synthetic users, projects and collections, returns the id of the measured user"""
+    now = datetime.utcnow()
+    user_ids = [ObjectId() for _ in range(users)]
+    insert(User, [{'_id': user_id, 'email': f'user{i}@example.com', 'password': 'x',
+                   'username': f'user{i}', 'full_name': f'User {i}', 'role': 'user'}
+                  for i, user_id in enumerate(user_ids)])
+
+    target = user_ids[0]
+    project_rows, collection_rows = [], []
+    for i in range(projects):
+        team = random.sample(user_ids[1:], min(members, users - 1))
+        if i < member_of:
+            team[0] = target
+        project_id = ObjectId()
+        created_at = now - timedelta(minutes=i)
+        project_rows.append({
+            '_id': project_id, 'name': f'Project {i}', 'status': 'progress',
+            'created_at': created_at, 'updated_at': created_at, 'revision': 1,
+            'total_images': 10,
+            'team_members': [{'user': user_id, 'role': 'editor', 'joined_at': created_at}
+                             for user_id in team],
+        })
+        collection_rows.append({
+            '_id': ObjectId(), 'project': project_id, 'created_at': created_at,
+            'revision': 1, 'total_images': 10, 'items': [],
+        })
+    insert(Project, project_rows)
+    insert(Collection, collection_rows)
+    return target
+
+
+class Command(BaseCommand):
+    help = 'Time finding the projects (and latest collections) of a user'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--projects', type=int, default=2000,
+                            help='Projects stored in total')
+        parser.add_argument('--users', type=int, default=500,
+                            help='Users the team members are picked from')
+        parser.add_argument('--members', type=int, default=4,
+                            help='Team members per project')
+        parser.add_argument('--member-of', type=int, default=20,
+                            help='Projects the measured user is a member of')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        with scratch_collections(User, Project, Collection):
+            target = seed(options['projects'], options['users'],
+                          options['members'], options['member_of'])
+            user = User.objects.get(id=target)
+            user_id = str(target)
+
+            def scan():
+                found = []
+                for project in Project.objects.all():
+                    if any(str(member.user.id) == user_id for member in project.team_members):
+                        found.append((project, Collection.objects(project=project).first()))
+                return found
+
+            def indexed():
+                projects = list(get_user_projects(user))
+                return projects, get_collection_summaries([p.id for p in projects])
+
+            scanned, (projects, summaries) = scan(), indexed()
+            if len(scanned) != len(projects) or len(summaries) != len(projects):
+                self.stderr.write(self.style.ERROR(
+                    f'Results differ: {len(scanned)} scanned, {len(projects)} indexed'))
+
+            repeat = options['repeat']
+            self.stdout.write(
+                f"{options['projects']} projects, member of {len(projects)}, best of {repeat} runs")
+            for label, func in [('scan + member dereference (before)', scan),
+                                ('team_members.user index + aggregation', indexed)]:
+                self.stdout.write(f'{label:45} {best_of(func, repeat):10.2f} ms')
@@ -0,0 +1,62 @@
+"""
+Django management command to time deep pages of a list endpoint.
+Run with: python manage.py benchmark_pagination [--rows 20000 --limit 20]
+
+Pages of one collection's generated images (api_collection_generated_images)
+are read at several depths, with the former skip/limit and with the cursor
+of paginate(). Uses scratch collections, see _benchmark.py.
+"""
+from datetime import datetime, timedelta
+from bson import ObjectId
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from common.pagination import DEFAULT_SORT, encode_cursor, paginate
+from probackendapp.models import GeneratedImage
+from ._benchmark import scratch_collections, insert, best_of
+
+
+class Command(BaseCommand):
+    help = 'Time skip/limit against cursor pagination at increasing page depths'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000,
+                            help='Generated images of the collection')
+        parser.add_argument('--limit', type=int, default=20, help='Page size')
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        rows, limit, repeat = options['rows'], options['limit'], options['repeat']
+        factory = RequestFactory()
+
+        with scratch_collections(GeneratedImage):
+            collection_id = ObjectId()
+            start = datetime.utcnow()
+            insert(GeneratedImage, [{
+                '_id': ObjectId(), 'collection': collection_id, 'product_id': collection_id,
+                'kind': 'generated', 'type': 'white_background', 'prompt': 'Benchmark prompt',
+                'cloud_url': f'https://res.cloudinary.com/demo/image/upload/{i}.png',
+                'created_at': start - timedelta(seconds=i),
+            } for i in range(rows)])
+            queryset = GeneratedImage.objects(collection=collection_id).as_pymongo()
+            ordered = queryset.order_by('-created_at', '-id')
+
+            self.stdout.write(f'{rows} rows, {limit} per page, best of {repeat} runs')
+            self.stdout.write(f"{'page starting at row':>22} {'skip/limit':>12} {'cursor':>12}")
+            for depth in (0, rows // 10, rows // 2, rows - limit):
+                def skipped():
+                    return list(ordered.skip(depth).limit(limit))
+
+                params = {'limit': limit}
+                if depth:
+                    # Cursor of the last row of the previous page, as the client sends it
+                    previous = ordered.skip(depth - 1).limit(1).first()
+                    params['cursor'] = encode_cursor([previous[field] for field, _ in DEFAULT_SORT])
+                request = factory.get('/', params)
+
+                def keyset():
+                    return paginate(request, queryset)[0]
+
+                if [row['_id'] for row in skipped()] != [row['_id'] for row in keyset()]:
+                    self.stderr.write(self.style.ERROR(f'Pages at row {depth} differ'))
+                self.stdout.write(
+                    f'{depth:>22} {best_of(skipped, repeat):9.2f} ms {best_of(keyset, repeat):9.2f} ms')
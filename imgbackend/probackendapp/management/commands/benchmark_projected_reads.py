@@ -0,0 +1,146 @@
+"""
+Django management command to time the read-only endpoints built from raw documents.
+Run with: python manage.py benchmark_projected_reads [--uploads 50 --products 100]
+
+Compares loading full MongoEngine documents and building the response by
+hand (to_mongo() per uploaded image, project and users dereferenced), as the
+collection detail and prompt master list used to, with the projected raw
+reads of serialization_utils.py. Uses scratch collections, see _benchmark.py.
+"""
+from datetime import datetime
+from bson import ObjectId
+from django.core.management.base import BaseCommand
+from users.models import User
+from probackendapp.generated_image_utils import get_generated_images_by_product, serialize_product_images
+from probackendapp.models import Collection, GeneratedImage, Project, PromptMaster
+from probackendapp.serialization_utils import get_raw_collection, serialize_collection_detail, serialize_prompt
+from ._benchmark import scratch_collections, insert, best_of
+
+UPLOAD_CATEGORIES = ('theme', 'background', 'pose', 'location', 'color')
+
+
+def seed_collection(uploads, products, images):
+    """Store one large collection with its project and generated images, returns its id"""
+    now = datetime.utcnow()
+    project_id, collection_id = ObjectId(), ObjectId()
+    insert(Project, [{'_id': project_id, 'name': 'Benchmark', 'created_at': now, 'team_members': []}])
+    item = {
+        f'uploaded_{category}_images': [{
+            'local_path': f'media/{category}/{i}.png',
+            'cloud_url': f'https://res.cloudinary.com/demo/{category}/{i}.png',
+            'original_filename': f'{i}.png', 'uploaded_by': str(ObjectId()),
+            'uploaded_at': now, 'file_size': 123456, 'category': category,
+        } for i in range(uploads)]
+        for category in UPLOAD_CATEGORIES
+    }
+    item.update({
+        'selected_themes': ['Minimal', 'Festive'],
+        'generated_prompts': {'white_background': 'Studio shot ' * 20},
+        # Large fields the detail does not return
+        'final_moodboard_prompt': 'Moodboard prompt ' * 2000,
+        'moodboard_explanation': 'Explanation ' * 2000,
+        'product_images': [{
+            'product_id': ObjectId(),
+            'uploaded_image_url': f'https://res.cloudinary.com/demo/product/{i}.png',
+            'uploaded_image_path': f'media/product/{i}.png', 'uploaded_at': now,
+        } for i in range(products)],
+    })
+    insert(Collection, [{'_id': collection_id, 'project': project_id, 'description': 'Benchmark',
+                         'created_at': now, 'revision': 1, 'items': [item]}])
+    insert(GeneratedImage, [{
+        'collection': collection_id, 'project': project_id, 'product_id': product['product_id'],
+        'kind': 'generated', 'type': 'white_background', 'prompt': 'Studio shot',
+        'cloud_url': f'https://res.cloudinary.com/demo/generated/{i}.png', 'created_at': now,
+    } for product in item['product_images'] for i in range(images)])
+    return collection_id
+
+
+def seed_prompts(prompts):
+    now = datetime.utcnow()
+    user_ids = [ObjectId() for _ in range(10)]
+    insert(User, [{'_id': user_id, 'email': f'user{i}@example.com', 'password': 'x',
+                   'username': f'user{i}'} for i, user_id in enumerate(user_ids)])
+    insert(PromptMaster, [{
+        'prompt_key': f'prompt_{i}', 'title': f'Prompt {i}', 'prompt_content': 'Prompt ' * 200,
+        'category': f'category_{i % 8}', 'is_active': True, 'created_at': now, 'updated_at': now,
+        'created_by': user_ids[i % 10], 'updated_by': user_ids[i % 10],
+    } for i in range(prompts)])
+
+
+def document_collection_detail(collection_id):
+    """The collection detail as built before, from the full documents"""
+    collection = Collection.objects.get(id=collection_id)
+    images_by_product = get_generated_images_by_product(collection.id)
+    items = []
+    for item in collection.items:
+        item_data = {
+            f'uploaded_{category}_images': [
+                img.to_mongo().to_dict() for img in getattr(item, f'uploaded_{category}_images')]
+            for category in UPLOAD_CATEGORIES
+        }
+        item_data.update({
+            'suggested_themes': item.suggested_themes or [],
+            'selected_themes': item.selected_themes or [],
+            'generated_prompts': item.generated_prompts or {},
+            'generated_model_images': item.generated_model_images or [],
+            'uploaded_model_images': item.uploaded_model_images or [],
+            'selected_model': item.selected_model,
+            'product_images': serialize_product_images(
+                [product.to_mongo().to_dict() for product in item.product_images], images_by_product),
+        })
+        items.append(item_data)
+    return {'id': str(collection.id), 'project_id': str(collection.project.id),
+            'description': collection.description, 'items': items}
+
+
+def document_prompt_list():
+    """The prompt master list as built before: documents, user dereferences, categories from a scan"""
+    prompts = [{
+        'id': str(prompt.id), 'prompt_key': prompt.prompt_key, 'title': prompt.title,
+        'prompt_content': prompt.prompt_content, 'category': prompt.category,
+        'created_by': str(prompt.created_by.id) if prompt.created_by else None,
+        'updated_by': str(prompt.updated_by.id) if prompt.updated_by else None,
+    } for prompt in PromptMaster.objects.order_by('category', 'prompt_key')]
+    categories = sorted({p.category for p in PromptMaster.objects.all() if p.category})
+    return prompts, categories
+
+
+def raw_prompt_list():
+    prompts = [serialize_prompt(prompt) for prompt in
+               PromptMaster.objects.order_by('category', 'prompt_key').as_pymongo()]
+    categories = sorted(c for c in PromptMaster.objects.distinct('category') if c)
+    return prompts, categories
+
+
+class Command(BaseCommand):
+    help = 'Time full document reads against projected raw reads of the read-only endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uploads', type=int, default=50,
+                            help='Uploaded images per category of the collection')
+        parser.add_argument('--products', type=int, default=100,
+                            help='Product images of the collection')
+        parser.add_argument('--images', type=int, default=4,
+                            help='Generated images per product')
+        parser.add_argument('--prompts', type=int, default=100,
+                            help='Prompts of the prompt master list')
+        parser.add_argument('--repeat', type=int, default=10)
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        with scratch_collections(User, Project, Collection, GeneratedImage, PromptMaster):
+            collection_id = seed_collection(
+                options['uploads'], options['products'], options['images'])
+            seed_prompts(options['prompts'])
+
+            timings = [
+                ('collection detail, documents (before)',
+                 lambda: document_collection_detail(collection_id)),
+                ('collection detail, projected raw',
+                 lambda: serialize_collection_detail(get_raw_collection(id=collection_id))),
+                ('prompt master list, documents (before)', document_prompt_list),
+                ('prompt master list, raw + distinct', raw_prompt_list),
+            ]
+            self.stdout.write(f'Best of {repeat} runs')
+            for label, func in timings:
+                self.stdout.write(f'{label:45} {best_of(func, repeat):10.2f} ms')
@@ -0,0 +1,112 @@
+"""
+Django management command to move generated images out of collection documents.
+Run with: python manage.py migrate_generated_images [--collection <id>] [--dry-run]
+
+Images nested in Collection.items[*].product_images[*].generated_images (with their
+regenerated_images and enhanced_images) are inserted into the GeneratedImage
+collection and removed from the collection document. Products also get their
+product_id stored. The command can be run again safely: product ids are stored
+before any image is inserted, and every image gets an id derived from its
+place in the nested lists, so the images an interrupted run inserted are
+found again instead of being inserted twice.
+"""
+import hashlib
+from bson import ObjectId
+from django.core.management.base import BaseCommand
+from probackendapp.models import Collection, GeneratedImage
+from probackendapp.collection_updates import ConcurrentUpdateError, to_mongo_value, update_collection
+from probackendapp.generated_image_utils import create_generated_image, ensure_product_ids
+
+PENDING_QUERY = {"$or": [
+    {"items.product_images.generated_images.0": {"$exists": True}},
+    {"items.product_images": {"$elemMatch": {"product_id": {"$exists": False}}}},
+]}
+
+
+def migration_id(key):
+    """Stable ObjectId of the image at `key` (its place in the nested lists)"""
+    return ObjectId(hashlib.sha1(key.encode()).digest()[:12])
+
+
+class Command(BaseCommand):
+    help = 'Move embedded generated images into the generated_images collection'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--collection', help='Only migrate this collection')
+        parser.add_argument(
+            '--dry-run', action='store_true', help='Count the images without writing anything')
+
+    def handle(self, *args, **options):
+        query = dict(PENDING_QUERY)
+        if options.get('collection'):
+            query = {"$and": [PENDING_QUERY, {"_id": ObjectId(options['collection'])}]}
+        dry_run = options.get('dry_run')
+
+        self.stdout.write('Migrating generated images...')
+        collection_count = 0
+        image_count = 0
+        for collection in Collection.objects(__raw__=query).no_dereference().no_cache():
+            if not dry_run:
+                # Images point at their product by id, which must not change between runs
+                try:
+                    collection = ensure_product_ids(collection)
+                except ConcurrentUpdateError:
+                    self.stdout.write(self.style.WARNING(
+                        f'  {collection.id}: changed during migration, run the command again'))
+                    continue
+
+            migrated = 0
+            for item_index, item in enumerate(collection.items or []):
+                for product in item.product_images or []:
+                    for index, generated in enumerate(product.generated_images or []):
+                        key = f"{collection.id}/{item_index}/{product.product_id}/{index}"
+                        migrated += self._migrate_image(
+                            collection, product, generated, key, dry_run)
+                    if not dry_run:
+                        product.generated_images = []
+
+            if not dry_run:
+                # Stores the emptied lists and the product ids, unless the
+                # collection changed meanwhile (the next run picks it up)
+                stored = update_collection(
+                    collection.id, {"$set": {"items": to_mongo_value(collection.items)}},
+                    expected_revision=collection.revision or 0)
+                if not stored:
+                    self.stdout.write(self.style.WARNING(
+                        f'  {collection.id}: changed during migration, run the command again'))
+                    continue
+            collection_count += 1
+            image_count += migrated
+            self.stdout.write(f'  {collection.id}: {migrated} images')
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'{"Would migrate" if dry_run else "Successfully migrated"} images! '
+                f'Collections: {collection_count}, Images: {image_count}'
+            )
+        )
+
+    def _migrate_image(self, collection, product, generated, key, dry_run):
+        """Insert one embedded generated image and its children, returns the number of images"""
+        regenerated = generated.get("regenerated_images") or []
+        enhanced = generated.get("enhanced_images") or []
+        count = 1 + len(regenerated) + len(enhanced)
+        if dry_run:
+            return count
+
+        parent = self._insert(collection, product, generated, "generated", key)
+        for index, image in enumerate(regenerated):
+            self._insert(collection, product, image, "regenerated", f"{key}/regenerated/{index}", parent)
+        for index, image in enumerate(enhanced):
+            self._insert(collection, product, image, "enhanced", f"{key}/enhanced/{index}", parent)
+        return count
+
+    def _insert(self, collection, product, data, kind, key, parent=None):
+        # Skip images inserted by an earlier, interrupted run
+        image_id = migration_id(key)
+        existing = GeneratedImage.objects(id=image_id).first()
+        # Not touched: the final update of the collection bumps its revision,
+        # and must find the revision it read
+        return existing or create_generated_image(
+            collection, product, data, kind=kind, parent=parent, image_id=image_id, touch=False)
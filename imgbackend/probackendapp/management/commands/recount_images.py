@@ -0,0 +1,58 @@
+"""
+Django management command to rebuild the denormalized image counters.
+Run with: python manage.py recount_images [--collection <id>]
+"""
+from collections import Counter
+from django.core.management.base import BaseCommand
+from probackendapp.models import Project, Collection
+from probackendapp.image_counters import recount_collection, store_project_counts
+
+
+def _ref_id(value):
+    return getattr(value, 'id', value)
+
+
+class Command(BaseCommand):
+    help = 'Recompute image counters on collections and projects from the stored images'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--collection', help='Only recount this collection\'s project')
+
+    def handle(self, *args, **options):
+        projects = Project.objects.all()
+        collections = Collection.objects.all()
+
+        if options.get('collection'):
+            # A project's counters span all of its collections, so recount them all
+            project_ids = [
+                _ref_id(ref) for ref in
+                Collection.objects(id=options['collection']).no_dereference().scalar('project')
+            ]
+            projects = Project.objects(id__in=project_ids)
+            collections = Collection.objects(project__in=project_ids)
+
+        self.stdout.write('Recounting collection images...')
+        project_totals = {}
+        collection_count = 0
+        for collection in collections.no_dereference().no_cache():
+            kinds, models = recount_collection(collection)
+            collection_count += 1
+
+            totals = project_totals.setdefault(
+                _ref_id(collection.project), (Counter(), Counter()))
+            totals[0].update(kinds)
+            totals[1].update(models)
+
+        project_count = 0
+        for project_id in projects.scalar('id'):
+            kinds, models = project_totals.get(
+                project_id, (Counter(), Counter()))
+            store_project_counts(project_id, kinds, models)
+            project_count += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Successfully recounted images! Collections: {collection_count}, Projects: {project_count}'
+            )
+        )
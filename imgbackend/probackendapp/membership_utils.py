@@ -0,0 +1,167 @@
+"""
+Cached project membership and role resolution.
+
+The permission decorators and api_get_user_role used to load the whole
+Project (or the Collection and then its project) and scan team_members on
+every guarded request. The role of a user in a project is now read with an
+$elemMatch projection of the matching team member only, and kept in a
+per-process TTL cache keyed by (user_id, project_id); the project of a
+collection, which never changes, is cached the same way.
+
+Views changing a membership (invite acceptance, role update, project
+deletion) call invalidate_membership(), which drops the entries of this
+process and bumps a version stamp stored in MongoDB, like the prompt registry
+(see prompt_registry.py). Each process compares its version with the stored
+one at most every MEMBERSHIP_VERSION_CHECK_SECONDS and empties its caches when
+it changed; the TTL only bounds the age of entries.
+"""
+import threading
+import time
+from bson import ObjectId
+from cachetools import TTLCache
+from django.conf import settings
+from pymongo import ReturnDocument
+from .models import Collection, Project
+
+VERSION_COLLECTION = 'membership_cache_version'
+VERSION_ID = 'membership'
+
+# Cached for users that are not members of the project
+NOT_MEMBER = ''
+
+_roles = TTLCache(
+    maxsize=getattr(settings, 'MEMBERSHIP_CACHE_SIZE', 4096),
+    ttl=getattr(settings, 'MEMBERSHIP_CACHE_TTL', 60))
+_collection_projects = TTLCache(
+    maxsize=getattr(settings, 'MEMBERSHIP_CACHE_SIZE', 4096),
+    ttl=getattr(settings, 'MEMBERSHIP_CACHE_TTL', 60) * 10)
+_lock = threading.Lock()
+_state = {'version': None, 'checked_at': 0.0}
+
+
+def _versions():
+    return Project._get_db()[VERSION_COLLECTION]
+
+
+def _clear():
+    _roles.clear()
+    _collection_projects.clear()
+
+
+def _check_version():
+    """Empty the caches if another process changed a membership since the last check"""
+    now = time.monotonic()
+    check_every = getattr(settings, 'MEMBERSHIP_VERSION_CHECK_SECONDS', 5)
+    if now - _state['checked_at'] < check_every:
+        return
+    with _lock:
+        if now - _state['checked_at'] < check_every:
+            return
+        row = _versions().find_one({'_id': VERSION_ID}, {'version': 1})
+        version = row['version'] if row else 0
+        if version != _state['version']:
+            _clear()
+            _state['version'] = version
+        _state['checked_at'] = now
+
+
+def _bump_version():
+    row = _versions().find_one_and_update(
+        {'_id': VERSION_ID}, {'$inc': {'version': 1}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    with _lock:
+        # Another process changed a membership since this one last checked
+        if _state['version'] is None or row['version'] != _state['version'] + 1:
+            _clear()
+        _state['version'] = row['version']
+
+
+def _load_role(user_id, project_id):
+    user_id = ObjectId(user_id)
+    project = Project._get_collection().find_one(
+        {'_id': ObjectId(project_id), 'team_members.user': user_id},
+        {'team_members': {'$elemMatch': {'user': user_id}}})
+    members = (project or {}).get('team_members') or []
+    return (members[0].get('role') if members else None) or NOT_MEMBER
+
+
+def get_project_role(user_id, project_id):
+    """
+    Role of a user in a project.
+
+    Args:
+        user_id (str|ObjectId): ID of the user
+        project_id (str|ObjectId): ID of the project
+
+    Returns:
+        str: 'owner', 'editor' or 'viewer', or None if the user is not a
+        member (or the project does not exist, see project_exists)
+    """
+    if not ObjectId.is_valid(str(project_id)):
+        return None
+    _check_version()
+    key = (str(user_id), str(project_id))
+    with _lock:
+        role = _roles.get(key)
+    if role is None:
+        role = _load_role(*key)
+        with _lock:
+            _roles[key] = role
+    return role or None
+
+
+def project_exists(project_id):
+    """Whether a project exists, to tell a missing project from a non-member"""
+    return ObjectId.is_valid(str(project_id)) and \
+        Project.objects(id=project_id).only('id').as_pymongo().first() is not None
+
+
+def get_collection_project_id(collection_id):
+    """
+    ID of the project a collection belongs to.
+
+    Returns:
+        str: The project id, or None if the collection does not exist
+    """
+    if not ObjectId.is_valid(str(collection_id)):
+        return None
+    _check_version()
+    key = str(collection_id)
+    with _lock:
+        project_id = _collection_projects.get(key)
+    if project_id is None:
+        collection = Collection.objects(id=collection_id).only('project').as_pymongo().first()
+        if not collection or not collection.get('project'):
+            return None
+        project_id = str(collection['project'])
+        with _lock:
+            _collection_projects[key] = project_id
+    return project_id
+
+
+def invalidate_membership(project_id, user_id=None):
+    """
+    Drop cached roles after a membership change.
+
+    Args:
+        project_id (str|ObjectId): Project whose team changed
+        user_id (str|ObjectId, optional): The member that changed, all
+            members of the project when not given (e.g. project deleted)
+    """
+    project_id = str(project_id)
+    with _lock:
+        if user_id is not None:
+            _roles.pop((str(user_id), project_id), None)
+        else:
+            for key in [key for key in _roles.keys() if key[1] == project_id]:
+                _roles.pop(key, None)
+    _bump_version()
+
+
+def forget_project_collections(project_id):
+    """Drop the cached collections of a deleted project, in every process"""
+    project_id = str(project_id)
+    with _lock:
+        for key in [key for key, value in _collection_projects.items() if value == project_id]:
+            _collection_projects.pop(key, None)
+    _bump_version()
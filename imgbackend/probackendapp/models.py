@@ -1,12 +1,48 @@
-from mongoengine import Document, StringField, DateTimeField, ListField, ReferenceField, ImageField, URLField, EmbeddedDocument, EmbeddedDocumentField, DictField, BooleanField, IntField
+from mongoengine import Document, StringField, DateTimeField, ListField, ReferenceField, ImageField, URLField, EmbeddedDocument, EmbeddedDocumentField, DictField, BooleanField, IntField, ObjectIdField
+from bson import ObjectId
 from datetime import datetime
 from users.models import User
+from common.response_cache import invalidate
 import enum
 # -----------------------------
 # Project Model
 # -----------------------------
 
 
+def revision_condition(revision):
+    """
+    save_condition of a document loaded at `revision`.
+
+    Documents stored before revisions existed have no revision field, which
+    {'$in': [0, None]} matches.
+    """
+    if not revision:
+        return {'revision__in': [0, None]}
+    return {'revision': revision}
+
+
+def save_next_revision(document, save, *args, **kwargs):
+    """
+    Save a document with a `revision` field as its next revision.
+
+    The new revision is written by the same update as the data, and only if
+    the stored revision is still the one that was loaded, so two writers can
+    never store the same revision: a save racing another save or a targeted
+    update (collection_updates.py) raises SaveConditionError instead of
+    overwriting it. New documents are inserted at revision 1.
+    """
+    revision = document.revision or 0
+    if document.pk is not None and not kwargs.get('force_insert'):
+        kwargs['save_condition'] = dict(
+            kwargs.get('save_condition') or {}, **revision_condition(revision))
+    document.revision = revision + 1
+    try:
+        return save(*args, **kwargs)
+    except Exception:
+        document.revision = revision
+        raise
+
+
 class ProjectRole(enum.Enum):
     OWNER = "owner"
     EDITOR = "editor"
@@ -34,12 +70,29 @@ class Project(Document):
     status = StringField(default="progress")
     team_members = ListField(EmbeddedDocumentField(ProjectMember))
 
+    # Denormalized image counters, kept up to date with $inc (see image_counters.py)
+    total_images = IntField(default=0)
+    image_type_counts = DictField()
+    model_usage_counts = DictField()
+
+    # Incremented by every save, with updated_at; used as version by the
+    # conditional GET of the read endpoints (see version_utils.py)
+    revision = IntField(default=0)
+
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.updated_at = datetime.utcnow()
+        result = save_next_revision(self, super().save, *args, **kwargs)
+        invalidate(project=self.id)
+        return result
+
     meta = {
         'collection': 'projectsUpdated',
-        'ordering': ['-created_at']
+        'ordering': ['-created_at'],
+        # Membership lookups ("which projects is this user in?") hit this index
+        'indexes': [('team_members.user', '-updated_at')]
     }
 
 
@@ -60,9 +113,12 @@ class Project(Document):
 
 
 class ProductImage(EmbeddedDocument):
+    # Stable id that GeneratedImage documents point at
+    product_id = ObjectIdField(default=ObjectId)
     uploaded_image_url = URLField(required=True)
     uploaded_image_path = StringField()
-    # For each product, store multiple generated versions as a list of dicts
+    # Legacy: generated versions now live in the GeneratedImage collection.
+    # Existing data is moved with `python manage.py migrate_generated_images`.
     generated_images = ListField(DictField())
     # Track when this product image was uploaded
     uploaded_at = DateTimeField(default=datetime.utcnow)
@@ -138,13 +194,31 @@ class Collection(Document):
     target_audience = StringField()
     campaign_season = StringField()
     items = ListField(EmbeddedDocumentField(CollectionItem))
+    # Incremented by every save and targeted update, with updated_at; used for
+    # optimistic concurrency checks (see collection_updates.py) and as version
+    # by the conditional GET of the read endpoints (see version_utils.py)
+    revision = IntField(default=0)
+
+    # Denormalized image counters, kept up to date with $inc (see image_counters.py)
+    total_images = IntField(default=0)
+    image_type_counts = DictField()
+    model_usage_counts = DictField()
 
     def __str__(self):
         return f"{self.project.name} Collection"
 
+    def save(self, *args, **kwargs):
+        self.updated_at = datetime.utcnow()
+        result = save_next_revision(self, super().save, *args, **kwargs)
+        # Projects list their (latest) collection
+        project = self._data.get('project')
+        invalidate(collection=self.id, project=getattr(project, 'id', project))
+        return result
+
     meta = {
         'collection': 'collections',
-        'ordering': ['-created_at']
+        'ordering': ['-created_at'],
+        'indexes': [('project', '-created_at')]
     }
 
 # -----------------------------
@@ -153,20 +227,59 @@ class Collection(Document):
 
 
 class GeneratedImage(Document):
+    """
+    A generated, regenerated or enhanced image of a collection's product.
+
+    Regenerated and enhanced images point at the generated image they were
+    made from through `parent`, so a product's whole image tree can be read
+    with one indexed query (see generated_image_utils.py).
+    """
     collection = ReferenceField(
-        Collection, required=True, reverse_delete_rule=2)
-    image_path = StringField(required=True)  # store local path or URL
+        Collection, required=True, reverse_delete_rule=2)  # CASCADE
+    project = ReferenceField(Project)
+    # ProductImage.product_id of the product the image was generated from
+    product_id = ObjectIdField(required=True)
+    product_image_path = StringField()
+    parent = ReferenceField("self")
+    # Materialized lineage of regenerated/enhanced images (see lineage_utils.py)
+    lineage_root = ObjectIdField()
+    lineage_depth = IntField(default=0)
+    lineage_path = ListField(ObjectIdField())
+
+    # 'generated', 'regenerated' or 'enhanced'
+    kind = StringField(required=True, default="generated",
+                       choices=["generated", "regenerated", "enhanced"])
+    # Prompt type, e.g. 'white_background', 'model_image', 'campaign_image'
+    type = StringField()
+    prompt = StringField()
+    original_prompt = StringField()  # For regenerated images
+    combined_prompt = StringField()  # For regenerated images
+    local_path = StringField()
+    cloud_url = StringField()
+    model_used = DictField()
+    enhanced_from = DictField()  # For enhanced images
+    # Any other keys carried over from the embedded format
+    metadata = DictField()
+
     created_by = ReferenceField("User")
     updated_by = ReferenceField("User")
     created_at = DateTimeField(default=datetime.utcnow)
     updated_at = DateTimeField(default=datetime.utcnow)
 
     def __str__(self):
-        return f"Image for {self.collection.project.name} Collection"
+        return f"{self.kind} image {self.local_path}"
 
     meta = {
         'collection': 'generated_images',
-        'ordering': ['-created_at']
+        'ordering': ['created_at'],
+        'indexes': [
+            ('collection', 'created_at'),
+            ('collection', 'product_id', 'created_at'),
+            ('collection', 'local_path'),
+            ('collection', 'cloud_url'),
+            'parent',
+            ('lineage_root', 'lineage_depth', 'created_at'),
+        ]
     }
 
 
@@ -199,6 +312,8 @@ class ImageGenerationHistory(Document):
     # Timestamps
     created_at = DateTimeField(default=datetime.utcnow)
     updated_at = DateTimeField(default=datetime.utcnow)
+    # Deleted by MongoDB once passed, only set when settings.HISTORY_TTL_DAYS is
+    expires_at = DateTimeField()
 
     # Additional metadata
     # Store any additional info like model type, settings, etc.
@@ -209,7 +324,18 @@ class ImageGenerationHistory(Document):
 
     meta = {
         'collection': 'image_generation_history',
-        'ordering': ['-created_at']
+        'ordering': ['-created_at'],
+        # Newest-first keyset pagination per user (see common/pagination.py),
+        # and created_at ranges for the usage rollups (see usage_tracking/rollups.py)
+        'indexes': [
+            ('user_id', '-created_at', '-id'),
+            # Version of a collection's history (see version_utils.py)
+            ('collection', 'user_id', '-created_at'),
+            # Latest activity of a page of projects (api_recent_projects)
+            ('project', '-created_at'),
+            'created_at',
+            {'fields': ['expires_at'], 'expireAfterSeconds': 0},
+        ]
     }
 
 
@@ -8,9 +8,11 @@ Roles:
 """
 
 from functools import wraps
-from django.http import JsonResponse
-from mongoengine.errors import DoesNotExist
+from common.responses import JsonResponse
+from django.utils.functional import SimpleLazyObject
+from common.dereference import reference_id
 from .models import Project
+from .membership_utils import get_collection_project_id, get_project_role, project_exists
 
 
 def get_user_role_in_project(user, project):
@@ -22,12 +24,17 @@ def get_user_role_in_project(user, project):
         return None
 
     for member in project.team_members:
-        if str(member.user.id) == str(user.id):
+        if str(reference_id(member, 'user')) == str(user.id):
             return member.role
 
     return None
 
 
+def _lazy_project(project_id):
+    """request.project, loaded on first use only"""
+    return SimpleLazyObject(lambda: Project.objects.get(id=project_id))
+
+
 def require_project_role(allowed_roles):
     """
     Decorator to require specific roles for a view.
@@ -59,18 +66,14 @@ def require_project_role(allowed_roles):
                     'error': 'Authentication required'
                 }, status=401)
 
-            # Get project
-            try:
-                project = Project.objects.get(id=project_id)
-            except DoesNotExist:
-                return JsonResponse({
-                    'error': 'Project not found'
-                }, status=404)
-
-            # Get user role
-            user_role = get_user_role_in_project(request.user, project)
+            # Get the user's role (cached), the project is only loaded if the view uses it
+            user_role = get_project_role(request.user.id, project_id)
 
             if not user_role:
+                if not project_exists(project_id):
+                    return JsonResponse({
+                        'error': 'Project not found'
+                    }, status=404)
                 return JsonResponse({
                     'error': 'You are not a member of this project'
                 }, status=403)
@@ -82,7 +85,7 @@ def require_project_role(allowed_roles):
 
             # Add role to request for use in view
             request.user_role = user_role
-            request.project = project
+            request.project = _lazy_project(project_id)
 
             return view_func(request, project_id, *args, **kwargs)
 
@@ -103,26 +106,20 @@ def require_collection_role(allowed_roles):
     def decorator(view_func):
         @wraps(view_func)
         def wrapped_view(request, collection_id, *args, **kwargs):
-            from .models import Collection
-
             # Check if user is authenticated
             if not hasattr(request, 'user') or not request.user:
                 return JsonResponse({
                     'error': 'Authentication required'
                 }, status=401)
 
-            # Get collection
-            try:
-                collection = Collection.objects.get(id=collection_id)
-            except DoesNotExist:
+            # Get the collection's project and the user's role (both cached)
+            project_id = get_collection_project_id(collection_id)
+            if not project_id:
                 return JsonResponse({
                     'error': 'Collection not found'
                 }, status=404)
 
-            project = collection.project
-
-            # Get user role
-            user_role = get_user_role_in_project(request.user, project)
+            user_role = get_project_role(request.user.id, project_id)
 
             if not user_role:
                 return JsonResponse({
@@ -136,7 +133,7 @@ def require_collection_role(allowed_roles):
 
             # Add role to request for use in view
             request.user_role = user_role
-            request.project = project
+            request.project = _lazy_project(project_id)
 
             return view_func(request, collection_id, *args, **kwargs)
 
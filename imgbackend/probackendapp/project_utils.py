@@ -0,0 +1,108 @@
+"""
+Query helpers for project listings (dashboard, recent projects)
+"""
+from common.dereference import reference_id
+from .models import Project, Collection, ImageGenerationHistory
+
+
+def get_user_projects(user):
+    """
+    Get the projects the user is a team member of.
+
+    Resolved with the `team_members.user` index instead of scanning every
+    project and checking its members in Python.
+
+    Args:
+        user (User): The user whose projects should be returned
+
+    Returns:
+        QuerySet: Projects where the user is a team member
+    """
+    return Project.objects(team_members__user=user.id)
+
+
+def get_member_role(project, user):
+    """
+    Get the user's role from an already loaded project.
+
+    Returns:
+        str: The member role, or None if the user is not a team member
+    """
+    user_id = str(user.id)
+    for member in project.team_members:
+        # Compare ids without loading every member's User document
+        if str(reference_id(member, 'user')) == user_id:
+            return member.role
+    return None
+
+
+def get_collection_summaries(project_ids):
+    """
+    Fetch the latest collection of many projects in one aggregation.
+
+    Image counts are read from the collections' denormalized counters
+    (see image_counters.py) instead of walking their items.
+
+    Args:
+        project_ids (list): IDs of the projects to summarize
+
+    Returns:
+        dict: project id (str) -> {'collection_id', 'total_images'}
+    """
+    if not project_ids:
+        return {}
+
+    pipeline = [
+        {"$match": {"project": {"$in": list(project_ids)}}},
+        # Newest first so $first matches Collection.objects(project=...).first()
+        {"$sort": {"created_at": -1}},
+        {"$group": {
+            "_id": "$project",
+            "collection_id": {"$first": "$_id"},
+            "total_images": {"$first": "$total_images"},
+        }},
+    ]
+
+    summaries = {}
+    for row in Collection.objects.aggregate(pipeline):
+        summaries[str(row["_id"])] = {
+            "collection_id": str(row["collection_id"]),
+            "total_images": row.get("total_images") or 0,
+        }
+    return summaries
+
+
+def get_recent_activity(project_ids, start, end, limit=5):
+    """
+    Fetch the latest history records of many projects in one aggregation.
+
+    Args:
+        project_ids (list): IDs of the projects
+        start (datetime): Oldest creation date (included)
+        end (datetime): Newest creation date (included)
+        limit (int): Records per project
+
+    Returns:
+        dict: project id (str) -> raw records, newest first
+    """
+    if not project_ids:
+        return {}
+
+    pipeline = [
+        {"$match": {"project": {"$in": list(project_ids)},
+                    "created_at": {"$gte": start, "$lte": end}}},
+        {"$sort": {"created_at": -1}},
+        {"$group": {
+            "_id": "$project",
+            "records": {"$push": {
+                "_id": "$_id",
+                "image_type": "$image_type",
+                "image_url": "$image_url",
+                "created_at": "$created_at",
+                "prompt": {"$ifNull": ["$prompt", None]},
+            }},
+        }},
+        {"$project": {"records": {"$slice": ["$records", limit]}}},
+    ]
+    return {str(row["_id"]): row["records"]
+            for row in ImageGenerationHistory.objects.aggregate(pipeline)}
@@ -2,10 +2,14 @@
 Initialize default prompts in the database.
 This ensures all system prompts are available in the PromptMaster collection.
 """
+import logging
 from .models import PromptMaster
+from .prompt_registry import bump_prompt_version, get_compiled_prompt
 from users.models import User
 from datetime import datetime, timezone
 
+logger = logging.getLogger(__name__)
+
 
 def initialize_default_prompts():
     """Initialize all default prompts in the database if they don't exist"""
@@ -426,11 +430,10 @@ Campaign instructions: {user_prompt}""",
 
             if needs_update:
                 existing.save()
-                print(
-                    f"Updated prompt '{prompt_key}' with new template structure")
+                logger.info("Updated prompt '%s' with new template structure", prompt_key)
                 updated_count += 1
             else:
-                print(f"Prompt '{prompt_key}' already exists, skipping update")
+                logger.debug("Prompt '%s' already exists, skipping update", prompt_key)
                 updated_count += 1
         else:
             # Create new prompt
@@ -450,15 +453,18 @@ Campaign instructions: {user_prompt}""",
                 )
                 prompt.save()
                 created_count += 1
-                print(
-                    f"Created prompt: {prompt_key} (category: {prompt_data['category']})")
+                logger.info(
+                    "Created prompt: %s (category: %s)", prompt_key, prompt_data['category'])
             except Exception as e:
-                print(f"Error creating prompt '{prompt_key}': {e}")
+                logger.exception("Error creating prompt '%s'", prompt_key)
                 # Continue with other prompts even if one fails
 
-    print("\n✅ Prompt initialization complete!")
-    print(f"   Created: {created_count} prompts")
-    print(f"   Already existed: {updated_count} prompts")
+    if created_count or updated_count:
+        bump_prompt_version()
+
+    logger.info("Prompt initialization complete!")
+    logger.info("Created: %s prompts", created_count)
+    logger.info("Already existed: %s prompts", updated_count)
 
     return created_count, updated_count
 
@@ -478,61 +484,12 @@ def get_prompt_from_db(prompt_key, default_prompt=None, **format_kwargs):
         The formatted prompt content from database or default_prompt
     """
     try:
-        prompt = PromptMaster.objects(
-            prompt_key=prompt_key, is_active=True).first()
+        # Served from the in-process registry of compiled prompts
+        prompt = get_compiled_prompt(prompt_key)
         if prompt:
-            prompt_content = prompt.prompt_content
-            instructions = prompt.instructions or ""
-            rules = prompt.rules or ""
-
-            # Add instructions and rules to format_kwargs if they exist in the prompt
-            if '{instructions}' in prompt_content or '{rules}' in prompt_content:
-                if 'instructions' not in format_kwargs:
-                    format_kwargs['instructions'] = instructions
-                if 'rules' not in format_kwargs:
-                    format_kwargs['rules'] = rules
-            elif instructions or rules:
-                # If placeholders don't exist but instructions/rules do, append them
-                # Find insertion point (before "Generate prompts" or before JSON section)
-                insertion_text = ""
-                if instructions:
-                    insertion_text += f"\n\n{instructions}"
-                if rules:
-                    insertion_text += f"\n\n{rules}"
-
-                # Also add global_instruction_rule if provided
-                global_rule = format_kwargs.get('global_instruction_rule', '')
-                if global_rule:
-                    insertion_text += f"\n{global_rule}"
-
-                # Insert before "Generate prompts" if it exists
-                if 'Generate prompts for the following' in prompt_content:
-                    parts = prompt_content.split(
-                        'Generate prompts for the following', 1)
-                    if len(parts) == 2:
-                        prompt_content = parts[0].rstrip(
-                        ) + insertion_text + '\n\nGenerate prompts for the following' + parts[1]
-                # Or insert before JSON section
-                elif 'Respond ONLY in valid JSON' in prompt_content:
-                    prompt_content = prompt_content.replace(
-                        'Respond ONLY in valid JSON',
-                        insertion_text + '\n\nRespond ONLY in valid JSON'
-                    )
-                # Or just append at the end before any closing braces
-                else:
-                    prompt_content = prompt_content.rstrip() + insertion_text
-
-            # Format the prompt if kwargs are provided
-            if format_kwargs:
-                try:
-                    return prompt_content.format(**format_kwargs)
-                except KeyError as e:
-                    print(
-                        f"Warning: Missing format variable {e} in prompt {prompt_key}, using as-is")
-                    return prompt_content
-            return prompt_content
+            return prompt.render(prompt_key, format_kwargs)
     except Exception as e:
-        print(f"Error fetching prompt from database: {e}")
+        logger.exception("Error fetching prompt from database")
 
     # Fallback to default and format if needed
     if default_prompt:
@@ -546,8 +503,7 @@ def get_prompt_from_db(prompt_key, default_prompt=None, **format_kwargs):
             try:
                 return default_prompt.format(**format_kwargs)
             except KeyError as e:
-                print(
-                    f"Warning: Missing format variable {e} in default prompt, using as-is")
+                logger.warning("Missing format variable %s in default prompt, using as-is", e)
                 return default_prompt
         return default_prompt
 
@@ -0,0 +1,150 @@
+"""
+In-process registry of compiled PromptMaster templates.
+
+get_prompt_from_db() used to query PromptMaster and redo the instructions and
+rules splicing on every call, several times per generation request. The
+registry loads all active prompts with one query, splices their instructions
+and rules once, and serves the compiled templates from memory.
+
+Consistency between worker processes relies on a version stamp stored in
+MongoDB: every change to the prompts calls bump_prompt_version(), and each
+process compares its version with the stored one at most every
+PROMPT_VERSION_CHECK_SECONDS, reloading when it changed.
+"""
+import logging
+import threading
+import time
+from django.conf import settings
+from pymongo import ReturnDocument
+from .models import PromptMaster
+
+logger = logging.getLogger(__name__)
+
+VERSION_COLLECTION = 'prompt_registry_version'
+VERSION_ID = 'prompts'
+
+# Markers the instructions and rules are spliced in front of, when the
+# template has no {instructions} / {rules} placeholders
+INSERTION_MARKERS = ('Generate prompts for the following', 'Respond ONLY in valid JSON')
+
+
+class CompiledPrompt:
+    """
+    A prompt with its instructions and rules already spliced in.
+
+    When the template has {instructions} / {rules} placeholders, they are
+    filled at render time (callers may override them). Otherwise the text is
+    inserted before the first "Generate prompts for the following", before
+    every "Respond ONLY in valid JSON", or at the end: the template is kept
+    split at that place, so only the caller's global_instruction_rule is
+    added per call.
+    """
+
+    __slots__ = ('segments', 'joiner', 'insertion', 'defaults')
+
+    def __init__(self, content, instructions, rules):
+        self.segments = [content]
+        self.joiner = ''
+        self.insertion = None
+        self.defaults = {}
+        if '{instructions}' in content or '{rules}' in content:
+            self.defaults = {'instructions': instructions, 'rules': rules}
+            return
+        if not (instructions or rules):
+            return
+
+        self.insertion = ''
+        if instructions:
+            self.insertion += f"\n\n{instructions}"
+        if rules:
+            self.insertion += f"\n\n{rules}"
+
+        if INSERTION_MARKERS[0] in content:
+            before, after = content.split(INSERTION_MARKERS[0], 1)
+            self.segments = [before.rstrip(), after]
+            self.joiner = '\n\n' + INSERTION_MARKERS[0]
+        elif INSERTION_MARKERS[1] in content:
+            self.segments = content.split(INSERTION_MARKERS[1])
+            self.joiner = '\n\n' + INSERTION_MARKERS[1]
+        else:
+            self.segments = [content.rstrip(), '']
+
+    def render(self, prompt_key, format_kwargs):
+        """Build the final prompt, formatted with format_kwargs if there are any"""
+        if self.insertion is None:
+            content = self.segments[0]
+        else:
+            insertion = self.insertion
+            global_rule = format_kwargs.get('global_instruction_rule', '')
+            if global_rule:
+                insertion += f"\n{global_rule}"
+            content = (insertion + self.joiner).join(self.segments)
+        kwargs = dict(self.defaults, **format_kwargs)
+        if not kwargs:
+            return content
+        try:
+            return content.format(**kwargs)
+        except KeyError as e:
+            logger.warning("Missing format variable %s in prompt %s, using as-is", e, prompt_key)
+            return content
+
+
+_lock = threading.Lock()
+_state = {'version': None, 'checked_at': 0.0, 'prompts': None}
+
+
+def _versions():
+    return PromptMaster._get_db()[VERSION_COLLECTION]
+
+
+def _stored_version():
+    row = _versions().find_one({'_id': VERSION_ID}, {'version': 1})
+    return row['version'] if row else 0
+
+
+def _load():
+    prompts = {}
+    rows = PromptMaster.objects(is_active=True).only(
+        'prompt_key', 'prompt_content', 'instructions', 'rules').as_pymongo()
+    for row in rows:
+        # Like .first(), the first active prompt of a key wins
+        if row.get('prompt_key') and row['prompt_key'] not in prompts:
+            prompts[row['prompt_key']] = CompiledPrompt(
+                row.get('prompt_content') or '', row.get('instructions') or '', row.get('rules') or '')
+    return prompts
+
+
+def get_compiled_prompt(prompt_key):
+    """
+    Compiled template of an active prompt.
+
+    Returns:
+        CompiledPrompt: The prompt, or None if there is no active prompt with this key
+    """
+    now = time.monotonic()
+    check_every = getattr(settings, 'PROMPT_VERSION_CHECK_SECONDS', 5)
+    prompts = _state['prompts']
+    if prompts is None or now - _state['checked_at'] >= check_every:
+        with _lock:
+            if _state['prompts'] is None or now - _state['checked_at'] >= check_every:
+                version = _stored_version()
+                if _state['prompts'] is None or version != _state['version']:
+                    _state['prompts'] = _load()
+                    _state['version'] = version
+                _state['checked_at'] = now
+            prompts = _state['prompts']
+    return prompts.get(prompt_key)
+
+
+def bump_prompt_version():
+    """
+    Mark the prompts as changed, after creating, updating or deleting any.
+    This process reloads on its next lookup, the others within
+    PROMPT_VERSION_CHECK_SECONDS.
+    """
+    row = _versions().find_one_and_update(
+        {'_id': VERSION_ID}, {'$inc': {'version': 1}},
+        upsert=True, return_document=ReturnDocument.AFTER)
+    with _lock:
+        _state['prompts'] = None
+        _state['version'] = row['version']
@@ -0,0 +1,133 @@
+"""
+Lean read helpers for read-only API responses.
+
+Detail and list endpoints used to load full MongoEngine documents and then
+build dicts by hand (e.g. img.to_mongo().to_dict() per uploaded image). The
+helpers below read raw pymongo dicts with a projection of just the fields a
+response needs (as_pymongo() + only()), and turn them into JSON-ready dicts
+without creating any document objects. ObjectIds and datetimes are left as
+they are, common.responses.JsonResponse converts them.
+"""
+from .models import Collection
+from .generated_image_utils import get_generated_images_by_product, serialize_product_images
+
+# Item fields returned by the collection detail endpoints, with their empty value
+COLLECTION_ITEM_FIELDS = (
+    ('suggested_themes', list),
+    ('suggested_backgrounds', list),
+    ('suggested_poses', list),
+    ('suggested_locations', list),
+    ('suggested_colors', list),
+    ('selected_themes', list),
+    ('selected_backgrounds', list),
+    ('selected_poses', list),
+    ('selected_locations', list),
+    ('selected_colors', list),
+    ('uploaded_theme_images', list),
+    ('uploaded_background_images', list),
+    ('uploaded_pose_images', list),
+    ('uploaded_location_images', list),
+    ('uploaded_color_images', list),
+    ('generated_prompts', dict),
+    ('generated_model_images', list),
+    ('picked_colors', list),
+    ('global_instructions', str),
+    ('uploaded_model_images', list),
+)
+
+COLLECTION_DETAIL_FIELDS = (
+    'project', 'description', 'target_audience', 'campaign_season', 'created_at',
+    *[f'items.{field}' for field, _ in COLLECTION_ITEM_FIELDS],
+    'items.selected_model', 'items.product_images',
+)
+
+
+def isoformat(value):
+    """ISO format of a datetime read from MongoDB, or None"""
+    return value.isoformat() if value else None
+
+
+def object_id(value):
+    """String form of a raw ObjectId (or reference), or None"""
+    return str(value) if value else None
+
+
+def get_raw_collection(**query):
+    """
+    Load the first matching collection as a raw dict with the detail fields.
+
+    Args:
+        **query: MongoEngine filters, e.g. id=collection_id or project=project_id
+
+    Returns:
+        dict: The raw collection, or None if not found
+    """
+    return Collection.objects(**query).only(*COLLECTION_DETAIL_FIELDS).as_pymongo().first()
+
+
+def serialize_collection_item(item, images_by_product):
+    """
+    Build an item of a collection detail response from the raw item dict.
+
+    Args:
+        item (dict): Raw collection item
+        images_by_product (dict): See get_generated_images_by_product
+
+    Returns:
+        dict: The item as returned by the API
+    """
+    item_data = {field: item.get(field) or empty()
+                 for field, empty in COLLECTION_ITEM_FIELDS}
+    item_data['selected_model'] = item.get('selected_model') or {}
+    item_data['product_images'] = serialize_product_images(
+        item.get('product_images') or [], images_by_product)
+    return item_data
+
+
+def serialize_collection_detail(collection):
+    """
+    Build the collection detail response from a raw collection.
+
+    Args:
+        collection (dict): Raw collection from get_raw_collection
+
+    Returns:
+        dict: The collection with its items and their generated images
+    """
+    images_by_product = get_generated_images_by_product(collection['_id'])
+    return {
+        'id': collection['_id'],
+        'project_id': collection.get('project'),
+        'description': collection.get('description'),
+        'target_audience': collection.get('target_audience'),
+        'campaign_season': collection.get('campaign_season'),
+        'created_at': collection.get('created_at'),
+        'items': [serialize_collection_item(item, images_by_product)
+                  for item in collection.get('items') or []]
+    }
+
+
+def serialize_prompt(prompt):
+    """
+    Build a prompt of the prompt master responses from a raw PromptMaster dict.
+
+    Returns:
+        dict: The prompt as returned by the API
+    """
+    return {
+        "id": str(prompt['_id']),
+        "prompt_key": prompt.get('prompt_key'),
+        "title": prompt.get('title'),
+        "description": prompt.get('description'),
+        "prompt_content": prompt.get('prompt_content'),
+        "instructions": prompt.get('instructions') or "",
+        "rules": prompt.get('rules') or "",
+        "category": prompt.get('category'),
+        "prompt_type": prompt.get('prompt_type'),
+        "is_active": prompt.get('is_active', True),
+        "created_at": isoformat(prompt.get('created_at')),
+        "updated_at": isoformat(prompt.get('updated_at')),
+        "created_by": object_id(prompt.get('created_by')),
+        "updated_by": object_id(prompt.get('updated_by')),
+        "metadata": prompt.get('metadata') or {}
+    }
@@ -1,3 +1,626 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+import jwt
+from bson import ObjectId
+from django.core.management import call_command
+from django.conf import settings
+from django.test import RequestFactory, override_settings
+from mongoengine.errors import SaveConditionError
+from common.archive import archive_collection_name, get_document
+from common import response_cache
+from common.pagination import split_page
+from common.testing import MongoTestCase
+from imgbackendapp.mongo_models import OrnamentMongo
+from users.models import User
+from . import api_views, membership_utils, prompt_registry
+from .collection_updates import push_item_values, set_item_fields, update_collection, update_with_retry
+from .generated_image_utils import find_generated_image, find_product, find_products
+from .history_utils import count_user_history, get_user_history_page
+from .prompt_initializer import get_prompt_from_db
+from .image_counters import decode_counter_key, record_image_counts, tally_collection_images
+from .models import (Collection, CollectionItem, GeneratedImage, ImageGenerationHistory, ProductImage, Project,
+                     ProjectInvite, ProjectMember, PromptMaster)
 
-# Create your tests here.
+
+class CollectionUpdateConcurrencyTests(MongoTestCase):
+    """Parallel writers of one collection must not lose each other's updates"""
+
+    WRITERS = 20
+
+    def setUp(self):
+        super().setUp()
+        self.project = Project(name='Project')
+        self.project.save()
+        self.collection = Collection(project=self.project, items=[CollectionItem()])
+        self.collection.save()
+
+    def run_parallel(self, func):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            return list(pool.map(func, range(self.WRITERS)))
+
+    def test_parallel_pushes_are_all_kept(self):
+        self.run_parallel(lambda i: push_item_values(
+            self.collection.id, 'uploaded_model_images', [{'cloud': f'https://example.com/{i}.png'}]))
+
+        collection = Collection.objects.get(id=self.collection.id)
+        self.assertEqual(len(collection.items[0].uploaded_model_images), self.WRITERS)
+        self.assertEqual(collection.revision, 1 + self.WRITERS)
+
+    def test_parallel_read_modify_writes_are_all_kept(self):
+        def add_prompt(i):
+            def build_update(collection):
+                prompts = dict(collection.items[0].generated_prompts or {}, **{f'prompt{i}': str(i)})
+                return {'$set': {'items.0.generated_prompts': prompts}}
+            update_with_retry(self.collection.id, build_update, retries=self.WRITERS * 2)
+
+        self.run_parallel(add_prompt)
+
+        collection = Collection.objects.get(id=self.collection.id)
+        self.assertEqual(len(collection.items[0].generated_prompts), self.WRITERS)
+        self.assertEqual(collection.revision, 1 + self.WRITERS)
+
+    def test_full_save_does_not_overwrite_a_targeted_update(self):
+        stale = Collection.objects.get(id=self.collection.id)
+        self.assertTrue(update_collection(self.collection.id, {'$set': {'description': 'targeted'}}))
+
+        stale.description = 'full save'
+        with self.assertRaises(SaveConditionError):
+            stale.save()
+
+        collection = Collection.objects.get(id=self.collection.id)
+        self.assertEqual(collection.description, 'targeted')
+        self.assertEqual(collection.revision, 2)
+        self.assertEqual(stale.revision, 1)
+
+    def test_parallel_saves_store_distinct_revisions(self):
+        def rename(i):
+            project = Project.objects.get(id=self.project.id)
+            project.name = f'Project {i}'
+            try:
+                project.save()
+            except SaveConditionError:
+                return None
+            return project.revision
+
+        revisions = [r for r in self.run_parallel(rename) if r is not None]
+        self.assertEqual(len(revisions), len(set(revisions)))
+        self.assertEqual(Project.objects.get(id=self.project.id).revision, 1 + len(revisions))
+
+    def test_documents_without_revision_can_be_saved(self):
+        Collection._get_collection().update_one(
+            {'_id': self.collection.id}, {'$unset': {'revision': ''}})
+        legacy = Collection.objects.get(id=self.collection.id)
+
+        legacy.description = 'saved'
+        legacy.save()
+
+        self.assertEqual(Collection.objects.get(id=self.collection.id).revision, 1)
+
+
+class ConcurrentSaveViewTests(MongoTestCase):
+    """A save that lost the race with another write is answered with a 409"""
+
+    def test_update_project_conflict(self):
+        user = User(email='owner@example.com', password='x', username='owner')
+        user.save()
+        project = Project(name='Project', team_members=[ProjectMember(user=user, role='owner')])
+        project.save()
+        token = jwt.encode({'id': str(user.id)}, settings.SECRET_KEY, algorithm='HS256')
+        request = RequestFactory(HTTP_AUTHORIZATION=f'Bearer {token}').put(
+            '/', json.dumps({'name': 'Mine'}), content_type='application/json')
+
+        # Loaded by the view, then changed by another request before it saves
+        stale = Project.objects.get(id=project.id)
+        project.name = 'Theirs'
+        project.save()
+        with mock.patch.object(api_views.Project, 'objects') as objects:
+            objects.get.return_value = stale
+            response = api_views.api_update_project(request, str(project.id))
+
+        self.assertEqual(response.status_code, 409, response.content)
+        self.assertEqual(Project.objects.get(id=project.id).name, 'Theirs')
+
+
+@override_settings(RESPONSE_CACHE_ENABLED=False)
+class ReferenceBatchingTests(MongoTestCase):
+    """List endpoints load their references with one query per model, whatever the number of rows"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('owner')
+        token = jwt.encode({'id': str(self.user.id)}, settings.SECRET_KEY, algorithm='HS256')
+        self.factory = RequestFactory(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def create_user(self, name):
+        name = f'{name}{User.objects.count()}'
+        user = User(email=f'{name}@example.com', password='x', username=name, full_name=name.title())
+        user.save()
+        return user
+
+    def add_projects(self, count, members=3):
+        users = [self.create_user('member') for _ in range(members)]
+        projects = []
+        for i in range(count):
+            project = Project(name=f'Project {i}', team_members=[
+                ProjectMember(user=self.user, role='owner'),
+                *[ProjectMember(user=user, role='viewer') for user in users]])
+            project.save()
+            Collection(project=project, items=[CollectionItem()]).save()
+            ProjectInvite(project=project, inviter=users[0], invitee=self.user).save()
+            projects.append(project)
+        return projects
+
+    def get(self, view, *args):
+        response = view(self.factory.get('/'), *args)
+        self.assertEqual(response.status_code, 200, response.content)
+        return json.loads(response.content)
+
+    def count_commands(self, view, *args):
+        # The first request also loads the authenticated user
+        self.get(view, *args)
+        with self.captureMongoCommands() as commands:
+            self.get(view, *args)
+        return len(commands)
+
+    def test_projects_list(self):
+        self.add_projects(2)
+        few = self.count_commands(api_views.api_projects_list)
+        self.add_projects(8, members=5)
+        self.assertEqual(len(self.get(api_views.api_projects_list)['projects']), 10)
+        # Projects, their members' users, then the collection summaries
+        self.assertEqual(self.count_commands(api_views.api_projects_list), few)
+        self.assertEqual(few, 3)
+
+    def test_invite_lists(self):
+        projects = self.add_projects(2)
+        few_all = self.count_commands(api_views.api_list_all_invites)
+        few_project = self.count_commands(api_views.api_list_invites, str(projects[0].id))
+        self.add_projects(8, members=5)
+        for _ in range(8):
+            ProjectInvite(project=projects[0], inviter=self.user,
+                          invitee=self.create_user('invitee')).save()
+
+        self.assertEqual(len(self.get(api_views.api_list_all_invites)['pending_invites']), 10)
+        self.assertEqual(self.count_commands(api_views.api_list_all_invites), few_all)
+        self.assertEqual(self.count_commands(api_views.api_list_invites, str(projects[0].id)), few_project)
+        # Invites, then projects and users
+        self.assertEqual(few_all, 3)
+
+    def add_history(self, projects, count):
+        now = datetime.utcnow()
+        ImageGenerationHistory._get_collection().insert_many([
+            {'project': project.id, 'image_type': 'project_white_background', 'user_id': str(self.user.id),
+             'image_url': f'https://example.com/{project.id}/{i}.png', 'created_at': now - timedelta(minutes=i)}
+            for project in projects for i in range(count)])
+
+    def test_recent_projects(self):
+        self.add_history(self.add_projects(2), 7)
+        few = self.count_commands(api_views.api_recent_projects)
+        self.add_history(self.add_projects(8, members=5), 7)
+
+        projects = self.get(api_views.api_recent_projects)['projects']
+        self.assertEqual(len(projects), 10)
+        # The 5 newest records of each project
+        self.assertEqual([len(p['recent_activity']) for p in projects], [5] * 10)
+        self.assertTrue(all(p['recent_activity'][0]['image_url'].endswith('/0.png') for p in projects))
+        self.assertEqual({p['user_role'] for p in projects}, {'owner'})
+        self.assertEqual(self.count_commands(api_views.api_recent_projects), few)
+        # The page of projects, the ids of all of them, collection summaries and activity
+        self.assertEqual(few, 4)
+
+
+@override_settings(MEMBERSHIP_VERSION_CHECK_SECONDS=0)
+class MembershipCacheTests(MongoTestCase):
+    """Membership changes made by another worker process invalidate the cached roles"""
+
+    def setUp(self):
+        super().setUp()
+        with membership_utils._lock:
+            membership_utils._clear()
+            membership_utils._state.update(version=None, checked_at=0.0)
+        self.user = User(email='member@example.com', password='x', username='member')
+        self.user.save()
+        self.project = Project(name='Project', team_members=[ProjectMember(user=self.user, role='viewer')])
+        self.project.save()
+        self.collection = Collection(project=self.project)
+        self.collection.save()
+
+    def change_in_other_process(self, **changes):
+        """Change the project behind this process' back, then bump the stored version"""
+        Project._get_collection().update_one({'_id': self.project.id}, {'$set': changes})
+        membership_utils._versions().update_one(
+            {'_id': membership_utils.VERSION_ID}, {'$inc': {'version': 1}}, upsert=True)
+
+    def test_role_is_cached(self):
+        self.assertEqual(membership_utils.get_project_role(self.user.id, self.project.id), 'viewer')
+        Project._get_collection().update_one(
+            {'_id': self.project.id}, {'$set': {'team_members.0.role': 'editor'}})
+        self.assertEqual(membership_utils.get_project_role(self.user.id, self.project.id), 'viewer')
+
+    def test_role_change_in_other_process(self):
+        self.assertEqual(membership_utils.get_project_role(self.user.id, self.project.id), 'viewer')
+        self.change_in_other_process(**{'team_members.0.role': 'editor'})
+        self.assertEqual(membership_utils.get_project_role(self.user.id, self.project.id), 'editor')
+
+    def test_collection_deleted_in_other_process(self):
+        self.assertEqual(membership_utils.get_collection_project_id(self.collection.id), str(self.project.id))
+        Collection._get_collection().delete_one({'_id': self.collection.id})
+        self.change_in_other_process()
+        self.assertIsNone(membership_utils.get_collection_project_id(self.collection.id))
+
+    def test_invalidation_in_this_process(self):
+        self.assertEqual(membership_utils.get_project_role(self.user.id, self.project.id), 'viewer')
+        Project._get_collection().update_one(
+            {'_id': self.project.id}, {'$set': {'team_members.0.role': 'editor'}})
+        membership_utils.invalidate_membership(self.project.id, self.user.id)
+        self.assertEqual(membership_utils.get_project_role(self.user.id, self.project.id), 'editor')
+
+
+class MigrateGeneratedImagesTests(MongoTestCase):
+    """migrate_generated_images moves the embedded images to GeneratedImage documents once"""
+
+    def setUp(self):
+        super().setUp()
+        project = Project(name='Project')
+        project.save()
+        generated = {
+            'type': 'white_background', 'prompt': 'Studio shot', 'cloud_url': 'https://example.com/1.png',
+            'regenerated_images': [{'prompt': 'Again', 'cloud_url': 'https://example.com/2.png'}],
+        }
+        self.collection_id = ObjectId()
+        Collection._get_collection().insert_one({
+            '_id': self.collection_id, 'project': project.id, 'revision': 3, 'items': [{'product_images': [
+                {'uploaded_image_url': 'https://example.com/product.png', 'generated_images': [generated]},
+            ]}]})
+
+    def migrate(self):
+        call_command('migrate_generated_images', stdout=StringIO())
+
+    def test_migrates_in_one_run(self):
+        self.migrate()
+
+        collection = Collection._get_collection().find_one({'_id': self.collection_id})
+        self.assertEqual(collection['items'][0]['product_images'][0]['generated_images'], [])
+        images = {image.kind: image for image in GeneratedImage.objects(collection=self.collection_id)}
+        self.assertEqual(set(images), {'generated', 'regenerated'})
+        self.assertEqual(images['regenerated'].parent.id, images['generated'].id)
+        self.assertEqual(images['generated'].product_id,
+                         collection['items'][0]['product_images'][0]['product_id'])
+
+    def test_rerun_inserts_nothing(self):
+        self.migrate()
+        self.migrate()
+        self.assertEqual(GeneratedImage.objects(collection=self.collection_id).count(), 2)
+
+
+class ImageCounterTests(MongoTestCase):
+    """The denormalized counters follow the images, and recount_images rebuilds them"""
+
+    def setUp(self):
+        super().setUp()
+        self.project = Project(name='Project')
+        self.project.save()
+        self.collection = Collection(project=self.project, items=[CollectionItem(product_images=[
+            ProductImage(uploaded_image_url=f'https://example.com/{i}.png') for i in range(2)])])
+        self.collection.save()
+        product_id = self.collection.items[0].product_images[0].product_id
+        model = {'type': 'ai', 'name': 'model.v2'}
+        for kind in ('generated', 'generated', 'regenerated', 'enhanced'):
+            GeneratedImage(collection=self.collection, project=self.project, product_id=product_id,
+                           kind=kind, model_used=model).save()
+
+    def counters(self, document):
+        row = type(document)._get_collection().find_one(
+            {'_id': document.id}, {'total_images': 1, 'image_type_counts': 1, 'model_usage_counts': 1})
+        return (row.get('total_images'), row.get('image_type_counts'),
+                {decode_counter_key(k): v for k, v in (row.get('model_usage_counts') or {}).items()})
+
+    def test_record_image_counts(self):
+        record_image_counts(self.collection, {'product': 2}, {})
+        record_image_counts(self.collection, *tally_collection_images(self.collection.id))
+        record_image_counts(self.collection, {'generated': 1}, {'ai:model.v2': 1}, sign=-1)
+
+        expected = (4, {'product': 2, 'generated': 1, 'regenerated': 1, 'enhanced': 1}, {'ai:model.v2': 2})
+        self.assertEqual(self.counters(self.collection), expected)
+        self.assertEqual(self.counters(self.project), expected)
+
+    def test_recount_rebuilds_the_counters(self):
+        for document in (self.collection, self.project):
+            type(document)._get_collection().update_one(
+                {'_id': document.id}, {'$set': {'total_images': 99, 'image_type_counts': {'product': 99}}})
+
+        call_command('recount_images', stdout=StringIO())
+
+        # Enhanced images are counted apart from total_images
+        expected = (5, {'product': 2, 'generated': 2, 'regenerated': 1, 'enhanced': 1}, {'ai:model.v2': 3})
+        self.assertEqual(self.counters(self.collection), expected)
+        self.assertEqual(self.counters(self.project), expected)
+
+
+class UserHistoryTests(MongoTestCase):
+    """The history pages merge project and individual records, newest first"""
+
+    def setUp(self):
+        super().setUp()
+        self.user_id = str(ObjectId())
+        project = ObjectId()
+        self.now = datetime.utcnow()
+        ImageGenerationHistory._get_collection().insert_many([
+            *[{'project': project, 'image_type': 'project_white_background', 'user_id': self.user_id,
+               'image_url': f'https://example.com/p{i}.png', 'created_at': self.now - timedelta(minutes=2 * i)}
+              for i in range(5)],
+            # Listed from the individual records, or without a project
+            {'project': project, 'image_type': 'white_background', 'user_id': self.user_id,
+             'image_url': 'https://example.com/skipped.png', 'created_at': self.now},
+            {'image_type': 'project_white_background', 'user_id': self.user_id,
+             'image_url': 'https://example.com/no-project.png', 'created_at': self.now},
+            # Outside of the window
+            {'project': project, 'image_type': 'project_white_background', 'user_id': self.user_id,
+             'image_url': 'https://example.com/old.png', 'created_at': self.now - timedelta(days=40)},
+        ])
+        OrnamentMongo._get_collection().insert_many([
+            {'type': 'white_background', 'user_id': self.user_id, 'generated_image_url': f'https://example.com/i{i}.png',
+             'created_at': self.now - timedelta(minutes=2 * i + 1)}
+            for i in range(4)])
+        self.start = self.now - timedelta(days=30)
+
+    def test_count(self):
+        self.assertEqual(count_user_history(self.user_id, self.start, self.now), 9)
+
+    @skipUnless(os.environ.get('MONGO_TEST_URI'), 'mongomock does not run $unionWith')
+    def test_pages_follow_the_cursor(self):
+        urls, cursor = [], None
+        while True:
+            rows, cursor = split_page(get_user_history_page(
+                self.user_id, self.start, self.now, cursor=cursor, limit=4), 4)
+            urls.extend(row['image_url'] for row in rows)
+            if not cursor:
+                break
+
+        self.assertEqual(urls, ['https://example.com/p0.png', 'https://example.com/i0.png',
+                                'https://example.com/p1.png', 'https://example.com/i1.png',
+                                'https://example.com/p2.png', 'https://example.com/i2.png',
+                                'https://example.com/p3.png', 'https://example.com/i3.png',
+                                'https://example.com/p4.png'])
+
+
+class ImageResolutionTests(MongoTestCase):
+    """Products and generated images are found by id, path or URL"""
+
+    def setUp(self):
+        super().setUp()
+        self.collection = Collection(project=Project(name='Project').save(), items=[CollectionItem(product_images=[
+            ProductImage(uploaded_image_url=f'https://example.com/{i}.png', uploaded_image_path=f'/media/{i}.png')
+            for i in range(3)])])
+        self.collection.save()
+        self.products = self.collection.items[0].product_images
+        self.image = GeneratedImage(collection=self.collection, product_id=self.products[0].product_id,
+                                    local_path='/media/generated.png', cloud_url='https://example.com/generated.png')
+        self.image.save()
+
+    def test_find_products(self):
+        found = find_products(self.collection.id, product_ids=[str(self.products[2].product_id), 'not-an-id'],
+                              paths=['/media/0.png'], urls=['https://example.com/1.png'])
+        # In their stored order, whatever matched them
+        self.assertEqual([p.product_id for p in found], [p.product_id for p in self.products])
+        self.assertEqual(find_products(self.collection.id, product_ids=['not-an-id']), [])
+
+    def test_find_product(self):
+        self.assertEqual(find_product(self.collection.id, url='https://example.com/1.png').uploaded_image_path,
+                         '/media/1.png')
+        self.assertIsNone(find_product(self.collection.id, path='/media/missing.png'))
+
+    def test_find_generated_image(self):
+        for lookup in ({'image_id': str(self.image.id)}, {'local_path': '/media/generated.png'},
+                       {'cloud_url': 'https://example.com/generated.png'}):
+            self.assertEqual(find_generated_image(self.collection.id, **lookup).id, self.image.id, lookup)
+        self.assertIsNone(find_generated_image(self.collection.id, image_id='not-an-id'))
+        self.assertIsNone(find_generated_image(ObjectId(), image_id=str(self.image.id)))
+        self.assertIsNone(find_generated_image(
+            self.collection.id, local_path='/media/generated.png', kinds=['regenerated']))
+
+
+class ArchiveRecordsTests(MongoTestCase):
+    """archive_records moves old records to cold storage, where they can still be found by id"""
+
+    def setUp(self):
+        super().setUp()
+        now = datetime.utcnow()
+        self.old, self.recent = (ImageGenerationHistory._get_collection().insert_many([
+            {'image_type': 'white_background', 'image_url': 'https://example.com/1.png', 'user_id': 'u1',
+             'created_at': created_at}
+            for created_at in (now - timedelta(days=400), now - timedelta(days=10))]).inserted_ids)
+
+    def archive(self, *args):
+        out = StringIO()
+        call_command('archive_records', '--days', '365', '--only', 'history', *args, stdout=out)
+        return out.getvalue()
+
+    def test_dry_run_moves_nothing(self):
+        self.assertIn('1 records to archive', self.archive('--dry-run'))
+        self.assertEqual(ImageGenerationHistory.objects.count(), 2)
+
+    def test_archive_to_collection(self):
+        self.archive('--target', 'collection')
+        self.archive('--target', 'collection')
+
+        self.assertEqual(list(ImageGenerationHistory.objects.scalar('id')), [self.recent])
+        cold = ImageGenerationHistory._get_db()[archive_collection_name(ImageGenerationHistory)]
+        self.assertEqual([row['_id'] for row in cold.find()], [self.old])
+        self.assertEqual(get_document(ImageGenerationHistory, self.old, user_id='u1').id, self.old)
+        self.assertIsNone(get_document(ImageGenerationHistory, self.old, user_id='u2'))
+
+    def test_archive_to_files(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(ARCHIVE_DIR=directory):
+            self.archive('--target', 'file')
+
+            self.assertEqual(list(ImageGenerationHistory.objects.scalar('id')), [self.recent])
+            self.assertEqual(get_document(ImageGenerationHistory, self.old).image_url, 'https://example.com/1.png')
+
+
+@override_settings(PROMPT_VERSION_CHECK_SECONDS=0)
+class PromptRegistryTests(MongoTestCase):
+    """Prompts are compiled once per process and reloaded when another process changes them"""
+
+    def setUp(self):
+        super().setUp()
+        PromptMaster(prompt_key='white_background', title='White', category='template',
+                     prompt_content='Photo of {item}. Respond ONLY in valid JSON', instructions='Be brief',
+                     rules='No text').save()
+        PromptMaster(prompt_key='inactive', title='Inactive', category='template',
+                     prompt_content='Old', is_active=False).save()
+        prompt_registry.bump_prompt_version()
+
+    def test_instructions_and_rules_are_spliced(self):
+        # Inserted right before the JSON section, as the prompts were before the registry
+        self.assertEqual(get_prompt_from_db('white_background', item='a ring'),
+                         'Photo of a ring. \n\nBe brief\n\nNo text\n\nRespond ONLY in valid JSON')
+        self.assertEqual(get_prompt_from_db('inactive', 'Default'), 'Default')
+
+    def test_change_in_other_process(self):
+        get_prompt_from_db('white_background', item='a ring')
+        PromptMaster._get_collection().update_one(
+            {'prompt_key': 'white_background'}, {'$set': {'prompt_content': 'Studio photo of {item}'}})
+        self.assertTrue(get_prompt_from_db('white_background', item='a ring').startswith('Photo of a ring'))
+
+        # What bump_prompt_version() does in the other process
+        PromptMaster._get_db()[prompt_registry.VERSION_COLLECTION].update_one(
+            {'_id': prompt_registry.VERSION_ID}, {'$inc': {'version': 1}})
+        self.assertTrue(get_prompt_from_db('white_background', item='a ring').startswith('Studio photo of a ring'))
+
+
+class PromptListTests(MongoTestCase):
+    """The prompt list returns every prompt, unless the client asks for pages"""
+
+    def setUp(self):
+        super().setUp()
+        user = User(email='admin@example.com', password='x', username='admin')
+        user.save()
+        token = jwt.encode({'id': str(user.id)}, settings.SECRET_KEY, algorithm='HS256')
+        self.factory = RequestFactory(HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.keys = sorted(f'prompt_{i:03}' for i in range(api_views.MAX_LIMIT + 5))
+        PromptMaster._get_collection().insert_many([
+            {'prompt_key': key, 'title': key, 'category': 'template', 'prompt_content': key, 'is_active': True}
+            for key in self.keys])
+
+    def get(self, **params):
+        response = api_views.api_prompt_master_list(self.factory.get('/', params))
+        self.assertEqual(response.status_code, 200, response.content)
+        return json.loads(response.content)
+
+    def test_without_page_parameters(self):
+        data = self.get()
+        self.assertEqual([p['prompt_key'] for p in data['prompts']], self.keys)
+        self.assertFalse(data['pagination']['has_more'])
+
+    def test_pages(self):
+        keys, params = [], {'limit': 40}
+        while True:
+            data = self.get(**params)
+            self.assertLessEqual(len(data['prompts']), 40)
+            keys.extend(p['prompt_key'] for p in data['prompts'])
+            if not data['pagination']['has_more']:
+                break
+            params['cursor'] = data['pagination']['next_cursor']
+        self.assertEqual(keys, self.keys)
+
+
+class ConditionalGetTests(MongoTestCase):
+    """Polls of an unchanged project or collection get a 304 without loading it"""
+
+    def setUp(self):
+        super().setUp()
+        user = User(email='owner@example.com', password='x', username='owner')
+        user.save()
+        self.project = Project(name='Project', team_members=[ProjectMember(user=user, role='owner')])
+        self.project.save()
+        self.collection = Collection(project=self.project, description='First', items=[CollectionItem()])
+        self.collection.save()
+        token = jwt.encode({'id': str(user.id)}, settings.SECRET_KEY, algorithm='HS256')
+        self.factory = RequestFactory(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def get(self, view, object_id, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        return view(self.factory.get('/', **headers), str(object_id))
+
+    def test_project_detail(self):
+        response = self.get(api_views.api_project_detail, self.project.id)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # The project and collection versions only
+        with self.assertNumMongoCommands(2):
+            self.assertEqual(self.get(api_views.api_project_detail, self.project.id, etag).status_code, 304)
+
+        # A change of its collection changes the project detail too
+        update_collection(self.collection.id, {'$set': {'description': 'Second'}})
+        response = self.get(api_views.api_project_detail, self.project.id, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(RESPONSE_CACHE_ENABLED=False)
+    def test_collection_detail(self):
+        etag = self.get(api_views.api_collection_detail, self.collection.id)['ETag']
+        self.assertEqual(self.get(api_views.api_collection_detail, self.collection.id, etag).status_code, 304)
+
+        self.project.name = 'Renamed'
+        self.project.save()
+        self.assertEqual(self.get(api_views.api_collection_detail, self.collection.id, etag).status_code, 304)
+
+        push_item_values(self.collection.id, 'uploaded_model_images', [{'cloud': 'https://example.com/1.png'}])
+        response = self.get(api_views.api_collection_detail, self.collection.id, etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(RESPONSE_CACHE_ENABLED=True, RESPONSE_CACHE_BACKEND='mongo')
+class ResponseCacheInvalidationTests(MongoTestCase):
+    """Cached responses are dropped by the writes of any worker"""
+
+    def setUp(self):
+        super().setUp()
+        self.user = User(email='owner@example.com', password='x', username='owner')
+        self.user.save()
+        self.project = Project(name='Project', team_members=[ProjectMember(user=self.user, role='owner')])
+        self.project.save()
+        self.collection = Collection(project=self.project, description='First', items=[CollectionItem()])
+        self.collection.save()
+        token = jwt.encode({'id': str(self.user.id)}, settings.SECRET_KEY, algorithm='HS256')
+        self.factory = RequestFactory(HTTP_AUTHORIZATION=f'Bearer {token}')
+        # Two workers, each with its own entries
+        self.workers = [response_cache.MongoBackend(16, 60), response_cache.MongoBackend(16, 60)]
+
+    def get(self, worker, view, *args):
+        with mock.patch.object(response_cache, '_backend', self.workers[worker]):
+            response = view(self.factory.get('/'), *args)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response['X-Cache'], json.loads(response.content)
+
+    def test_collection_detail(self):
+        collection_id = str(self.collection.id)
+        for worker in (0, 1):
+            self.assertEqual(self.get(worker, api_views.api_collection_detail, collection_id)[0], 'MISS')
+            self.assertEqual(self.get(worker, api_views.api_collection_detail, collection_id)[0], 'HIT')
+
+        with mock.patch.object(response_cache, '_backend', self.workers[0]):
+            set_item_fields(collection_id, {}, collection_fields={'description': 'Second'})
+
+        for worker in (0, 1):
+            cache, data = self.get(worker, api_views.api_collection_detail, collection_id)
+            self.assertEqual((cache, data['description']), ('MISS', 'Second'))
+
+    def test_projects_list(self):
+        self.assertEqual(self.get(1, api_views.api_projects_list)[0], 'MISS')
+        self.assertEqual(self.get(1, api_views.api_projects_list)[0], 'HIT')
+
+        with mock.patch.object(response_cache, '_backend', self.workers[0]):
+            self.project.name = 'Renamed'
+            self.project.save()
+
+        cache, data = self.get(1, api_views.api_projects_list)
+        self.assertEqual((cache, [p['name'] for p in data['projects']]), ('MISS', ['Renamed']))
@@ -59,6 +59,10 @@ urlpatterns = [
 
     path("api/collections/<str:collection_id>/",
          api_views.api_collection_detail, name="api_collection_detail"),
+    path("api/collections/<str:collection_id>/generated-images/",
+         api_views.api_collection_generated_images, name="api_collection_generated_images"),
+    path("api/collections/<str:collection_id>/generated-images/<str:image_id>/lineage/",
+         api_views.api_generated_image_lineage, name="api_generated_image_lineage"),
 
     path("api/projects/<str:project_id>/setup/description/",
          api_views.api_project_setup_description, name="api_project_setup_description"),
@@ -114,6 +118,8 @@ urlpatterns = [
          api_views_extended.api_get_model_usage_stats, name='api_get_model_usage_stats'),
     path('api/projects/<str:project_id>/user-role/',
          api_views_extended.api_get_user_role, name='api_get_user_role'),
+    path('api/cache/stats/',
+         api_views_extended.api_response_cache_stats, name='api_response_cache_stats'),
 
     # Recent History API endpoints
     path('api/recent/history/',
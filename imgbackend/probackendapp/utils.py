@@ -1,8 +1,11 @@
+import logging
 import os
-import requests
 import json
 import re
 from dotenv import load_dotenv
+from common.http_client import get_async_client, get_client
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
@@ -10,20 +13,46 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
 
 
-def call_gemini_api(prompt: str):
-    headers = {"x-goog-api-key": GEMINI_API_KEY,
-               "Content-Type": "application/json"}
+def _gemini_payload(prompt):
+    headers = {"Content-Type": "application/json"}
+    if GEMINI_API_KEY:
+        headers["x-goog-api-key"] = GEMINI_API_KEY
     data = {"contents": [{"parts": [{"text": prompt}]}]}
+    return headers, data
+
+
+def _gemini_text(response):
+    response.raise_for_status()
+    result = response.json()
+    return result["candidates"][0]["content"]["parts"][0]["text"]
+
+
+def call_gemini_api(prompt: str):
+    """
+    Send a text prompt to Gemini, over the pooled connections of this process.
+
+    Returns:
+        str: The text of the answer, or None if the call failed
+    """
+    headers, data = _gemini_payload(prompt)
     try:
-        response = requests.post(
+        response = get_client().post(
             GEMINI_URL, headers=headers, json=data, timeout=60)
-        response.raise_for_status()
-        result = response.json()
-        text_output = result["candidates"][0]["content"]["parts"][0]["text"]
+        return _gemini_text(response)
+    except Exception:
+        logger.exception("Gemini API error")
+        return None
 
-        return text_output
-    except Exception as e:
-        print("Gemini API error:", e)
+
+async def acall_gemini_api(prompt: str):
+    """call_gemini_api for async code"""
+    headers, data = _gemini_payload(prompt)
+    try:
+        response = await get_async_client().post(
+            GEMINI_URL, headers=headers, json=data, timeout=60)
+        return _gemini_text(response)
+    except Exception:
+        logger.exception("Gemini API error")
         return None
 
 
@@ -189,13 +218,13 @@ def get_prompt_from_db(prompt_key, default_prompt=None, **format_kwargs):
                 try:
                     return prompt_content.format(**format_kwargs)
                 except KeyError as e:
-                    print(
-                        f"Warning: Missing format variable {e} in prompt {prompt_key}, using as-is")
+                    logger.warning(
+                        "Missing format variable %s in prompt %s, using as-is", e, prompt_key)
                     return prompt_content
-            print(f"Prompt content: {prompt_content}")
+            logger.debug("Prompt content: %s", prompt_content)
             return prompt_content
     except Exception as e:
-        print(f"Error fetching prompt from database: {e}")
+        logger.exception("Error fetching prompt from database")
 
     # Fallback to default and format if needed
     if default_prompt:
@@ -209,8 +238,7 @@ def get_prompt_from_db(prompt_key, default_prompt=None, **format_kwargs):
             try:
                 return default_prompt.format(**format_kwargs)
             except KeyError as e:
-                print(
-                    f"Warning: Missing format variable {e} in default prompt, using as-is")
+                logger.warning("Missing format variable %s in default prompt, using as-is", e)
                 return default_prompt
         return default_prompt
 
@@ -0,0 +1,66 @@
+"""
+Versions of projects and collections, for the conditional GET of the polled
+read endpoints (see common/conditional.py).
+
+Project and Collection have a revision that every write increments, next to
+the time of that write (updated_at): Document.save() does it in their save(),
+targeted collection updates in update_collection(), and adding or removing
+generated images touches the collection. A version is read with a projection
+of these two fields, so a poll that gets a 304 never loads the document body.
+"""
+import hashlib
+from bson import ObjectId
+from .models import Collection, ImageGenerationHistory, Project
+
+STAMP_FIELDS = ('revision', 'updated_at')
+
+
+def _stamp(model, **query):
+    row = model.objects(**query).only(*STAMP_FIELDS).as_pymongo().first()
+    if row is None:
+        return None
+    return row['_id'], row.get('revision') or 0, row.get('updated_at')
+
+
+def _version(*stamps):
+    """ETag and Last-Modified of a response built from several documents"""
+    etag = hashlib.blake2b(repr(stamps).encode(), digest_size=16).hexdigest()
+    times = [stamp[-1] for stamp in stamps if stamp and stamp[-1]]
+    return etag, max(times) if times else None
+
+
+def collection_version(request, collection_id, *args, **kwargs):
+    """Version of a collection detail, None if the collection does not exist"""
+    if not ObjectId.is_valid(str(collection_id)):
+        return None
+    stamp = _stamp(Collection, id=collection_id)
+    return _version(stamp) if stamp else None
+
+
+def project_version(request, project_id, *args, **kwargs):
+    """Version of a project detail, which includes its collection"""
+    if not ObjectId.is_valid(str(project_id)):
+        return None
+    project = _stamp(Project, id=project_id)
+    if project is None:
+        return None
+    return _version(project, _stamp(Collection, project=project_id))
+
+
+def collection_history_version(request, collection_id, *args, **kwargs):
+    """
+    Version of the generation history of a collection for the request's user.
+
+    History records are only ever added (or expired), so the newest record and
+    the number of records identify the history.
+    """
+    if not ObjectId.is_valid(str(collection_id)):
+        return None
+    collection = _stamp(Collection, id=collection_id)
+    if collection is None:
+        return None
+    history = ImageGenerationHistory.objects(
+        collection=collection_id, user_id=str(request.user.id))
+    newest = history.order_by('-created_at').only('created_at').as_pymongo().first()
+    latest = (newest['_id'], history.count(), newest.get('created_at')) if newest else None
+    return _version(collection, latest)
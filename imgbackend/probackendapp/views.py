@@ -3,7 +3,7 @@ from google.genai import types
 from .models import Collection, ProductImage  # ✅ ensure ProductImage is imported
 import io
 import cloudinary.uploader
-import traceback
+import logging
 import base64
 from .models import Project, Collection, CollectionItem
 from django.shortcuts import render, redirect
@@ -19,9 +19,20 @@ from datetime import timezone
 from .models import Project, Collection, CollectionItem, GeneratedImage
 from .utils import request_suggestions
 from mongoengine.errors import DoesNotExist
-from django.http import JsonResponse
+from common.responses import JsonResponse
 from .utils import request_suggestions, call_gemini_api, parse_gemini_response
+from .image_counters import record_image_counts, record_image_delta, tally_collection_images, tally_generated_images, model_usage_key
+from .generated_image_utils import create_generated_image, ensure_product_ids, find_generated_image, find_product
+from .collection_updates import (ConcurrentUpdateError, item_field, push_item_values, set_item_fields,
+                                 to_mongo_value, touch_collection, update_collection, update_with_retry)
+from .history_utils import HistoryWriter
+from common.dereference import reference_id
 from common.middleware import authenticate
+from CREDITS.balance import CREDITS_PER_IMAGE, InsufficientCredits, reserve_credits
+
+logger = logging.getLogger(__name__)
+
+
 # -------------------------
 # Dashboard - Shows all projects
 # -------------------------
@@ -73,6 +84,7 @@ def project_setup_description(request, project_id):
         uploaded_image = request.FILES.get("uploaded_image")
 
         # Create a new collection if not found
+        is_new_collection = not collection or not collection.items
         if not collection:
             collection = Collection(project=project)
             item = CollectionItem()
@@ -99,7 +111,21 @@ def project_setup_description(request, project_id):
         item.suggested_locations = suggestions.get("locations", [])
         item.suggested_colors = suggestions.get("colors", [])
 
-        collection.save()
+        if is_new_collection:
+            collection.save()
+        else:
+            # Only send the changed fields so concurrent uploads are kept
+            fields = {
+                'suggested_themes': item.suggested_themes,
+                'suggested_backgrounds': item.suggested_backgrounds,
+                'suggested_poses': item.suggested_poses,
+                'suggested_locations': item.suggested_locations,
+                'suggested_colors': item.suggested_colors,
+            }
+            if uploaded_image:
+                fields['uploaded_theme_images'] = item.uploaded_theme_images
+            set_item_fields(collection.id, fields,
+                            collection_fields={'description': description})
 
         return redirect("probackendapp:project_setup_select", str(project.id), str(collection.id))
 
@@ -258,7 +284,11 @@ def project_setup_select(request, project_id, collection_id):
     item = collection.items[0] if collection.items else CollectionItem()
     if not collection.items:
         collection.items.append(item)
-        collection.save()
+        # Only add the item if no other request did meanwhile
+        if not update_collection(collection.id, {"$set": {"items": to_mongo_value(collection.items)}},
+                                 expected_revision=collection.revision or 0):
+            collection = Collection.objects.get(id=collection_id)
+            item = collection.items[0]
 
     # Use previously generated prompts if exist
     ai_response = item.generated_prompts or {}
@@ -278,10 +308,13 @@ def project_setup_select(request, project_id, collection_id):
         item.selected_colors = getlist("colors") or []
 
         # Save uploaded images for each category
+        uploaded_fields = {}
         for category in ["theme", "background", "pose", "location", "color"]:
             files = request.FILES.getlist(f"uploaded_{category}_images")
             if files:
                 getattr(item, f"uploaded_{category}_images").extend(files)
+                uploaded_fields[f"uploaded_{category}_images"] = getattr(
+                    item, f"uploaded_{category}_images")
 
         # Prepare uploaded images info for Gemini prompt
         uploaded_images_info = ""
@@ -337,7 +370,18 @@ Generate prompts for the following 4 types. Respond ONLY in valid JSON:
         item.final_moodboard_prompt = gemini_prompt
         item.moodboard_explanation = ai_json_text
         item.generated_prompts = ai_response
-        collection.save()
+        # Only send the changed fields so concurrent uploads are kept
+        set_item_fields(collection.id, {
+            'selected_themes': item.selected_themes,
+            'selected_backgrounds': item.selected_backgrounds,
+            'selected_poses': item.selected_poses,
+            'selected_locations': item.selected_locations,
+            'selected_colors': item.selected_colors,
+            'final_moodboard_prompt': item.final_moodboard_prompt,
+            'moodboard_explanation': item.moodboard_explanation,
+            'generated_prompts': item.generated_prompts,
+            **uploaded_fields,
+        })
 
         # Refresh detailed_prompt_text to show in template
         detailed_prompt_text = ai_json_text
@@ -461,6 +505,7 @@ except ImportError:
 #         return JsonResponse({"error": str(e)})
 
 
+@authenticate
 def generate_ai_images(request, collection_id):
     if request.method != "POST":
         return JsonResponse({"error": "Invalid request method."})
@@ -469,67 +514,68 @@ def generate_ai_images(request, collection_id):
         collection = Collection.objects.get(id=collection_id)
         description = collection.description
         generated_images = []
+        history = HistoryWriter.for_collection(
+            collection, str(request.user.id))
 
         if has_genai:
             client = genai.Client(api_key=settings.GOOGLE_API_KEY)
             model_name = "gemini-2.5-flash-image-preview"
 
-            for i in range(4):
-                prompt_text = (
-                    f"Generate a realistic human model image (face and shoulders visible) "
-                    f"suitable for the collection description: {description}. "
-                    f"High-quality, photorealistic."
-                )
-
-                contents = [{"role": "user", "parts": [{"text": prompt_text}]}]
-                try:
-                    resp = client.models.generate_content(
-                        model=model_name,
-                        contents=contents,
-                        config=types.GenerateContentConfig(
-                            response_modalities=[types.Modality.IMAGE]
-                        ),
+            # Hold the credits of the 4 images up front, only the generated ones are charged
+            with reserve_credits(str(request.user.id), 4 * CREDITS_PER_IMAGE,
+                                 reason="project_ai_model_generation", project=reference_id(collection, "project")) as credits:
+                for i in range(4):
+                    prompt_text = (
+                        f"Generate a realistic human model image (face and shoulders visible) "
+                        f"suitable for the collection description: {description}. "
+                        f"High-quality, photorealistic."
                     )
 
-                    if not resp.candidates:
-                        print("⚠️ No candidates returned:", resp)
-                        continue
-
-                    candidate = resp.candidates[0]
-                    if not getattr(candidate, "content", None):
-                        print("⚠️ Candidate has no content:", candidate)
-                        continue
-
-                    image_bytes = None
-                    for part in candidate.content.parts:
-                        if hasattr(part, "inline_data") and part.inline_data:
-                            data = part.inline_data.data
-                            image_bytes = (
-                                data if isinstance(
-                                    data, bytes) else base64.b64decode(data)
-                            )
-                            break
-
-                    if not image_bytes:
-                        print("⚠️ No image data found in parts.")
-                        continue
+                    contents = [{"role": "user", "parts": [{"text": prompt_text}]}]
+                    try:
+                        resp = client.models.generate_content(
+                            model=model_name,
+                            contents=contents,
+                            config=types.GenerateContentConfig(
+                                response_modalities=[types.Modality.IMAGE]
+                            ),
+                        )
 
-                    buf = io.BytesIO(image_bytes)
-                    buf.seek(0)
-                    upload_result = cloudinary.uploader.upload(
-                        buf,
-                        folder="collection_ai_models",
-                        public_id=f"collection_{collection.id}_{i+1}",
-                        overwrite=True,
-                    )
-                    generated_images.append(upload_result["secure_url"])
+                        if not resp.candidates:
+                            logger.warning("No candidates returned: %s", resp)
+                            continue
+
+                        candidate = resp.candidates[0]
+                        if not getattr(candidate, "content", None):
+                            logger.warning("Candidate has no content: %s", candidate)
+                            continue
+
+                        image_bytes = None
+                        for part in candidate.content.parts:
+                            if hasattr(part, "inline_data") and part.inline_data:
+                                data = part.inline_data.data
+                                image_bytes = (
+                                    data if isinstance(
+                                        data, bytes) else base64.b64decode(data)
+                                )
+                                break
+
+                        if not image_bytes:
+                            logger.warning("No image data found in parts.")
+                            continue
+
+                        buf = io.BytesIO(image_bytes)
+                        buf.seek(0)
+                        upload_result = cloudinary.uploader.upload(
+                            buf,
+                            folder="collection_ai_models",
+                            public_id=f"collection_{collection.id}_{i+1}",
+                            overwrite=True,
+                        )
+                        generated_images.append(upload_result["secure_url"])
 
-                    # Track AI model generation in history
-                    try:
-                        from .history_utils import track_project_image_generation
-                        track_project_image_generation(
-                            user_id=str(request.user.id),
-                            collection_id=str(collection.id),
+                        # Track AI model generation in history
+                        history.add(
                             image_type="project_ai_model_generation",
                             image_url=upload_result["secure_url"],
                             prompt=prompt_text,
@@ -539,13 +585,12 @@ def generate_ai_images(request, collection_id):
                                 "total_generated": len(generated_images)
                             }
                         )
-                    except Exception as history_error:
-                        print(
-                            f"Error tracking AI model generation history: {history_error}")
 
-                except Exception as gen_err:
-                    print("❌ Error generating image:", gen_err)
-                    continue
+                    except Exception as gen_err:
+                        logger.exception("Error generating image")
+                        continue
+                credits.commit(len(generated_images) * CREDITS_PER_IMAGE)
+            history.flush()
         else:
             return JsonResponse({"error": "Gemini SDK not available."})
 
@@ -560,8 +605,10 @@ def generate_ai_images(request, collection_id):
             "saved_images": saved_images
         })
 
+    except InsufficientCredits as e:
+        return JsonResponse({"error": str(e)}, status=402)
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Error in generate_ai_images")
         return JsonResponse({"error": str(e)})
 
 
@@ -636,59 +683,65 @@ def save_generated_images(request, collection_id):
         data = json.loads(request.body)
         selected_images = set(data.get("images", []))
 
-        collection = Collection.objects.get(id=collection_id)
-        if not collection.items:
-            return JsonResponse({"success": False, "error": "No items found in collection."})
+        local_dir = os.path.join(settings.MEDIA_ROOT, "model_images")
+        os.makedirs(local_dir, exist_ok=True)
 
-        item = collection.items[0]
+        # Downloads are kept across retries of the update below
+        downloaded = {}
+        updated_images = []
 
-        # Existing images
-        existing = item.generated_model_images or []
-        existing_urls = {img.get("cloud")
-                         for img in existing if "cloud" in img}
+        def build_update(collection):
+            if not collection.items:
+                return None
 
-        local_dir = os.path.join(settings.MEDIA_ROOT, "model_images")
-        os.makedirs(local_dir, exist_ok=True)
+            # Existing images
+            existing = collection.items[0].generated_model_images or []
+            existing_urls = {img.get("cloud")
+                             for img in existing if "cloud" in img}
 
-        # 1️⃣ Remove unselected images
-        updated_images = [img for img in existing if img.get(
-            "cloud") in selected_images]
+            # 1️⃣ Remove unselected images
+            new_images = [img for img in existing if img.get(
+                "cloud") in selected_images]
 
-        # 2️⃣ Add new ones
-        for url in selected_images - existing_urls:
-            filename = url.split("/")[-1]
-            local_path = os.path.join(local_dir, filename)
+            # 2️⃣ Add new ones
+            for url in selected_images - existing_urls:
+                if url not in downloaded:
+                    filename = url.split("/")[-1]
+                    local_path = os.path.join(local_dir, filename)
 
-            resp = requests.get(url)
-            if resp.status_code == 200:
-                with open(local_path, "wb") as f:
-                    f.write(resp.content)
+                    resp = requests.get(url)
+                    if resp.status_code == 200:
+                        with open(local_path, "wb") as f:
+                            f.write(resp.content)
+                    downloaded[url] = {"local": local_path, "cloud": url}
 
-            updated_images.append({"local": local_path, "cloud": url})
+                new_images.append(downloaded[url])
 
-        # Update and save
-        item.generated_model_images = updated_images
-        collection.save()
+            updated_images[:] = new_images
+            return {"$set": {item_field("generated_model_images"): new_images}}
+
+        # Read-modify-write: only applied if nobody changed the collection meanwhile
+        collection = update_with_retry(
+            collection_id, build_update, only=("project", "items.generated_model_images"))
+        if not collection.items:
+            return JsonResponse({"success": False, "error": "No items found in collection."})
 
         # Track model image selection in history
-        try:
-            from .history_utils import track_project_image_generation
-            for img in updated_images:
-                if img.get("cloud"):
-                    track_project_image_generation(
-                        user_id="system",  # TODO: Get actual user ID from request
-                        collection_id=str(collection.id),
-                        image_type="project_model_selection",
-                        image_url=img["cloud"],
-                        prompt="Model image selected for project",
-                        local_path=img.get("local"),
-                        metadata={
-                            "action": "model_selection",
-                            "total_models": len(updated_images)
-                        }
-                    )
-        except Exception as history_error:
-            print(f"Error tracking model selection history: {history_error}")
+        # TODO: Get actual user ID from request
+        history = HistoryWriter.for_collection(collection, "system")
+        for img in updated_images:
+            if img.get("cloud"):
+                history.add(
+                    image_type="project_model_selection",
+                    image_url=img["cloud"],
+                    prompt="Model image selected for project",
+                    local_path=img.get("local"),
+                    metadata={
+                        "action": "model_selection",
+                        "total_models": len(updated_images)
+                    }
+                )
+        history.flush()
 
         return JsonResponse({
             "success": True,
@@ -698,8 +751,10 @@ def save_generated_images(request, collection_id):
 
     except Collection.DoesNotExist:
         return JsonResponse({"success": False, "error": "Collection not found."})
+    except ConcurrentUpdateError as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=409)
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Error in save_generated_images")
         return JsonResponse({"success": False, "error": str(e)})
 
 # -------------------------
@@ -756,46 +811,37 @@ def upload_product_images_api(request, collection_id):
             # ✅ Create EmbeddedDocument object instead of dict
             product_img = ProductImage(
                 uploaded_image_url=cloud_url,
-                uploaded_image_path=local_path,
-                generated_images=[]
+                uploaded_image_path=local_path
             )
 
             new_product_images.append(product_img)
 
-        # ✅ Append properly
-        if not hasattr(item, "product_images"):
-            item.product_images = []
-        item.product_images.extend(new_product_images)
-
-        # ✅ Save back properly to MongoEngine
-        collection.items[0] = item
-        collection.save()
+        # ✅ Append atomically so concurrent uploads are kept
+        push_item_values(collection.id, "product_images", new_product_images)
+        record_image_counts(
+            collection, {"product": len(new_product_images)})
 
         # Track product image uploads in history
-        try:
-            from .history_utils import track_project_image_generation
-            user_id = str(request.user.id) if hasattr(
-                request, 'user') and request.user else "system"
-            for product_img in new_product_images:
-                track_project_image_generation(
-                    user_id=user_id,
-                    collection_id=str(collection.id),
-                    image_type="project_product_upload",
-                    image_url=product_img.uploaded_image_url,
-                    prompt="Product image uploaded to project",
-                    local_path=product_img.uploaded_image_path,
-                    metadata={
-                        "action": "product_upload",
-                        "total_products": len(new_product_images)
-                    }
-                )
-        except Exception as history_error:
-            print(f"Error tracking product upload history: {history_error}")
+        user_id = str(request.user.id) if hasattr(
+            request, 'user') and request.user else "system"
+        history = HistoryWriter.for_collection(collection, user_id)
+        for product_img in new_product_images:
+            history.add(
+                image_type="project_product_upload",
+                image_url=product_img.uploaded_image_url,
+                prompt="Product image uploaded to project",
+                local_path=product_img.uploaded_image_path,
+                metadata={
+                    "action": "product_upload",
+                    "total_products": len(new_product_images)
+                }
+            )
+        history.flush()
 
         return JsonResponse({"success": True, "count": len(new_product_images)})
 
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Error in upload_product_images_api")
         return JsonResponse({"success": False, "error": str(e)})
 
 
@@ -816,11 +862,12 @@ def generate_product_model_page(request, collection_id):
             "model_images": model_images,
         })
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Error in generate_product_model_page")
         return JsonResponse({"success": False, "error": str(e)}, status=500)
 
 
 @csrf_exempt
+@authenticate
 def generate_product_model_api(request, collection_id):
     """
     Generate composite AI image combining a product and selected model
@@ -864,49 +911,54 @@ def generate_product_model_api(request, collection_id):
         config = types.GenerateContentConfig(
             response_modalities=[types.Modality.IMAGE])
 
-        resp = client.models.generate_content(
-            model=model_name, contents=contents, config=config)
-
-        candidate = resp.candidates[0]
-        generated_bytes = None
-        for part in candidate.content.parts:
-            if part.inline_data and part.inline_data.data:
-                data = part.inline_data.data
-                generated_bytes = data if isinstance(
-                    data, bytes) else base64.b64decode(data)
-                break
-
-        if not generated_bytes:
-            return JsonResponse({"success": False, "error": "Gemini did not return an image."})
-
-        # Save locally
-        output_dir = os.path.join("media", "composite_images", str(
-            collection_id), str(uuid.uuid4()))
-        os.makedirs(output_dir, exist_ok=True)
-        local_path = os.path.join(output_dir, "composite.png")
-        with open(local_path, "wb") as f:
-            f.write(generated_bytes)
-
-        # Upload to Cloudinary
-        import cloudinary.uploader
-        cloud_upload = cloudinary.uploader.upload(
-            local_path,
-            folder=f"ai_studio/composite/{collection_id}/{uuid.uuid4()}/",
-            use_filename=True,
-            unique_filename=False,
-            resource_type="image"
-        )
+        # Charged once the image is stored, refunded if anything before fails
+        with reserve_credits(str(request.user.id), reason="project_model_image",
+                             project=reference_id(collection, "project")) as credits:
+            resp = client.models.generate_content(
+                model=model_name, contents=contents, config=config)
+
+            candidate = resp.candidates[0]
+            generated_bytes = None
+            for part in candidate.content.parts:
+                if part.inline_data and part.inline_data.data:
+                    data = part.inline_data.data
+                    generated_bytes = data if isinstance(
+                        data, bytes) else base64.b64decode(data)
+                    break
 
-        result = {
-            "url": cloud_upload["secure_url"],
-            "path": local_path
-        }
+            if not generated_bytes:
+                credits.refund()
+                return JsonResponse({"success": False, "error": "Gemini did not return an image."})
+
+            # Save locally
+            output_dir = os.path.join("media", "composite_images", str(
+                collection_id), str(uuid.uuid4()))
+            os.makedirs(output_dir, exist_ok=True)
+            local_path = os.path.join(output_dir, "composite.png")
+            with open(local_path, "wb") as f:
+                f.write(generated_bytes)
+
+            # Upload to Cloudinary
+            import cloudinary.uploader
+            cloud_upload = cloudinary.uploader.upload(
+                local_path,
+                folder=f"ai_studio/composite/{collection_id}/{uuid.uuid4()}/",
+                use_filename=True,
+                unique_filename=False,
+                resource_type="image"
+            )
+
+            result = {
+                "url": cloud_upload["secure_url"],
+                "path": local_path
+            }
 
         return JsonResponse({"success": True, "image": result})
 
+    except InsufficientCredits as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=402)
     except Exception as e:
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in generate_product_model_api")
         return JsonResponse({"success": False, "error": str(e)}, status=500)
 
 
@@ -1065,13 +1117,12 @@ def generate_all_product_model_images(request, collection_id):
     import base64
     import uuid
     import json
-    import traceback
     import cloudinary.uploader
     from datetime import datetime
     from google import genai
     from google.genai import types
     from django.conf import settings
-    from django.http import JsonResponse
+    from common.responses import JsonResponse
 
     try:
         # ---------------------------
@@ -1173,110 +1224,123 @@ Follow this specific style prompt: {prompt_text}"""
             "campaign_image": get_prompt_from_db('campaign_image_template', default_campaign),
         }
 
+        # New images reference products by id, so make sure the ids are stored
+        collection = ensure_product_ids(collection)
+        item = collection.items[0]
+        replaced_product_ids = []
+        new_image_ids = []
+        new_images = []
+        history = HistoryWriter.for_collection(
+            collection, str(request.user.id))
+
         # ---------------------------
         # 4. Loop through each product image
         # ---------------------------
-        for product in item.product_images:
-            product_path = product.uploaded_image_path
-
-            if not os.path.exists(product_path):
-                print(f"⚠️ Product image not found: {product_path}")
-                continue
-
-            with open(product_path, "rb") as f:
-                product_bytes = f.read()
-            product_b64 = base64.b64encode(product_bytes).decode("utf-8")
-
-            # Clear any old generated images for this run
-            product.generated_images = []
-
-            # ---------------------------
-            # 5. Generate images for each prompt
-            # ---------------------------
-            for key, prompt_text in item.generated_prompts.items():
-                try:
-                    template = prompt_templates.get(key, "")
-                    if template:
-                        custom_prompt = template.format(
-                            prompt_text=prompt_text)
-                    else:
-                        custom_prompt = prompt_text
-
-                    contents = [
-                        {"inline_data": {"mime_type": "image/jpeg", "data": model_b64}},
-                        {"inline_data": {"mime_type": "image/jpeg", "data": product_b64}},
-                        {"text": custom_prompt},
-                    ]
-
-                    config = types.GenerateContentConfig(
-                        response_modalities=[types.Modality.IMAGE]
-                    )
+        # Hold the credits of every image up front, only the generated ones are charged
+        planned = len(item.product_images) * len(item.generated_prompts or {})
+        with reserve_credits(str(request.user.id), planned * CREDITS_PER_IMAGE,
+                             reason="project_generate_all", project=reference_id(collection, "project")) as credits:
+            for product in item.product_images:
+                product_path = product.uploaded_image_path
+
+                if not os.path.exists(product_path):
+                    logger.warning("Product image not found: %s", product_path)
+                    continue
 
-                    resp = client.models.generate_content(
-                        model=model_name, contents=contents, config=config
-                    )
+                with open(product_path, "rb") as f:
+                    product_bytes = f.read()
+                product_b64 = base64.b64encode(product_bytes).decode("utf-8")
 
-                    candidate = resp.candidates[0]
-                    generated_bytes = None
+                # Old generated images of this product are replaced after the run
+                replaced_product_ids.append(product.product_id)
+
+                # ---------------------------
+                # 5. Generate images for each prompt
+                # ---------------------------
+                for key, prompt_text in item.generated_prompts.items():
+                    try:
+                        template = prompt_templates.get(key, "")
+                        if template:
+                            custom_prompt = template.format(
+                                prompt_text=prompt_text)
+                        else:
+                            custom_prompt = prompt_text
+
+                        contents = [
+                            {"inline_data": {"mime_type": "image/jpeg", "data": model_b64}},
+                            {"inline_data": {"mime_type": "image/jpeg", "data": product_b64}},
+                            {"text": custom_prompt},
+                        ]
+
+                        config = types.GenerateContentConfig(
+                            response_modalities=[types.Modality.IMAGE]
+                        )
 
-                    for part in candidate.content.parts:
-                        if part.inline_data and part.inline_data.data:
-                            data = part.inline_data.data
-                            generated_bytes = data if isinstance(
-                                data, bytes) else base64.b64decode(data)
-                            break
+                        resp = client.models.generate_content(
+                            model=model_name, contents=contents, config=config
+                        )
 
-                    if not generated_bytes:
-                        print(
-                            f"⚠️ No image returned for {key} of {product.uploaded_image_url}")
-                        continue
+                        candidate = resp.candidates[0]
+                        generated_bytes = None
 
-                    # ---------------------------
-                    # 6. Save locally
-                    # ---------------------------
-                    output_dir = os.path.join(
-                        "media", "composite_images", str(collection_id))
-                    os.makedirs(output_dir, exist_ok=True)
-                    local_path = os.path.join(
-                        output_dir, f"{uuid.uuid4()}_{key}.png")
-
-                    with open(local_path, "wb") as f:
-                        f.write(generated_bytes)
-
-                    # ---------------------------
-                    # 7. Upload to Cloudinary
-                    # ---------------------------
-                    cloud_upload = cloudinary.uploader.upload(
-                        local_path,
-                        folder=f"ai_studio/composite/{collection_id}/{uuid.uuid4()}/",
-                        use_filename=True,
-                        unique_filename=False,
-                        resource_type="image",
-                    )
+                        for part in candidate.content.parts:
+                            if part.inline_data and part.inline_data.data:
+                                data = part.inline_data.data
+                                generated_bytes = data if isinstance(
+                                    data, bytes) else base64.b64decode(data)
+                                break
+
+                        if not generated_bytes:
+                            logger.warning(
+                                "No image returned for %s of %s", key, product.uploaded_image_url)
+                            continue
+
+                        # ---------------------------
+                        # 6. Save locally
+                        # ---------------------------
+                        output_dir = os.path.join(
+                            "media", "composite_images", str(collection_id))
+                        os.makedirs(output_dir, exist_ok=True)
+                        local_path = os.path.join(
+                            output_dir, f"{uuid.uuid4()}_{key}.png")
+
+                        with open(local_path, "wb") as f:
+                            f.write(generated_bytes)
+
+                        # ---------------------------
+                        # 7. Upload to Cloudinary
+                        # ---------------------------
+                        cloud_upload = cloudinary.uploader.upload(
+                            local_path,
+                            folder=f"ai_studio/composite/{collection_id}/{uuid.uuid4()}/",
+                            use_filename=True,
+                            unique_filename=False,
+                            resource_type="image",
+                        )
 
-                    # ---------------------------
-                    # 8. Store result in product with model tracking
-                    # ---------------------------
-                    product.generated_images.append({
-                        "type": key,
-                        "prompt": prompt_text,
-                        "local_path": local_path,
-                        "cloud_url": cloud_upload["secure_url"],
-                        "created_at": datetime.now(timezone.utc).isoformat(),
-                        "model_used": {
-                            "type": selected_model.get("type"),
-                            "local": selected_model.get("local"),
-                            "cloud": selected_model.get("cloud"),
-                            "name": selected_model.get("name", "")
+                        # ---------------------------
+                        # 8. Store result as a GeneratedImage with model tracking
+                        # ---------------------------
+                        generated_data = {
+                            "type": key,
+                            "prompt": prompt_text,
+                            "local_path": local_path,
+                            "cloud_url": cloud_upload["secure_url"],
+                            "created_at": datetime.now(timezone.utc).isoformat(),
+                            "model_used": {
+                                "type": selected_model.get("type"),
+                                "local": selected_model.get("local"),
+                                "cloud": selected_model.get("cloud"),
+                                "name": selected_model.get("name", "")
+                            }
                         }
-                    })
+                        generated_image = create_generated_image(
+                            collection, product, generated_data, user=request.user)
+                        new_image_ids.append(generated_image.id)
+                        new_images.append(generated_data)
 
-                    # Track image generation in history
-                    try:
-                        from .history_utils import track_project_image_generation
-                        track_project_image_generation(
-                            user_id=str(request.user.id),
-                            collection_id=str(collection.id),
+                        # Track image generation in history (stored in batches)
+                        history.add(
                             image_type=f"project_{key}",
                             image_url=cloud_upload["secure_url"],
                             prompt=prompt_text,
@@ -1288,23 +1352,32 @@ Follow this specific style prompt: {prompt_text}"""
                                 "generation_type": key
                             }
                         )
-                    except Exception as history_error:
-                        print(
-                            f"Error tracking project image generation history: {history_error}")
-
-                except Exception as e:
-                    traceback.print_exc()
-                    print(
-                        f"⚠️ Failed to generate {key} for {product.uploaded_image_url}: {e}")
-                    continue
+
+                    except Exception as e:
+                        logger.exception(
+                            "Failed to generate %s for %s", key, product.uploaded_image_url)
+                        continue
+            credits.commit(len(new_images) * CREDITS_PER_IMAGE)
+
+        history.flush()
 
         # ---------------------------
-        # 9. Save updated collection
+        # 9. Replace the old generated images of the processed products
         # ---------------------------
-        collection.save()
+        replaced_filters = {
+            "product_id__in": replaced_product_ids,
+            "id__nin": new_image_ids,
+        }
+        counts_before = tally_collection_images(
+            collection.id, **replaced_filters)
+        GeneratedImage.objects(
+            collection=collection.id, **replaced_filters).delete()
+        touch_collection(collection.id)
+        record_image_delta(collection, counts_before, tally_generated_images(
+            dict(image, kind="generated") for image in new_images))
 
-        total_generated = sum(len(p.generated_images)
-                              for p in item.product_images)
+        total_generated = GeneratedImage.objects(
+            collection=collection.id, kind="generated").count()
 
         return JsonResponse({
             "success": True,
@@ -1312,8 +1385,10 @@ Follow this specific style prompt: {prompt_text}"""
             "total_generated": total_generated,
         })
 
+    except InsufficientCredits as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=402)
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Error in generate_all_product_model_images")
         return JsonResponse({"success": False, "error": str(e)}, status=500)
 
 
@@ -1329,64 +1404,49 @@ def regenerate_product_model_image(request, collection_id):
     import os
     import uuid
     import base64
-    import traceback
     import cloudinary.uploader
     from datetime import datetime
     from google import genai
     from google.genai import types
-    from django.http import JsonResponse
+    from common.responses import JsonResponse
 
     try:
         data = json.loads(request.body)
         product_image_path = data.get("product_image_path")
+        # The image can be addressed by id or by its local path
+        generated_image_id = data.get("generated_image_id")
         generated_image_path = data.get("generated_image_path")
         new_prompt = data.get("prompt")
         use_different_model = data.get("use_different_model", False)
         # {type: 'ai'/'real', local: path, cloud: url}
         new_model_data = data.get("new_model")
 
-        if not (product_image_path and generated_image_path):
-            print("Missing parameters", product_image_path,
-                  generated_image_path, new_prompt)
+        if not (generated_image_id or (product_image_path and generated_image_path)):
+            logger.warning(
+                "Missing parameters: %s, %s, %s", product_image_path, generated_image_path, new_prompt)
             return JsonResponse({"success": False, "error": "Missing parameters"}, status=400)
 
-        # Load collection and item
-        collection = Collection.objects.get(id=collection_id)
+        # Load collection and the selected model only, products are resolved on the server
+        collection = Collection.objects.only(
+            "project", "items.selected_model").get(id=collection_id)
         item = collection.items[0]
 
         # Find the generated image we're regenerating and the product
         # This could be either an original generated image or a regenerated image
-        target_generated = None
-        target_product = None
-        is_regenerated_image = False
-        original_prompt = None
-
-        for p in item.product_images:
-            for g in p.generated_images:
-                # Check if it's the original generated image
-                if g.get("local_path") == generated_image_path:
-                    target_generated = g
-                    target_product = p
-                    original_prompt = g.get("prompt")
-                    break
+        target_image = find_generated_image(
+            collection.id, generated_image_path, kinds=["generated", "regenerated"],
+            image_id=generated_image_id)
+        if not target_image:
+            return JsonResponse({"success": False, "error": "Generated image not found"}, status=404)
+
+        # Regenerations are always stored under the original generated image
+        target_generated = target_image.parent if target_image.kind == "regenerated" else target_image
+        target_product = find_product(
+            collection.id, product_id=target_image.product_id)
 
-                # Check if it's a regenerated image
-                if "regenerated_images" in g:
-                    for regen in g.get("regenerated_images", []):
-                        if regen.get("local_path") == generated_image_path:
-                            target_generated = g  # Store the parent generated image
-                            target_product = p
-                            is_regenerated_image = True
-                            original_prompt = regen.get(
-                                "prompt", g.get("prompt"))
-                            break
-                    if target_generated:
-                        break
-            if target_generated:
-                break
-
-        if not target_generated:
+        if not target_generated or not target_product:
             return JsonResponse({"success": False, "error": "Generated image not found"}, status=404)
+        product_image_path = product_image_path or target_product.uploaded_image_path
 
         # --- Google GenAI setup ---
         client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
@@ -1422,8 +1482,8 @@ def regenerate_product_model_image(request, collection_id):
 
         # Build custom prompt based on the original image type
         # Combine original prompt context with new modifications
-        original_type = target_generated.get("type", "model_image")
-        original_base_prompt = target_generated.get("prompt", "")
+        original_type = target_generated.type or "model_image"
+        original_base_prompt = target_generated.prompt or ""
 
         # Get regeneration prompts from database with fallback
         from .prompt_initializer import get_prompt_from_db
@@ -1479,92 +1539,97 @@ def regenerate_product_model_image(request, collection_id):
             response_modalities=[types.Modality.IMAGE]
         )
 
-        resp = client.models.generate_content(
-            model=model_name,
-            contents=contents,
-            config=config
-        )
+        # Charged once the image is stored, refunded if anything before fails
+        with reserve_credits(str(request.user.id), reason="project_regenerated",
+                             project=reference_id(collection, "project")) as credits:
+            resp = client.models.generate_content(
+                model=model_name,
+                contents=contents,
+                config=config
+            )
 
-        # Extract generated image bytes
-        candidate = resp.candidates[0]
-        generated_bytes = None
-        for part in candidate.content.parts:
-            if part.inline_data and part.inline_data.data:
-                data_part = part.inline_data.data
-                generated_bytes = data_part if isinstance(
-                    data_part, bytes) else base64.b64decode(data_part)
-                break
-
-        if not generated_bytes:
-            return JsonResponse({"success": False, "error": "No image generated by GenAI"})
-
-        # --- Save new regenerated image locally ---
-        new_filename = f"{uuid.uuid4()}_regenerated.png"
-        local_dir = os.path.join(
-            "media", "composite_images", str(collection_id))
-        os.makedirs(local_dir, exist_ok=True)
-        local_output_path = os.path.join(local_dir, new_filename)
+            # Extract generated image bytes
+            candidate = resp.candidates[0]
+            generated_bytes = None
+            for part in candidate.content.parts:
+                if part.inline_data and part.inline_data.data:
+                    data_part = part.inline_data.data
+                    generated_bytes = data_part if isinstance(
+                        data_part, bytes) else base64.b64decode(data_part)
+                    break
 
-        with open(local_output_path, "wb") as f:
-            f.write(generated_bytes)
+            if not generated_bytes:
+                credits.refund()
+                return JsonResponse({"success": False, "error": "No image generated by GenAI"})
 
-        # --- Upload to Cloudinary ---
-        upload_result = cloudinary.uploader.upload(
-            local_output_path,
-            folder=f"ai_studio/regenerated/{collection_id}/"
-        )
-        cloud_url = upload_result["secure_url"]
-
-        # --- Append regenerated image metadata with model tracking ---
-        # This tracks which model was used for each regeneration, supporting both AI and Real models
-        # Model count is calculated as: 1 (original) + len(regenerated_images)
-        # Model types used are tracked in the model_used field for each version
-        regenerated_data = {
-            # Use new prompt if provided, otherwise original
-            "prompt": new_prompt or original_base_prompt,
-            "original_prompt": original_base_prompt,
-            "combined_prompt": custom_prompt,
-            "type": original_type,
-            "local_path": local_output_path,
-            "cloud_url": cloud_url,
-            "created_at": datetime.now(timezone.utc).isoformat(),
-            "product_image_path": product_image_path,
-            "model_used": {
-                "type": model_to_use.get("type"),  # 'ai' or 'real'
-                "local": model_to_use.get("local"),
-                "cloud": model_to_use.get("cloud"),
-                "name": model_to_use.get("name", "")
-            }
-        }
+            # --- Save new regenerated image locally ---
+            new_filename = f"{uuid.uuid4()}_regenerated.png"
+            local_dir = os.path.join(
+                "media", "composite_images", str(collection_id))
+            os.makedirs(local_dir, exist_ok=True)
+            local_output_path = os.path.join(local_dir, new_filename)
 
-        target_generated.setdefault(
-            "regenerated_images", []).append(regenerated_data)
-        collection.save()
-
-        # Track regeneration in history
-        try:
-            from .history_utils import track_image_regeneration
-            track_image_regeneration(
-                user_id=str(request.user.id),
-                original_image_id=str(target_generated.get("id", "unknown")),
-                new_image_url=cloud_url,
-                new_prompt=new_prompt or "",
-                original_prompt=original_base_prompt,
-                image_type=original_type,
-                project_id=str(collection.project.id),
-                collection_id=str(collection.id),
-                local_path=local_output_path,
-                metadata={
-                    "model_used": regenerated_data["model_used"],
-                    "regeneration_count": len(target_generated.get("regenerated_images", [])),
-                    "used_different_model": use_different_model
-                }
+            with open(local_output_path, "wb") as f:
+                f.write(generated_bytes)
+
+            # --- Upload to Cloudinary ---
+            upload_result = cloudinary.uploader.upload(
+                local_output_path,
+                folder=f"ai_studio/regenerated/{collection_id}/"
             )
-        except Exception as history_error:
-            print(f"Error tracking regeneration history: {history_error}")
+            cloud_url = upload_result["secure_url"]
+
+            # --- Append regenerated image metadata with model tracking ---
+            # This tracks which model was used for each regeneration, supporting both AI and Real models
+            # Model count is calculated as: 1 (original) + len(regenerated_images)
+            # Model types used are tracked in the model_used field for each version
+            regenerated_data = {
+                # Use new prompt if provided, otherwise original
+                "prompt": new_prompt or original_base_prompt,
+                "original_prompt": original_base_prompt,
+                "combined_prompt": custom_prompt,
+                "type": original_type,
+                "local_path": local_output_path,
+                "cloud_url": cloud_url,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "product_image_path": product_image_path,
+                "model_used": {
+                    "type": model_to_use.get("type"),  # 'ai' or 'real'
+                    "local": model_to_use.get("local"),
+                    "cloud": model_to_use.get("cloud"),
+                    "name": model_to_use.get("name", "")
+                }
+            }
+
+            regenerated_image = create_generated_image(collection, target_product, regenerated_data,
+                                                       kind="regenerated", parent=target_generated, user=request.user)
+
+        regeneration_count = GeneratedImage.objects(
+            parent=target_generated.id, kind="regenerated").count()
+        model_key = model_usage_key(regenerated_data["model_used"])
+        record_image_counts(collection, {"regenerated": 1},
+                            {model_key: 1} if model_key else None)
+
+        # Track regeneration in history, with the references already loaded
+        history = HistoryWriter.for_collection(collection, str(request.user.id))
+        history.add(
+            image_type=f"{original_type}_regenerated",
+            image_url=cloud_url,
+            prompt=new_prompt or "",
+            original_prompt=original_base_prompt,
+            parent_image_id=str(target_generated.id),
+            local_path=local_output_path,
+            metadata={
+                "model_used": regenerated_data["model_used"],
+                "regeneration_count": regeneration_count,
+                "used_different_model": use_different_model
+            }
+        )
+        history.flush()
 
         return JsonResponse({
             "success": True,
+            "id": str(regenerated_image.id),
             "url": cloud_url,
             "local_path": local_output_path,
             "model_used": regenerated_data["model_used"],
@@ -1572,11 +1637,13 @@ def regenerate_product_model_image(request, collection_id):
             "new_prompt": new_prompt or "",
             "combined_prompt": custom_prompt,
             "type": original_type,
-            "regeneration_count": len(target_generated.get("regenerated_images", [])),
+            "regeneration_count": regeneration_count,
             "product_image_url": target_product.uploaded_image_url,
             "used_different_model": use_different_model
         })
 
+    except InsufficientCredits as e:
+        return JsonResponse({"success": False, "error": str(e)}, status=402)
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("Error in regenerate_product_model_image")
         return JsonResponse({"success": False, "error": str(e)}, status=500)
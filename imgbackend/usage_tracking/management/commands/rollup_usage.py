@@ -0,0 +1,26 @@
+"""
+Django management command to roll up organization usage into daily snapshots.
+Run with: python manage.py rollup_usage [--full]
+
+Meant to run periodically (e.g. every 15 minutes from cron). Each run only
+recomputes the days that got new records since the previous one, see
+usage_tracking/rollups.py.
+"""
+from django.core.management.base import BaseCommand
+from usage_tracking.rollups import run_daily_rollup
+
+
+class Command(BaseCommand):
+    help = 'Roll up images generated, credits used and active users per organization and day'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full', action='store_true', help='Ignore the watermark and recompute every day')
+
+    def handle(self, *args, **options):
+        result = run_daily_rollup(full=options.get('full'))
+        for day in result['days']:
+            self.stdout.write(f'  recomputed {day}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Rolled up {len(result["days"])} days ({result["snapshots"]} snapshots), '
+            f'watermark {result["watermark"].isoformat()}'))
@@ -1,4 +1,4 @@
-from mongoengine import Document, ReferenceField, DateTimeField, IntField
+from mongoengine import Document, ReferenceField, DateTimeField, IntField, StringField
 from datetime import datetime
 
 
@@ -13,4 +13,17 @@ class OrgUsageSnapshotDaily(Document):
     created_at = DateTimeField(default=datetime.utcnow)
     updated_at = DateTimeField(default=datetime.utcnow)
 
-    meta = {"collection": "org_usage_snapshot_daily"}
+    meta = {
+        "collection": "org_usage_snapshot_daily",
+        # One snapshot per organization and day; dashboards read a date range
+        "indexes": [{"fields": ["organization", "date"], "unique": True}],
+    }
+
+
+class UsageRollupState(Document):
+    """Progress of a rollup job: everything created before watermark is rolled up"""
+    name = StringField(required=True, unique=True)
+    watermark = DateTimeField()
+    updated_at = DateTimeField(default=datetime.utcnow)
+
+    meta = {"collection": "usage_rollup_state"}
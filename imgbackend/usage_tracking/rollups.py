@@ -0,0 +1,202 @@
+"""
+Daily usage rollups per organization.
+
+Dashboards read OrgUsageSnapshotDaily (one document per organization and day)
+instead of scanning ImageGenerationHistory. run_daily_rollup() keeps the
+snapshots up to date incrementally:
+
+    1. find the days that got new history or credit ledger records since the
+       stored watermark (UsageRollupState),
+    2. recompute those whole days from history and the ledger, and upsert
+       their snapshots,
+    3. move the watermark forward.
+
+Recomputing whole days keeps active_users (distinct users) exact and makes a
+run safe to repeat. Records younger than ROLLUP_LAG are left for the next run,
+since a HistoryWriter may still hold them in its buffer.
+"""
+from datetime import datetime, timedelta
+from pymongo import UpdateMany, UpdateOne
+from organization.models import Organization
+from CREDITS.models import CreditLedger
+from probackendapp.models import ImageGenerationHistory
+from .models import OrgUsageSnapshotDaily, UsageRollupState
+
+ROLLUP_NAME = "org_usage_daily"
+ROLLUP_LAG = timedelta(minutes=10)
+DAY_FORMAT = "%Y-%m-%d"
+
+# History records that do not stand for a generated image
+NON_GENERATION_TYPES = ["project_product_upload", "project_model_selection"]
+
+
+def _day_key(field):
+    return {"$dateToString": {"format": DAY_FORMAT, "date": f"${field}"}}
+
+
+def _created_between(start, end):
+    query = {"$lt": end}
+    if start is not None:
+        query["$gte"] = start
+    return {"created_at": query}
+
+
+def _touched_days(start, end):
+    """Days (as 'YYYY-MM-DD') with history or ledger records created in [start, end)"""
+    days = set()
+    for model in (ImageGenerationHistory, CreditLedger):
+        rows = model._get_collection().aggregate([
+            {"$match": _created_between(start, end)},
+            {"$group": {"_id": _day_key("created_at")}},
+        ])
+        days.update(row["_id"] for row in rows)
+    return sorted(days)
+
+
+def _user_organizations():
+    """
+    user id (str) -> id of the organization the user's images are counted in.
+
+    Like the credits (CREDITS.balance.get_user_organization_id), the first
+    organization by id the user owns or is a member of, so that an image is
+    counted once even for users of several organizations.
+    """
+    organizations = {}
+    for org in Organization.objects.only("owner", "members").order_by("id").as_pymongo():
+        for user_id in [org.get("owner")] + list(org.get("members") or []):
+            if user_id:
+                organizations.setdefault(str(user_id), org["_id"])
+    return organizations
+
+
+def compute_daily_usage(days):
+    """
+    Aggregate the usage of every organization on the given days.
+
+    Args:
+        days (list): Days as 'YYYY-MM-DD' strings
+
+    Returns:
+        dict: (organization id, day) -> {'images_generated', 'credits_used', 'active_users'}
+    """
+    if not days:
+        return {}
+    wanted = set(days)
+    start = datetime.strptime(min(days), DAY_FORMAT)
+    end = datetime.strptime(max(days), DAY_FORMAT) + timedelta(days=1)
+    user_orgs = _user_organizations()
+
+    images = {}
+    users = {}
+    history = ImageGenerationHistory._get_collection().aggregate([
+        {"$match": {**_created_between(start, end),
+                    "image_type": {"$nin": NON_GENERATION_TYPES}}},
+        {"$group": {"_id": {"user": "$user_id", "day": _day_key("created_at")},
+                    "count": {"$sum": 1}}},
+    ])
+    for row in history:
+        day = row["_id"]["day"]
+        if day not in wanted:
+            continue
+        user_id = str(row["_id"]["user"])
+        org_id = user_orgs.get(user_id)
+        if org_id is None:
+            continue
+        images[(org_id, day)] = images.get((org_id, day), 0) + row["count"]
+        users.setdefault((org_id, day), set()).add(user_id)
+
+    credits = {}
+    ledger = CreditLedger._get_collection().aggregate([
+        {"$match": {**_created_between(start, end), "change_type": "debit"}},
+        {"$group": {"_id": {"org": "$organization", "user": "$user", "day": _day_key("created_at")},
+                    "credits": {"$sum": {"$abs": "$credits_changed"}}}},
+    ])
+    for row in ledger:
+        key = (row["_id"]["org"], row["_id"]["day"])
+        if key[1] not in wanted or key[0] is None:
+            continue
+        credits[key] = credits.get(key, 0) + row["credits"]
+        if row["_id"].get("user"):
+            users.setdefault(key, set()).add(str(row["_id"]["user"]))
+
+    return {
+        key: {
+            "images_generated": images.get(key, 0),
+            "credits_used": credits.get(key, 0),
+            "active_users": len(users.get(key, ())),
+        }
+        for key in set(images) | set(credits) | set(users)
+    }
+
+
+def save_daily_usage(days, usage):
+    """
+    Upsert the snapshots of the given days, zeroing organizations without usage left.
+
+    Args:
+        days (list): Days as 'YYYY-MM-DD' strings that were recomputed
+        usage (dict): Result of compute_daily_usage(days)
+
+    Returns:
+        int: Number of snapshots written
+    """
+    now = datetime.utcnow()
+    operations = []
+    orgs_by_day = {}
+    for (org_id, day), values in usage.items():
+        orgs_by_day.setdefault(day, []).append(org_id)
+        operations.append(UpdateOne(
+            {"organization": org_id, "date": datetime.strptime(day, DAY_FORMAT)},
+            {"$set": {**values, "updated_at": now}, "$setOnInsert": {"created_at": now}},
+            upsert=True))
+    for day in days:
+        operations.append(UpdateMany(
+            {"date": datetime.strptime(day, DAY_FORMAT),
+             "organization": {"$nin": orgs_by_day.get(day, [])}},
+            {"$set": {"images_generated": 0, "credits_used": 0, "active_users": 0,
+                      "updated_at": now}}))
+    if operations:
+        OrgUsageSnapshotDaily._get_collection().bulk_write(operations, ordered=False)
+    return len(usage)
+
+
+def run_daily_rollup(full=False, now=None):
+    """
+    Roll up the usage recorded since the last run into OrgUsageSnapshotDaily.
+
+    Args:
+        full (bool): Ignore the watermark and recompute every day
+        now (datetime, optional): Current UTC time, for tests
+
+    Returns:
+        dict: 'days' recomputed, 'snapshots' written and the new 'watermark'
+    """
+    state = UsageRollupState.objects(name=ROLLUP_NAME).first()
+    since = None if full or state is None else state.watermark
+    until = (now or datetime.utcnow()) - ROLLUP_LAG
+    if since is not None and since >= until:
+        return {"days": [], "snapshots": 0, "watermark": since}
+
+    days = _touched_days(since, until)
+    snapshots = save_daily_usage(days, compute_daily_usage(days))
+
+    UsageRollupState.objects(name=ROLLUP_NAME).update_one(
+        set__watermark=until, set__updated_at=datetime.utcnow(), upsert=True)
+    return {"days": days, "snapshots": snapshots, "watermark": until}
+
+
+def get_daily_usage(organization_id, start, end):
+    """
+    Read the snapshots of an organization, one per day with usage.
+
+    Args:
+        organization_id (str): Organization id
+        start (datetime): First day (included)
+        end (datetime): Last day (included)
+
+    Returns:
+        list: Raw snapshots ordered by date
+    """
+    return list(OrgUsageSnapshotDaily.objects(
+        organization=organization_id, date__gte=start, date__lte=end,
+    ).only("date", "images_generated", "credits_used", "active_users").order_by("date").as_pymongo())
@@ -1,3 +1,83 @@
-from django.test import TestCase
+from datetime import datetime, timedelta
+from common.testing import MongoTestCase
+from CREDITS.balance import get_user_organization_id
+from CREDITS.models import CreditLedger
+from organization.models import Organization
+from probackendapp.models import ImageGenerationHistory
+from users.models import User
+from .models import OrgUsageSnapshotDaily, UsageRollupState
+from .rollups import ROLLUP_LAG, ROLLUP_NAME, compute_daily_usage, get_daily_usage, run_daily_rollup
 
-# Create your tests here.
+
+class DailyUsageTests(MongoTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.create_user('member')
+        self.organization = Organization(name='Organization', owner=self.user)
+        self.organization.save()
+
+    def create_user(self, name):
+        user = User(email=f'{name}@example.com', password='x', username=name)
+        user.save()
+        return user
+
+    def add_history(self, user, count, created_at=datetime(2026, 1, 5, 12)):
+        ImageGenerationHistory._get_collection().insert_many([
+            {'image_type': 'white_background', 'image_url': f'https://example.com/{i}.png',
+             'user_id': str(user.id), 'created_at': created_at}
+            for i in range(count)])
+
+    def add_debit(self, credits, created_at=datetime(2026, 1, 5, 12)):
+        CreditLedger(user=self.user, organization=self.organization, change_type='debit',
+                     credits_changed=-credits, balance_after=0, created_at=created_at).save()
+
+    def snapshots(self):
+        return {row['date'].strftime('%Y-%m-%d'): (row['images_generated'], row['credits_used'], row['active_users'])
+                for row in get_daily_usage(self.organization.id, datetime(2026, 1, 1), datetime(2026, 1, 31))}
+
+    def test_rollup(self):
+        self.add_history(self.user, 3)
+        self.add_history(self.user, 1, created_at=datetime(2026, 1, 6, 12))
+        self.add_debit(2)
+        # Project uploads are not generations
+        ImageGenerationHistory._get_collection().insert_one({
+            'image_type': 'project_product_upload', 'image_url': 'https://example.com/upload.png',
+            'user_id': str(self.user.id), 'created_at': datetime(2026, 1, 5, 13)})
+
+        result = run_daily_rollup(now=datetime(2026, 1, 7))
+
+        self.assertEqual(result['days'], ['2026-01-05', '2026-01-06'])
+        self.assertEqual(self.snapshots(), {'2026-01-05': (3, 2, 1), '2026-01-06': (1, 0, 1)})
+        self.assertEqual(UsageRollupState.objects.get(name=ROLLUP_NAME).watermark,
+                         datetime(2026, 1, 7) - ROLLUP_LAG)
+
+    def test_rollup_only_recomputes_new_days(self):
+        self.add_history(self.user, 3)
+        run_daily_rollup(now=datetime(2026, 1, 7))
+        # Recorded after the first run, but in the lag it left for the next one
+        late = datetime(2026, 1, 7) - ROLLUP_LAG / 2
+        self.add_history(self.user, 2, created_at=late)
+
+        result = run_daily_rollup(now=datetime(2026, 1, 7, 1))
+
+        self.assertEqual(result['days'], [late.strftime('%Y-%m-%d')])
+        self.assertEqual(self.snapshots(), {'2026-01-05': (3, 0, 1), '2026-01-06': (2, 0, 1)})
+        # Nothing new: nothing recomputed, the snapshots stay
+        self.assertEqual(run_daily_rollup(now=datetime(2026, 1, 7, 2))['days'], [])
+        self.assertEqual(OrgUsageSnapshotDaily.objects.count(), 2)
+
+    def test_images_of_a_user_in_two_organizations_are_counted_once(self):
+        self.organization.delete()
+        first = Organization(name='First', owner=self.create_user('first'), members=[self.user])
+        first.save()
+        second = Organization(name='Second', owner=self.user)
+        second.save()
+        self.add_history(self.user, 3)
+
+        usage = compute_daily_usage(['2026-01-05'])
+
+        # In the organization the user's credits are taken from
+        self.assertEqual(get_user_organization_id(self.user.id), first.id)
+        self.assertEqual(usage, {
+            (first.id, '2026-01-05'): {'images_generated': 3, 'credits_used': 0, 'active_users': 1}})
@@ -0,0 +1,7 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path("organizations/<str:organization_id>/daily/",
+         views.api_organization_daily_usage, name="api_organization_daily_usage"),
+]
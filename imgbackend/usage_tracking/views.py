@@ -1,3 +1,73 @@
-from django.shortcuts import render
+from datetime import datetime, timedelta
+from bson import ObjectId
+from bson.errors import InvalidId
+from common.responses import JsonResponse
+from django.views.decorators.http import require_http_methods
+from organization.models import Organization
+from common.middleware import authenticate
+from .rollups import DAY_FORMAT, get_daily_usage
 
-# Create your views here.
+MAX_DAYS = 366
+
+
+@require_http_methods(["GET"])
+@authenticate
+def api_organization_daily_usage(request, organization_id):
+    """
+    Daily usage of an organization, read from the rollups.
+    Query params: days (default 30), or start and end as YYYY-MM-DD.
+    Days without usage are returned with zeros.
+    """
+    try:
+        try:
+            org_id = ObjectId(organization_id)
+        except (InvalidId, TypeError):
+            return JsonResponse({'error': 'Invalid organization id'}, status=400)
+
+        user_id = request.user.id
+        is_member = Organization.objects(__raw__={
+            '_id': org_id,
+            '$or': [{'owner': user_id}, {'members': user_id}],
+        }).only('id').as_pymongo().first()
+        if not is_member:
+            return JsonResponse({'error': 'Organization not found'}, status=404)
+
+        try:
+            today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+            end = datetime.strptime(request.GET['end'], DAY_FORMAT) if request.GET.get('end') else today
+            if request.GET.get('start'):
+                start = datetime.strptime(request.GET['start'], DAY_FORMAT)
+            else:
+                start = end - timedelta(days=int(request.GET.get('days', 30)) - 1)
+        except ValueError:
+            return JsonResponse({'error': 'Invalid date range'}, status=400)
+        if start > end or (end - start).days >= MAX_DAYS:
+            return JsonResponse({'error': f'Date range must cover 1 to {MAX_DAYS} days'}, status=400)
+
+        snapshots = {row['date']: row for row in get_daily_usage(org_id, start, end)}
+        days = []
+        totals = {'images_generated': 0, 'credits_used': 0}
+        day = start
+        while day <= end:
+            row = snapshots.get(day, {})
+            entry = {
+                'date': day.strftime(DAY_FORMAT),
+                'images_generated': row.get('images_generated', 0),
+                'credits_used': row.get('credits_used', 0),
+                'active_users': row.get('active_users', 0),
+            }
+            totals['images_generated'] += entry['images_generated']
+            totals['credits_used'] += entry['credits_used']
+            days.append(entry)
+            day += timedelta(days=1)
+
+        return JsonResponse({
+            'success': True,
+            'organization_id': organization_id,
+            'start': start.strftime(DAY_FORMAT),
+            'end': end.strftime(DAY_FORMAT),
+            'totals': totals,
+            'days': days,
+        })
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
@@ -1,4 +1,5 @@
-from django.http import JsonResponse
+import logging
+from common.responses import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 import json
@@ -10,6 +11,9 @@ import datetime
 from datetime import timedelta
 from django.conf import settings
 from common.middleware import authenticate
+from common.user_cache import invalidate_user
+
+logger = logging.getLogger(__name__)
 
 SECRET_KEY = settings.SECRET_KEY
 
@@ -78,7 +82,7 @@ def register_user(request):
     except NotUniqueError:
         return JsonResponse({"error": "Email or username already exists"}, status=400)
     except Exception as e:
-        print(e)
+        logger.exception("Error in register_user")
         return JsonResponse({"error": str(e)}, status=500)
 
 
@@ -222,6 +226,7 @@ def update_user_profile(request):
         # Update timestamp
         user.updated_at = datetime.datetime.utcnow()
         user.save()
+        invalidate_user(user.id)
         
         return JsonResponse({
             "success": True,